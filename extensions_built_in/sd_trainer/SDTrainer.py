@@ -32,7 +32,7 @@ from jobs.process import BaseSDTrainProcess
 from torchvision import transforms
 from diffusers import EMAModel
 import math
-from toolkit.train_tools import precondition_model_outputs_flow_match
+from toolkit.train_tools import precondition_model_outputs_flow_match, predict_with_fused_prior
 from toolkit.models.diffusion_feature_extraction import DiffusionFeatureExtractor, load_dfe
 from toolkit.util.losses import wavelet_loss, stepped_loss
 import torch.nn.functional as F
@@ -103,6 +103,17 @@ class SDTrainer(BaseSDTrainProcess):
         if self.train_config.blank_prompt_preservation or self.train_config.diff_output_preservation:
             # always do a prior prediction when doing output preservation
             self.do_prior_prediction = True
+
+        self.fuse_preservation_forward = False
+        if self.train_config.fuse_preservation_forward and (self.train_config.blank_prompt_preservation or self.train_config.diff_output_preservation):
+            if self.network_config.type.lower() in ['lora', 'locon']:
+                self.fuse_preservation_forward = True
+            else:
+                # lokr and dora modules scale by a single multiplier, they cannot zero part of a batch
+                print_acc(
+                    f"fuse_preservation_forward is not supported with {self.network_config.type} networks, "
+                    f"using separate preservation passes"
+                )
         
         # store the loss target for a batch so we can use it in a loss
         self._guidance_loss_target_batch: float = 0.0
@@ -1200,6 +1211,50 @@ class SDTrainer(BaseSDTrainProcess):
         )
     
 
+    def get_preservation_embeds(self, batch_size: int, dtype) -> PromptEmbeds:
+        if self.train_config.diff_output_preservation:
+            preservation_embeds = self.diff_output_preservation_embeds.expand_to_batch(batch_size)
+        else:
+            blank_embeds = self.cached_blank_embeds.clone().detach().to(
+                self.device_torch, dtype=dtype
+            )
+            preservation_embeds = concat_prompt_embeds([blank_embeds] * batch_size)
+        return preservation_embeds.to(self.device_torch, dtype=dtype)
+
+    def can_fuse_preservation(
+        self,
+        batch: 'DataLoaderBatchDTO',
+        conditional_embeds: PromptEmbeds,
+        unconditional_embeds: Optional[PromptEmbeds],
+        pred_kwargs: dict,
+        preservation_embeds: PromptEmbeds,
+    ) -> bool:
+        # the fused forward must see exactly what the separate passes would, anything that
+        # conditions the prediction per pass or per sample falls back to the separate passes
+        if not self.fuse_preservation_forward:
+            return False
+        if self.adapter is not None or self.assistant_adapter is not None:
+            return False
+        if unconditional_embeds is not None or len(pred_kwargs) > 0:
+            return False
+        if batch.control_tensor is not None or batch.unconditional_latents is not None:
+            return False
+        if self.do_guided_loss or self.train_config.loss_type == 'mean_flow':
+            return False
+        if self.train_config.do_prior_divergence:
+            return False
+        if self.train_config.timestep_type == 'next_sample' or self.train_config.single_item_batching:
+            return False
+        if self.train_config.do_guidance_loss or self.train_config.bypass_guidance_embedding:
+            return False
+        # padding to a common length would change what the model attends to
+        if isinstance(conditional_embeds.text_embeds, (list, tuple)):
+            return all(
+                c.shape[1:] == p.shape[1:]
+                for c, p in zip(conditional_embeds.text_embeds, preservation_embeds.text_embeds)
+            )
+        return conditional_embeds.text_embeds.shape[1:] == preservation_embeds.text_embeds.shape[1:]
+
     def train_single_accumulation(self, batch: DataLoaderBatchDTO):
         with torch.no_grad():
             self.timer.start('preprocess_batch')
@@ -1773,8 +1828,21 @@ class SDTrainer(BaseSDTrainProcess):
                     if guidance_type == 'tnt':
                         do_guidance_prior = True
 
+                fuse_preservation = False
+                preservation_embeds = None
+                if self.fuse_preservation_forward and not (do_guidance_prior or do_reg_prior or do_inverted_masked_prior or self.train_config.correct_pred_norm):
+                    with torch.no_grad():
+                        preservation_embeds = self.get_preservation_embeds(noisy_latents.shape[0], dtype)
+                    fuse_preservation = self.can_fuse_preservation(
+                        batch=batch,
+                        conditional_embeds=conditional_embeds,
+                        unconditional_embeds=unconditional_embeds,
+                        pred_kwargs=pred_kwargs,
+                        preservation_embeds=preservation_embeds,
+                    )
+
                 if ((
-                        has_adapter_img and self.assistant_adapter and match_adapter_assist) or self.do_prior_prediction or do_guidance_prior or do_reg_prior or do_inverted_masked_prior or self.train_config.correct_pred_norm):
+                        has_adapter_img and self.assistant_adapter and match_adapter_assist) or (self.do_prior_prediction and not fuse_preservation) or do_guidance_prior or do_reg_prior or do_inverted_masked_prior or self.train_config.correct_pred_norm):
                     with self.timer('prior predict'):
                         prior_embeds_to_use = conditional_embeds
                         # use diff_output_preservation embeds if doing dfe
@@ -1946,6 +2014,51 @@ class SDTrainer(BaseSDTrainProcess):
                         unconditional_embeds=unconditional_embeds,
                         prior_pred=prior_pred,
                     )
+                elif fuse_preservation:
+                    with self.timer('predict_unet'):
+                        # [training batch | preservation batch | prior batch with the network at 0.0]
+                        fused_embeds = concat_prompt_embeds([
+                            conditional_embeds.to(self.device_torch, dtype=dtype),
+                            preservation_embeds,
+                            preservation_embeds,
+                        ])
+                        noise_pred, preservation_pred, prior_pred = predict_with_fused_prior(
+                            network=network,
+                            network_weight_list=network_weight_list,
+                            predict_fn=lambda latents, t, embeds: self.predict_noise(
+                                noisy_latents=latents,
+                                timesteps=t,
+                                conditional_embeds=embeds,
+                                batch=batch,
+                                is_primary_pred=True,
+                            ),
+                            latents=noisy_latents.to(self.device_torch, dtype=dtype),
+                            timesteps=timesteps,
+                            embeds=fused_embeds,
+                        )
+                    self.after_unet_predict()
+
+                    with self.timer('calculate_loss'):
+                        noise = noise.to(self.device_torch, dtype=dtype).detach()
+                        loss = self.calculate_loss(
+                            noise_pred=noise_pred,
+                            noise=noise,
+                            noisy_latents=noisy_latents,
+                            timesteps=timesteps,
+                            batch=batch,
+                            mask_multiplier=mask_multiplier,
+                            prior_pred=None,
+                        )
+                        multiplier = self.train_config.diff_output_preservation_multiplier if self.train_config.diff_output_preservation else self.train_config.blank_prompt_preservation_multiplier
+                        preservation_loss = torch.nn.functional.mse_loss(preservation_pred, prior_pred) * multiplier
+                        loss = loss + preservation_loss
+
+                    # the fused multipliers have to stay set through backward for gradient checkpointing
+                    self.accelerator.backward(loss)
+                    network.multiplier = network_weight_list
+                    loss = loss.clone().detach()
+                    # require grad again so the backward wont fail
+                    loss.requires_grad_(True)
                 else:
                     with self.timer('predict_unet'):
                         noise_pred = self.predict_noise(
@@ -30,12 +30,28 @@ class ExtractJob(BaseJob):
         self.output_folder = self.get_conf('output_folder', required=True)
         self.is_v2 = self.get_conf('is_v2', False)
         self.device = self.get_conf('device', 'cpu')
+        # read both checkpoints layer by layer instead of loading them. Requires safetensors files
+        self.streaming = self.get_conf('streaming', False)
 
         # loads the processes from the config
         self.load_processes(process_dict)
 
     def run(self):
         super().run()
+        if self.streaming:
+            print(f"Streaming extraction, models will be read layer by layer")
+            print(f" - Base model: {self.base_model_path}")
+            print(f" - Extract model: {self.extract_model_path}")
+        else:
+            self.load_models()
+
+        print("")
+        print(f"Running  {len(self.process)} process{'' if len(self.process) == 1 else 'es'}")
+
+        for process in self.process:
+            process.run()
+
+    def load_models(self):
         # load models
         print(f"Loading models for extraction")
         print(f" - Loading base model: {self.base_model_path}")
@@ -50,9 +66,3 @@ class ExtractJob(BaseJob):
         self.model_extract_text_encoder = self.model_extract[0]
         self.model_extract_vae = self.model_extract[1]
         self.model_extract_unet = self.model_extract[2]
-
-        print("")
-        print(f"Running  {len(self.process)} process{'' if len(self.process) == 1 else 'es'}")
-
-        for process in self.process:
-            process.run()
@@ -4,6 +4,7 @@ from jobs import BaseJob
 from toolkit.train_tools import get_torch_dtype
 
 process_dict = {
+    'weighted': 'MergeCheckpointsProcess',
 }
 
 
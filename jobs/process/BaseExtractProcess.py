@@ -5,8 +5,9 @@ from safetensors.torch import save_file
 
 from jobs.process.BaseProcess import BaseProcess
 from toolkit.metadata import get_meta_for_safetensors
+from toolkit.safetensors_stream import SafeTensorsStreamWriter
 
-from typing import ForwardRef
+from typing import ForwardRef, Iterator
 
 from toolkit.train_tools import get_torch_dtype
 
@@ -84,3 +85,14 @@ class BaseExtractProcess(BaseProcess):
         save_file(state_dict, self.output_path, save_meta)
 
         print(f"Saved to {self.output_path}")
+
+    def save_streaming(self, lora_iter: Iterator[OrderedDict]):
+        # writes each extracted layer to disk as soon as it is done
+        save_meta = get_meta_for_safetensors(self.meta, self.job.name)
+
+        with SafeTensorsStreamWriter(self.output_path, save_meta) as writer:
+            for loras in lora_iter:
+                for key, v in loras.items():
+                    writer.add(key, v.detach().to("cpu").to(self.torch_dtype))
+
+        print(f"Saved {len(writer)} tensors to {self.output_path}")
@@ -24,9 +24,11 @@ from huggingface_hub.utils import HfFolder
 from toolkit.memory_management import MemoryManager
 
 from toolkit.basic import value_map
+from toolkit.batch_prefetcher import BatchPrefetcher
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
-from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
+from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch, get_dataloader_state, \
+    track_dataloader_position
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
 from toolkit.ema import ExponentialMovingAverage
 from toolkit.embedding import Embedding
@@ -39,6 +41,7 @@ from toolkit.lycoris_special import LycorisSpecialNetwork
 from toolkit.models.decorator import Decorator
 from toolkit.network_mixins import Network
 from toolkit.optimizer import get_optimizer
+from toolkit.optimizers.state_offload import OffloadedOptimizer
 from toolkit.paths import CONFIG_ROOT
 from toolkit.progress_bar import ToolkitProgressBar
 from toolkit.reference_adapter import ReferenceAdapter
@@ -97,6 +100,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.step_num = 0
         self.start_step = 0
         self.epoch_num = 0
+        # where the dataloaders were at the save being resumed from
+        self.dataloader_state = None
+        self.dataloader_reg_state = None
         self.last_save_step = 0
         # start at 1 so we can do a sample at the start
         self.grad_accumulation_step = 1
@@ -402,6 +408,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
             'step': self.step_num,
             'epoch': self.epoch_num,
         })
+        if self.data_loader is not None:
+            info['dataloader'] = get_dataloader_state(self.data_loader)
+        if self.data_loader_reg is not None:
+            info['dataloader_reg'] = get_dataloader_state(self.data_loader_reg)
         return info
 
     def clean_up_saves(self):
@@ -837,9 +847,15 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.step_num = meta['training_info']['step']
             if 'epoch' in meta['training_info']:
                 self.epoch_num = meta['training_info']['epoch']
+            self.load_dataloader_states(meta['training_info'])
             self.start_step = self.step_num
             print_acc(f"Found step {self.step_num} in metadata, starting from there")
 
+    def load_dataloader_states(self, training_info):
+        # the dataloaders are made after the weights are loaded, they pick these up then
+        self.dataloader_state = training_info.get('dataloader', None)
+        self.dataloader_reg_state = training_info.get('dataloader_reg', None)
+
     def load_weights(self, path):
         if self.network is not None:
             extra_weights = self.network.load_weights(path)
@@ -876,6 +892,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 self.step_num = meta['training_info']['step']
                 if 'epoch' in meta['training_info']:
                     self.epoch_num = meta['training_info']['epoch']
+                self.load_dataloader_states(meta['training_info'])
                 self.start_step = self.step_num
                 print_acc(f"Found step {self.step_num} in metadata, starting from there")
 
@@ -985,6 +1002,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         return noise
 
+    def get_dataloader_iterator(self, dataloader: DataLoader):
+        iterator = iter(dataloader)
+        if self.train_config.prefetch_batches > 0:
+            # batches come out already on the device, so moving them in process_general_training_batch does nothing
+            iterator = BatchPrefetcher(iterator, self.device_torch, num_ahead=self.train_config.prefetch_batches)
+        return track_dataloader_position(dataloader, iterator)
+
     def process_general_training_batch(self, batch: 'DataLoaderBatchDTO'):
         with torch.no_grad():
             with self.timer('prepare_prompt'):
@@ -1759,9 +1783,10 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     self.train_config.train_unet
                 )
 
-                # we cannot merge in if quantized
-                if self.model_config.quantize or self.model_config.layer_offloading:
-                    # todo find a way around this
+                # we cannot merge in if quantized, unless merging into dequantized shadow weights
+                if self.model_config.layer_offloading or (
+                        self.model_config.quantize and not self.network_config.merge_quantized_shadow
+                ):
                     self.network.can_merge_in = False
 
                 if is_lorm:
@@ -1929,6 +1954,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.ensure_params_requires_grad(force=True)
         optimizer = get_optimizer(self.params, optimizer_type, learning_rate=self.train_config.lr,
                                   optimizer_params=self.train_config.optimizer_params)
+        if self.train_config.offload_optimizer_state:
+            optimizer = OffloadedOptimizer(
+                optimizer,
+                update_device=self.train_config.optimizer_offload_update_device,
+                mmap_dir=self.train_config.optimizer_offload_mmap_dir,
+                chunk_mb=self.train_config.optimizer_offload_chunk_mb,
+            )
         self.optimizer = optimizer
         
         # set it to do paramiter swapping
@@ -1992,10 +2024,13 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.before_dataset_load()
         # load datasets if passed in the root process
         if self.datasets is not None:
-            self.data_loader = get_dataloader_from_datasets(self.datasets, self.train_config.batch_size, self.sd)
+            self.data_loader = get_dataloader_from_datasets(
+                self.datasets, self.train_config.batch_size, self.sd, state=self.dataloader_state
+            )
         if self.datasets_reg is not None:
-            self.data_loader_reg = get_dataloader_from_datasets(self.datasets_reg, self.train_config.batch_size,
-                                                                self.sd)
+            self.data_loader_reg = get_dataloader_from_datasets(
+                self.datasets_reg, self.train_config.batch_size, self.sd, state=self.dataloader_reg_state
+            )
 
         flush()
         self.last_save_step = self.step_num
@@ -2027,14 +2062,14 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
         if self.data_loader is not None:
             dataloader = self.data_loader
-            dataloader_iterator = iter(dataloader)
+            dataloader_iterator = self.get_dataloader_iterator(dataloader)
         else:
             dataloader = None
             dataloader_iterator = None
 
         if self.data_loader_reg is not None:
             dataloader_reg = self.data_loader_reg
-            dataloader_iterator_reg = iter(dataloader_reg)
+            dataloader_iterator_reg = self.get_dataloader_iterator(dataloader_reg)
         else:
             dataloader_reg = None
             dataloader_iterator_reg = None
@@ -2104,8 +2139,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
                                 # hit the end of an epoch, reset
                                 if self.progress_bar is not None:
                                     self.progress_bar.pause()
-                                dataloader_iterator_reg = iter(dataloader_reg)
+                                # set up the next epoch first, its order is drawn when the iterator is made
                                 trigger_dataloader_setup_epoch(dataloader_reg)
+                                dataloader_iterator_reg = self.get_dataloader_iterator(dataloader_reg)
 
                             with self.timer('get_batch:reg'):
                                 batch = next(dataloader_iterator_reg)
@@ -2121,8 +2157,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
                                 # hit the end of an epoch, reset
                                 if self.progress_bar is not None:
                                     self.progress_bar.pause()
-                                dataloader_iterator = iter(dataloader)
+                                # set up the next epoch first, its order is drawn when the iterator is made
                                 trigger_dataloader_setup_epoch(dataloader)
+                                dataloader_iterator = self.get_dataloader_iterator(dataloader)
                                 self.epoch_num += 1
                                 if self.train_config.gradient_accumulation_steps == -1:
                                     # if we are accumulating for an entire epoch, trigger a step
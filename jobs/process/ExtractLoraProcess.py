@@ -1,5 +1,5 @@
 from collections import OrderedDict
-from toolkit.lycoris_utils import extract_diff
+from toolkit.lycoris_utils import extract_diff, iter_extract_diff_from_files
 from .BaseExtractProcess import BaseExtractProcess
 
 
@@ -49,6 +49,24 @@ class ExtractLoraProcess(BaseExtractProcess):
         super().run()
         print(f"Running process: {self.mode}, dim: {self.dim}")
 
+        if self.job.streaming:
+            self.save_streaming(iter_extract_diff_from_files(
+                self.job.base_model_path,
+                self.job.extract_model_path,
+                is_v2=self.job.is_v2,
+                mode=self.mode,
+                linear_mode_param=self.linear_param,
+                conv_mode_param=self.conv_param,
+                extract_device=self.job.device,
+                use_bias=self.use_sparse_bias,
+                sparsity=self.sparsity,
+                small_conv=False,
+                linear_only=self.conv_param > 0.0000000001,
+                extract_unet=self.extract_unet,
+                extract_text_encoder=self.extract_text_encoder
+            ))
+            return
+
         state_dict, extract_diff_meta = extract_diff(
             self.job.model_base,
             self.job.model_extract,
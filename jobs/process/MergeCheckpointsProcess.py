@@ -0,0 +1,55 @@
+from collections import OrderedDict
+
+from jobs.process.BaseMergeProcess import BaseMergeProcess
+from toolkit.checkpoint_merge import MERGE_METHODS, MergeModel, merge_checkpoints
+from toolkit.metadata import get_meta_for_safetensors
+
+
+class MergeCheckpointsProcess(BaseMergeProcess):
+
+    def __init__(
+            self,
+            process_id: int,
+            job,
+            config: OrderedDict
+    ):
+        super().__init__(process_id, job, config)
+        self.method = self.get_conf('method', 'weighted_sum')
+        if self.method not in MERGE_METHODS:
+            raise ValueError(f"Unknown merge method: {self.method}")
+        self.base_model = self.get_conf('base_model', None)
+        self.models = [MergeModel(**model) for model in self.get_conf('models', required=True)]
+        # ties only, fraction of each task vector kept by magnitude
+        self.density = self.get_conf('density', 1.0, as_type=float)
+        self.normalize = self.get_conf('normalize', True)
+        self.max_shard_size = self.get_conf('max_shard_size', 0)
+        self.num_workers = self.get_conf('num_workers', 0, as_type=int)
+        self.device = self.get_conf('device', self.job.device)
+
+        if self.method != 'weighted_sum' and self.base_model is None:
+            raise ValueError(f"base_model is required for {self.method} merge")
+
+    def run(self):
+        super().run()
+        print(f"Merging {len(self.models)} models with {self.method}")
+        for model in self.models:
+            print(f" - {model.path}: {model.weight}")
+
+        stats = merge_checkpoints(
+            self.models,
+            self.output_path,
+            method=self.method,
+            base_model_path=self.base_model,
+            density=self.density,
+            normalize=self.normalize,
+            device=self.device,
+            save_dtype=self.torch_dtype,
+            max_shard_size=self.max_shard_size,
+            num_workers=self.num_workers,
+            metadata=get_meta_for_safetensors(self.meta, self.job.name),
+        )
+
+        print(f"Merged {stats['keys']} keys ({stats['copied_keys']} copied) in {stats['seconds']:.1f}s")
+        print(f" - read {stats['bytes_read'] / 1e9:.2f} GB at {stats['read_gb_per_sec']:.2f} GB/s")
+        for path in stats['output_paths']:
+            print(f"Saved to {path}")
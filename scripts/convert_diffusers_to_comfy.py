@@ -23,10 +23,14 @@ import os
 from pathlib import Path
 import safetensors
 import safetensors.torch
+import sys
 import torch
 import tqdm
 from collections import OrderedDict
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from toolkit.safetensors_stream import SafeTensorsStreamWriter
+
 
 parser = argparse.ArgumentParser()
 
@@ -324,28 +328,30 @@ for key, weights in diffusers_map.items():
         if found:
             flux_values[key] = [f"{weight}" for weight in weights]
 
-flux = {}
 
-for key, values in tqdm.tqdm(flux_values.items()):
+def load_flux_tensor(values):
+    # tensors are only read when they are written out
     if len(values) == 1:
-        flux[key] = original_safetensors[diffusers[values[0]]
-                                         ].get_tensor(values[0]).to("cpu")
-    else:
-        flux[key] = torch.cat(
-            [
-                original_safetensors[diffusers[value]
-                                     ].get_tensor(value).to("cpu")
-                for value in values
-            ]
-        )
+        return original_safetensors[diffusers[values[0]]].get_tensor(values[0]).to("cpu")
+    return torch.cat(
+        [
+            original_safetensors[diffusers[value]].get_tensor(value).to("cpu")
+            for value in values
+        ]
+    )
+
+
+flux_loaders = OrderedDict()
+for key, values in flux_values.items():
+    flux_loaders[key] = (lambda values=values: load_flux_tensor(values))
 
 if "norm_out.linear.weight" in diffusers:
-    flux["final_layer.adaLN_modulation.1.weight"] = swap_scale_shift(
+    flux_loaders["final_layer.adaLN_modulation.1.weight"] = lambda: swap_scale_shift(
         original_safetensors[diffusers["norm_out.linear.weight"]].get_tensor(
             "norm_out.linear.weight").to("cpu")
     )
 if "norm_out.linear.bias" in diffusers:
-    flux["final_layer.adaLN_modulation.1.bias"] = swap_scale_shift(
+    flux_loaders["final_layer.adaLN_modulation.1.bias"] = lambda: swap_scale_shift(
         original_safetensors[diffusers["norm_out.linear.bias"]].get_tensor(
             "norm_out.linear.bias").to("cpu")
     )
@@ -379,31 +385,13 @@ def stochastic_round_to(tensor, dtype=torch.float8_e4m3fn):
     return rounded.to(dtype)
 
 
-# set all the keys to bf16
-for key in flux.keys():
+def to_save_dtype(tensor):
     if do_8_bit:
-        flux[key] = stochastic_round_to(
-            flux[key], torch.float8_e4m3fn).to('cpu')
-    else:
-        flux[key] = flux[key].clone().to('cpu', torch.bfloat16)
+        return stochastic_round_to(tensor, torch.float8_e4m3fn).to('cpu')
+    return tensor.clone().to('cpu', torch.bfloat16)
 
-# load the quantized state dict
-quantized_state_dict = safetensors.torch.load_file(quantized_state_dict_path)
 
 transformer_pre = "model.diffusion_model."
-did_print = False
-# remove old parts
-for key in list(quantized_state_dict.keys()):
-    if key.startswith(transformer_pre):
-        if not did_print:
-            # print("dtype: ", quantized_state_dict[key].dtype)
-            did_print = True
-        del quantized_state_dict[key]
-
-# add the new parts
-for key, value in flux.items():
-    quantized_state_dict[transformer_pre + key] = value
-
 
 meta = OrderedDict()
 meta['format'] = 'pt'
@@ -421,6 +409,18 @@ os.makedirs(os.path.dirname(flux_path), exist_ok=True)
 
 print(f"Saving to {flux_path}")
 
-safetensors.torch.save_file(quantized_state_dict, flux_path, metadata=meta)
+# stream everything to the output one tensor at a time so neither the template
+# nor the converted transformer has to be fully loaded
+with safetensors.safe_open(quantized_state_dict_path, framework="pt", device="cpu") as template, \
+        SafeTensorsStreamWriter(str(flux_path), meta) as writer:
+    # keep everything but the old transformer from the template
+    for key in tqdm.tqdm(list(template.keys()), desc="Copying template"):
+        if key.startswith(transformer_pre):
+            continue
+        writer.add(key, template.get_tensor(key))
+
+    # add the new parts
+    for key, loader in tqdm.tqdm(flux_loaders.items(), desc="Converting transformer"):
+        writer.add(transformer_pre + key, to_save_dtype(loader()))
 
 print("Done.")
@@ -0,0 +1,41 @@
+import argparse
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from toolkit.basic import parse_size
+from toolkit.cache_root import collect_cache_garbage
+
+# trims a shared cache root (dataset cache_root / AITK_CACHE_ROOT) down to a size budget, least recently used first
+# python scripts/gc_cache_root.py /nvme/aitk_cache 500G --dry_run
+# entries used since the oldest running job using the cache root started are kept. Jobs on other machines
+# are only known by their lease files, a job that crashed there keeps its entries for up to a week
+
+def format_size(num_bytes: int) -> str:
+    return f"{num_bytes / 1024 ** 3:.2f} GB"
+
+
+parser = argparse.ArgumentParser(description='Remove least recently used cache entries until under a size budget')
+parser.add_argument("cache_root", type=str, help="Path to the cache root")
+parser.add_argument("max_size", type=str, help="Size budget, eg 500G or 2T (binary), or 500GB (decimal)")
+parser.add_argument("--dry_run", action='store_true', help="Only report what would be removed")
+
+args = parser.parse_args()
+
+if not os.path.isdir(args.cache_root):
+    raise ValueError(f"Cache root not found: {args.cache_root}")
+
+result = collect_cache_garbage(args.cache_root, parse_size(args.max_size), dry_run=args.dry_run)
+
+action = "Would remove" if args.dry_run else "Removed"
+print(f"{action} {result['removed_files']} files, {format_size(result['removed_bytes'])}")
+print(f"Kept {result['kept_files']} files, {format_size(result['kept_bytes'])}")
+if result['active_leases'] > 0:
+    print(
+        f"{result['active_leases']} running jobs use this cache root, "
+        f"{result['protected_files']} files ({format_size(result['protected_bytes'])}) they may use were kept"
+    )
+if result['kept_bytes'] > parse_size(args.max_size):
+    print("Warning: still over the size budget, the rest is in use by running jobs")
@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from toolkit.cache_inspection import inspect_caches
+from toolkit.config import get_config
+
+# finds cache files in _latent_cache, _t_e_cache and _resized_image_cache that no dataset in the given job
+# configs would load anymore (old resolution, model, caption ...), reports them and deletes them
+# python scripts/inspect_cache.py config/my_lora.yaml config/other_lora.yaml --dry_run
+
+
+def format_size(num_bytes: int) -> str:
+    return f"{num_bytes / 1024 ** 2:.1f} MB"
+
+
+parser = argparse.ArgumentParser(description='Report and remove orphaned dataset cache files')
+parser.add_argument("configs", type=str, nargs='+', help="Job configs whose datasets share the cache folders")
+parser.add_argument("--dry_run", action='store_true', help="Only report, do not delete anything")
+parser.add_argument(
+    "--bucket_divisibility", type=int, default=None,
+    help="Bucket divisibility of the model. Without it every common value counts as live"
+)
+parser.add_argument(
+    "--force", action='store_true',
+    help="Also clean folders where not a single file matched, normally a sign of wrong settings"
+)
+parser.add_argument("--num_workers", type=int, default=4, help="Datasets and folders processed in parallel")
+
+args = parser.parse_args()
+
+jobs = []
+for config_path in args.configs:
+    config = get_config(config_path)
+    for process in config['config']['process']:
+        if 'datasets' in process and 'model' in process:
+            jobs.append({'model': process['model'], 'datasets': process['datasets']})
+
+reports = inspect_caches(
+    jobs,
+    bucket_divisibility=args.bucket_divisibility,
+    dry_run=args.dry_run,
+    force=args.force,
+    num_workers=args.num_workers,
+)
+
+total_orphans = 0
+total_bytes = 0
+for report in reports:
+    if report['hits'] == 0 and report['orphans'] == 0:
+        continue
+    if not report['refused']:
+        total_orphans += report['orphans']
+        total_bytes += report['orphan_bytes']
+    line = (
+        f"{report['cache_dir']}: {report['hits']} / {report['live']} live cached ({report['hit_rate'] * 100:.0f}%), "
+        f"{report['orphans']} orphans, {format_size(report['orphan_bytes'])}"
+    )
+    if report['refused']:
+        line += ", nothing matched so skipped it (use --force)"
+    elif report['deleted'] > 0:
+        line += f", removed {report['deleted']}"
+    print(line)
+
+action = "Would remove" if args.dry_run else "Removed"
+print(f"{action} {total_orphans} orphans, {format_size(total_bytes)}")
@@ -0,0 +1,223 @@
+import copy
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import toolkit.optimizers.adam8bit as adam8bit_module
+from toolkit.optimizers.adam8bit import Adam8bit, MultiTensorAdam8bit
+from toolkit.optimizers.optimizer_utils import copy_stochastic_bf16
+
+
+def cpu_copy_stochastic(target, source):
+    # copy_stochastic refuses cpu tensors, this lets the per tensor optimizer run here
+    if target.dtype == torch.bfloat16:
+        copy_stochastic_bf16(target, source)
+    else:
+        target.copy_(source)
+
+
+adam8bit_module.copy_stochastic = cpu_copy_stochastic
+
+
+def make_model(seed=0):
+    torch.manual_seed(seed)
+    return nn.Sequential(
+        nn.Linear(64, 300),
+        nn.GELU(),
+        nn.Linear(300, 17),
+        nn.LayerNorm(17),
+        nn.Linear(17, 8),
+    )
+
+
+def train(model, optimizer, steps, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    for _ in range(steps):
+        x = torch.randn(32, 64, generator=generator)
+        y = torch.randn(32, 8, generator=generator)
+        loss = nn.functional.mse_loss(model(x), y)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+
+def max_error(model, reference):
+    return max(
+        (p - r).abs().max().item() for p, r in zip(model.parameters(), reference.parameters())
+    )
+
+
+def run_equivalence(decouple, weight_decay, steps=20, lr=1e-3):
+    reference = make_model()
+    per_tensor = copy.deepcopy(reference)
+    multi_tensor = copy.deepcopy(reference)
+
+    reference_cls = torch.optim.AdamW if decouple else torch.optim.Adam
+    reference_opt = reference_cls(reference.parameters(), lr=lr, eps=1e-6, weight_decay=weight_decay)
+    per_tensor_opt = Adam8bit(per_tensor.parameters(), lr=lr, eps=1e-6, weight_decay=weight_decay,
+                              decouple=decouple)
+    # small buckets so params get split across several of them
+    multi_tensor_opt = MultiTensorAdam8bit(multi_tensor.parameters(), lr=lr, eps=1e-6,
+                                           weight_decay=weight_decay, decouple=decouple, bucket_size=8192)
+
+    train(reference, reference_opt, steps)
+    train(per_tensor, per_tensor_opt, steps)
+    train(multi_tensor, multi_tensor_opt, steps)
+
+    per_tensor_error = max_error(per_tensor, reference)
+    multi_tensor_error = max_error(multi_tensor, reference)
+    print(f"decouple={decouple} wd={weight_decay}: per tensor err {per_tensor_error:.2e}, "
+          f"multi tensor err {multi_tensor_error:.2e}")
+    # every step moves a param at most ~lr, so quantization noise is a fraction of lr * steps
+    assert multi_tensor_error < lr * steps * 0.1, multi_tensor_error
+    assert multi_tensor_error <= per_tensor_error * 1.5 + lr * 0.5, (multi_tensor_error, per_tensor_error)
+
+
+def test_equivalence():
+    run_equivalence(decouple=True, weight_decay=0.0)
+    run_equivalence(decouple=True, weight_decay=0.01)
+    run_equivalence(decouple=False, weight_decay=0.01)
+
+
+def test_missing_grads_keep_state():
+    model = make_model()
+    optimizer = MultiTensorAdam8bit(model.parameters(), lr=1e-3)
+    train(model, optimizer, 3)
+    frozen = model[4].weight
+    before = frozen.detach().clone()
+    state_before = {k: v.clone() for k, v in optimizer.state[frozen].items() if torch.is_tensor(v)}
+    frozen.requires_grad_(False)
+    train(model, optimizer, 2)
+    assert torch.equal(frozen, before)
+    for key, value in state_before.items():
+        assert torch.equal(optimizer.state[frozen][key], value), key
+
+
+def test_skipped_steps_keep_their_own_bias_correction():
+    lr = 1e-3
+    steps = 20
+    reference = make_model()
+    multi_tensor = copy.deepcopy(reference)
+    reference_opt = torch.optim.AdamW(reference.parameters(), lr=lr, eps=1e-6, weight_decay=0.0)
+    # small buckets, the skipped param shares its bucket with params that do step
+    optimizer = MultiTensorAdam8bit(multi_tensor.parameters(), lr=lr, eps=1e-6, weight_decay=0.0, bucket_size=8192)
+    generator = torch.Generator().manual_seed(1)
+    for step in range(steps):
+        x = torch.randn(32, 64, generator=generator)
+        y = torch.randn(32, 8, generator=generator)
+        for model, opt in [(reference, reference_opt), (multi_tensor, optimizer)]:
+            opt.zero_grad()
+            nn.functional.mse_loss(model(x), y).backward()
+            if step < 5:
+                # no grad, like a param that is not used for a few steps
+                model[4].weight.grad = None
+            opt.step()
+
+    assert optimizer.state[multi_tensor[4].weight]['step'] == steps - 5
+    assert optimizer.state[multi_tensor[4].bias]['step'] == steps
+    # the steps after the skip are bias corrected from its own step, like torch and Adam8bit
+    skipped_error = (multi_tensor[4].weight - reference[4].weight).abs().max().item()
+    assert skipped_error < lr * (steps - 5) * 0.1, skipped_error
+    assert max_error(multi_tensor, reference) < lr * steps * 0.1
+
+
+def test_state_dict_round_trip():
+    model = make_model()
+    optimizer = MultiTensorAdam8bit(model.parameters(), lr=1e-3, bucket_size=8192)
+    train(model, optimizer, 5)
+    state_dict = optimizer.state_dict()
+    # saved state should not drag the whole bucket along
+    for param_state in state_dict['state'].values():
+        assert param_state['exp_avg'].untyped_storage().nbytes() == param_state['exp_avg'].numel()
+
+    resumed_model = copy.deepcopy(model)
+    resumed = MultiTensorAdam8bit(resumed_model.parameters(), lr=1e-3, bucket_size=8192)
+    resumed.load_state_dict(state_dict)
+    train(model, optimizer, 3, seed=2)
+    train(resumed_model, resumed, 3, seed=2)
+    for p, r in zip(model.parameters(), resumed_model.parameters()):
+        assert torch.allclose(p, r), (p - r).abs().max()
+
+
+def test_bf16_params():
+    model = make_model().to(torch.bfloat16)
+    reference = copy.deepcopy(model).float()
+    optimizer = MultiTensorAdam8bit(model.parameters(), lr=1e-3)
+    reference_opt = torch.optim.AdamW(reference.parameters(), lr=1e-3, eps=1e-8, weight_decay=0.0)
+    for p in model.parameters():
+        p.grad = torch.full_like(p, 0.01)
+    for p in reference.parameters():
+        p.grad = torch.full_like(p, 0.01)
+    optimizer.step()
+    reference_opt.step()
+    for p, r in zip(model.parameters(), reference.parameters()):
+        assert p.dtype == torch.bfloat16
+        # one step moves every value by lr, stochastic rounding keeps it within a bf16 ulp
+        assert (p.float() - r).abs().max() < 0.02
+
+
+def test_bf16_state_dict_round_trip():
+    model = make_model().to(torch.bfloat16)
+    optimizer = MultiTensorAdam8bit(model.parameters(), lr=1e-3, bucket_size=8192)
+    for step in range(5):
+        for p in model.parameters():
+            p.grad = (torch.randn_like(p, dtype=torch.float32) * 0.01 * (step + 1)).to(torch.bfloat16)
+        optimizer.step()
+    state_dict = optimizer.state_dict()
+
+    resumed_model = copy.deepcopy(model)
+    resumed = MultiTensorAdam8bit(resumed_model.parameters(), lr=1e-3, bucket_size=8192)
+    resumed.load_state_dict(copy.deepcopy(state_dict))
+    for p, r in zip(model.parameters(), resumed_model.parameters()):
+        for key in ['exp_avg', 'exp_avg_scale', 'exp_avg_sq', 'exp_avg_sq_scale']:
+            # the scales stay fp32 instead of being cast to the bf16 param dtype
+            assert resumed.state[r][key].dtype == optimizer.state[p][key].dtype, key
+            assert torch.equal(resumed.state[r][key], optimizer.state[p][key]), key
+
+    # and the steps after it are bit exact, with the same stochastic rounding
+    for opt, m in [(optimizer, model), (resumed, resumed_model)]:
+        torch.manual_seed(3)
+        for p in m.parameters():
+            p.grad = (torch.randn_like(p, dtype=torch.float32) * 0.01).to(torch.bfloat16)
+        opt.step()
+    for p, r in zip(model.parameters(), resumed_model.parameters()):
+        assert torch.equal(p, r), (p.float() - r.float()).abs().max()
+
+
+def benchmark(num_layers=48, dim=512, steps=10):
+    # many small tensors is where the per tensor loop hurts the most
+    torch.manual_seed(0)
+    params = [nn.Parameter(torch.randn(dim, dim) * 0.02) for _ in range(num_layers)]
+    params += [nn.Parameter(torch.zeros(dim)) for _ in range(num_layers)]
+
+    results = {}
+    for name, cls in [('Adam8bit', Adam8bit), ('MultiTensorAdam8bit', MultiTensorAdam8bit)]:
+        model_params = [nn.Parameter(p.detach().clone()) for p in params]
+        optimizer = cls(model_params, lr=1e-4)
+        for p in model_params:
+            p.grad = torch.randn_like(p) * 0.01
+        # warmup builds state / buckets
+        optimizer.step()
+        start = time.perf_counter()
+        for _ in range(steps):
+            optimizer.step()
+        results[name] = (time.perf_counter() - start) / steps
+        print(f"{name}: {results[name] * 1000:.1f} ms / step")
+    print(f"speedup: {results['Adam8bit'] / results['MultiTensorAdam8bit']:.2f}x")
+    return results
+
+
+if __name__ == '__main__':
+    test_equivalence()
+    test_missing_grads_keep_state()
+    test_skipped_steps_keep_their_own_bias_correction()
+    test_state_dict_round_trip()
+    test_bf16_params()
+    test_bf16_state_dict_round_trip()
+    print("multi tensor Adam8bit matches within quantization tolerance")
+    benchmark()
@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.batch_collation import collate_prompt_embeds, collate_tensors
+from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
+
+# (batch size, shape of one item) for common buckets
+BUCKETS = [
+    ('latents 1024 bs4', 4, (16, 128, 128)),
+    ('latents 512 bs16', 16, (16, 64, 64)),
+    ('images 1024 bs4', 4, (3, 1024, 1024)),
+    ('images 768x1344 bs2', 2, (3, 1344, 768)),
+    ('video latents 33f bs1', 1, (16, 9, 60, 104)),
+]
+
+
+def cat_with_zeros(tensors):
+    # what the batch used to do
+    base = next(t for t in tensors if t is not None)
+    return torch.cat([(torch.zeros_like(base) if t is None else t).unsqueeze(0) for t in tensors])
+
+
+def test_matches_cat():
+    tensors = [torch.randn(4, 8, 8) for _ in range(3)]
+    batch, mask = collate_tensors(tensors)
+    assert torch.equal(batch, cat_with_zeros(tensors))
+    assert mask is None
+
+    # missing ones are zero and flagged
+    tensors[1] = None
+    batch, mask = collate_tensors(tensors)
+    assert torch.equal(batch, cat_with_zeros(tensors))
+    assert mask.tolist() == [True, False, True]
+
+    assert collate_tensors([None, None]) == (None, None)
+
+
+def test_mismatched_tensors_raise():
+    # a 1 channel mask among 3 channel ones, and controls of different sizes without buckets
+    for other in [torch.randn(1, 8, 8), torch.randn(3, 8, 16), torch.randn(3, 8, 8).half()]:
+        try:
+            collate_tensors([torch.randn(3, 8, 8), other])
+            raise AssertionError(f"expected an error for {other.shape} {other.dtype}")
+        except RuntimeError as e:
+            assert 'collate' in str(e)
+
+
+def test_prompt_embeds_match_concat():
+    # different lengths are zero padded
+    prompt_embeds = []
+    for length in [5, 9, 7]:
+        pe = PromptEmbeds([torch.randn(1, length, 8), torch.randn(1, 4)])
+        pe.attention_mask = torch.ones(1, length)
+        prompt_embeds.append(pe)
+    expected = concat_prompt_embeds(prompt_embeds)
+    collated = collate_prompt_embeds(prompt_embeds)
+    assert torch.equal(collated.text_embeds, expected.text_embeds)
+    assert torch.equal(collated.pooled_embeds, expected.pooled_embeds)
+    assert torch.equal(collated.attention_mask, expected.attention_mask)
+
+    # models with several text encoders
+    prompt_embeds = [PromptEmbeds([[torch.randn(1, length, 8), torch.randn(1, 3, 4)], None]) for length in [2, 6]]
+    expected = concat_prompt_embeds(prompt_embeds)
+    collated = collate_prompt_embeds(prompt_embeds)
+    for a, b in zip(collated.text_embeds, expected.text_embeds):
+        assert torch.equal(a, b)
+
+
+def collate_in_worker(items):
+    batch, _ = collate_tensors(items)
+    return batch, batch.is_shared()
+
+
+def test_worker_batches_are_in_shared_memory():
+    loader = DataLoader([torch.full((2, 4), float(i)) for i in range(4)], batch_size=2, num_workers=1, collate_fn=collate_in_worker)
+    for batch, was_shared in loader:
+        # written straight into shared memory, so sending it did not copy it again
+        assert was_shared
+        assert batch.shape == (2, 2, 4)
+
+
+def benchmark():
+    for name, batch_size, shape in BUCKETS:
+        tensors = [torch.randn(shape) for _ in range(batch_size)]
+        for label, fn in [('cat', cat_with_zeros), ('collate', lambda x: collate_tensors(x)[0])]:
+            fn(tensors)
+            num_runs = 20
+            start = time.perf_counter()
+            for _ in range(num_runs):
+                fn(tensors)
+            per_batch = (time.perf_counter() - start) / num_runs * 1000
+            print(f"{name} {label}: {per_batch:.2f} ms per batch")
+
+
+if __name__ == '__main__':
+    test_matches_cat()
+    test_mismatched_tensors_raise()
+    test_prompt_embeds_match_concat()
+    test_worker_batches_are_in_shared_memory()
+    print("batch collation works")
+    benchmark()
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.batch_prefetcher import BatchPrefetcher
+
+DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+class CountingLoader:
+    # yields numbered batches, raising at fail_at, and counts how many were pulled
+    def __init__(self, num_batches, fail_at=None, load_time=0.0, shape=(2, 4)):
+        self.num_batches = num_batches
+        self.fail_at = fail_at
+        self.load_time = load_time
+        self.shape = shape
+        self.pulled = 0
+
+    def __iter__(self):
+        for idx in range(self.num_batches):
+            if idx == self.fail_at:
+                raise ValueError(f"bad batch {idx}")
+            time.sleep(self.load_time)
+            self.pulled += 1
+            yield {'index': idx, 'tensor': torch.full(self.shape, float(idx)), 'captions': [f'caption {idx}']}
+
+
+def test_order_and_device():
+    loader = CountingLoader(10)
+    batches = list(BatchPrefetcher(iter(loader), DEVICE))
+    assert [b['index'] for b in batches] == list(range(10))
+    for idx, batch in enumerate(batches):
+        assert batch['tensor'].device.type == DEVICE
+        assert torch.equal(batch['tensor'].cpu(), torch.full((2, 4), float(idx)))
+        # things that are not tensors pass through
+        assert batch['captions'] == [f'caption {idx}']
+
+
+def test_exception_is_raised_in_order():
+    prefetcher = BatchPrefetcher(iter(CountingLoader(10, fail_at=3)), DEVICE)
+    # the batches before it still come out
+    assert [next(prefetcher)['index'] for _ in range(3)] == [0, 1, 2]
+    try:
+        next(prefetcher)
+        raise AssertionError("expected the loader error")
+    except ValueError as e:
+        assert str(e) == "bad batch 3"
+    try:
+        next(prefetcher)
+        raise AssertionError("expected the end")
+    except StopIteration:
+        pass
+
+
+def test_gets_ahead():
+    loader = CountingLoader(10)
+    prefetcher = BatchPrefetcher(iter(loader), DEVICE, num_ahead=2)
+    # nothing is read until the first batch is asked for
+    time.sleep(0.1)
+    assert loader.pulled == 0
+    next(prefetcher)
+    deadline = time.time() + 2
+    while loader.pulled < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    # two in the queue, one more waiting for room
+    assert 3 <= loader.pulled <= 4
+    prefetcher.close()
+    time.sleep(0.3)
+    pulled = loader.pulled
+    time.sleep(0.3)
+    assert loader.pulled == pulled
+
+
+def benchmark():
+    # a loader and a train step that each take time, one after the other or overlapped
+    num_batches = 20
+    step_time = 0.01
+    shape = (4, 16, 128, 128)
+    for label, make_iterator in [
+        ('in loop', lambda loader: (
+            {k: v.to(DEVICE) if isinstance(v, torch.Tensor) else v for k, v in b.items()} for b in loader
+        )),
+        ('prefetched', lambda loader: BatchPrefetcher(iter(loader), DEVICE)),
+    ]:
+        loader = CountingLoader(num_batches, load_time=step_time, shape=shape)
+        start = time.perf_counter()
+        for batch in make_iterator(loader):
+            batch['tensor'].sum().item()
+            time.sleep(step_time)
+        per_batch = (time.perf_counter() - start) / num_batches * 1000
+        print(f"{label} on {DEVICE}: {per_batch:.2f} ms per batch")
+
+
+if __name__ == '__main__':
+    test_order_and_device()
+    test_exception_is_raised_in_order()
+    test_gets_ahead()
+    print("batch prefetcher works")
+    benchmark()
@@ -0,0 +1,172 @@
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.cache_inspection import get_live_cache_keys, inspect_caches
+from toolkit.cache_root import STALE_TMP_SECONDS
+from toolkit.config_modules import ModelConfig, get_latent_space_version
+from toolkit.resized_image_cache import ResizedImagePack
+
+MODEL = {'name_or_path': 'not/loaded', 'arch': 'sdxl'}
+
+
+def write_dataset(folder, count=3):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for idx in range(count):
+        pixels = rng.integers(0, 256, size=(96, 128, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, f'img_{idx}.png'))
+        with open(os.path.join(folder, f'img_{idx}.txt'), 'w') as f:
+            f.write(f'caption {idx}')
+
+
+def write_file(path, size=100):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'0' * size)
+
+
+def make_job(folder, resolution):
+    return {'model': MODEL, 'datasets': [{'folder_path': folder, 'resolution': resolution, 'caption_ext': 'txt'}]}
+
+
+def test_orphans_reported_and_removed():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        live = get_live_cache_keys(make_job(tmp_dir, 64)['datasets'][0], MODEL, bucket_divisibility=16)['live']
+        assert len(live['latents']) == 3
+        for path in live['latents']:
+            write_file(path)
+        # left from an older resolution and an older caption
+        orphans = [
+            os.path.join(tmp_dir, '_latent_cache', 'img_0_oldresolution.safetensors'),
+            os.path.join(tmp_dir, '_latent_cache', 'img_1_oldresolution.safetensors'),
+            os.path.join(tmp_dir, '_t_e_cache', 'img_0_oldcaption.safetensors'),
+        ]
+        for path in orphans:
+            write_file(path)
+
+        reports = inspect_caches([make_job(tmp_dir, 64)], bucket_divisibility=16, dry_run=True)
+        by_kind = {r['kind']: r for r in reports}
+        assert by_kind['latents']['hits'] == 3
+        assert by_kind['latents']['hit_rate'] == 1.0
+        assert by_kind['latents']['orphans'] == 2
+        assert by_kind['latents']['orphan_bytes'] == 200
+        # a dry run leaves everything
+        assert all(os.path.exists(path) for path in orphans)
+
+        # nothing in the text embedding folder matched, so it is left alone
+        assert by_kind['text_embeddings']['refused']
+
+        reports = inspect_caches([make_job(tmp_dir, 64)], bucket_divisibility=16)
+        assert sum(r['deleted'] for r in reports) == 2
+        assert all(os.path.exists(path) for path in live['latents'])
+        assert [os.path.exists(path) for path in orphans] == [False, False, True]
+
+        reports = inspect_caches([make_job(tmp_dir, 64)], bucket_divisibility=16, force=True)
+        assert not os.path.exists(orphans[2])
+
+
+def test_shared_folder_keeps_every_dataset():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        paths = []
+        for resolution in [64, 96]:
+            live = get_live_cache_keys(make_job(tmp_dir, resolution)['datasets'][0], MODEL, bucket_divisibility=16)
+            paths += list(live['live']['latents'])
+        for path in paths:
+            write_file(path)
+        # two jobs on the same folder, in parallel, keep both sets
+        reports = inspect_caches(
+            [make_job(tmp_dir, 64), make_job(tmp_dir, 96)], bucket_divisibility=16, num_workers=2
+        )
+        assert sum(r['deleted'] for r in reports) == 0
+        assert all(os.path.exists(path) for path in paths)
+
+        # without the bucket divisibility every common one is live, so nothing is lost either
+        reports = inspect_caches([make_job(tmp_dir, 64), make_job(tmp_dir, 96)])
+        assert sum(r['deleted'] for r in reports) == 0
+
+        # a job alone only keeps its own
+        reports = inspect_caches([make_job(tmp_dir, 64)], bucket_divisibility=16)
+        assert sum(r['deleted'] for r in reports) == 3
+
+
+def test_latent_space_versions():
+    # what the loaded models give, vega and ssd have is_xl set on the config but their own arch
+    expected = {
+        'sd1': 'sd1',
+        'sdxl': 'sdxl',
+        'vega': 'vega',
+        'ssd': 'ssd',
+        'sd3': 'sd3',
+        'auraflow': 'sdxl',
+        'flux': 'flux1',
+        'pixart_sigma': 'sdxl',
+        'wan21': 'wan21',
+    }
+    for arch, version in expected.items():
+        assert get_latent_space_version(ModelConfig(name_or_path='not/loaded', arch=arch)) == version, arch
+    config = ModelConfig(name_or_path='not/loaded', arch='flux', latent_space_version='custom')
+    assert get_latent_space_version(config) == 'custom'
+
+
+def test_temp_files_of_running_jobs_are_kept():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        live = get_live_cache_keys(make_job(tmp_dir, 64)['datasets'][0], MODEL, bucket_divisibility=16)['live']
+        for path in live['latents']:
+            write_file(path)
+        # what atomic_write_path leaves while a job is still writing, and after one crashed
+        fresh_tmp = os.path.join(tmp_dir, '_latent_cache', '.img_0_new.0123abcd.tmp.safetensors')
+        stale_tmp = os.path.join(tmp_dir, '_latent_cache', '.img_1_new.4567cdef.tmp.safetensors')
+        write_file(fresh_tmp)
+        write_file(stale_tmp)
+        old = time.time() - STALE_TMP_SECONDS - 60
+        os.utime(stale_tmp, (old, old))
+
+        reports = inspect_caches([make_job(tmp_dir, 64)], bucket_divisibility=16)
+        latents_report = [r for r in reports if r['kind'] == 'latents'][0]
+        assert latents_report['orphans'] == 1
+        assert os.path.exists(fresh_tmp)
+        assert not os.path.exists(stale_tmp)
+
+
+def test_resized_image_pack_compaction():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        live = get_live_cache_keys(make_job(tmp_dir, 64)['datasets'][0], MODEL, bucket_divisibility=16)
+        pack_dir = os.path.join(tmp_dir, '_resized_image_cache')
+        live_keys = sorted(live['live_pack_keys'][pack_dir])
+        rng = np.random.default_rng(0)
+        images = {key: rng.integers(0, 256, size=(48, 64, 3), dtype=np.uint8) for key in live_keys + ['old_key']}
+        ResizedImagePack(pack_dir).add_many(list(images.items()))
+        size_before = os.path.getsize(os.path.join(pack_dir, 'images.bin'))
+
+        reports = inspect_caches([make_job(tmp_dir, 64)], bucket_divisibility=16)
+        pack_report = [r for r in reports if r['kind'] == 'resized_images'][0]
+        assert pack_report['orphans'] == 1
+        assert pack_report['orphan_bytes'] == 48 * 64 * 3
+
+        pack = ResizedImagePack(pack_dir)
+        assert 'old_key' not in pack
+        assert os.path.getsize(pack.data_path) == size_before - 48 * 64 * 3
+        # the old generation of the data file is gone
+        assert not os.path.exists(os.path.join(pack_dir, 'images.bin'))
+        for key in live_keys:
+            assert np.array_equal(pack.get(key), images[key])
+
+
+if __name__ == '__main__':
+    test_orphans_reported_and_removed()
+    test_shared_folder_keeps_every_dataset()
+    test_latent_space_versions()
+    test_temp_files_of_running_jobs_are_kept()
+    test_resized_image_pack_compaction()
+    print("cache inspection works")
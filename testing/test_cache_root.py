@@ -0,0 +1,240 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from torchvision import transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.basic import parse_size
+from toolkit.cache_root import STALE_TMP_SECONDS, acquire_cache_lease, atomic_write_path, collect_cache_garbage, \
+    get_file_content_hash, get_lease_dir
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+from toolkit.dataloader_mixins import LatentCachingMixin
+
+
+class TinySD:
+    # stands in for a model, a patchify instead of a real vae
+    def __init__(self):
+        torch.manual_seed(0)
+        self.vae = nn.Conv2d(3, 4, kernel_size=8, stride=8)
+        self.model_config = SimpleNamespace(latent_space_version='tiny', arch='tiny')
+        self.torch_dtype = torch.float32
+        self.device = 'cpu'
+        self.device_torch = torch.device('cpu')
+        self.num_encoded = 0
+
+    def set_device_state_preset(self, preset):
+        pass
+
+    def restore_device_state(self):
+        pass
+
+    @torch.no_grad()
+    def encode_images(self, imgs):
+        self.num_encoded += imgs.shape[0]
+        return self.vae(imgs)
+
+
+class TinyDataset(LatentCachingMixin):
+    def __init__(self, dataset_config, sd):
+        super().__init__()
+        self.dataset_config = dataset_config
+        self.dataset_path = dataset_config.folder_path
+        self.sd = sd
+        self.is_video = False
+        self.is_caching_latents_to_disk = True
+        self.is_caching_latents_to_memory = False
+        self.transform = transforms.Compose([transforms.ToTensor()])
+        paths = sorted(os.path.join(self.dataset_path, f) for f in os.listdir(self.dataset_path) if f.endswith('.png'))
+        self.file_list = [FileItemDTO(path=path, dataset_config=dataset_config) for path in paths]
+
+
+def write_images(folder, count=4):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for idx in range(count):
+        pixels = rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, f'img_{idx}.png'))
+
+
+def test_content_hash():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'a.bin')
+        with open(path, 'wb') as f:
+            f.write(b'hello')
+        copy_path = os.path.join(tmp_dir, 'b.bin')
+        shutil.copy(path, copy_path)
+        database = {}
+        assert get_file_content_hash(path, database) == get_file_content_hash(copy_path)
+        assert path in database
+
+        # a remembered hash is used while the size and mtime match
+        database[path] = [database[path][0], 'remembered']
+        assert get_file_content_hash(path, database) == 'remembered'
+        with open(path, 'wb') as f:
+            f.write(b'changed!')
+        os.utime(path, (time.time() + 5, time.time() + 5))
+        assert get_file_content_hash(path, database) != 'remembered'
+
+
+def test_latent_cache_shared_between_datasets():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_root = os.path.join(tmp_dir, 'cache')
+        dataset_a = os.path.join(tmp_dir, 'a')
+        write_images(dataset_a)
+        # the same images under other names, like a copied dataset
+        dataset_b = os.path.join(tmp_dir, 'b')
+        os.makedirs(dataset_b)
+        for idx, file in enumerate(sorted(os.listdir(dataset_a))):
+            shutil.copy(os.path.join(dataset_a, file), os.path.join(dataset_b, f'copy_{idx}.png'))
+
+        sd = TinySD()
+        dataset = TinyDataset(DatasetConfig(folder_path=dataset_a, resolution=64, cache_root=cache_root), sd)
+        dataset.cache_latents_all_latents()
+        assert sd.num_encoded == 4
+        # nothing is written next to the images
+        assert not os.path.exists(os.path.join(dataset_a, '_latent_cache'))
+        assert all(x.get_latent_path().startswith(cache_root) for x in dataset.file_list)
+
+        sd = TinySD()
+        copied = TinyDataset(DatasetConfig(folder_path=dataset_b, resolution=64, cache_root=cache_root), sd)
+        copied.cache_latents_all_latents()
+        assert sd.num_encoded == 0
+        for a, b in zip(dataset.file_list, copied.file_list):
+            assert a.get_latent_path() == b.get_latent_path()
+            assert torch.equal(a.get_latent(), b.get_latent())
+
+        # other processing params are other entries
+        other = FileItemDTO(path=dataset.file_list[0].path, dataset_config=DatasetConfig(
+            folder_path=dataset_a, resolution=64, cache_root=cache_root
+        ))
+        other.latent_space_version = 'tiny'
+        other.flip_x = True
+        assert other.get_latent_path() != dataset.file_list[0].get_latent_path()
+
+
+def test_atomic_write():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'sub', 'entry.safetensors')
+        try:
+            with atomic_write_path(path) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    f.write('partial')
+                raise RuntimeError('writer died')
+        except RuntimeError:
+            pass
+        # neither the entry nor the temp file is left
+        assert os.listdir(os.path.join(tmp_dir, 'sub')) == []
+
+        with atomic_write_path(path) as tmp_path:
+            assert tmp_path.endswith('.safetensors')
+            with open(tmp_path, 'w') as f:
+                f.write('done')
+        assert open(path).read() == 'done'
+        assert os.listdir(os.path.join(tmp_dir, 'sub')) == ['entry.safetensors']
+
+
+def test_lru_garbage_collection():
+    with tempfile.TemporaryDirectory() as cache_root:
+        now = time.time()
+        folder = os.path.join(cache_root, 'latents', 'ab')
+        os.makedirs(folder)
+        paths = []
+        for idx in range(5):
+            path = os.path.join(folder, f'entry_{idx}.safetensors')
+            with open(path, 'wb') as f:
+                f.write(b'0' * 100)
+            # entry_0 was used longest ago
+            os.utime(path, (now - 1000 + idx, now - 1000 + idx))
+            paths.append(path)
+        stale_tmp = os.path.join(folder, '.entry_9.abc.tmp.safetensors')
+        young_tmp = os.path.join(folder, '.entry_8.def.tmp.safetensors')
+        for path, age in [(stale_tmp, STALE_TMP_SECONDS + 10), (young_tmp, 10)]:
+            with open(path, 'wb') as f:
+                f.write(b'0' * 100)
+            os.utime(path, (now - age, now - age))
+
+        result = collect_cache_garbage(cache_root, max_bytes=300, dry_run=True, now=now)
+        assert result['removed_files'] == 3
+        assert all(os.path.exists(path) for path in paths + [stale_tmp])
+
+        result = collect_cache_garbage(cache_root, max_bytes=300, now=now)
+        assert result['kept_bytes'] == 300
+        assert [os.path.exists(path) for path in paths] == [False, False, True, True, True]
+        assert not os.path.exists(stale_tmp)
+        # a writer may still be busy with it
+        assert os.path.exists(young_tmp)
+
+
+def test_garbage_collection_keeps_entries_of_running_jobs():
+    with tempfile.TemporaryDirectory() as cache_root:
+        now = time.time()
+        folder = os.path.join(cache_root, 'latents', 'ab')
+        os.makedirs(folder)
+        old_path = os.path.join(folder, 'old.safetensors')
+        with open(old_path, 'wb') as f:
+            f.write(b'0' * 100)
+        os.utime(old_path, (now - 100000, now - 100000))
+
+        # a job that crashed on this machine does not hold its lease
+        finished = subprocess.Popen([sys.executable, '-c', 'pass'])
+        finished.wait()
+        os.makedirs(get_lease_dir(cache_root))
+        with open(os.path.join(get_lease_dir(cache_root), 'crashed.json'), 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': finished.pid, 'started': now - 200000}, f)
+
+        lease_path = acquire_cache_lease(cache_root)
+        assert acquire_cache_lease(cache_root) == lease_path
+        # a job touches what it reads while setting up, after taking the lease
+        in_use_path = os.path.join(folder, 'in_use.safetensors')
+        with open(in_use_path, 'wb') as f:
+            f.write(b'0' * 100)
+
+        result = collect_cache_garbage(cache_root, max_bytes=0)
+        assert result['active_leases'] == 1
+        assert result['protected_files'] == 1
+        assert os.path.exists(in_use_path)
+        assert not os.path.exists(old_path)
+
+        # once the job is done it can go
+        os.remove(lease_path)
+        collect_cache_garbage(cache_root, max_bytes=0)
+        assert not os.path.exists(in_use_path)
+
+
+def test_parse_size():
+    # one parser for the gc budget and the shard sizes
+    assert parse_size('500G') == 500 * 1024 ** 3
+    assert parse_size('2T') == 2 * 1024 ** 4
+    assert parse_size('1.5GiB') == int(1.5 * 1024 ** 3)
+    assert parse_size('5GB') == 5 * 1000 ** 3
+    assert parse_size(' 100 KB ') == 100000
+    assert parse_size('1024') == 1024
+    assert parse_size(None) == 0
+    try:
+        parse_size('5 apples')
+        raise AssertionError("expected a ValueError")
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+    test_content_hash()
+    test_latent_cache_shared_between_datasets()
+    test_atomic_write()
+    test_lru_garbage_collection()
+    test_garbage_collection_keeps_entries_of_running_jobs()
+    test_parse_size()
+    print("cache root works")
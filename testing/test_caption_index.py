@@ -0,0 +1,122 @@
+import builtins
+import copy
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.cache_inspection import CacheKeyModel
+from toolkit.config_modules import DatasetConfig, ModelConfig
+from toolkit.data_loader import AiToolkitDataset
+
+MODEL = CacheKeyModel(ModelConfig(name_or_path='not/loaded', arch='sdxl'), 16)
+
+
+def write_dataset(folder, count=4):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for idx in range(count):
+        pixels = rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, f'img_{idx}.png'))
+        # the last one has no caption
+        if idx < count - 1:
+            with open(os.path.join(folder, f'img_{idx}.txt'), 'w') as f:
+                f.write(f'caption {idx}')
+
+
+@contextmanager
+def count_filesystem_calls():
+    calls = []
+
+    def counted(name, fn):
+        def wrapper(*args, **kwargs):
+            calls.append(name)
+            return fn(*args, **kwargs)
+        return wrapper
+
+    with mock.patch.object(os.path, 'exists', counted('exists', os.path.exists)), \
+            mock.patch.object(os, 'stat', counted('stat', os.stat)), \
+            mock.patch.object(os, 'scandir', counted('scandir', os.scandir)), \
+            mock.patch.object(builtins, 'open', counted('open', builtins.open)):
+        yield calls
+
+
+def get_caption_calls(dataset):
+    # what loading the captions of every sample costs, like __getitem__ does
+    captions = []
+    with count_filesystem_calls() as calls:
+        for file_item in dataset.file_list:
+            file_item = copy.deepcopy(file_item)
+            file_item.load_caption(dataset.caption_dict)
+            captions.append(file_item.raw_caption)
+    return len(calls), captions
+
+
+def make_dataset(folder, **kwargs):
+    return AiToolkitDataset(DatasetConfig(folder_path=folder, resolution=64, caption_ext='txt', **kwargs), sd=MODEL)
+
+
+def test_no_filesystem_calls_per_sample():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        num_calls, captions = get_caption_calls(make_dataset(tmp_dir, preload_captions=False))
+        # an exists for every sample and an open for every caption
+        assert num_calls == 4 + 3
+        num_preloaded_calls, preloaded_captions = get_caption_calls(make_dataset(tmp_dir))
+        assert num_preloaded_calls == 0
+        assert preloaded_captions == captions
+        assert sorted(captions) == ['', 'caption 0', 'caption 1', 'caption 2']
+        print(f"filesystem calls for 4 samples: {num_calls} before, {num_preloaded_calls} preloaded")
+
+
+def test_folder_default_caption():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        with open(os.path.join(tmp_dir, 'default.txt'), 'w') as f:
+            f.write('a folder default')
+        for preload in [False, True]:
+            dataset = make_dataset(tmp_dir, preload_captions=preload)
+            captions = {os.path.basename(x.path): dataset.get_caption_item(i) for i, x in enumerate(dataset.file_list)}
+            assert captions['img_3.png'] == 'a folder default'
+            assert captions['img_0.png'] == 'caption 0'
+
+
+def test_watch_reloads_changed_captions():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        dataset = make_dataset(tmp_dir, watch_captions=True)
+        unwatched = make_dataset(tmp_dir)
+        caption_path = os.path.join(tmp_dir, 'img_0.txt')
+        with open(caption_path, 'w') as f:
+            f.write('edited caption')
+        later = time.time() + 5
+        os.utime(caption_path, (later, later))
+        with open(os.path.join(tmp_dir, 'img_3.txt'), 'w') as f:
+            f.write('new caption')
+
+        for d in [dataset, unwatched]:
+            # second epoch
+            d.setup_epoch()
+        _, captions = get_caption_calls(dataset)
+        by_name = {os.path.basename(x.path): c for x, c in zip(dataset.file_list, captions)}
+        assert by_name['img_0.png'] == 'edited caption'
+        assert by_name['img_3.png'] == 'new caption'
+        assert by_name['img_1.png'] == 'caption 1'
+
+        _, captions = get_caption_calls(unwatched)
+        by_name = {os.path.basename(x.path): c for x, c in zip(unwatched.file_list, captions)}
+        assert by_name['img_0.png'] == 'caption 0'
+
+
+if __name__ == '__main__':
+    test_no_filesystem_calls_per_sample()
+    test_folder_default_caption()
+    test_watch_reloads_changed_captions()
+    print("caption index works")
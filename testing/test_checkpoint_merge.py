@@ -0,0 +1,123 @@
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import load_file, save_file
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.checkpoint_merge import MergeModel, merge_checkpoints, merge_tensors, trim_to_density
+
+
+def make_checkpoint(path, seed, num_blocks=8, dim=64):
+    generator = torch.Generator().manual_seed(seed)
+    state_dict = OrderedDict()
+    for i in range(num_blocks):
+        state_dict[f"blocks.{i}.weight"] = torch.randn(dim, dim, generator=generator).half()
+        state_dict[f"blocks.{i}.bias"] = torch.randn(dim, generator=generator).half()
+    state_dict["position_ids"] = torch.arange(16)
+    save_file(state_dict, path)
+    return state_dict
+
+
+def test_weighted_sum_and_block_weights():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        a = make_checkpoint(os.path.join(tmp_dir, 'a.safetensors'), 1)
+        b = make_checkpoint(os.path.join(tmp_dir, 'b.safetensors'), 2)
+        models = [
+            MergeModel(path=os.path.join(tmp_dir, 'a.safetensors'), weight=0.25,
+                       block_weights={r"blocks\.0\.": 1.0}),
+            MergeModel(path=os.path.join(tmp_dir, 'b.safetensors'), weight=0.75,
+                       block_weights={r"blocks\.0\.": 0.0}),
+        ]
+        out_path = os.path.join(tmp_dir, 'out.safetensors')
+        stats = merge_checkpoints(models, out_path, save_dtype=torch.float32)
+        merged = load_file(out_path)
+
+    assert stats['copied_keys'] == 1
+    assert torch.equal(merged['position_ids'], a['position_ids'])
+    assert torch.allclose(merged['blocks.0.weight'], a['blocks.0.weight'].float())
+    expected = a['blocks.3.weight'].float() * 0.25 + b['blocks.3.weight'].float() * 0.75
+    assert torch.allclose(merged['blocks.3.weight'], expected, atol=1e-6)
+
+
+def test_add_difference_and_ties():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [os.path.join(tmp_dir, f'{n}.safetensors') for n in ['base', 'a', 'b']]
+        base, a, b = [make_checkpoint(path, seed) for seed, path in enumerate(paths)]
+        models = [MergeModel(path=paths[1], weight=0.5), MergeModel(path=paths[2], weight=1.0)]
+
+        out_path = os.path.join(tmp_dir, 'add_diff.safetensors')
+        merge_checkpoints(models, out_path, method='add_difference', base_model_path=paths[0],
+                          save_dtype=torch.float32)
+        merged = load_file(out_path)
+        key = 'blocks.2.weight'
+        expected = base[key].float() + 0.5 * (a[key].float() - base[key].float()) + (
+                b[key].float() - base[key].float())
+        assert torch.allclose(merged[key], expected, atol=1e-5)
+
+        out_path = os.path.join(tmp_dir, 'ties.safetensors')
+        merge_checkpoints(models, out_path, method='ties', base_model_path=paths[0], density=0.5,
+                          save_dtype=torch.float32)
+        merged = load_file(out_path)
+        expected = merge_tensors(
+            [a[key].float(), b[key].float()], [0.5, 1.0], 'ties', base=base[key].float(), density=0.5
+        )
+        assert torch.allclose(merged[key], expected, atol=1e-6)
+
+
+def test_ties_sign_election():
+    base = torch.zeros(4)
+    a = torch.tensor([1.0, -1.0, 2.0, 0.0])
+    b = torch.tensor([3.0, 2.0, -1.0, 0.0])
+    merged = merge_tensors([a, b], [1.0, 1.0], 'ties', base=base)
+    # agreeing values are averaged, disagreeing ones only keep the elected sign
+    assert torch.allclose(merged, torch.tensor([2.0, 2.0, 2.0, 0.0]))
+    trimmed = trim_to_density(torch.tensor([0.1, -5.0, 0.2, 3.0]), 0.5)
+    assert torch.equal(trimmed, torch.tensor([0.0, -5.0, 0.0, 3.0]))
+
+
+def test_sharding_and_workers_match():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [os.path.join(tmp_dir, f'{n}.safetensors') for n in ['a', 'b', 'c']]
+        for seed, path in enumerate(paths):
+            make_checkpoint(path, seed, num_blocks=16, dim=128)
+        models = [MergeModel(path=path, weight=1 / 3) for path in paths]
+
+        single_path = os.path.join(tmp_dir, 'single.safetensors')
+        merge_checkpoints(models, single_path)
+        single = load_file(single_path)
+
+        sharded_path = os.path.join(tmp_dir, 'sharded.safetensors')
+        stats = merge_checkpoints(models, sharded_path, max_shard_size='100KB', num_workers=4)
+        assert len(stats['output_paths']) > 1
+        assert os.path.exists(f"{sharded_path}.index.json")
+        sharded = OrderedDict()
+        for path in stats['output_paths']:
+            sharded.update(load_file(path))
+
+    assert set(sharded.keys()) == set(single.keys())
+    for key in single:
+        assert torch.equal(sharded[key], single[key]), key
+
+
+def benchmark_merge_throughput(num_models=3, num_blocks=32, dim=1024, num_workers=4):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [os.path.join(tmp_dir, f'{i}.safetensors') for i in range(num_models)]
+        for seed, path in enumerate(paths):
+            make_checkpoint(path, seed, num_blocks=num_blocks, dim=dim)
+        models = [MergeModel(path=path, weight=1 / num_models) for path in paths]
+        for workers in [0, num_workers]:
+            stats = merge_checkpoints(models, os.path.join(tmp_dir, 'out.safetensors'), num_workers=workers)
+            print(f"workers: {workers}, read {stats['bytes_read'] / 1e9:.3f} GB "
+                  f"at {stats['read_gb_per_sec']:.2f} GB/s, wrote {stats['write_gb_per_sec']:.2f} GB/s")
+
+
+if __name__ == '__main__':
+    test_ties_sign_election()
+    test_weighted_sum_and_block_weights()
+    test_add_difference_and_ties()
+    test_sharding_and_workers_match()
+    benchmark_merge_throughput()
@@ -0,0 +1,163 @@
+import json
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from PIL import Image
+from torchvision import transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.cache_sharding import CacheShard, get_shard_for_key
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+from toolkit.dataloader_mixins import LatentCachingMixin
+
+NUM_IMAGES = 12
+
+
+class TinySD:
+    # stands in for a model, a patchify instead of a real vae
+    def __init__(self):
+        torch.manual_seed(0)
+        self.vae = nn.Conv2d(3, 4, kernel_size=8, stride=8)
+        self.model_config = SimpleNamespace(latent_space_version='tiny', arch='tiny')
+        self.torch_dtype = torch.float32
+        self.device = 'cpu'
+        self.device_torch = torch.device('cpu')
+        self.num_encoded = 0
+
+    def set_device_state_preset(self, preset):
+        pass
+
+    def restore_device_state(self):
+        pass
+
+    @torch.no_grad()
+    def encode_images(self, imgs):
+        self.num_encoded += imgs.shape[0]
+        return self.vae(imgs)
+
+
+class TinyDataset(LatentCachingMixin):
+    def __init__(self, dataset_config, paths, sd):
+        super().__init__()
+        self.dataset_config = dataset_config
+        self.dataset_path = dataset_config.folder_path
+        self.sd = sd
+        self.is_video = False
+        self.is_caching_latents_to_disk = True
+        self.is_caching_latents_to_memory = False
+        self.transform = transforms.Compose([transforms.ToTensor()])
+        self.file_list = [FileItemDTO(path=path, dataset_config=dataset_config) for path in paths]
+
+
+def write_images(folder, count=NUM_IMAGES):
+    rng = np.random.default_rng(0)
+    paths = []
+    for idx in range(count):
+        path = os.path.join(folder, f'img_{idx}.png')
+        Image.fromarray(rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+def run_distributed(fn, world_size, tmp_dir, *args):
+    mp.spawn(fn, args=(world_size, tmp_dir) + args, nprocs=world_size, join=True)
+
+
+def init_gloo(rank, world_size, tmp_dir):
+    dist.init_process_group(
+        'gloo',
+        init_method=f'file://{os.path.join(tmp_dir, "dist_init")}',
+        rank=rank,
+        world_size=world_size
+    )
+
+
+def test_shard_assignment():
+    keys = [f'/data/_latent_cache/img_{idx}_abc.safetensors' for idx in range(1000)]
+    for num_shards in [2, 3, 4]:
+        shards = [CacheShard(idx, num_shards) for idx in range(num_shards)]
+        owners = [[s.shard_index for s in shards if s.is_mine(key)] for key in keys]
+        # every key is done exactly once
+        assert all(len(o) == 1 for o in owners)
+        sizes = [len(s.split(keys)) for s in shards]
+        assert sum(sizes) == len(keys)
+        assert min(sizes) > len(keys) / num_shards * 0.8
+    # stable between calls, so every rank agrees
+    assert get_shard_for_key(keys[0], 3) == get_shard_for_key(keys[0], 3)
+    # without a process group everything is local
+    assert CacheShard().split(keys) == keys
+
+
+def merge_worker(rank, world_size, tmp_dir):
+    init_gloo(rank, world_size, tmp_dir)
+    shard = CacheShard()
+    assert shard.shard_index == rank and shard.num_shards == world_size
+    keys = [os.path.join(tmp_dir, f'item_{idx}.txt') for idx in range(40)]
+    mine = shard.split(keys)
+    for key in mine:
+        with open(key, 'w') as f:
+            f.write(str(rank))
+    merged = shard.merge(mine)
+    # after the merge everything is on disk, written once
+    assert sorted(merged) == sorted(keys)
+    assert all(os.path.exists(key) for key in keys)
+    dist.destroy_process_group()
+
+
+def test_gloo_merge():
+    for world_size in [2, 3, 4]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_distributed(merge_worker, world_size, tmp_dir)
+
+
+def latent_cache_worker(rank, world_size, tmp_dir, image_dir):
+    init_gloo(rank, world_size, tmp_dir)
+    paths = sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.endswith('.png'))
+    config = DatasetConfig(folder_path=image_dir, resolution=64, cache_latents_to_disk=True)
+    sd = TinySD()
+    dataset = TinyDataset(config, paths, sd)
+    dataset.cache_latents_all_latents()
+    latents = [file_item.get_latent() for file_item in dataset.file_list]
+    with open(os.path.join(tmp_dir, f'result_{rank}.json'), 'w') as f:
+        json.dump({
+            'num_encoded': sd.num_encoded,
+            'all_cached': all(x.is_latent_cached for x in dataset.file_list),
+            'latent_sums': [float(latent.sum()) for latent in latents],
+        }, f)
+    dist.destroy_process_group()
+
+
+def test_gloo_latent_cache():
+    for world_size in [2, 4]:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_dir = os.path.join(tmp_dir, 'images')
+            os.makedirs(image_dir)
+            write_images(image_dir)
+            run_distributed(latent_cache_worker, world_size, tmp_dir, image_dir)
+            results = []
+            for rank in range(world_size):
+                with open(os.path.join(tmp_dir, f'result_{rank}.json'), 'r') as f:
+                    results.append(json.load(f))
+            # every image was encoded once, split over the ranks
+            assert sum(r['num_encoded'] for r in results) == NUM_IMAGES
+            assert all(r['num_encoded'] < NUM_IMAGES for r in results)
+            assert all(r['all_cached'] for r in results)
+            # and every rank loads the same merged cache
+            for r in results[1:]:
+                assert np.allclose(r['latent_sums'], results[0]['latent_sums'])
+
+
+if __name__ == '__main__':
+    test_shard_assignment()
+    test_gloo_merge()
+    test_gloo_latent_cache()
+    print("distributed cache building works")
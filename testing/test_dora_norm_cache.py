@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import NetworkConfig
+from toolkit.models.DoRA import DoRAModule
+from toolkit.network_mixins import ToolkitNetworkMixin
+
+
+class TinyNetwork(ToolkitNetworkMixin, nn.Module):
+    # just enough of a network to hold dora modules around some layers
+    def __init__(self, layers, rank=8):
+        ToolkitNetworkMixin.__init__(self, network_config=NetworkConfig(type='dora'))
+        nn.Module.__init__(self)
+        self.network_type = 'dora'
+        self.unet_loras = []
+        for idx, layer in enumerate(layers):
+            dora = DoRAModule(f"dora_{idx}", layer, lora_dim=rank, alpha=rank, network=self)
+            with torch.no_grad():
+                dora.lora_up.weight.normal_(std=0.05)
+            dora.apply_to()
+            self.unet_loras.append(dora)
+        self.loras = nn.ModuleList(self.unet_loras)
+        self._update_torch_multiplier()
+        self.is_active = True
+
+
+def reference_apply_dora(module, x, lora_scale):
+    # the previous implementation, builds W + s * up @ down every call
+    weight = module.get_orig_weight().to(module.lora_up.weight.dtype)
+    scaled_lora_weight = (module.lora_up.weight @ module.lora_down.weight) * lora_scale
+    combined = weight + scaled_lora_weight
+    weight_norm = torch.linalg.norm(combined, dim=1).detach()
+    return (module.magnitude / weight_norm - 1).view(1, -1) * F.linear(x, combined)
+
+
+def test_matches_reference():
+    torch.manual_seed(0)
+    network = TinyNetwork([nn.Linear(64, 48)])
+    dora = network.unet_loras[0]
+    with torch.no_grad():
+        dora.magnitude.mul_(1.1)
+    x = torch.randn(4, 64)
+    scale = torch.tensor(0.8)
+
+    out = dora.apply_dora(x, scale)
+    grads = torch.autograd.grad(out.square().sum(), list(dora.parameters()))
+    expected = reference_apply_dora(dora, x, scale)
+    expected_grads = torch.autograd.grad(expected.square().sum(), list(dora.parameters()))
+
+    assert torch.allclose(out, expected, atol=1e-5), (out - expected).abs().max()
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad, atol=1e-4), (grad - expected_grad).abs().max()
+
+
+def test_norm_cached_until_optimizer_step():
+    torch.manual_seed(0)
+    layer = nn.Linear(64, 48)
+    network = TinyNetwork([layer])
+    dora = network.unet_loras[0]
+    optimizer = torch.optim.SGD(network.parameters(), lr=0.1)
+    x = torch.randn(4, 64)
+
+    layer(x).sum().backward()
+    terms = dora._norm_terms
+    # another micro batch reuses the cached norm
+    layer(x).sum().backward()
+    assert dora._norm_terms is terms
+
+    optimizer.step()
+    optimizer.zero_grad()
+    out = layer(x)
+    assert dora._norm_terms is not terms
+    expected = reference_apply_dora(dora, x, torch.tensor(1.0))
+    weight_norm = dora.get_weight_norm(dora.get_orig_weight(), torch.tensor(1.0))
+    reference_norm = torch.linalg.norm(
+        dora.get_orig_weight() + dora.lora_up.weight @ dora.lora_down.weight, dim=1
+    )
+    assert torch.allclose(weight_norm, reference_norm, atol=1e-5)
+    assert out.shape == expected.shape
+
+
+def benchmark(dim=2048, rank=16, tokens=256, micro_batches=8, steps=5):
+    torch.manual_seed(0)
+    network = TinyNetwork([nn.Linear(dim, dim)], rank=rank)
+    dora = network.unet_loras[0]
+    x = torch.randn(tokens, dim)
+    scale = torch.tensor(1.0)
+
+    results = {}
+    for name, forward in [('reference', lambda: reference_apply_dora(dora, x, scale)),
+                          ('cached', lambda: dora.apply_dora(x, scale))]:
+        with torch.no_grad():
+            forward()
+            start = time.perf_counter()
+            for _ in range(steps):
+                # a new optimizer step invalidates the cache
+                dora._norm_cache_key = None
+                for _ in range(micro_batches):
+                    forward()
+        results[name] = (time.perf_counter() - start) / (steps * micro_batches)
+        print(f"{name}: {results[name] * 1000:.2f} ms / forward")
+    print(f"speedup: {results['reference'] / results['cached']:.2f}x")
+
+
+if __name__ == '__main__':
+    test_matches_reference()
+    test_norm_cached_until_optimizer_step()
+    print("cached dora norm matches the reference")
+    benchmark()
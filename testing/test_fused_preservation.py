@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRAModule
+from toolkit.network_mixins import ToolkitNetworkMixin
+from toolkit.train_tools import predict_with_fused_prior
+
+
+class TinyDenoiser(nn.Module):
+    # latents, timesteps and a pooled text embed in, a noise prediction out
+    def __init__(self, dim=16, embed_dim=8, hidden=64, gradient_checkpointing=False):
+        super().__init__()
+        self.in_proj = nn.Linear(dim, hidden)
+        self.text_proj = nn.Linear(embed_dim, hidden)
+        self.mid = nn.Linear(hidden, hidden)
+        self.out = nn.Linear(hidden, dim)
+        self.gradient_checkpointing = gradient_checkpointing
+
+    def forward(self, latents, timesteps, embeds):
+        h = self.in_proj(latents) + self.text_proj(embeds) + (timesteps / 1000).unsqueeze(-1)
+        h = F.gelu(h)
+        if self.gradient_checkpointing:
+            h = checkpoint(lambda x: F.gelu(self.mid(x)), h, use_reentrant=False)
+        else:
+            h = F.gelu(self.mid(h))
+        return self.out(h)
+
+
+class TinyNetwork(ToolkitNetworkMixin, nn.Module):
+    # just enough of a network to hold lora modules around some layers
+    def __init__(self, layers, rank=4):
+        ToolkitNetworkMixin.__init__(self, network_config=NetworkConfig(type='lora'))
+        nn.Module.__init__(self)
+        self.network_type = 'lora'
+        self.unet_loras = []
+        for idx, layer in enumerate(layers):
+            lora = LoRAModule(f"lora_{idx}", layer, lora_dim=rank, alpha=rank, network=self)
+            with torch.no_grad():
+                lora.lora_up.weight.normal_(std=0.1)
+            lora.apply_to()
+            self.unet_loras.append(lora)
+        self.loras = nn.ModuleList(self.unet_loras)
+        self._update_torch_multiplier()
+        self.is_active = True
+
+
+def make_model(gradient_checkpointing=False, seed=0):
+    torch.manual_seed(seed)
+    model = TinyDenoiser(gradient_checkpointing=gradient_checkpointing)
+    network = TinyNetwork([model.in_proj, model.text_proj, model.mid, model.out])
+    return model, network
+
+
+def make_batch(batch_size=4, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    latents = torch.randn(batch_size, 16, generator=generator)
+    timesteps = torch.randint(0, 1000, (batch_size,), generator=generator).float()
+    embeds = torch.randn(batch_size, 8, generator=generator)
+    preservation_embeds = torch.randn(1, 8, generator=generator).expand(batch_size, -1)
+    target = torch.randn(batch_size, 16, generator=generator)
+    return latents, timesteps, embeds, preservation_embeds, target
+
+
+def two_pass_step(model, network, weights, batch, preservation_multiplier=1.0):
+    # what the trainer does without fusing, the prior with the network disabled then two trained passes
+    latents, timesteps, embeds, preservation_embeds, target = batch
+    network.is_active = False
+    with torch.no_grad():
+        prior_pred = model(latents, timesteps, preservation_embeds)
+    network.is_active = True
+    network.multiplier = weights
+
+    loss = F.mse_loss(model(latents, timesteps, embeds), target)
+    loss.backward()
+    preservation_pred = model(latents, timesteps, preservation_embeds)
+    preservation_loss = F.mse_loss(preservation_pred, prior_pred) * preservation_multiplier
+    preservation_loss.backward()
+    return (loss + preservation_loss).item()
+
+
+def fused_step(model, network, weights, batch, preservation_multiplier=1.0):
+    latents, timesteps, embeds, preservation_embeds, target = batch
+    noise_pred, preservation_pred, prior_pred = predict_with_fused_prior(
+        network=network,
+        network_weight_list=weights,
+        predict_fn=model,
+        latents=latents,
+        timesteps=timesteps,
+        embeds=torch.cat([embeds, preservation_embeds, preservation_embeds], dim=0),
+    )
+    assert not prior_pred.requires_grad
+    loss = F.mse_loss(noise_pred, target)
+    loss = loss + F.mse_loss(preservation_pred, prior_pred) * preservation_multiplier
+    loss.backward()
+    network.multiplier = weights
+    return loss.item()
+
+
+def compare(weights, gradient_checkpointing=False, preservation_multiplier=1.0):
+    batch = make_batch()
+    two_pass_model, two_pass_network = make_model(gradient_checkpointing)
+    fused_model, fused_network = make_model(gradient_checkpointing)
+
+    two_pass_loss = two_pass_step(two_pass_model, two_pass_network, weights, batch, preservation_multiplier)
+    fused_loss = fused_step(fused_model, fused_network, weights, batch, preservation_multiplier)
+    assert abs(two_pass_loss - fused_loss) < 1e-5, (two_pass_loss, fused_loss)
+
+    for two_pass_p, fused_p in zip(two_pass_network.parameters(), fused_network.parameters()):
+        assert torch.allclose(two_pass_p.grad, fused_p.grad, atol=1e-5), \
+            (two_pass_p.grad - fused_p.grad).abs().max()
+
+
+def test_fused_matches_two_pass():
+    compare([1.0, 1.0, 1.0, 1.0])
+    compare([1.0, 0.5, 1.0, 0.25], preservation_multiplier=0.5)
+
+
+def test_fused_with_gradient_checkpointing():
+    # the recompute in backward has to see the fused multipliers
+    compare([1.0, 0.5, 1.0, 0.25], gradient_checkpointing=True)
+
+
+def test_prior_chunk_has_no_network():
+    model, network = make_model()
+    latents, timesteps, _, preservation_embeds, _ = make_batch()
+    with torch.no_grad():
+        _, _, prior_pred = predict_with_fused_prior(
+            network, [1.0] * 4, model, latents, timesteps,
+            torch.cat([preservation_embeds] * 3, dim=0),
+        )
+        network.is_active = False
+        expected = model(latents, timesteps, preservation_embeds)
+    # only blas blocking differences between a 3x batch and a single one
+    assert torch.allclose(prior_pred, expected, atol=1e-6)
+
+
+def benchmark(batch_size=16, steps=20):
+    batch = make_batch(batch_size)
+    weights = [1.0] * batch_size
+    for name, step in [('two pass', two_pass_step), ('fused', fused_step)]:
+        model, network = make_model()
+        step(model, network, weights, batch)
+        start = time.perf_counter()
+        for _ in range(steps):
+            network.zero_grad()
+            step(model, network, weights, batch)
+        print(f"{name}: {(time.perf_counter() - start) / steps * 1000:.2f} ms / step")
+
+
+if __name__ == '__main__':
+    test_fused_matches_two_pass()
+    test_fused_with_gradient_checkpointing()
+    test_prior_chunk_has_no_network()
+    print("fused preservation forward matches the separate passes")
+    benchmark()
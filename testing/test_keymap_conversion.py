@@ -0,0 +1,136 @@
+import json
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import torch
+from safetensors.torch import load_file, save_file
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# keep the compiled keymap cache out of the users home folder
+os.environ.setdefault("AITK_KEYMAPS_CACHE_PATH", tempfile.mkdtemp())
+
+from toolkit.saving import (
+    LazySafetensorsStateDict,
+    convert_state_dict_to_ldm_with_mapping,
+    get_keymap_cache_path,
+    get_slices_from_string,
+    load_compiled_keymap,
+    save_state_dict_to_ldm_with_mapping,
+)
+
+
+def make_fixture(tmp_dir):
+    torch.manual_seed(0)
+    diffusers_state_dict = OrderedDict([
+        ('unet_conv_in.weight', torch.randn(8, 4, 3, 3)),
+        ('unet_conv_in.bias', torch.randn(8)),
+        ('unet_attn.to_out.weight', torch.randn(8, 8)),
+        ('te_q_proj.weight', torch.randn(6, 6)),
+        ('te_k_proj.weight', torch.randn(6, 6)),
+        ('te_v_proj.weight', torch.randn(6, 6)),
+        ('te_packed.weight', torch.randn(12, 4)),
+    ])
+    mapping = {
+        'ldm_diffusers_keymap': OrderedDict([
+            ('model.diffusion_model.input_blocks.0.0.weight', 'unet_conv_in.weight'),
+            ('model.diffusion_model.input_blocks.0.0.bias', 'unet_conv_in.bias'),
+            ('model.diffusion_model.attn.proj_out.weight', 'unet_attn.to_out.weight'),
+            # not in the state dict, should stay what the base has
+            ('model.diffusion_model.missing.weight', 'unet_missing.weight'),
+        ]),
+        'ldm_diffusers_shape_map': {
+            'model.diffusion_model.attn.proj_out.weight': [[8, 8, 1, 1], [8, 8]],
+        },
+        'ldm_diffusers_operator_map': OrderedDict([
+            ('cond_stage_model.attn.in_proj_weight', {
+                'cat': ['te_q_proj.weight', 'te_k_proj.weight', 'te_v_proj.weight']
+            }),
+            ('cond_stage_model.packed_second_half', {
+                'slice': ['te_packed.weight', '6:, 1:3']
+            }),
+        ]),
+        'diffusers_ldm_operator_map': {},
+    }
+    mapping_path = os.path.join(tmp_dir, 'keymap.json')
+    with open(mapping_path, 'w') as f:
+        json.dump(mapping, f)
+
+    base_path = os.path.join(tmp_dir, 'base.safetensors')
+    save_file({
+        'model.diffusion_model.missing.weight': torch.ones(3, 3),
+        'model.diffusion_model.input_blocks.0.0.bias': torch.zeros(8),
+        'alphas_cumprod': torch.linspace(0, 1, 10),
+    }, base_path)
+    return diffusers_state_dict, mapping_path, base_path
+
+
+def assert_state_dicts_equal(a, b):
+    assert set(a.keys()) == set(b.keys()), set(a.keys()) ^ set(b.keys())
+    for key in a:
+        assert a[key].dtype == b[key].dtype, key
+        assert a[key].shape == b[key].shape, key
+        assert torch.equal(a[key], b[key]), key
+
+
+def test_slice_parsing():
+    assert get_slices_from_string('0:1024, :') == (slice(0, 1024), slice(None))
+    assert get_slices_from_string('2048:') == (slice(2048, None),)
+    assert get_slices_from_string('::2, 1:-1') == (slice(None, None, 2), slice(1, -1))
+    assert get_slices_from_string('5') == (slice(5),)
+
+
+def test_streaming_matches_in_memory():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        diffusers_state_dict, mapping_path, base_path = make_fixture(tmp_dir)
+        expected = convert_state_dict_to_ldm_with_mapping(
+            diffusers_state_dict, mapping_path, base_path, dtype=torch.float16
+        )
+        assert torch.equal(expected['model.diffusion_model.missing.weight'], torch.ones(3, 3).half())
+        assert expected['cond_stage_model.attn.in_proj_weight'].shape == (18, 6)
+        assert expected['cond_stage_model.packed_second_half'].shape == (6, 2)
+
+        # from an in memory state dict
+        output_path = os.path.join(tmp_dir, 'out.safetensors')
+        save_state_dict_to_ldm_with_mapping(
+            diffusers_state_dict, mapping_path, output_path, base_path, dtype=torch.float16
+        )
+        assert_state_dicts_equal(load_file(output_path), expected)
+
+        # from lazily read files, split across several shards
+        source_path = os.path.join(tmp_dir, 'source.safetensors')
+        save_file({k[len('unet_'):]: v for k, v in diffusers_state_dict.items() if k.startswith('unet_')},
+                  source_path)
+        te_path = os.path.join(tmp_dir, 'te.safetensors')
+        save_file({k[len('te_'):]: v for k, v in diffusers_state_dict.items() if k.startswith('te_')}, te_path)
+        lazy = LazySafetensorsStateDict().add_file(source_path, 'unet_').add_file(te_path, 'te_')
+        sharded_path = os.path.join(tmp_dir, 'sharded.safetensors')
+        output_paths = save_state_dict_to_ldm_with_mapping(
+            lazy, mapping_path, sharded_path, base_path, dtype=torch.float16, max_shard_size=200
+        )
+        assert len(output_paths) > 1
+        streamed = OrderedDict()
+        for path in output_paths:
+            streamed.update(load_file(path))
+        assert_state_dicts_equal(streamed, expected)
+
+
+def test_compiled_keymap_cache():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _, mapping_path, _ = make_fixture(tmp_dir)
+        compiled = load_compiled_keymap(mapping_path)
+        assert os.path.exists(get_keymap_cache_path(mapping_path))
+        with open(get_keymap_cache_path(mapping_path), 'r') as f:
+            cached = json.load(f)
+        assert cached['ops'] == json.loads(json.dumps(compiled.ops))
+        slice_op = [op for op in compiled.ops if op[0] == 'slice'][0]
+        assert slice_op[3] == [[6, None, None], [1, 3, None]]
+
+
+if __name__ == '__main__':
+    test_slice_parsing()
+    test_compiled_keymap_cache()
+    test_streaming_matches_in_memory()
+    print("streaming keymap conversion matches")
@@ -0,0 +1,133 @@
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from torchvision import transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+from toolkit.dataloader_mixins import LatentCachingMixin
+from toolkit.latent_quantization import dequantize_latent, get_reconstruction_error, quantize_latent
+
+# relative rmse each dtype has to stay under on vae like latents
+ERROR_BOUNDS = {'bf16': 0.005, 'fp8_e4m3': 0.06, 'int8': 0.02}
+
+
+class TinySD:
+    # stands in for a model, a patchify instead of a real vae
+    def __init__(self):
+        torch.manual_seed(0)
+        self.vae = nn.Conv2d(3, 16, kernel_size=8, stride=8)
+        self.model_config = SimpleNamespace(latent_space_version='tiny', arch='tiny')
+        self.torch_dtype = torch.float32
+        self.device = 'cpu'
+        self.device_torch = torch.device('cpu')
+
+    def set_device_state_preset(self, preset):
+        pass
+
+    def restore_device_state(self):
+        pass
+
+    @torch.no_grad()
+    def encode_images(self, imgs):
+        return self.vae(imgs)
+
+
+class TinyDataset(LatentCachingMixin):
+    def __init__(self, dataset_config, sd, to_memory=False):
+        super().__init__()
+        self.dataset_config = dataset_config
+        self.dataset_path = dataset_config.folder_path
+        self.sd = sd
+        self.is_video = False
+        self.is_caching_latents_to_disk = True
+        self.is_caching_latents_to_memory = to_memory
+        self.transform = transforms.Compose([transforms.ToTensor()])
+        paths = sorted(os.path.join(self.dataset_path, f) for f in os.listdir(self.dataset_path) if f.endswith('.png'))
+        self.file_list = [FileItemDTO(path=path, dataset_config=dataset_config) for path in paths]
+
+
+def make_latent(channels=16, height=64, width=64):
+    # channels with their own mean and spread, like a vae latent
+    torch.manual_seed(0)
+    mean = torch.randn(channels, 1, 1) * 2
+    std = torch.rand(channels, 1, 1) * 3 + 0.1
+    return torch.randn(channels, height, width) * std + mean
+
+
+def write_images(folder, count=3):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for idx in range(count):
+        pixels = rng.integers(0, 256, size=(128, 128, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, f'img_{idx}.png'))
+
+
+def get_cache_size(dataset):
+    return sum(os.path.getsize(x.get_latent_path()) for x in dataset.file_list)
+
+
+def test_round_trip_error_bounds():
+    for latent in [make_latent(), make_latent(16, 5 * 32, 32).reshape(16, 5, 32, 32)]:
+        for cache_dtype, bound in ERROR_BOUNDS.items():
+            state_dict = quantize_latent(latent, cache_dtype)
+            restored = dequantize_latent(state_dict, torch.float32)
+            assert restored.shape == latent.shape
+            error = get_reconstruction_error(latent, state_dict)
+            assert error < bound, f"{cache_dtype} error {error}"
+            if cache_dtype == 'int8':
+                # never off by more than half a step
+                step = state_dict['latent_scale']
+                assert ((restored - latent).abs() <= step / 2 + 1e-5).all()
+
+    # a constant channel does not divide by zero
+    latent = make_latent()
+    latent[3] = 1.5
+    for cache_dtype in ERROR_BOUNDS:
+        restored = dequantize_latent(quantize_latent(latent, cache_dtype), torch.float32)
+        assert torch.isfinite(restored).all()
+        assert torch.allclose(restored[3], latent[3], atol=1e-2)
+
+
+def test_quantized_cache_on_disk():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_images(tmp_dir)
+        reference = TinyDataset(DatasetConfig(folder_path=tmp_dir, resolution=128), TinySD())
+        reference.cache_latents_all_latents()
+        reference_size = get_cache_size(reference)
+
+        for cache_dtype, expected_ratio in [('bf16', 2), ('fp8', 4), ('int8', 4)]:
+            config = DatasetConfig(folder_path=tmp_dir, resolution=128, latent_cache_dtype=cache_dtype)
+            dataset = TinyDataset(config, TinySD())
+            dataset.cache_latents_all_latents()
+            # a separate cache entry from the full precision one
+            for a, b in zip(reference.file_list, dataset.file_list):
+                assert a.get_latent_path() != b.get_latent_path()
+            size = get_cache_size(dataset)
+            # safetensors headers and the scales take a bit on top
+            assert size < reference_size / expected_ratio * 1.5, f"{cache_dtype} {size} vs {reference_size}"
+
+            # loaded back in the model dtype, close to the full precision latent
+            loaded = TinyDataset(config, TinySD(), to_memory=True)
+            loaded.cache_latents_all_latents()
+            for a, b in zip(reference.file_list, loaded.file_list):
+                latent = b.get_latent()
+                assert latent.dtype == torch.float32
+                error = (latent - a.get_latent()).pow(2).mean().sqrt() / a.get_latent().pow(2).mean().sqrt()
+                assert error < ERROR_BOUNDS[config.latent_cache_dtype]
+                # kept quantized in memory
+                assert b._encoded_latent.element_size() <= 2
+
+
+if __name__ == '__main__':
+    test_round_trip_error_bounds()
+    test_quantized_cache_on_disk()
+    print("latent quantization works")
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import NetworkConfig
+from toolkit.models.lokr import LokrModule
+from toolkit.network_mixins import ToolkitNetworkMixin
+
+
+class TinyNetwork(ToolkitNetworkMixin, nn.Module):
+    # just enough of a network to hold lokr modules around some layers
+    def __init__(self, layers, rank=4, factor=-1, decompose_both=False):
+        ToolkitNetworkMixin.__init__(self, network_config=NetworkConfig(type='lokr'))
+        nn.Module.__init__(self)
+        self.network_type = 'lokr'
+        self.unet_loras = []
+        for idx, layer in enumerate(layers):
+            lokr = LokrModule(
+                f"lokr_{idx}", layer, lora_dim=rank, alpha=rank, network=self, factor=factor,
+                decompose_both=decompose_both
+            )
+            with torch.no_grad():
+                # the default init zeros part of the delta
+                for param in lokr.parameters():
+                    param.normal_(std=0.1)
+            lokr.apply_to()
+            self.unet_loras.append(lokr)
+        self.loras = nn.ModuleList(self.unet_loras)
+        self._update_torch_multiplier()
+        self.is_active = True
+
+
+CONFIGS = [
+    # in, out, rank, factor, decompose_both
+    (64, 48, 4, -1, False),
+    (128, 128, 4, 4, False),
+    (128, 96, 64, 8, False),
+    (256, 128, 4, 16, True),
+]
+
+
+def test_kron_forward_matches_materialized():
+    for in_dim, out_dim, rank, factor, decompose_both in CONFIGS:
+        torch.manual_seed(0)
+        layer = nn.Linear(in_dim, out_dim)
+        network = TinyNetwork([layer], rank=rank, factor=factor, decompose_both=decompose_both)
+        network.multiplier = 0.7
+        lokr = network.unet_loras[0]
+
+        x = torch.randn(2, 5, in_dim, requires_grad=True)
+        kron_out = lokr._call_forward(x)
+        kron_grads = torch.autograd.grad(kron_out.square().sum(), [x] + list(lokr.parameters()))
+
+        materialized_out = lokr._materialized_forward(x)
+        materialized_grads = torch.autograd.grad(
+            materialized_out.square().sum(), [x] + list(lokr.parameters())
+        )
+
+        assert torch.allclose(kron_out, materialized_out, atol=1e-4), \
+            (in_dim, out_dim, (kron_out - materialized_out).abs().max())
+        for kron_grad, materialized_grad in zip(kron_grads, materialized_grads):
+            assert torch.allclose(kron_grad, materialized_grad, atol=1e-3, rtol=1e-4), \
+                (in_dim, out_dim, (kron_grad - materialized_grad).abs().max())
+
+
+def test_merge_still_uses_full_weight():
+    torch.manual_seed(0)
+    layer = nn.Linear(64, 48)
+    network = TinyNetwork([layer])
+    lokr = network.unet_loras[0]
+    x = torch.randn(3, 64)
+    with torch.no_grad():
+        expected = lokr._call_forward(x)
+        network.merge_in(1.0)
+        merged = layer(x)
+    assert torch.allclose(expected, merged, atol=1e-4)
+
+
+def benchmark(tokens=1024, steps=10):
+    for dim, factor in [(1024, 8), (3072, 16), (3072, -1)]:
+        torch.manual_seed(0)
+        layer = nn.Linear(dim, dim)
+        network = TinyNetwork([layer], rank=16, factor=factor)
+        lokr = network.unet_loras[0]
+        x = torch.randn(1, tokens, dim)
+
+        results = {}
+        for name, forward in [('materialized', lokr._materialized_forward), ('kron', lokr._call_forward)]:
+            with torch.no_grad():
+                forward(x)
+                start = time.perf_counter()
+                for _ in range(steps):
+                    forward(x)
+            results[name] = (time.perf_counter() - start) / steps
+
+        w1 = lokr.lokr_w1 if lokr.use_w1 else lokr.lokr_w1_a @ lokr.lokr_w1_b
+        # the materialized path builds the kron product and the merged weight every call
+        materialized_bytes = 2 * dim * dim * 4
+        # the kron path only adds intermediates about the size of the activations
+        kron_bytes = tokens * dim * 4
+        print(
+            f"dim {dim} factor {factor} w1 {tuple(w1.shape)}: "
+            f"materialized {results['materialized'] * 1000:.2f} ms, kron {results['kron'] * 1000:.2f} ms, "
+            f"extra memory {materialized_bytes / 1e6:.1f} MB vs {kron_bytes / 1e6:.1f} MB"
+        )
+
+
+if __name__ == '__main__':
+    test_kron_forward_matches_materialized()
+    test_merge_still_uses_full_weight()
+    print("kron forward matches the materialized forward")
+    benchmark()
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRAModule
+from toolkit.network_mixins import ToolkitNetworkMixin
+
+
+class TinyNetwork(ToolkitNetworkMixin, nn.Module):
+    # just enough of a network to hold lora modules around some layers
+    def __init__(self, layers, network_config, rank=16):
+        ToolkitNetworkMixin.__init__(self, network_config=network_config)
+        nn.Module.__init__(self)
+        self.network_type = network_config.type
+        self.unet_loras = []
+        for idx, layer in enumerate(layers):
+            lora = LoRAModule(f"lora_{idx}", layer, lora_dim=rank, alpha=rank / 2, network=self)
+            with torch.no_grad():
+                lora.lora_up.weight.normal_(std=0.02)
+            lora.apply_to()
+            self.unet_loras.append(lora)
+        self.loras = nn.ModuleList(self.unet_loras)
+        self._update_torch_multiplier()
+        self.is_active = True
+
+
+def make_network(fast, dtype=torch.float32, dim=256, num_layers=8, seed=0):
+    torch.manual_seed(seed)
+    layers = [nn.Linear(dim, dim).to(dtype) for _ in range(num_layers)]
+    network = TinyNetwork(layers, NetworkConfig(type='lora', lora_fast_forward=fast))
+    return nn.Sequential(*layers), network
+
+
+def test_fast_forward_matches():
+    for multiplier in [1.0, 0.7]:
+        slow_model, slow_network = make_network(False)
+        fast_model, fast_network = make_network(True)
+        fast_network.load_state_dict(slow_network.state_dict())
+        slow_network.multiplier = multiplier
+        fast_network.multiplier = multiplier
+
+        x = torch.randn(2, 10, 256)
+        slow_out = slow_model(x)
+        fast_out = fast_model(x)
+        assert torch.allclose(slow_out, fast_out, atol=1e-5), (slow_out - fast_out).abs().max()
+
+        # gradients flow into the lora weights the same way
+        slow_out.square().mean().backward()
+        fast_out.square().mean().backward()
+        for slow_lora, fast_lora in zip(slow_network.unet_loras, fast_network.unet_loras):
+            for slow_p, fast_p in zip(slow_lora.parameters(), fast_lora.parameters()):
+                assert torch.allclose(slow_p.grad, fast_p.grad, atol=1e-5)
+
+
+def test_bf16_activations_with_fp32_lora_match():
+    # how training runs, the network is kept in fp32 while the model is bf16
+    models = []
+    for fast in [False, True]:
+        model, network = make_network(fast, dtype=torch.bfloat16)
+        for lora in network.unet_loras:
+            lora.lora_down.float()
+            lora.lora_up.float()
+        models.append((model, network))
+    (slow_model, slow_network), (fast_model, fast_network) = models
+    fast_network.load_state_dict(slow_network.state_dict())
+    assert fast_network.unet_loras[0].lora_up.weight.dtype == torch.float32
+
+    x = torch.randn(2, 10, 256, dtype=torch.bfloat16)
+    slow_out = slow_model(x)
+    fast_out = fast_model(x)
+    assert fast_out.dtype == torch.bfloat16
+    # the lora runs in fp32 on both, only rounding the scaling differently can move a bf16 ulp
+    assert torch.allclose(slow_out.float(), fast_out.float(), rtol=1e-2, atol=1e-2), (slow_out - fast_out).abs().max()
+
+    slow_out.float().square().mean().backward()
+    fast_out.float().square().mean().backward()
+    for slow_lora, fast_lora in zip(slow_network.unet_loras, fast_network.unet_loras):
+        for slow_p, fast_p in zip(slow_lora.parameters(), fast_lora.parameters()):
+            # gradients land in fp32 like the regular forward
+            assert fast_p.grad.dtype == torch.float32
+            assert torch.allclose(slow_p.grad, fast_p.grad, rtol=1e-2, atol=1e-4)
+
+
+def test_per_sample_multiplier_uses_slow_path():
+    model, network = make_network(True, num_layers=1)
+    network.multiplier = [1.0, 0.0]
+    x = torch.randn(2, 3, 256)
+    out = model(x)
+    # the second sample has no lora applied
+    base = torch.nn.functional.linear(x[1], model[0].weight, model[0].bias)
+    assert torch.allclose(out[1], base, atol=1e-6)
+
+
+def time_forward(model, x, steps):
+    with torch.no_grad():
+        for _ in range(3):
+            model(x)
+        start = time.perf_counter()
+        for _ in range(steps):
+            model(x)
+    return (time.perf_counter() - start) / steps
+
+
+def benchmark(dim=1024, num_layers=32, tokens=64, steps=50):
+    x = torch.randn(1, tokens, dim)
+    base_model, _ = make_network(False, dim=dim, num_layers=num_layers)
+    # a model without loras applied for the base cost
+    torch.manual_seed(0)
+    plain = nn.Sequential(*[nn.Linear(dim, dim) for _ in range(num_layers)])
+
+    base_time = time_forward(plain, x, steps)
+    slow_time = time_forward(base_model, x, steps)
+    fast_model, _ = make_network(True, dim=dim, num_layers=num_layers)
+    fast_time = time_forward(fast_model, x, steps)
+
+    print(f"base Linear: {base_time / num_layers * 1e6:.1f} us / layer")
+    print(f"lora forward: {(slow_time - base_time) / num_layers * 1e6:.1f} us / layer overhead")
+    print(f"lora fast forward: {(fast_time - base_time) / num_layers * 1e6:.1f} us / layer overhead")
+
+
+if __name__ == '__main__':
+    test_fast_forward_matches()
+    test_bf16_activations_with_fp32_lora_match()
+    test_per_sample_multiplier_uses_slow_path()
+    print("lora fast forward matches the regular forward")
+    benchmark()
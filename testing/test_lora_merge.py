@@ -0,0 +1,100 @@
+import os
+import sys
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import NetworkConfig
+from toolkit.lora_special import LoRAModule
+from toolkit.network_mixins import ToolkitNetworkMixin
+
+
+class TinyNetwork(ToolkitNetworkMixin, nn.Module):
+    # just enough of a network to hold lora modules around some layers
+    def __init__(self, layers, network_config, rank=4):
+        ToolkitNetworkMixin.__init__(self, network_config=network_config)
+        nn.Module.__init__(self)
+        self.network_type = network_config.type
+        self.unet_loras = []
+        for idx, layer in enumerate(layers):
+            lora = LoRAModule(f"lora_{idx}", layer, lora_dim=rank, alpha=rank / 2, network=self)
+            with torch.no_grad():
+                lora.lora_up.weight.normal_(std=0.1)
+            lora.apply_to()
+            self.unet_loras.append(lora)
+        self.loras = nn.ModuleList(self.unet_loras)
+        self._update_torch_multiplier()
+        self.is_active = True
+
+
+def make_layers(dtype, seed=0):
+    torch.manual_seed(seed)
+    layers = [
+        # same shapes so they get batched together
+        nn.Linear(64, 48),
+        nn.Linear(64, 48),
+        nn.Linear(64, 48),
+        nn.Linear(32, 64),
+        nn.Conv2d(8, 16, 1),
+        nn.Conv2d(8, 16, 3, padding=1),
+    ]
+    return [layer.to(dtype) for layer in layers]
+
+
+def run_round_trip(dtype, merge_residual, merge_weight=0.8):
+    layers = make_layers(dtype)
+    network = TinyNetwork(layers, NetworkConfig(type='lora', merge_residual=merge_residual))
+    originals = [layer.weight.detach().clone() for layer in layers]
+
+    # merged weights should match the unmerged forward
+    x_linear = torch.randn(2, 64, dtype=dtype)
+    network.multiplier = merge_weight
+    expected = layers[0](x_linear).float()
+    network.merge_in(merge_weight)
+    assert network.is_merged_in
+    merged = layers[0](x_linear).float()
+    tolerance = 1e-4 if dtype == torch.float32 else 5e-2
+    assert (merged - expected).abs().max() < tolerance, (merged - expected).abs().max()
+    for layer, original in zip(layers, originals):
+        assert not torch.equal(layer.weight, original)
+
+    network.merge_out(merge_weight)
+    assert not network.is_merged_in
+    errors = [(layer.weight.float() - original.float()).abs().max().item() for layer, original in
+              zip(layers, originals)]
+    return max(errors)
+
+
+def test_merge_round_trip_fp32():
+    assert run_round_trip(torch.float32, merge_residual=False) < 1e-5
+    assert run_round_trip(torch.float32, merge_residual=True) < 1e-6
+
+
+def test_merge_round_trip_bf16():
+    # re subtracting can land a bf16 ulp off, the residual restores the weights exactly
+    assert run_round_trip(torch.bfloat16, merge_residual=False) < 0.02
+    assert run_round_trip(torch.bfloat16, merge_residual=True) == 0.0
+
+
+def test_batched_merge_matches_single():
+    batched_layers = make_layers(torch.float32)
+    single_layers = make_layers(torch.float32)
+    config = NetworkConfig(type='lora')
+    batched = TinyNetwork(batched_layers, config)
+    single = TinyNetwork(single_layers, config)
+    single.load_state_dict(batched.state_dict())
+
+    batched.merge_in(0.5)
+    for module in single.get_all_modules():
+        module.merge_in(0.5)
+    for b, s in zip(batched_layers, single_layers):
+        assert torch.allclose(b.weight, s.weight, atol=1e-6)
+
+
+if __name__ == '__main__':
+    test_merge_round_trip_fp32()
+    test_merge_round_trip_bf16()
+    test_batched_merge_matches_single()
+    print("lora merge round trips within bounds")
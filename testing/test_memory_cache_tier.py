@@ -0,0 +1,157 @@
+import os
+import sys
+import tempfile
+import time
+
+import torch
+from safetensors.torch import load_file, save_file
+from torch.utils.data import DataLoader, Dataset
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.data_loader import KnownOrderSampler, PrefetchingConcatDataset
+from toolkit.memory_cache_tier import MemoryCacheTier, get_memory_cache_tier
+
+BUDGET_MB = 1
+
+
+def slow_load(path):
+    # like a network filesystem
+    time.sleep(0.02)
+    return load_file(path)
+
+
+class DiskCachedDataset(Dataset):
+    # one cache file per index, loaded through the tier
+    def __init__(self, folder, count, use_tier=True):
+        self.use_tier = use_tier
+        self.paths = []
+        for idx in range(count):
+            path = os.path.join(folder, f'{idx}.safetensors')
+            save_file({'latent': torch.full((4, 8, 8), float(idx))}, path)
+            self.paths.append(path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get_memory_cache_items(self, idx):
+        return [(self.paths[idx], slow_load)]
+
+    def __getitem__(self, idx):
+        if not self.use_tier:
+            slow_load(self.paths[idx])
+            return idx, os.getpid(), {}
+        tier = get_memory_cache_tier(BUDGET_MB)
+        latent = tier.get(self.paths[idx], slow_load)['latent']
+        assert latent[0, 0, 0].item() == idx
+        return idx, os.getpid(), dict(tier.stats)
+
+
+def write_tensor(folder, name, num_bytes):
+    path = os.path.join(folder, name)
+    save_file({'latent': torch.zeros(num_bytes // 4, dtype=torch.float32)}, path)
+    return path
+
+
+def test_lru_budget():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [write_tensor(tmp_dir, f'{idx}.safetensors', 400) for idx in range(4)]
+        tier = MemoryCacheTier(budget_bytes=1000)
+        tier.get(paths[0], load_file)
+        tier.get(paths[1], load_file)
+        tier.get(paths[0], load_file)
+        assert tier.stats['hits'] == 1 and tier.stats['misses'] == 2
+        # over budget, the least recently used one goes
+        tier.get(paths[2], load_file)
+        assert tier.size <= 1000
+        assert paths[1] not in tier.entries and paths[0] in tier.entries
+        assert tier.stats['evictions'] == 1
+
+        # too big for the budget, loaded but never kept
+        big = write_tensor(tmp_dir, 'big.safetensors', 2000)
+        assert tier.get(big, load_file)['latent'].numel() == 500
+        assert big not in tier.entries
+
+        tier.prefetch([(paths[3], load_file)])
+        tier.get(paths[3], load_file)
+        assert tier.stats['prefetched'] == 1
+        assert tier.stats['misses'] == 4
+
+
+def test_failed_prefetch_is_read_again():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = write_tensor(tmp_dir, 'latent.safetensors', 400)
+        calls = []
+        failures_left = [1]
+
+        def flaky_load(key):
+            # fails at first, like a file read while it was still being written
+            calls.append(key)
+            time.sleep(0.05)
+            if failures_left[0] > 0:
+                failures_left[0] -= 1
+                raise OSError("half written")
+            return load_file(key)
+
+        tier = MemoryCacheTier(budget_bytes=1000)
+        tier.prefetch([(path, flaky_load)])
+        future = tier.pending[path]
+        assert isinstance(future.exception(), OSError)
+        deadline = time.time() + 2
+        while path in tier.pending and time.time() < deadline:
+            time.sleep(0.01)
+        assert path not in tier.pending
+        assert tier.get(path, flaky_load)['latent'].numel() == 100
+        assert len(calls) == 2 and path in tier.entries
+
+        # a get waiting on the failed prefetch loads it itself
+        tier = MemoryCacheTier(budget_bytes=1000)
+        calls.clear()
+        tier.pending[path] = future
+        assert tier.get(path, flaky_load)['latent'].numel() == 100
+        assert len(calls) == 1
+
+
+def test_prefetch_follows_sampler_order():
+    num_workers = 2
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset = PrefetchingConcatDataset([DiskCachedDataset(tmp_dir, 24)], BUDGET_MB)
+        loader = DataLoader(
+            dataset,
+            batch_size=None,
+            sampler=KnownOrderSampler(dataset),
+            num_workers=num_workers,
+        )
+        for epoch in range(2):
+            seen = []
+            last_stats = {}
+            for idx, pid, stats in loader:
+                seen.append(idx)
+                last_stats[pid] = stats
+            assert sorted(seen) == list(range(24))
+            # only the first item of each worker was not prefetched
+            assert sum(stats['misses'] for stats in last_stats.values()) == num_workers
+            assert sum(stats['hits'] for stats in last_stats.values()) == 24 - num_workers
+
+
+def benchmark():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, dataset in [
+            ('disk', DiskCachedDataset(tmp_dir, 64, use_tier=False)),
+            ('memory tier', PrefetchingConcatDataset([DiskCachedDataset(tmp_dir, 64)], BUDGET_MB)),
+        ]:
+            kwargs = {'sampler': KnownOrderSampler(dataset)} if name != 'disk' else {'shuffle': True}
+            loader = DataLoader(dataset, batch_size=None, num_workers=2, **kwargs)
+            start = time.time()
+            for _ in loader:
+                # a training step
+                time.sleep(0.02)
+            print(f"{name}: {time.time() - start:.2f}s for 64 items")
+
+
+if __name__ == '__main__':
+    test_lru_budget()
+    test_failed_prefetch_is_read_again()
+    test_prefetch_follows_sampler_order()
+    print("memory cache tier works")
+    benchmark()
@@ -0,0 +1,185 @@
+import copy
+import os
+import sys
+import tempfile
+
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.optimizers.adafactor import Adafactor
+from toolkit.optimizers.adam8bit import Adam8bit
+from toolkit.optimizers.automagic import Automagic
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor
+from toolkit.optimizers.prodigy_8bit import Prodigy8bit
+from toolkit.optimizers.state_offload import OffloadedOptimizer
+
+OPTIMIZERS = {
+    'adam8bit': lambda groups: Adam8bit(groups, lr=1e-3),
+    'adafactor': lambda groups: Adafactor(groups, lr=None),
+    'automagic': lambda groups: Automagic(groups, lr=1e-6),
+    'prodigy8bit': lambda groups: Prodigy8bit(groups, lr=1.0),
+}
+
+
+def make_model(seed=0):
+    torch.manual_seed(seed)
+    return nn.Sequential(nn.Linear(16, 32), nn.GELU(), nn.Linear(32, 8))
+
+
+def param_groups(model):
+    # two groups so the per group streaming gets exercised
+    return [
+        {'params': list(model[0].parameters())},
+        {'params': list(model[2].parameters())},
+    ]
+
+
+def train(model, optimizer, steps, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    for _ in range(steps):
+        x = torch.randn(8, 16, generator=generator)
+        y = torch.randn(8, 8, generator=generator)
+        loss = nn.functional.mse_loss(model(x), y)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+
+def state_tensors(optimizer):
+    tensors = []
+    for group in optimizer.param_groups:
+        for p in group['params']:
+            for key, value in sorted(optimizer.state[p].items()):
+                if isinstance(value, Auto8bitTensor):
+                    value = value.dequantize()
+                if torch.is_tensor(value):
+                    tensors.append((key, value))
+    return tensors
+
+
+def run_offload(name, update_device, mmap_dir=None, steps=4):
+    model = make_model()
+    offloaded_model = copy.deepcopy(model)
+    optimizer = OPTIMIZERS[name](param_groups(model))
+    offloaded = OffloadedOptimizer(
+        OPTIMIZERS[name](param_groups(offloaded_model)),
+        update_device=update_device,
+        mmap_dir=mmap_dir,
+    )
+
+    train(model, optimizer, steps)
+    train(offloaded_model, offloaded, steps)
+
+    for p, o in zip(model.parameters(), offloaded_model.parameters()):
+        assert torch.allclose(p, o, atol=1e-6), (name, update_device, (p - o).abs().max())
+    expected = state_tensors(optimizer)
+    actual = state_tensors(offloaded)
+    assert len(expected) == len(actual) > 0
+    for (key, e), (_, a) in zip(expected, actual):
+        assert a.device.type == 'cpu', key
+        assert torch.allclose(e.cpu(), a, atol=1e-6), (name, key)
+
+
+def test_offload_matches_unwrapped():
+    for name in OPTIMIZERS:
+        for update_device in ['device', 'cpu']:
+            run_offload(name, update_device)
+
+
+def test_offload_mmap():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        run_offload('adam8bit', 'device', mmap_dir=tmp_dir)
+        run_offload('adafactor', 'cpu', mmap_dir=tmp_dir)
+        assert len(os.listdir(tmp_dir)) > 0
+
+
+def test_offload_state_dict_round_trip():
+    model = make_model()
+    offloaded = OffloadedOptimizer(Adam8bit(param_groups(model), lr=1e-3))
+    train(model, offloaded, 2)
+    state_dict = offloaded.state_dict()
+
+    resumed_model = copy.deepcopy(model)
+    resumed = OffloadedOptimizer(Adam8bit(param_groups(resumed_model), lr=1e-3))
+    resumed.load_state_dict(state_dict)
+    train(model, offloaded, 2, seed=2)
+    train(resumed_model, resumed, 2, seed=2)
+    for p, r in zip(model.parameters(), resumed_model.parameters()):
+        assert torch.allclose(p, r), (p - r).abs().max()
+
+
+class RecordingAdam8bit(Adam8bit):
+    # records how much state the params of each step call hold
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.step_state_bytes = []
+
+    def step(self, *args, **kwargs):
+        loss = super().step(*args, **kwargs)
+        num_bytes = 0
+        for group in self.param_groups:
+            for p in group['params']:
+                for value in self.state[p].values():
+                    if isinstance(value, Auto8bitTensor):
+                        value = value.quantized
+                    if torch.is_tensor(value):
+                        num_bytes += value.numel() * value.element_size()
+        self.step_state_bytes.append(num_bytes)
+        return loss
+
+
+def test_offload_chunks_within_a_group():
+    # one group, like a lora, still only streams in a chunk of the state at a time
+    torch.manual_seed(0)
+    model = nn.Sequential(*[nn.Linear(32, 32) for _ in range(8)])
+    offloaded_model = copy.deepcopy(model)
+    optimizer = Adam8bit(model.parameters(), lr=1e-3)
+    chunk_mb = 0.01
+    recording = RecordingAdam8bit(offloaded_model.parameters(), lr=1e-3)
+    offloaded = OffloadedOptimizer(recording, chunk_mb=chunk_mb)
+    generator = torch.Generator().manual_seed(1)
+    for step in range(3):
+        if step == 2:
+            # the state exists now, so the chunks are sized from it
+            recording.step_state_bytes = []
+        x = torch.randn(4, 32, generator=generator)
+        for m, o in [(model, optimizer), (offloaded_model, offloaded)]:
+            loss = m(x).square().mean()
+            o.zero_grad()
+            loss.backward()
+            o.step()
+
+    for p, o in zip(model.parameters(), offloaded_model.parameters()):
+        assert torch.allclose(p, o, atol=1e-6), (p - o).abs().max()
+    # each step call saw at most a chunk of the state, or a single param bigger than one
+    largest_param = max(offloaded._state_bytes(p) for p in offloaded_model.parameters())
+    total = sum(offloaded._state_bytes(p) for p in offloaded_model.parameters())
+    assert len(recording.step_state_bytes) > 1
+    for num_bytes in recording.step_state_bytes:
+        assert num_bytes <= max(chunk_mb * 1024 * 1024, largest_param), num_bytes
+    assert max(recording.step_state_bytes) < total
+    # the single group is whole again, with its hyperparameters
+    assert len(recording.param_groups) == 1
+    assert len(recording.param_groups[0]['params']) == 16
+    assert recording.param_groups[0]['lr'] == 1e-3
+
+
+def test_offload_lr_scheduler():
+    # schedulers need to see it as an optimizer and update the wrapped groups
+    model = make_model()
+    offloaded = OffloadedOptimizer(Adam8bit(param_groups(model), lr=1e-3))
+    scheduler = torch.optim.lr_scheduler.LambdaLR(offloaded, lambda step: 0.5)
+    assert offloaded.optimizer.param_groups[0]['lr'] == 5e-4
+    train(model, offloaded, 1)
+    scheduler.step()
+
+
+if __name__ == '__main__':
+    test_offload_matches_unwrapped()
+    test_offload_mmap()
+    test_offload_state_dict_round_trip()
+    test_offload_lr_scheduler()
+    test_offload_chunks_within_a_group()
+    print("offloaded optimizers match the unwrapped ones")
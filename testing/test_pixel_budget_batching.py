@@ -0,0 +1,123 @@
+import os
+import random
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.buckets import get_bucket_batch_size, simulate_bucket_batches
+from toolkit.config_modules import DatasetConfig
+from toolkit.dataloader_mixins import Bucket, BucketsMixin
+
+
+class FakeDataset(BucketsMixin):
+    # just the parts of the dataset the batch building uses
+    def __init__(self, dataset_config, batch_size, bucket_files):
+        super().__init__()
+        self.dataset_config = dataset_config
+        self.batch_size = batch_size
+        idx = 0
+        for (width, height), count in bucket_files.items():
+            bucket = Bucket(width, height)
+            bucket.file_list_idx = list(range(idx, idx + count))
+            idx += count
+            self.buckets[f'{width}x{height}'] = bucket
+
+
+def test_bucket_batch_size():
+    budget = 1024 * 1024
+    assert get_bucket_batch_size(1024, 1024, budget) == 1
+    assert get_bucket_batch_size(512, 512, budget) == 4
+    assert get_bucket_batch_size(256, 256, budget, max_batch_size=8) == 8
+    # never zero, even when a single sample is over the budget
+    assert get_bucket_batch_size(1024, 1024, budget, num_frames=33) == 1
+    assert get_bucket_batch_size(256, 256, budget, num_frames=4) == 4
+
+
+def test_build_batch_indices():
+    bucket_files = {(1024, 1024): 3, (512, 512): 10, (256, 256): 40}
+    fixed = FakeDataset(DatasetConfig(folder_path='/tmp'), 2, bucket_files)
+    fixed.build_batch_indices()
+    assert all(len(batch) <= 2 for batch in fixed.batch_indices)
+
+    config = DatasetConfig(folder_path='/tmp', pixel_budget=1024 * 1024, pixel_budget_max_batch_size=12)
+    dataset = FakeDataset(config, 1, bucket_files)
+    dataset.build_batch_indices()
+    sizes = {}
+    for batch in dataset.batch_indices:
+        bucket = [key for key, b in dataset.buckets.items() if batch[0] in b.file_list_idx][0]
+        # every batch stays in one bucket
+        assert all(idx in dataset.buckets[bucket].file_list_idx for idx in batch)
+        sizes.setdefault(bucket, []).append(len(batch))
+    assert max(sizes['1024x1024']) == 1
+    assert max(sizes['512x512']) == 4
+    assert max(sizes['256x256']) == 12
+    # every file is still used once
+    all_idx = sorted(idx for batch in dataset.batch_indices for idx in batch)
+    assert all_idx == list(range(53))
+    assert len(dataset.batch_indices) < len(fixed.batch_indices)
+
+
+def test_loss_weighting_matches_fixed_batch():
+    # with the loss multiplier at bucket batch size / batch_size, the mean loss of a bucket batch
+    # weighs each sample 1 / batch_size, the same as a fixed batch does
+    batch_size = 2
+    losses = [random.random() for _ in range(8)]
+    fixed = sum(sum(losses[i:i + batch_size]) / batch_size for i in range(0, 8, batch_size))
+    budget_batch = len(losses)
+    weighted = sum(loss * budget_batch / batch_size for loss in losses) / budget_batch
+    assert abs(fixed - weighted) < 1e-9
+
+
+def test_simulation_report():
+    sizes = [(1024, 1024)] * 4 + [(512, 512)] * 16 + [(768, 512)] * 6
+    report = simulate_bucket_batches(sizes, resolution=1024, pixel_budget=1024 * 1024, bytes_per_pixel=1024)
+    by_size = {(r['width'], r['height']): r for r in report}
+    assert by_size[(512, 512)]['batch_size'] == 4
+    assert by_size[(512, 512)]['steps'] == 4
+    assert by_size[(1024, 1024)]['samples_per_step'] == 1
+    # no step goes over the budget
+    assert all(r['pixels_per_step'] <= 1024 * 1024 for r in report)
+    assert sum(r['files'] for r in report) == len(sizes)
+
+
+def print_report(report):
+    total_files = sum(r['files'] for r in report)
+    total_steps = sum(r['steps'] for r in report)
+    for r in report:
+        print(
+            f"{r['width']}x{r['height']}: {r['files']} files, batch {r['batch_size']}, {r['steps']} steps, "
+            f"{r['samples_per_step']:.2f} samples / step, {r['pixels_per_step'] / 1e6:.2f} MP / step, "
+            f"~{r['memory_gb']:.2f} GB"
+        )
+    print(f"{total_files} files in {total_steps} steps, {total_files / total_steps:.2f} samples / step")
+
+
+def simulate(folder=None, resolution=1024, pixel_budget=1024 * 1024, batch_size=1, bytes_per_pixel=8 * 1024):
+    # pass a dataset folder to simulate it, otherwise a mixed resolution dataset is made up
+    if folder is not None:
+        from PIL import Image
+        sizes = []
+        for root, _, files in os.walk(folder):
+            for file in files:
+                if file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
+                    with Image.open(os.path.join(root, file)) as img:
+                        sizes.append(img.size)
+    else:
+        rng = random.Random(0)
+        sizes = [rng.choice([(512, 512), (768, 768), (1024, 1024), (1216, 832), (640, 960)]) for _ in range(500)]
+
+    for name, budget in [('fixed batch', None), ('pixel budget', pixel_budget)]:
+        print(f"{name}:")
+        print_report(simulate_bucket_batches(
+            sizes, resolution=resolution, pixel_budget=budget, batch_size=batch_size,
+            bytes_per_pixel=bytes_per_pixel
+        ))
+
+
+if __name__ == '__main__':
+    test_bucket_batch_size()
+    test_build_batch_indices()
+    test_loss_weighting_matches_fixed_batch()
+    test_simulation_report()
+    print("pixel budget batching works")
+    simulate(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,219 @@
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+from toolkit.dataloader_mixins import ResizedImageCachingMixin
+from toolkit.cache_root import STALE_TMP_SECONDS
+from toolkit.resized_image_cache import ResizedImagePack, get_resized_image_pack
+
+TRANSFORM = transforms.Compose([transforms.ToTensor()])
+
+
+def write_images(folder, count=4, size=(600, 400)):
+    rng = np.random.default_rng(0)
+    paths = []
+    for idx in range(count):
+        path = os.path.join(folder, f'img_{idx}.jpg')
+        pixels = rng.integers(0, 256, size=(size[1], size[0], 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+class FakeDataset(ResizedImageCachingMixin):
+    # just the parts of the dataset the resized image cache uses
+    def __init__(self, dataset_config, paths, flip_x=False):
+        super().__init__()
+        self.dataset_config = dataset_config
+        self.dataset_path = dataset_config.folder_path
+        self.file_list = []
+        for path in paths:
+            file_item = FileItemDTO(path=path, dataset_config=dataset_config)
+            # what the bucketing would pick for a 600x400 image at resolution 256
+            file_item.scale_to_width, file_item.scale_to_height = 312, 208
+            file_item.crop_x, file_item.crop_y = 28, 0
+            file_item.crop_width, file_item.crop_height = 256, 208
+            file_item.flip_x = flip_x
+            self.file_list.append(file_item)
+
+
+def make_config(folder, **kwargs):
+    return DatasetConfig(folder_path=folder, resolution=256, buckets=True, cache_resized_images=True, **kwargs)
+
+
+def load_tensors(dataset):
+    tensors = []
+    for file_item in dataset.file_list:
+        file_item.load_and_process_image(TRANSFORM)
+        tensors.append(file_item.tensor)
+    return tensors
+
+
+def test_cached_matches_decoded():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_images(tmp_dir)
+        config = make_config(tmp_dir)
+        for flip_x in [False, True]:
+            decoded = load_tensors(FakeDataset(config, paths, flip_x=flip_x))
+            dataset = FakeDataset(config, paths, flip_x=flip_x)
+            dataset.cache_resized_images()
+            cached = load_tensors(dataset)
+            for a, b in zip(decoded, cached):
+                assert a.shape == (3, 208, 256)
+                assert torch.equal(a, b)
+        # one entry per image per flip
+        assert len(get_resized_image_pack(dataset.resized_image_cache_dir)) == len(paths) * 2
+
+
+def test_cache_hits_across_runs():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_images(tmp_dir)
+        config = make_config(tmp_dir)
+        FakeDataset(config, paths).cache_resized_images()
+        cache_dir = os.path.join(tmp_dir, '_resized_image_cache')
+        data_size = os.path.getsize(os.path.join(cache_dir, 'images.bin'))
+        # a new process would start from the index on disk
+        assert len(ResizedImagePack(cache_dir)) == len(paths)
+        FakeDataset(config, paths).cache_resized_images()
+        assert os.path.getsize(os.path.join(cache_dir, 'images.bin')) == data_size
+
+        # a changed bucket misses and falls back to decoding
+        dataset = FakeDataset(config, paths)
+        dataset.cache_resized_images()
+        file_item = dataset.file_list[0]
+        file_item.scale_to_width, file_item.scale_to_height = 384, 256
+        assert file_item.get_cached_resized_image() is None
+        file_item.load_and_process_image(TRANSFORM)
+        assert file_item.tensor.shape == (3, 208, 256)
+
+
+def test_pack_round_trip_and_truncation():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rng = np.random.default_rng(0)
+        images = {f'key_{idx}': rng.integers(0, 256, size=(8 + idx, 12, 3), dtype=np.uint8) for idx in range(3)}
+        pack = ResizedImagePack(tmp_dir)
+        pack.add_many(list(images.items())[:2])
+        pack.add_many(list(images.items())[2:])
+        reloaded = ResizedImagePack(tmp_dir)
+        for key, image in images.items():
+            assert np.array_equal(reloaded.get(key), image)
+        assert reloaded.get('missing') is None
+
+        # a data file cut short drops only the entries past the end
+        data_path = os.path.join(tmp_dir, 'images.bin')
+        with open(data_path, 'r+b') as f:
+            f.truncate(os.path.getsize(data_path) - 1)
+        truncated = ResizedImagePack(tmp_dir)
+        assert 'key_0' in truncated and 'key_1' in truncated
+        assert 'key_2' not in truncated
+
+        try:
+            pack.add_many([('bad', np.zeros((4, 4), dtype=np.uint8))])
+            assert False, "expected a ValueError"
+        except ValueError:
+            pass
+
+
+def test_packs_opened_before_another_process_added():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rng = np.random.default_rng(0)
+        images = {f'key_{idx}': rng.integers(0, 256, size=(8, 12, 3), dtype=np.uint8) for idx in range(4)}
+        items = list(images.items())
+        # both loaded the empty pack, like two ranks
+        first = ResizedImagePack(tmp_dir)
+        second = ResizedImagePack(tmp_dir)
+        first.add_many(items[:2])
+        second.add_many(items[2:])
+        reloaded = ResizedImagePack(tmp_dir)
+        assert len(reloaded) == len(images)
+        for key, image in images.items():
+            assert np.array_equal(reloaded.get(key), image)
+        # the index temp files are gone
+        assert sorted(os.listdir(tmp_dir)) == ['images.bin', 'index.json']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, 'images.bin')
+        # data without an index, just written by a process that has not saved its index yet
+        with open(data_path, 'wb') as f:
+            f.write(b'0' * 100)
+        ResizedImagePack(tmp_dir).add_many(items[:1])
+        assert os.path.getsize(data_path) == 100 + 8 * 12 * 3
+        assert np.array_equal(ResizedImagePack(tmp_dir).get('key_0'), images['key_0'])
+
+        # left over from long ago, with an index from another version
+        with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+            f.write('{}')
+        old = time.time() - STALE_TMP_SECONDS - 60
+        os.utime(data_path, (old, old))
+        ResizedImagePack(tmp_dir).add_many(items[1:2])
+        assert os.path.getsize(data_path) == 8 * 12 * 3
+        assert np.array_equal(ResizedImagePack(tmp_dir).get('key_1'), images['key_1'])
+
+
+def test_compaction_survives_a_crash():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rng = np.random.default_rng(0)
+        images = {f'key_{idx}': rng.integers(0, 256, size=(8, 12, 3), dtype=np.uint8) for idx in range(4)}
+        ResizedImagePack(tmp_dir).add_many(list(images.items()))
+        keep_keys = {'key_1', 'key_3'}
+
+        # dies after writing the new data, before the index points at it
+        pack = ResizedImagePack(tmp_dir)
+
+        def crash():
+            raise KeyboardInterrupt()
+
+        pack._save_index = crash
+        try:
+            pack.compact(keep_keys)
+            assert False, "expected the crash"
+        except KeyboardInterrupt:
+            pass
+        reloaded = ResizedImagePack(tmp_dir)
+        assert len(reloaded) == len(images)
+        for key, image in images.items():
+            assert np.array_equal(reloaded.get(key), image)
+
+        # and once more without dying, twice
+        for _ in range(2):
+            reloaded.compact(keep_keys)
+        compacted = ResizedImagePack(tmp_dir)
+        assert compacted.data_path == reloaded.data_path
+        assert sorted(compacted.index.keys()) == sorted(keep_keys)
+        for key in keep_keys:
+            assert np.array_equal(compacted.get(key), images[key])
+        assert sorted(os.listdir(tmp_dir)) == ['images.2.bin', 'index.json']
+
+
+def benchmark(count=64, size=(2048, 1536)):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_images(tmp_dir, count=count, size=size)
+        config = make_config(tmp_dir)
+        for name, use_cache in [('decode and resize', False), ('resized image cache', True)]:
+            dataset = FakeDataset(config, paths)
+            if use_cache:
+                dataset.cache_resized_images()
+            start = time.perf_counter()
+            load_tensors(dataset)
+            elapsed = time.perf_counter() - start
+            print(f"{name}: {count / elapsed:.1f} images / s per worker")
+
+
+if __name__ == '__main__':
+    test_cached_matches_decoded()
+    test_cache_hits_across_runs()
+    test_pack_round_trip_and_truncation()
+    test_packs_opened_before_another_process_added()
+    test_compaction_survives_a_crash()
+    print("resized image cache matches decoding")
+    benchmark()
@@ -0,0 +1,89 @@
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.cache_inspection import CacheKeyModel
+from toolkit.config_modules import DatasetConfig, ModelConfig
+from toolkit.data_loader import get_dataloader_from_datasets, get_dataloader_state, track_dataloader_position, \
+    trigger_dataloader_setup_epoch
+
+MODEL = CacheKeyModel(ModelConfig(name_or_path='not/loaded', arch='sdxl'), 16)
+BATCH_SIZE = 2
+NUM_BATCHES = 20
+
+
+def write_dataset(folder):
+    # two sizes so there are two buckets
+    rng = np.random.default_rng(0)
+    for idx in range(9):
+        height = 64 if idx % 3 else 96
+        pixels = rng.integers(0, 256, size=(height, 64, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, f'img_{idx}.png'))
+
+
+def make_dataloader(folder, state=None, **kwargs):
+    config = DatasetConfig(folder_path=folder, resolution=64, num_workers=0, random_crop=True, **kwargs)
+    return get_dataloader_from_datasets([config], batch_size=BATCH_SIZE, sd=MODEL, state=state)
+
+
+def take_batches(dataloader, num_batches):
+    # what the train loop does, starting a new epoch when one runs out
+    batches = []
+    iterator = track_dataloader_position(dataloader, iter(dataloader))
+    while len(batches) < num_batches:
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            trigger_dataloader_setup_epoch(dataloader)
+            iterator = track_dataloader_position(dataloader, iter(dataloader))
+            continue
+        batches.append([(os.path.basename(x.path), x.crop_x, x.crop_y) for x in batch.file_items])
+    return batches
+
+
+def test_resume_matches_uninterrupted_run():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        for buckets in [True, False]:
+            uninterrupted = take_batches(make_dataloader(tmp_dir, buckets=buckets), NUM_BATCHES)
+            # stop mid epoch, in the first one and a later one
+            for stop_at in [3, 11]:
+                dataloader = make_dataloader(tmp_dir, buckets=buckets)
+                before = take_batches(dataloader, stop_at)
+                # through json, like the checkpoint metadata
+                state = json.loads(json.dumps(get_dataloader_state(dataloader)))
+                resumed = make_dataloader(tmp_dir, state=state, buckets=buckets)
+                after = take_batches(resumed, NUM_BATCHES - stop_at)
+                assert before + after == uninterrupted, f"buckets={buckets} stop_at={stop_at}"
+
+
+def test_new_seed_for_a_new_run():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        runs = [take_batches(make_dataloader(tmp_dir), NUM_BATCHES) for _ in range(3)]
+        assert runs[0] != runs[1] or runs[0] != runs[2]
+
+
+def test_changed_dataset_starts_epoch_over():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir)
+        dataloader = make_dataloader(tmp_dir, buckets=False)
+        take_batches(dataloader, 2)
+        state = get_dataloader_state(dataloader)
+        Image.new('RGB', (64, 64)).save(os.path.join(tmp_dir, 'img_new.png'))
+        resumed = make_dataloader(tmp_dir, state=state, buckets=False)
+        # a whole epoch of the 10 images
+        assert len(list(resumed)) == 5
+
+
+if __name__ == '__main__':
+    test_resume_matches_uninterrupted_run()
+    test_new_seed_for_a_new_run()
+    test_changed_dataset_starts_epoch_over()
+    print("resumable dataloader works")
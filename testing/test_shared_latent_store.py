@@ -0,0 +1,252 @@
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import uuid
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from safetensors.torch import load_file, save_file
+from torchvision import transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+from toolkit.dataloader_mixins import LatentCachingMixin
+from toolkit.shared_tensor_store import SharedTensorStore, get_shared_memory_dir, get_shared_tensor_store
+
+
+def temp_store_path():
+    return os.path.join(get_shared_memory_dir(), f'aitk_test_{uuid.uuid4().hex}')
+
+
+class TinySD:
+    # stands in for a model, a patchify instead of a real vae
+    def __init__(self):
+        self.vae = nn.Conv2d(3, 4, kernel_size=8, stride=8)
+        self.model_config = SimpleNamespace(latent_space_version='tiny', arch='tiny')
+        self.torch_dtype = torch.float32
+        self.device = 'cpu'
+        self.device_torch = torch.device('cpu')
+        self.num_encoded = 0
+
+    def set_device_state_preset(self, preset):
+        pass
+
+    def restore_device_state(self):
+        pass
+
+    @torch.no_grad()
+    def encode_images(self, imgs):
+        self.num_encoded += imgs.shape[0]
+        return self.vae(imgs)
+
+
+class TinyDataset(LatentCachingMixin):
+    def __init__(self, dataset_config, paths, sd):
+        super().__init__()
+        self.dataset_config = dataset_config
+        self.dataset_path = dataset_config.folder_path
+        self.sd = sd
+        self.is_video = False
+        self.is_caching_latents_to_disk = False
+        self.is_caching_latents_to_memory = True
+        self.transform = transforms.Compose([transforms.ToTensor()])
+        self.file_list = [FileItemDTO(path=path, dataset_config=dataset_config) for path in paths]
+
+
+def write_images(folder, count=4):
+    rng = np.random.default_rng(0)
+    paths = []
+    for idx in range(count):
+        path = os.path.join(folder, f'img_{idx}.png')
+        Image.fromarray(rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_store_round_trip():
+    tensors = OrderedDict([
+        ('a', torch.randn(4, 7, 5)),
+        ('b', torch.randn(3, 9).to(torch.bfloat16)),
+        ('c', torch.randn(11).to(torch.float16)),
+        ('d', torch.arange(6, dtype=torch.int64).reshape(2, 3)),
+    ])
+    store = SharedTensorStore(temp_store_path())
+    try:
+        store.write(tensors, remove_at_exit=False)
+        attached = SharedTensorStore(store.path)
+        for key, tensor in tensors.items():
+            loaded = attached.get(key)
+            assert loaded.dtype == tensor.dtype
+            assert torch.equal(loaded, tensor)
+        assert attached.get('missing') is None
+
+        # writes stay in the process that made them
+        attached.get('a').zero_()
+        assert torch.equal(SharedTensorStore(store.path).get('a'), tensors['a'])
+    finally:
+        store.remove()
+    assert len(SharedTensorStore(store.path)) == 0
+
+
+def set_owner_pid(store, pid):
+    with open(store.index_path, 'r') as f:
+        index = json.load(f)
+    index['pid'] = pid
+    with open(store.index_path, 'w') as f:
+        json.dump(index, f)
+
+
+def test_store_of_a_dead_builder_is_stale():
+    store = SharedTensorStore(temp_store_path())
+    try:
+        store.write(OrderedDict([('a', torch.randn(4, 5))]), remove_at_exit=False)
+        # a builder that is still running, eg another job on this node
+        set_owner_pid(store, os.getppid())
+        assert 'a' in SharedTensorStore(store.path)
+
+        # one that was killed without removing it
+        proc = multiprocessing.get_context('spawn').Process(target=os.getpid)
+        proc.start()
+        proc.join()
+        set_owner_pid(store, proc.pid)
+        assert len(SharedTensorStore(store.path)) == 0
+
+        # building it again makes this process the owner
+        store.write(OrderedDict([('a', torch.randn(4, 5))]), remove_at_exit=False)
+        assert 'a' in SharedTensorStore(store.path)
+    finally:
+        store.remove()
+
+
+def test_dataset_builds_and_attaches():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = write_images(tmp_dir)
+        config = DatasetConfig(folder_path=tmp_dir, resolution=64, cache_latents=True)
+        private = TinyDataset(config, paths, TinySD())
+        private.cache_latents_all_latents()
+        expected = [file_item.get_latent().clone() for file_item in private.file_list]
+
+        shared_config = DatasetConfig(folder_path=tmp_dir, resolution=64, cache_latents=True, shared_latent_cache=True)
+        sd = TinySD()
+        sd.vae.load_state_dict(private.sd.vae.state_dict())
+        dataset = TinyDataset(shared_config, paths, sd)
+        dataset.cache_latents_all_latents()
+        store_path = dataset.file_list[0].shared_latent_store_path
+        try:
+            assert store_path is not None and os.path.exists(store_path)
+            assert sd.num_encoded == len(paths)
+            for file_item, latent in zip(dataset.file_list, expected):
+                assert file_item._encoded_latent is None
+                assert torch.allclose(file_item.get_latent(), latent)
+
+            # another rank attaches without encoding anything
+            other_sd = TinySD()
+            other = TinyDataset(shared_config, paths, other_sd)
+            other.cache_latents_all_latents()
+            assert other_sd.num_encoded == 0
+            for file_item, latent in zip(other.file_list, expected):
+                assert file_item.shared_latent_store_path == store_path
+                assert torch.allclose(file_item.get_latent(), latent)
+        finally:
+            get_shared_tensor_store(store_path).remove()
+
+
+def read_memory():
+    # kB from /proc, Rss counts shared pages in full, Pss splits them between the processes mapping them
+    memory = {}
+    with open('/proc/self/smaps_rollup', 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+                memory[parts[0][:-1]] = int(parts[1])
+    memory['Private'] = memory.get('Private_Clean', 0) + memory.get('Private_Dirty', 0)
+    return memory
+
+
+def worker(mode, source, keys, barrier, queue):
+    before = read_memory()
+    if mode == 'private':
+        # the current behaviour, every process holds its own copy
+        latents = [load_file(path)['latent'] for path in source]
+    else:
+        store = SharedTensorStore(source)
+        latents = [store.get(key) for key in keys]
+    # touch everything, like an epoch over the dataset
+    total = sum(float(latent.sum()) for latent in latents)
+    # measure once every worker has mapped, so shared pages are split between all of them
+    barrier.wait()
+    after = read_memory()
+    queue.put({key: after[key] - before.get(key, 0) for key in ['Rss', 'Pss', 'Private']})
+    barrier.wait()
+
+
+def measure_memory(num_workers=4, num_latents=64, shape=(16, 128, 128)):
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        tensors = OrderedDict()
+        for idx in range(num_latents):
+            latent = torch.randn(*shape)
+            path = os.path.join(tmp_dir, f'latent_{idx}.safetensors')
+            save_file({'latent': latent}, path)
+            paths.append(path)
+            tensors[path] = latent
+        store = SharedTensorStore(temp_store_path())
+        store.write(tensors, remove_at_exit=False)
+        del tensors
+        try:
+            for mode, source in [('private', paths), ('shared', store.path)]:
+                barrier = ctx.Barrier(num_workers)
+                queue = ctx.Queue()
+                procs = [ctx.Process(target=worker, args=(mode, source, paths, barrier, queue)) for _ in range(num_workers)]
+                for proc in procs:
+                    proc.start()
+                stats = [queue.get() for _ in procs]
+                for proc in procs:
+                    proc.join()
+                results[mode] = {key: sum(s[key] for s in stats) / 1024 for key in stats[0]}
+        finally:
+            store.remove()
+    data_mb = num_latents * np.prod(shape) * 4 / 1024 / 1024
+    return data_mb, results
+
+
+def test_workers_share_memory():
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        print("skipping memory test, no /proc/self/smaps_rollup")
+        return
+    data_mb, results = measure_memory()
+    # each private worker holds the whole dataset, shared workers hold almost none of it themselves
+    assert results['private']['Private'] > data_mb * 3
+    assert results['shared']['Private'] < data_mb
+    assert results['shared']['Pss'] < results['private']['Pss'] / 2
+
+
+def benchmark(num_workers=4):
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        return
+    data_mb, results = measure_memory(num_workers=num_workers, num_latents=256)
+    print(f"{data_mb:.0f} MB of latents, {num_workers} workers")
+    for mode, stats in results.items():
+        print(
+            f"{mode}: total RSS {stats['Rss']:.0f} MB, total PSS {stats['Pss']:.0f} MB, "
+            f"total private {stats['Private']:.0f} MB"
+        )
+
+
+if __name__ == '__main__':
+    test_store_round_trip()
+    test_store_of_a_dead_builder_is_stale()
+    test_dataset_builds_and_attaches()
+    test_workers_share_memory()
+    print("shared latent store works")
+    benchmark()
@@ -0,0 +1,229 @@
+import json
+import os
+import sys
+import tempfile
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.lycoris_utils import (
+    extract_diff, iter_extract_diff_from_files, load_extract_keymap, read_checkpoint_tensor
+)
+from toolkit.safetensors_stream import SafeTensorsStreamWriter
+
+
+# tiny stand ins with the same class names extract_diff looks for
+class Attention(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.to_q = nn.Linear(dim, dim, bias=False)
+        self.to_k = nn.Linear(dim, dim, bias=False)
+        self.to_out = nn.ModuleList([nn.Linear(dim, dim)])
+
+
+class Transformer2DModel(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.norm = nn.GroupNorm(4, dim)
+        self.proj_in = nn.Conv2d(dim, dim, 1)
+        self.attn1 = Attention(dim)
+
+
+class ResnetBlock2D(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.conv1 = nn.Conv2d(dim, dim, 3, padding=1)
+        self.time_emb_proj = nn.Linear(dim * 2, dim)
+
+
+class Block(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.attentions = nn.ModuleList([Transformer2DModel(dim)])
+        self.resnets = nn.ModuleList([ResnetBlock2D(dim)])
+
+
+class TinyUNet(nn.Module):
+    def __init__(self, dim=32):
+        super().__init__()
+        self.conv_in = nn.Conv2d(4, dim, 3, padding=1)
+        self.down_blocks = nn.ModuleList([Block(dim), Block(dim)])
+
+
+class CLIPAttention(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.q_proj = nn.Linear(dim, dim)
+        self.out_proj = nn.Linear(dim, dim)
+
+
+class CLIPMLP(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.fc1 = nn.Linear(dim, dim * 2)
+        self.fc2 = nn.Linear(dim * 2, dim)
+
+
+class Layer(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.self_attn = CLIPAttention(dim)
+        self.mlp = CLIPMLP(dim)
+
+
+class TinyTextEncoder(nn.Module):
+    def __init__(self, dim=24):
+        super().__init__()
+        self.layers = nn.ModuleList([Layer(dim), Layer(dim)])
+
+
+def perturb(model: nn.Module, seed: int):
+    generator = torch.Generator().manual_seed(seed)
+    tuned = type(model)()
+    tuned.load_state_dict(model.state_dict())
+    with torch.no_grad():
+        for name, param in tuned.named_parameters():
+            # leave one layer untouched so the allclose skip gets exercised
+            if name.startswith('down_blocks.1.resnets'):
+                continue
+            param.add_(torch.randn(param.shape, generator=generator) * 0.05)
+    return tuned
+
+
+def write_ldm_checkpoint(te, unet, path):
+    # fabricated ldm layout
+    state_dict = OrderedDict()
+    for key, value in te.state_dict().items():
+        state_dict[f"cond_stage_model.{key}"] = value.contiguous()
+    for key, value in unet.state_dict().items():
+        state_dict[f"model.diffusion_model.{key}"] = value.contiguous()
+    save_file(state_dict, path)
+
+
+def write_keymap(te, unet, path):
+    keymap = OrderedDict()
+    for key in te.state_dict().keys():
+        keymap[f"cond_stage_model.{key}"] = f"te_{key}"
+    for key in unet.state_dict().keys():
+        keymap[f"model.diffusion_model.{key}"] = f"unet_{key}"
+    with open(path, 'w') as f:
+        json.dump({
+            'ldm_diffusers_keymap': keymap,
+            'ldm_diffusers_shape_map': {},
+            'ldm_diffusers_operator_map': {},
+            'diffusers_ldm_operator_map': {},
+        }, f)
+
+
+def run_extract(mode, linear, conv, small_conv, linear_only, use_bias):
+    torch.manual_seed(0)
+    base_te, base_unet = TinyTextEncoder(), TinyUNet()
+    tuned_te, tuned_unet = perturb(base_te, 1), perturb(base_unet, 2)
+
+    kwargs = dict(
+        mode=mode,
+        linear_mode_param=linear,
+        conv_mode_param=conv,
+        use_bias=use_bias,
+        small_conv=small_conv,
+        linear_only=linear_only,
+    )
+
+    expected, _ = extract_diff(
+        (base_te, None, base_unet),
+        (tuned_te, None, tuned_unet),
+        **kwargs
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        base_path = os.path.join(tmp_dir, 'base.safetensors')
+        tuned_path = os.path.join(tmp_dir, 'tuned.safetensors')
+        keymap_path = os.path.join(tmp_dir, 'keymap.json')
+        output_path = os.path.join(tmp_dir, 'out.safetensors')
+        write_ldm_checkpoint(base_te, base_unet, base_path)
+        write_ldm_checkpoint(tuned_te, tuned_unet, tuned_path)
+        write_keymap(base_te, base_unet, keymap_path)
+
+        with SafeTensorsStreamWriter(output_path, {'format': 'pt'}) as writer:
+            for loras in iter_extract_diff_from_files(
+                    base_path, tuned_path, keymap_path=keymap_path, **kwargs
+            ):
+                writer.update(loras)
+        streamed = load_file(output_path)
+
+    assert len(expected) > 0
+    assert set(streamed.keys()) == set(expected.keys()), \
+        set(streamed.keys()) ^ set(expected.keys())
+    for key in expected:
+        assert streamed[key].dtype == expected[key].dtype, key
+        assert streamed[key].shape == expected[key].shape, key
+        assert torch.equal(streamed[key], expected[key]), key
+    return len(expected)
+
+
+def test_streaming_extract_locon():
+    run_extract('fixed', 4, 2, small_conv=True, linear_only=False, use_bias=False)
+
+
+def test_streaming_extract_lora_linear_only():
+    run_extract('fixed', 4, 0, small_conv=False, linear_only=True, use_bias=False)
+
+
+def test_streaming_extract_ratio_with_bias():
+    run_extract('ratio', 0.5, 0.5, small_conv=True, linear_only=False, use_bias=True)
+
+
+def test_sd2_in_proj_slices():
+    # sd2 keeps q, k and v of the text encoder in one in_proj weight and bias
+    keymap = load_extract_keymap(is_v2=True)
+    ldm_prefix = 'cond_stage_model.model.transformer.resblocks.0.attn.in_proj_'
+    diffusers_prefix = 'te_text_model.encoder.layers.0.self_attn.'
+    state_dict = {
+        ldm_prefix + 'weight': torch.randn(3072, 1024),
+        ldm_prefix + 'bias': torch.randn(3072),
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'sd2.safetensors')
+        save_file(state_dict, path)
+        with safe_open(path, framework='pt') as f:
+            lookup = {key: key for key in f.keys()}
+            for idx, name in enumerate(['q_proj', 'k_proj', 'v_proj']):
+                for kind in ['weight', 'bias']:
+                    ldm_key, slice_text = keymap[f'{diffusers_prefix}{name}.{kind}']
+                    assert ldm_key == ldm_prefix + kind
+                    tensor = read_checkpoint_tensor(f, lookup, ldm_key, slice_text)
+                    expected = state_dict[ldm_key][idx * 1024:(idx + 1) * 1024]
+                    assert torch.equal(tensor, expected), (name, kind)
+
+
+def test_stream_writer_round_trip():
+    tensors = OrderedDict([
+        ('a', torch.randn(3, 5)),
+        ('b', torch.randn(7).to(torch.bfloat16)),
+        ('c', torch.arange(10, dtype=torch.int16)),
+        ('d', torch.tensor(1.5, dtype=torch.float16)),
+        ('e', torch.zeros(0)),
+    ])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'out.safetensors')
+        with SafeTensorsStreamWriter(path, {'name': 'test'}) as writer:
+            writer.update(tensors)
+        loaded = load_file(path)
+        assert not os.path.exists(f"{path}.data.tmp")
+    for key, value in tensors.items():
+        assert loaded[key].dtype == value.dtype
+        assert torch.equal(loaded[key], value), key
+
+
+if __name__ == '__main__':
+    test_stream_writer_round_trip()
+    test_sd2_in_proj_slices()
+    test_streaming_extract_locon()
+    test_streaming_extract_lora_linear_only()
+    test_streaming_extract_ratio_with_bias()
+    print("streaming extract matches extract_diff")
@@ -0,0 +1,120 @@
+import hashlib
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.cache_inspection import CacheKeyModel
+from toolkit.config_modules import DatasetConfig, ModelConfig
+from toolkit.data_loader import AiToolkitDataset
+from toolkit.prompt_utils import PromptEmbeds
+
+NUM_VARIANTS = 4
+DROPOUT_RATE = 0.2
+
+
+class TinyTextModel(CacheKeyModel):
+    # a text encoder that maps each caption to its own fixed tensor
+    def __init__(self):
+        super().__init__(ModelConfig(name_or_path='not/loaded', arch='sdxl'), 16)
+        self.encoded = []
+
+    def set_device_state_preset(self, preset):
+        pass
+
+    def embed(self, caption):
+        seed = int(hashlib.md5(caption.encode('utf-8')).hexdigest()[:8], 16)
+        return torch.randn(4, 8, generator=torch.Generator().manual_seed(seed))
+
+    def encode_prompt(self, prompts):
+        self.encoded += prompts
+        return PromptEmbeds(torch.stack([self.embed(caption) for caption in prompts]))
+
+
+def write_dataset(folder, captions):
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(0)
+    for idx, caption in enumerate(captions):
+        pixels = rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(os.path.join(folder, f'img_{idx}.png'))
+        with open(os.path.join(folder, f'img_{idx}.txt'), 'w') as f:
+            f.write(caption)
+
+
+def make_dataset(folder, model, **kwargs):
+    config = DatasetConfig(
+        folder_path=folder,
+        resolution=64,
+        caption_ext='txt',
+        cache_text_embeddings=True,
+        text_embedding_variants=NUM_VARIANTS,
+        shuffle_tokens=True,
+        caption_dropout_rate=DROPOUT_RATE,
+        **kwargs
+    )
+    return AiToolkitDataset(config, sd=model)
+
+
+def test_variants_are_deduplicated():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # two images share a caption
+        write_dataset(tmp_dir, ['a dog, a ball, grass, sunny', 'a dog, a ball, grass, sunny', 'a cat, a sofa, indoors'])
+        model = TinyTextModel()
+        dataset = make_dataset(tmp_dir, model)
+        by_name = {os.path.basename(x.path): x for x in dataset.file_list}
+        assert by_name['img_0.png'].text_embedding_variant_paths == by_name['img_1.png'].text_embedding_variant_paths
+        unique_captions = set()
+        for file_item in dataset.file_list:
+            unique_captions.update(file_item.get_caption_variants())
+        # every unique variant and the empty caption encoded once
+        assert sorted(model.encoded) == sorted(unique_captions | {''})
+        assert len(os.listdir(os.path.join(tmp_dir, '_t_e_cache'))) == len(unique_captions) + 1
+
+        # each file holds the embedding of its caption
+        file_item = by_name['img_2.png']
+        for caption, path in zip(file_item.get_caption_variants(), file_item.text_embedding_variant_paths):
+            assert torch.equal(PromptEmbeds.load(path).text_embeds, model.embed(caption).unsqueeze(0))
+
+        # the same variants come out again, so nothing is encoded the second time
+        model = TinyTextModel()
+        make_dataset(tmp_dir, model)
+        assert model.encoded == []
+
+
+def test_variant_distribution():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        write_dataset(tmp_dir, ['one, two, three, four, five, six'])
+        dataset = make_dataset(tmp_dir, TinyTextModel())
+        file_item = dataset.file_list[0]
+        variants = file_item.get_caption_variants()
+        # shuffled, so the variants differ but keep the same tokens
+        assert len(set(variants)) > 1
+        assert all(sorted(v.split(', ')) == sorted(variants[0].split(', ')) for v in variants)
+
+        random.seed(0)
+        num_samples = 20000
+        counts = Counter(file_item.get_text_embedding_load_path() for _ in range(num_samples))
+        dropout_share = counts[file_item.text_embedding_dropout_path] / num_samples
+        assert abs(dropout_share - DROPOUT_RATE) < 0.02
+        # the rest split evenly over the variants, one slot per variant index
+        variant_counts = Counter()
+        for path, count in counts.items():
+            if path != file_item.text_embedding_dropout_path:
+                variant_counts[path] += count
+        expected = num_samples * (1 - DROPOUT_RATE)
+        for path, count in variant_counts.items():
+            slots = file_item.text_embedding_variant_paths.count(path)
+            assert abs(count / expected - slots / NUM_VARIANTS) < 0.02
+
+
+if __name__ == '__main__':
+    test_variants_are_deduplicated()
+    test_variant_distribution()
+    print("text embedding variants work")
@@ -0,0 +1,169 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from torchvision import transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+from toolkit.dataloader_mixins import get_video_metadata, read_video_frames
+
+
+def write_video(path, total_frames=60, size=64, fps=24):
+    # every frame is a flat gray so the frame index can be read back from its brightness,
+    # with some noise so the encoder has real work to do
+    rng = np.random.default_rng(0)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (size, size))
+    for idx in range(total_frames):
+        frame = np.full((size, size, 3), (idx % 60) * 4, dtype=np.int16)
+        frame = frame + rng.integers(-2, 3, size=frame.shape)
+        writer.write(np.clip(frame, 0, 255).astype(np.uint8))
+    writer.release()
+
+
+def frame_index(frame):
+    return int(round(float(np.mean(frame)) / 4))
+
+
+def read_frames_seeking(path, frame_indices):
+    # the previous extraction, one seek per frame
+    cap = cv2.VideoCapture(path)
+    frames = []
+    for frame_idx in frame_indices:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        ret, frame = cap.read()
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    cap.release()
+    return frames
+
+
+def read_frames(path, frame_indices, **kwargs):
+    cap = cv2.VideoCapture(path)
+    frames = read_video_frames(cap, frame_indices, **kwargs)
+    cap.release()
+    return frames
+
+
+class WrongTimestampCapture:
+    # a capture whose seeks never land where they should, going by the frame timestamps
+    def __init__(self, path):
+        self.cap = cv2.VideoCapture(path)
+        self.num_seeks = 0
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_POS_FRAMES and value > 0:
+            self.num_seeks += 1
+        return self.cap.set(prop, value)
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return -1000.0
+        return self.cap.get(prop)
+
+    def __getattr__(self, name):
+        return getattr(self.cap, name)
+
+
+def test_metadata():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'clip.mp4')
+        write_video(path)
+        metadata = get_video_metadata(path)
+        assert metadata['frame_count'] == 60
+        assert abs(metadata['fps'] - 24) < 0.01
+
+
+def test_sequential_matches_seeking():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'clip.mp4')
+        write_video(path)
+        rng = random.Random(0)
+        for _ in range(5):
+            frame_indices = [rng.randint(0, 59) for _ in range(8)]
+            expected = [frame_index(f) for f in read_frames_seeking(path, frame_indices)]
+            assert [frame_index(f) for f in read_frames(path, frame_indices)] == expected
+            # seeking to every target ahead, and never seeking
+            assert [frame_index(f) for f in read_frames(path, frame_indices, seek_ahead_frames=0)] == expected
+            assert [frame_index(f) for f in read_frames(path, frame_indices, seek_ahead_frames=1000)] == expected
+
+
+def test_wrong_seek_falls_back_to_decoding():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'clip.mp4')
+        write_video(path)
+        frame_indices = [5, 40, 50, 10]
+        expected = [frame_index(f) for f in read_frames_seeking(path, frame_indices)]
+        cap = WrongTimestampCapture(path)
+        frames = read_video_frames(cap, frame_indices, seek_ahead_frames=0)
+        cap.release()
+        assert [frame_index(f) for f in frames] == expected
+        # it gave up on seeking after the first one went wrong
+        assert cap.num_seeks == 1
+
+        # past the real end of the video it gets the last frame that decoded
+        frames = read_frames(path, [200, 40], seek_ahead_frames=0)
+        assert [frame_index(f) for f in frames] == [40, 40]
+
+
+def test_metadata_in_size_database():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'clip.mp4')
+        write_video(path)
+        config = DatasetConfig(folder_path=tmp_dir, num_frames=8)
+        size_database = {}
+        file_item = FileItemDTO(path=path, dataset_config=config, size_database=size_database)
+        entry = size_database['clip.mp4']
+        assert entry[:2] == (64, 64)
+        assert entry[3]['frame_count'] == 60
+
+        # the next load reads the metadata from the index
+        entry[3]['frame_count'] = 30
+        file_item = FileItemDTO(path=path, dataset_config=config, size_database=size_database)
+        assert file_item.video_metadata['frame_count'] == 30
+        file_item.scale_to_width = file_item.crop_width = 64
+        file_item.scale_to_height = file_item.crop_height = 64
+        file_item.load_and_process_video(transforms.ToTensor())
+        # frames were spread over the 30 frames from the metadata
+        indices = [frame_index(f.numpy() * 255) for f in file_item.tensor]
+        assert indices == [0, 4, 8, 12, 17, 21, 25, 29], indices
+
+
+def time_it(fn, repeats=3):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark(total_frames=600, size=256, clip_frames=33):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'long.mp4')
+        write_video(path, total_frames=total_frames, size=size)
+        print(f"{total_frames} frames at {size}x{size}")
+
+        spread = [int(round(i * (total_frames - 1) / (clip_frames - 1))) for i in range(clip_frames)]
+        start = total_frames * 3 // 4
+        late_clip = list(range(start, start + clip_frames))
+        for name, frame_indices in [('spread over video', spread), ('clip near the end', late_clip)]:
+            seek_time = time_it(lambda: read_frames_seeking(path, frame_indices))
+            sequential_time = time_it(lambda: read_frames(path, frame_indices, seek_ahead_frames=total_frames))
+            forward_time = time_it(lambda: read_frames(path, frame_indices))
+            print(
+                f"{name}: seek per frame {seek_time * 1000:.1f} ms, sequential {sequential_time * 1000:.1f} ms, "
+                f"forward with seeks ahead {forward_time * 1000:.1f} ms"
+            )
+
+
+if __name__ == '__main__':
+    test_metadata()
+    test_sequential_matches_seeking()
+    test_wrong_seek_falls_back_to_decoding()
+    test_metadata_in_size_database()
+    print("forward frame extraction matches seeking")
+    benchmark()
@@ -0,0 +1,141 @@
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision import transforms
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+from toolkit.dataloader_mixins import LatentCachingMixin, read_video_frames
+
+WIDTH = 64
+HEIGHT = 48
+TOTAL_FRAMES = 24
+
+
+def write_video(path, total_frames=TOTAL_FRAMES, fps=24):
+    # every frame is a flat gray so the frame index can be read back from its brightness
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (WIDTH, HEIGHT))
+    for idx in range(total_frames):
+        writer.write(np.full((HEIGHT, WIDTH, 3), idx * 10, dtype=np.uint8))
+    writer.release()
+
+
+def frame_index(frame):
+    return int(round(float(np.mean(frame)) / 10))
+
+
+class TinyVideoSD:
+    # stands in for a video model, a 3d patchify instead of a real vae
+    def __init__(self):
+        self.vae = nn.Conv3d(3, 4, kernel_size=(1, 8, 8), stride=(1, 8, 8))
+        self.model_config = SimpleNamespace(latent_space_version='tiny_video', arch='tiny_video')
+        self.torch_dtype = torch.float32
+        self.device = 'cpu'
+        self.device_torch = torch.device('cpu')
+        self.encoded_batch_sizes = []
+
+    def set_device_state_preset(self, preset):
+        pass
+
+    def restore_device_state(self):
+        pass
+
+    @torch.no_grad()
+    def encode_images(self, imgs):
+        self.encoded_batch_sizes.append(imgs.shape[0])
+        # (B, T, C, H, W) -> (B, C, T, H, W)
+        return self.vae(imgs.permute(0, 2, 1, 3, 4))
+
+
+class TinyVideoDataset(LatentCachingMixin):
+    def __init__(self, dataset_config, paths, sd):
+        super().__init__()
+        self.dataset_config = dataset_config
+        self.dataset_path = dataset_config.folder_path
+        self.sd = sd
+        self.is_video = True
+        self.is_caching_latents_to_disk = True
+        self.is_caching_latents_to_memory = False
+        self.transform = transforms.Compose([transforms.ToTensor()])
+        self.file_list = [FileItemDTO(path=path, dataset_config=dataset_config) for path in paths]
+
+
+def make_config(folder, **kwargs):
+    return DatasetConfig(folder_path=folder, num_frames=5, cache_latents_to_disk=True, **kwargs)
+
+
+def test_read_video_frames():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'clip.avi')
+        write_video(path)
+        cap = cv2.VideoCapture(path)
+        # out of order, repeated and past the end
+        frames = read_video_frames(cap, [12, 0, 5, 5, TOTAL_FRAMES + 3])
+        cap.release()
+        assert [frame_index(f) for f in frames] == [12, 0, 5, 5, TOTAL_FRAMES - 1]
+
+
+def test_clip_matches_seek_loader():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'clip.avi')
+        write_video(path)
+        file_item = FileItemDTO(path=path, dataset_config=make_config(tmp_dir))
+        transform = transforms.Compose([transforms.ToTensor()])
+        file_item.load_and_process_video(transform)
+        seeked = file_item.tensor
+        file_item.load_video_clip(transform)
+        assert file_item.tensor.shape == (5, 3, HEIGHT, WIDTH)
+        assert torch.allclose(seeked, file_item.tensor)
+
+
+def test_cache_hits_and_shapes():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for idx in range(3):
+            path = os.path.join(tmp_dir, f'clip_{idx}.avi')
+            write_video(path)
+            paths.append(path)
+
+        sd = TinyVideoSD()
+        config = make_config(tmp_dir, video_cache_batch_size=2)
+        dataset = TinyVideoDataset(config, paths, sd)
+        dataset.cache_latents_all_latents()
+        # three clips in one bucket, encoded as a batch of two and the rest
+        assert sd.encoded_batch_sizes == [2, 1]
+        for file_item in dataset.file_list:
+            assert file_item.is_latent_cached
+            assert os.path.exists(file_item.get_latent_path())
+            file_item.cleanup_latent()
+            assert file_item.get_latent().shape == (4, 5, HEIGHT // 8, WIDTH // 8)
+
+        # a second run only loads from the cache
+        sd.encoded_batch_sizes = []
+        dataset = TinyVideoDataset(config, paths, sd)
+        dataset.cache_latents_all_latents()
+        assert sd.encoded_batch_sizes == []
+        assert all(x.is_latent_cached for x in dataset.file_list)
+
+        # loading a cached item gets the latent and skips decoding
+        file_item = dataset.file_list[0]
+        file_item.load_and_process_image(dataset.transform)
+        assert file_item.tensor is None
+        assert file_item.get_latent() is not None
+
+        # different frame sampling is a different cache entry
+        fps_item = FileItemDTO(path=paths[0], dataset_config=make_config(tmp_dir, shrink_video_to_frames=False))
+        assert fps_item.get_latent_path() != dataset.file_list[0].get_latent_path()
+
+
+if __name__ == '__main__':
+    test_read_video_frames()
+    test_clip_matches_seek_loader()
+    test_cache_hits_and_shapes()
+    print("video latent caching works")
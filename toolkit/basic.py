@@ -1,9 +1,42 @@
 import gc
 import os
+import re
+from typing import Union
 
 import torch
 
 
+# decimal units for KB / MB, binary for KiB / MiB and a bare K / M like du and df print them
+SIZE_UNITS = {
+    '': 1,
+    'b': 1,
+    'kb': 1000,
+    'mb': 1000 ** 2,
+    'gb': 1000 ** 3,
+    'tb': 1000 ** 4,
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+    't': 1024 ** 4,
+    'kib': 1024,
+    'mib': 1024 ** 2,
+    'gib': 1024 ** 3,
+    'tib': 1024 ** 4,
+}
+
+
+def parse_size(size: Union[int, float, str, None]) -> int:
+    # "5GB", "500M", "2TiB", 1000000 -> bytes. 0 or None means no limit
+    if size is None:
+        return 0
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]*)\s*', size)
+    if match is None or match.group(2).lower() not in SIZE_UNITS:
+        raise ValueError(f"Invalid size {size}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
 def value_map(inputs, min_in, max_in, min_out, max_out):
     return (inputs - min_in) * (max_out - min_out) / (max_in - min_in) + min_out
 
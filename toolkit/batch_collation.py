@@ -0,0 +1,92 @@
+from typing import Callable, List, Tuple, Union
+
+import torch
+from torch.utils.data import get_worker_info
+
+from toolkit.prompt_utils import PromptEmbeds
+
+
+def new_batch_buffer(like: torch.Tensor, shape: Tuple[int, ...]) -> torch.Tensor:
+    # in a dataloader worker the buffer goes in shared memory, like default_collate does, so handing the
+    # batch to the main process does not copy it again
+    if get_worker_info() is not None:
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        storage = like._typed_storage()._new_shared(numel, device=like.device)
+        return like.new(storage).resize_(*shape)
+    return torch.empty(shape, dtype=like.dtype, device=like.device)
+
+
+def collate_tensors(tensors: List[Union[torch.Tensor, None]]) -> Tuple[Union[torch.Tensor, None], Union[torch.Tensor, None]]:
+    """
+    Stacks the tensors of a batch into one buffer sized from the first one that is there. Items without
+    one are left zero and come back as False in the mask, which is None when every item has one. They all
+    need the same shape and dtype, the copy would otherwise broadcast or cast them without complaint.
+    """
+    base = next((t for t in tensors if t is not None), None)
+    if base is None:
+        return None, None
+    for tensor in tensors:
+        if tensor is not None and (tensor.shape != base.shape or tensor.dtype != base.dtype):
+            raise RuntimeError(
+                f"Can not collate a {tuple(tensor.shape)} {tensor.dtype} tensor into a batch of "
+                f"{tuple(base.shape)} {base.dtype} ones"
+            )
+    out = new_batch_buffer(base, (len(tensors),) + tuple(base.shape))
+    for idx, tensor in enumerate(tensors):
+        if tensor is None:
+            out[idx].zero_()
+        else:
+            out[idx].copy_(tensor)
+    if all(t is not None for t in tensors):
+        return out, None
+    return out, torch.tensor([t is not None for t in tensors])
+
+
+def collate_padded(tensors: List[torch.Tensor]) -> torch.Tensor:
+    # concatenates (batch, length, ...) tensors, zero padding them to the longest length like concat_prompt_embeds
+    base = tensors[0]
+    max_len = max(t.shape[1] for t in tensors)
+    out = new_batch_buffer(base, (sum(t.shape[0] for t in tensors), max_len) + tuple(base.shape[2:]))
+    start = 0
+    for tensor in tensors:
+        end = start + tensor.shape[0]
+        length = tensor.shape[1]
+        out[start:end, :length].copy_(tensor)
+        if length < max_len:
+            out[start:end, length:].zero_()
+        start = end
+    return out
+
+
+def collate_prompt_embeds(prompt_embeds: List[PromptEmbeds]) -> PromptEmbeds:
+    # same result as concat_prompt_embeds, written once into the batch buffers
+    if isinstance(prompt_embeds[0].text_embeds, (list, tuple)):
+        text_embeds = [
+            collate_padded([p.text_embeds[i] for p in prompt_embeds])
+            for i in range(len(prompt_embeds[0].text_embeds))
+        ]
+    else:
+        text_embeds = collate_padded([p.text_embeds for p in prompt_embeds])
+    pooled_embeds = None
+    if prompt_embeds[0].pooled_embeds is not None:
+        pooled_embeds = collate_padded([p.pooled_embeds for p in prompt_embeds])
+    pe = PromptEmbeds([text_embeds, pooled_embeds])
+    if prompt_embeds[0].attention_mask is not None:
+        pe.attention_mask = collate_padded([p.attention_mask for p in prompt_embeds])
+    return pe
+
+
+def apply_to_prompt_embeds(prompt_embeds: PromptEmbeds, fn: Callable[[torch.Tensor], torch.Tensor]) -> PromptEmbeds:
+    # a new PromptEmbeds with fn applied to each of its tensors, for pinning and moving batches
+    def apply(value):
+        if value is None:
+            return None
+        if isinstance(value, (list, tuple)):
+            return [fn(t) for t in value]
+        return fn(value)
+
+    pe = PromptEmbeds([apply(prompt_embeds.text_embeds), apply(prompt_embeds.pooled_embeds)])
+    pe.attention_mask = apply(prompt_embeds.attention_mask)
+    return pe
@@ -0,0 +1,121 @@
+import queue
+import threading
+from typing import Callable, Iterator, Union
+
+import torch
+
+# kinds of what the thread hands over
+_BATCH = 'batch'
+_END = 'end'
+_ERROR = 'error'
+
+
+def apply_to_batch(batch, fn: Callable[[torch.Tensor], torch.Tensor]):
+    # applies fn to the tensors of a batch. DataLoaderBatchDTO and anything else with apply_to_tensors do it themselves
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(apply_to_batch(x, fn) for x in batch)
+    if isinstance(batch, dict):
+        return {k: apply_to_batch(v, fn) for k, v in batch.items()}
+    if hasattr(batch, 'apply_to_tensors'):
+        return batch.apply_to_tensors(fn)
+    return batch
+
+
+def _record_stream(tensor: torch.Tensor, stream: torch.cuda.Stream) -> torch.Tensor:
+    # the tensor was allocated on the side stream, keep the allocator from reusing it while the train stream uses it
+    tensor.record_stream(stream)
+    return tensor
+
+
+class BatchPrefetcher:
+    """
+    Iterates a dataloader iterator with the next batches already on the device. A thread pulls the next
+    num_ahead batches, pins them and starts their copies on a side stream while the train loop works
+    on the current one. Without cuda there is no stream, the thread does the moves and the batches come
+    out the same. Batches come out in order, and an exception raised getting one is raised here in its place.
+    """
+
+    def __init__(self, iterator: Iterator, device: Union[str, torch.device], num_ahead: int = 2, pin_memory: bool = True):
+        self.iterator = iterator
+        self.device = torch.device(device)
+        self.num_ahead = max(1, num_ahead)
+        self.stream = None
+        if self.device.type == 'cuda' and torch.cuda.is_available():
+            self.stream = torch.cuda.Stream(device=self.device)
+        # pinning only helps copies to a gpu
+        self.pin_memory = pin_memory and self.stream is not None
+        self.queue = queue.Queue(maxsize=self.num_ahead)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.is_done = False
+
+    def __iter__(self):
+        return self
+
+    def _put(self, item) -> bool:
+        # waits for room, gives up if closed in the meantime
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _prepare(self, batch):
+        if self.stream is None:
+            return apply_to_batch(batch, lambda t: t.to(self.device)), None
+        if self.pin_memory:
+            # already pinned tensors, from the dataloader pinning them, come back as they are
+            batch = apply_to_batch(batch, lambda t: t.pin_memory())
+        with torch.cuda.stream(self.stream):
+            batch = apply_to_batch(batch, lambda t: t.to(self.device, non_blocking=True))
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return batch, ready
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    batch = next(self.iterator)
+                except StopIteration:
+                    self._put((_END, None, None))
+                    return
+                batch, ready = self._prepare(batch)
+                if not self._put((_BATCH, batch, ready)):
+                    return
+        except Exception as e:
+            self._put((_ERROR, e, None))
+
+    def __next__(self):
+        if self.is_done:
+            raise StopIteration
+        if self.thread is None:
+            # started on the first batch, so the dataset is not read before the epoch is set up
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        kind, value, ready = self.queue.get()
+        if kind == _END:
+            self.is_done = True
+            raise StopIteration
+        if kind == _ERROR:
+            self.is_done = True
+            raise value
+        if ready is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(ready)
+            value = apply_to_batch(value, lambda t: _record_stream(t, current_stream))
+        return value
+
+    def close(self):
+        # stops the thread after the batch it is on, dropping the ones it got ahead
+        self.stop_event.set()
+        self.is_done = True
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
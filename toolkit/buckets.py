@@ -126,4 +126,57 @@ def get_bucket_for_image_size(
     if closest_bucket is None:
         raise ValueError("No suitable bucket found")
 
-    return closest_bucket
\ No newline at end of file
+    return closest_bucket
+
+def get_bucket_batch_size(
+        width: int,
+        height: int,
+        pixel_budget: int,
+        num_frames: int = 1,
+        max_batch_size: Union[int, None] = None
+) -> int:
+    # how many samples of this bucket fit in the pixel budget, always at least one
+    batch_size = max(1, pixel_budget // (width * height * max(1, num_frames)))
+    if max_batch_size is not None:
+        batch_size = min(batch_size, max_batch_size)
+    return batch_size
+
+
+def simulate_bucket_batches(
+        image_sizes: List[tuple],
+        resolution: int,
+        pixel_budget: Union[int, None] = None,
+        batch_size: int = 1,
+        num_frames: int = 1,
+        max_batch_size: Union[int, None] = None,
+        divisibility: int = 8,
+        bytes_per_pixel: float = 0.0
+) -> List[dict]:
+    # buckets a list of (width, height) image sizes the way the dataset does and reports the
+    # batching for each bucket. Buckets never pad, so every sample in a step is a real one.
+    # bytes_per_pixel is the activation memory of the model per input pixel, 0 to skip the estimate
+    bucket_counts = {}
+    for width, height in image_sizes:
+        bucket = get_bucket_for_image_size(width, height, resolution=resolution, divisibility=divisibility)
+        key = (bucket["width"], bucket["height"])
+        bucket_counts[key] = bucket_counts.get(key, 0) + 1
+
+    report = []
+    for (width, height), count in sorted(bucket_counts.items(), key=lambda x: x[0][0] * x[0][1]):
+        if pixel_budget is not None:
+            bucket_batch_size = get_bucket_batch_size(width, height, pixel_budget, num_frames, max_batch_size)
+        else:
+            bucket_batch_size = batch_size
+        num_steps = -(-count // bucket_batch_size)
+        step_pixels = bucket_batch_size * width * height * num_frames
+        report.append({
+            "width": width,
+            "height": height,
+            "files": count,
+            "batch_size": bucket_batch_size,
+            "steps": num_steps,
+            "samples_per_step": count / num_steps,
+            "pixels_per_step": step_pixels,
+            "memory_gb": step_pixels * bytes_per_pixel / 1024 ** 3,
+        })
+    return report
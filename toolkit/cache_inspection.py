@@ -0,0 +1,247 @@
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Set, Union
+
+from toolkit.cache_root import STALE_TMP_SECONDS, is_tmp_cache_file
+from toolkit.config_modules import DatasetConfig, ModelConfig, get_latent_space_version, preprocess_dataset_raw_config
+from toolkit.resized_image_cache import ResizedImagePack
+
+# folders next to the images that hold one file per cache key
+CACHE_DIR_NAMES = OrderedDict([
+    ('latents', '_latent_cache'),
+    ('text_embeddings', '_t_e_cache'),
+])
+RESIZED_IMAGE_CACHE_DIR_NAME = '_resized_image_cache'
+
+# bucket divisibility comes from the model's vae and patching, so without a loaded model every
+# value a model uses is treated as live
+BUCKET_DIVISIBILITIES = [8, 16, 32, 64]
+
+
+class CacheKeyModel:
+    """
+    Just enough of a model for a dataset to work out its cache keys, without loading any weights
+    """
+
+    def __init__(self, model_config: ModelConfig, bucket_divisibility: int):
+        self.model_config = model_config
+        self.arch = model_config.arch
+        self.bucket_divisibility = bucket_divisibility
+        self.is_xl = model_config.is_xl
+        self.is_vega = getattr(model_config, 'is_vega', False)
+        self.is_ssd = getattr(model_config, 'is_ssd', False)
+        self.encode_control_in_text_embeddings = False
+
+    def get_bucket_divisibility(self):
+        return self.bucket_divisibility
+
+
+def get_live_cache_keys(
+        raw_dataset: dict,
+        raw_model: dict,
+        bucket_divisibility: Union[int, None] = None
+) -> dict:
+    """
+    Builds the dataset like training does and returns every cache file it would use, per kind,
+    the cache folders it owns and the live keys of its resized image pack.
+    """
+    from toolkit.data_loader import AiToolkitDataset
+
+    model_config = ModelConfig(**raw_model)
+    latent_space_version = get_latent_space_version(model_config)
+    live = {kind: set() for kind in CACHE_DIR_NAMES}
+    live_pack_keys: Dict[str, Set[str]] = {}
+    cache_dirs: Set[str] = set()
+    divisibilities = BUCKET_DIVISIBILITIES if bucket_divisibility is None else [bucket_divisibility]
+
+    for divisibility in divisibilities:
+        # only work out the keys, do not cache or generate anything
+        dataset_config = DatasetConfig(**dict(
+            raw_dataset,
+            cache_latents=False,
+            cache_latents_to_disk=False,
+            cache_text_embeddings=False,
+            cache_clip_vision_to_disk=False,
+            cache_resized_images=False,
+            controls=[],
+        ))
+        if dataset_config.cache_root is not None:
+            # content addressed and shared between datasets, scripts/gc_cache_root.py handles those
+            print(f"Skipping {dataset_config.folder_path}, it uses cache root {dataset_config.cache_root}")
+            return {'live': live, 'live_pack_keys': live_pack_keys, 'cache_dirs': []}
+        dataset = AiToolkitDataset(dataset_config, sd=CacheKeyModel(model_config, divisibility))
+        dataset_folder = dataset.dataset_path
+        if not os.path.isdir(dataset_folder):
+            dataset_folder = os.path.dirname(dataset_folder)
+        pack_dir = os.path.join(dataset_folder, RESIZED_IMAGE_CACHE_DIR_NAME)
+
+        for file_item in dataset.file_list:
+            img_dir = os.path.dirname(file_item.path)
+            for dir_name in CACHE_DIR_NAMES.values():
+                cache_dirs.add(os.path.join(img_dir, dir_name))
+
+            file_item.latent_space_version = latent_space_version
+            live['latents'].add(file_item.get_latent_path(recalculate=True))
+
+            file_item.text_embedding_space_version = model_config.arch
+            # some models put the control image in the key, keep both
+            for encode_control in [False, True]:
+                file_item.encode_control_in_text_embeddings = encode_control
+                live['text_embeddings'].add(file_item.get_text_embedding_path(recalculate=True))
+            if dataset_config.text_embedding_variants > 0:
+                # caption variants live in the dataset folder, keyed by the caption alone
+                variants = file_item.get_caption_variants()
+                if dataset_config.caption_dropout_rate > 0:
+                    variants.append('')
+                for caption in variants:
+                    live['text_embeddings'].add(file_item.get_text_embedding_variant_path(caption, dataset_folder))
+
+            if dataset_config.buckets:
+                live_pack_keys.setdefault(pack_dir, set()).add(file_item.get_resized_image_cache_key(dataset_folder))
+
+    return {'live': live, 'live_pack_keys': live_pack_keys, 'cache_dirs': sorted(cache_dirs)}
+
+
+def get_hit_rate(report: dict) -> float:
+    # share of the live keys that are cached. Without a bucket divisibility the live keys hold a
+    # variant per divisibility, so this is a lower bound
+    return report['hits'] / report['live'] if report['live'] > 0 else 0.0
+
+
+def inspect_cache_dir(cache_dir: str, kind: str, live_paths: Set[str], dry_run: bool = True, force: bool = False) -> dict:
+    # everything in the folder that no dataset would load is an orphan
+    report = {
+        'cache_dir': cache_dir,
+        'kind': kind,
+        'live': 0,
+        'hits': 0,
+        'orphans': 0,
+        'orphan_bytes': 0,
+        'deleted': 0,
+        'refused': False,
+        'hit_rate': 0.0,
+    }
+    live_in_dir = {path for path in live_paths if os.path.dirname(path) == cache_dir}
+    report['live'] = len(live_in_dir)
+    if not os.path.isdir(cache_dir):
+        return report
+    orphans = []
+    now = time.time()
+    for file in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, file)
+        if not os.path.isfile(path):
+            continue
+        if is_tmp_cache_file(file) and now - os.path.getmtime(path) <= STALE_TMP_SECONDS:
+            # a job caching right now is still writing it
+            continue
+        if path in live_in_dir:
+            report['hits'] += 1
+        else:
+            orphans.append(path)
+            report['orphan_bytes'] += os.path.getsize(path)
+    report['orphans'] = len(orphans)
+    report['hit_rate'] = get_hit_rate(report)
+
+    if report['hits'] == 0 and len(orphans) > 0 and not force:
+        # nothing matched at all, more likely the keys were worked out with the wrong settings
+        # than every file being dead
+        report['refused'] = True
+        return report
+    if not dry_run:
+        for path in orphans:
+            os.remove(path)
+            report['deleted'] += 1
+    return report
+
+
+def inspect_resized_image_pack(pack_dir: str, live_keys: Set[str], dry_run: bool = True, force: bool = False) -> dict:
+    # the pack is one file, so orphans are compacted out instead of deleted
+    pack = ResizedImagePack(pack_dir)
+    report = {
+        'cache_dir': pack_dir,
+        'kind': 'resized_images',
+        'live': len(live_keys),
+        'hits': len([key for key in pack.index if key in live_keys]),
+        'orphans': 0,
+        'orphan_bytes': 0,
+        'deleted': 0,
+        'refused': False,
+        'hit_rate': 0.0,
+    }
+    orphans = [key for key in pack.index if key not in live_keys]
+    report['orphans'] = len(orphans)
+    report['orphan_bytes'] = sum(pack.get_entry_size(key) for key in orphans)
+    report['hit_rate'] = get_hit_rate(report)
+    if len(orphans) == 0:
+        return report
+    if report['hits'] == 0 and not force:
+        report['refused'] = True
+        return report
+    if not dry_run:
+        pack.compact(live_keys)
+        report['deleted'] = len(orphans)
+    return report
+
+
+def _inspect_dir(args):
+    return inspect_cache_dir(*args)
+
+
+def _inspect_pack(args):
+    return inspect_resized_image_pack(*args)
+
+
+def _get_live_cache_keys(args):
+    return get_live_cache_keys(*args)
+
+
+def inspect_caches(
+        jobs: List[dict],
+        bucket_divisibility: Union[int, None] = None,
+        dry_run: bool = True,
+        force: bool = False,
+        num_workers: int = 1
+) -> List[dict]:
+    """
+    jobs are dicts with a 'model' and a 'datasets' section, like a train process config. Live keys
+    are combined over every dataset first, so a folder shared by several datasets or resolutions
+    only loses what none of them use.
+    """
+    key_args = []
+    for job in jobs:
+        for raw_dataset in preprocess_dataset_raw_config(job['datasets']):
+            key_args.append((raw_dataset, job['model'], bucket_divisibility))
+
+    def run(fn, args_list):
+        if num_workers > 1 and len(args_list) > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                return list(executor.map(fn, args_list))
+        return [fn(args) for args in args_list]
+
+    live = {kind: set() for kind in CACHE_DIR_NAMES}
+    live_pack_keys: Dict[str, Set[str]] = {}
+    dirs_by_kind = {kind: set() for kind in CACHE_DIR_NAMES}
+    for result in run(_get_live_cache_keys, key_args):
+        for kind in CACHE_DIR_NAMES:
+            live[kind].update(result['live'][kind])
+        for pack_dir, keys in result['live_pack_keys'].items():
+            live_pack_keys.setdefault(pack_dir, set()).update(keys)
+        for cache_dir in result['cache_dirs']:
+            for kind, dir_name in CACHE_DIR_NAMES.items():
+                if os.path.basename(cache_dir) == dir_name:
+                    dirs_by_kind[kind].add(cache_dir)
+
+    dir_args = []
+    for kind, cache_dirs in dirs_by_kind.items():
+        # only hand each worker the keys of its own folder
+        live_by_dir: Dict[str, Set[str]] = {}
+        for path in live[kind]:
+            live_by_dir.setdefault(os.path.dirname(path), set()).add(path)
+        for cache_dir in sorted(cache_dirs):
+            dir_args.append((cache_dir, kind, live_by_dir.get(cache_dir, set()), dry_run, force))
+    pack_args = [
+        (pack_dir, keys, dry_run, force) for pack_dir, keys in sorted(live_pack_keys.items()) if os.path.isdir(pack_dir)
+    ]
+    return run(_inspect_dir, dir_args) + run(_inspect_pack, pack_args)
@@ -0,0 +1,256 @@
+import atexit
+import hashlib
+import json
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, List, Union
+
+from toolkit.basic import get_quick_signature_string
+
+CACHE_ROOT_VERSION = 1
+
+# content addressed entries, safe to share between datasets and jobs and to garbage collect
+CACHE_ROOT_KINDS = ['latents', 'text_embeddings', 'clip_vision', 'controls', 'resized_images']
+
+# per dataset bookkeeping, keyed by where the dataset is instead of what is in it
+CACHE_ROOT_DATASETS = 'datasets'
+
+# temp files older than this are left over from a crashed writer
+STALE_TMP_SECONDS = 60 * 60
+
+# jobs hold a lease in here while they use the cache root, see acquire_cache_lease
+CACHE_ROOT_LEASES = 'leases'
+
+# leases of jobs on other machines can not be checked, they count until they are this old
+LEASE_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+
+# slack for file system timestamp precision and the clocks of other machines
+LEASE_MARGIN_SECONDS = 10 * 60
+
+# cache root -> lease file held by this process
+_leases: Dict[str, str] = {}
+
+# path -> (signature, hash) for files hashed by this process
+_content_hashes: Dict[str, list] = {}
+
+
+def get_file_content_hash(path: str, hash_database: Union[dict, None] = None) -> str:
+    # md5 of the file bytes. Remembered against the size and mtime, in hash_database when given
+    # so it survives between runs, so files are only read again when they change
+    signature = get_quick_signature_string(path)
+    for database in [hash_database, _content_hashes]:
+        if database is not None:
+            entry = database.get(path, None)
+            if entry is not None and entry[0] == signature:
+                _content_hashes[path] = entry
+                return entry[1]
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    entry = [signature, md5.hexdigest()]
+    _content_hashes[path] = entry
+    if hash_database is not None:
+        hash_database[path] = entry
+    return entry[1]
+
+
+def get_cache_entry_path(cache_root: str, kind: str, info: dict, ext: str = '.safetensors') -> str:
+    # info holds the content hash of every input plus the encoder and processing params,
+    # never a path, so copies and symlinks of a file share their entries
+    info = dict(info)
+    info['cache_root_version'] = CACHE_ROOT_VERSION
+    hash_input = json.dumps(info, sort_keys=True).encode('utf-8')
+    key = hashlib.md5(hash_input).hexdigest()
+    return os.path.join(cache_root, kind, key[:2], f'{key}{ext}')
+
+
+def get_dataset_cache_dir(cache_root: str, dataset_folder: str, kind: str = CACHE_ROOT_DATASETS) -> str:
+    key = hashlib.md5(os.path.realpath(dataset_folder).encode('utf-8')).hexdigest()
+    return os.path.join(cache_root, kind, key)
+
+
+@contextmanager
+def atomic_write_path(path: str):
+    """
+    Yields a temp path next to path to write to, and moves it in place once the write finished.
+    Readers only ever see complete files, and jobs writing the same entry at once each move in
+    a complete copy.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    name, ext = os.path.splitext(os.path.basename(path))
+    # keep the extension, some writers pick the format from it
+    tmp_path = os.path.join(directory, f'.{name}.{uuid.uuid4().hex}.tmp{ext}')
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def touch_cache_entry(path: str):
+    # the mtime is the last use for the lru garbage collection
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def get_lease_dir(cache_root: str) -> str:
+    return os.path.join(cache_root, CACHE_ROOT_DATASETS, CACHE_ROOT_LEASES)
+
+
+def acquire_cache_lease(cache_root: str) -> str:
+    """
+    Marks the cache root as in use by this process until it exits. A job touches or writes every
+    entry it reads while setting up its datasets, after its lease started, so the garbage
+    collection keeps everything used since the oldest active lease started.
+    """
+    key = os.path.abspath(cache_root)
+    if key in _leases:
+        return _leases[key]
+    path = os.path.join(get_lease_dir(cache_root), f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex}.json')
+    with atomic_write_path(path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump({'host': socket.gethostname(), 'pid': os.getpid(), 'started': time.time()}, f)
+    _leases[key] = path
+    atexit.register(_release_cache_lease, path, os.getpid())
+    return path
+
+
+def _release_cache_lease(path: str, owner_pid: int):
+    # forked dataloader workers can run this too, only the process that took it gives it up
+    if os.getpid() != owner_pid:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # someone else's, but it is there
+        return True
+    return True
+
+
+def get_active_leases(cache_root: str, now: Union[float, None] = None) -> List[dict]:
+    now = time.time() if now is None else now
+    lease_dir = get_lease_dir(cache_root)
+    if not os.path.isdir(lease_dir):
+        return []
+    leases = []
+    for file in os.listdir(lease_dir):
+        if file.startswith('.') or not file.endswith('.json'):
+            continue
+        path = os.path.join(lease_dir, file)
+        try:
+            with open(path, 'r') as f:
+                lease = json.load(f)
+            modified = os.stat(path).st_mtime
+        except (OSError, ValueError):
+            continue
+        # os.kill would end the process on windows, go by age there
+        if lease.get('host', None) == socket.gethostname() and os.name != 'nt':
+            if not is_process_alive(lease['pid']):
+                # left by a job that crashed
+                continue
+        elif now - modified > LEASE_MAX_AGE_SECONDS:
+            continue
+        lease['path'] = path
+        leases.append(lease)
+    return leases
+
+
+def is_tmp_cache_file(file_name: str) -> bool:
+    # what atomic_write_path writes to before it is moved into place
+    return file_name.startswith('.') and '.tmp' in file_name
+
+
+def list_cache_entries(cache_root: str, kinds: Union[List[str], None] = None) -> List[dict]:
+    entries = []
+    for kind in kinds if kinds is not None else CACHE_ROOT_KINDS:
+        kind_dir = os.path.join(cache_root, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for root, _, files in os.walk(kind_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # removed by someone else in the meantime
+                    continue
+                entries.append({
+                    'path': path,
+                    'kind': kind,
+                    'size': stat.st_size,
+                    'last_used': stat.st_mtime,
+                    'is_tmp': is_tmp_cache_file(file),
+                })
+    return entries
+
+
+def collect_cache_garbage(
+        cache_root: str,
+        max_bytes: int,
+        dry_run: bool = False,
+        now: Union[float, None] = None
+) -> dict:
+    """
+    Removes the least recently used entries until the cache root is under max_bytes, plus any
+    temp files left by crashed writers. Running jobs read their entries straight from disk, so
+    entries used since the oldest active lease started are never removed, even if that leaves
+    the cache root over max_bytes.
+    """
+    now = time.time() if now is None else now
+    leases = get_active_leases(cache_root, now=now)
+    protect_after = None
+    if len(leases) > 0:
+        protect_after = min(lease['started'] for lease in leases) - LEASE_MARGIN_SECONDS
+    entries = list_cache_entries(cache_root)
+    removed = []
+    kept = []
+    protected = []
+    for entry in entries:
+        if entry['is_tmp']:
+            # a writer may still be busy with a young one
+            if now - entry['last_used'] > STALE_TMP_SECONDS:
+                removed.append(entry)
+        elif protect_after is not None and entry['last_used'] >= protect_after:
+            protected.append(entry)
+        else:
+            kept.append(entry)
+
+    total = sum(entry['size'] for entry in kept + protected)
+    kept.sort(key=lambda x: x['last_used'])
+    while total > max_bytes and len(kept) > 0:
+        entry = kept.pop(0)
+        total -= entry['size']
+        removed.append(entry)
+
+    if not dry_run:
+        for entry in removed:
+            try:
+                os.remove(entry['path'])
+            except OSError:
+                pass
+    return {
+        'removed_files': len(removed),
+        'removed_bytes': sum(entry['size'] for entry in removed),
+        'kept_files': len(kept) + len(protected),
+        'kept_bytes': total,
+        'protected_files': len(protected),
+        'protected_bytes': sum(entry['size'] for entry in protected),
+        'active_leases': len(leases),
+    }
@@ -0,0 +1,46 @@
+import hashlib
+from typing import List, Union
+
+import torch.distributed as dist
+
+
+def get_shard_for_key(key: str, num_shards: int) -> int:
+    # md5 instead of hash() so every process and every run agrees
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest(), 16) % num_shards
+
+
+class CacheShard:
+    """
+    The part of a disk cache build one rank does. Work is split by hashing the cache path, each rank
+    writes its own files and merge() waits for every rank and gathers what they wrote.
+    """
+
+    def __init__(self, shard_index: Union[int, None] = None, num_shards: Union[int, None] = None):
+        is_distributed = dist.is_available() and dist.is_initialized()
+        if num_shards is None:
+            num_shards = dist.get_world_size() if is_distributed else 1
+        if shard_index is None:
+            shard_index = dist.get_rank() if is_distributed else 0
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+
+    @property
+    def is_distributed(self) -> bool:
+        return self.num_shards > 1
+
+    def is_mine(self, key: str) -> bool:
+        return get_shard_for_key(key, self.num_shards) == self.shard_index
+
+    def split(self, keys: List[str]) -> List[str]:
+        return [key for key in keys if self.is_mine(key)]
+
+    def merge(self, written: List[str]) -> List[str]:
+        # acts as the barrier, nobody reads the cache before every rank finished its part
+        if not self.is_distributed or not dist.is_initialized():
+            return list(written)
+        gathered = [None] * dist.get_world_size()
+        dist.all_gather_object(gathered, list(written))
+        merged = []
+        for keys in gathered:
+            merged.extend(keys)
+        return merged
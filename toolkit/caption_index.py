@@ -0,0 +1,88 @@
+import os
+from typing import Dict, List, Set, Tuple, Union
+
+# folders can hold a caption used for every image in them without their own
+DEFAULT_CAPTION_NAME = 'default'
+
+
+def get_caption_path(img_path: str, caption_ext: str) -> str:
+    return os.path.splitext(img_path)[0] + caption_ext
+
+
+class CaptionIndex:
+    """
+    The text of every caption file and folder default caption of a dataset, read once at setup, with
+    the mtime and size each was read at. Looking a caption up does not touch the filesystem, refresh()
+    rereads the ones that changed.
+    """
+
+    def __init__(self, img_paths: List[str], caption_ext: str):
+        self.caption_ext = caption_ext
+        self.caption_paths: Set[str] = set(get_caption_path(path, caption_ext) for path in img_paths)
+        self.directories: List[str] = sorted(set(os.path.dirname(path) for path in img_paths))
+        # path -> text, only for files that exist
+        self.captions: Dict[str, str] = {}
+        self.signatures: Dict[str, Tuple[int, int]] = {}
+        self.refresh()
+
+    def _get_default_paths(self, directory: str) -> List[str]:
+        # default with the caption extension first, then default.txt
+        paths = [os.path.join(directory, DEFAULT_CAPTION_NAME + self.caption_ext)]
+        if self.caption_ext != '.txt':
+            paths.append(os.path.join(directory, DEFAULT_CAPTION_NAME + '.txt'))
+        return paths
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        # one listing per folder instead of an exists per image
+        wanted = set(self.caption_paths)
+        for directory in self.directories:
+            wanted.update(self._get_default_paths(directory))
+        found = {}
+        for directory in self.directories:
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.path in wanted and entry.is_file():
+                    stat = entry.stat()
+                    found[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        return found
+
+    def refresh(self) -> Set[str]:
+        """
+        Rereads the caption files that were added, changed or removed since they were last read and
+        returns their paths
+        """
+        found = self._scan()
+        changed = set()
+        for path in list(self.captions.keys()):
+            if path not in found:
+                del self.captions[path]
+                del self.signatures[path]
+                changed.add(path)
+        for path, signature in found.items():
+            if self.signatures.get(path) == signature:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.captions[path] = f.read()
+            except OSError:
+                continue
+            self.signatures[path] = signature
+            changed.add(path)
+        return changed
+
+    def get_caption(self, caption_path: str) -> Union[str, None]:
+        # None when there is no caption file
+        return self.captions.get(caption_path, None)
+
+    def get_default_caption(self, directory: str) -> Union[str, None]:
+        for path in self._get_default_paths(directory):
+            if path in self.captions:
+                return self.captions[path]
+        return None
+
+    def __deepcopy__(self, memo):
+        # file items are deep copied for every sample, they all share the one index
+        return self
@@ -0,0 +1,196 @@
+import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
+
+import torch
+from safetensors import safe_open
+from tqdm import tqdm
+
+from toolkit.basic import parse_size
+from toolkit.safetensors_stream import ShardedSafeTensorsWriter
+
+MERGE_METHODS = ['weighted_sum', 'add_difference', 'ties']
+
+
+class MergeModel:
+    def __init__(self, **kwargs):
+        self.path: str = kwargs.get('path', None)
+        if self.path is None:
+            raise ValueError("path is required for every merge model")
+        self.weight: float = float(kwargs.get('weight', 1.0))
+        # pattern -> weight. Patterns are regex searched against the key, first match wins
+        self.block_weights: OrderedDict = OrderedDict(kwargs.get('block_weights', {}) or {})
+        self._compiled = [(re.compile(pattern), float(w)) for pattern, w in self.block_weights.items()]
+
+    def get_weight(self, key: str) -> float:
+        for pattern, weight in self._compiled:
+            if pattern.search(key):
+                return weight
+        return self.weight
+
+
+def trim_to_density(delta: torch.Tensor, density: float) -> torch.Tensor:
+    # keep the top density fraction of values by magnitude
+    if density >= 1.0 or delta.numel() == 0:
+        return delta
+    k = int(delta.numel() * (1.0 - density))
+    if k <= 0:
+        return delta
+    threshold = delta.abs().flatten().kthvalue(k).values
+    return delta * (delta.abs() > threshold)
+
+
+def merge_tensors(
+        tensors: List[torch.Tensor],
+        weights: List[float],
+        method: str = 'weighted_sum',
+        base: Optional[torch.Tensor] = None,
+        density: float = 1.0,
+        normalize: bool = True,
+) -> torch.Tensor:
+    if method == 'weighted_sum':
+        merged = torch.zeros_like(tensors[0])
+        for tensor, weight in zip(tensors, weights):
+            merged.add_(tensor, alpha=weight)
+        return merged
+
+    if base is None:
+        raise ValueError(f"{method} merge requires a base model")
+
+    if method == 'add_difference':
+        merged = base.clone()
+        for tensor, weight in zip(tensors, weights):
+            merged.add_(tensor - base, alpha=weight)
+        return merged
+
+    if method == 'ties':
+        # TIES: trim each task vector, elect a sign per element, then average only the agreeing values
+        deltas = torch.stack([trim_to_density(tensor - base, density) * weight for tensor, weight in
+                              zip(tensors, weights)])
+        elected_sign = torch.sign(deltas.sum(dim=0))
+        agree = (torch.sign(deltas) == elected_sign) & (deltas != 0)
+        merged_delta = (deltas * agree).sum(dim=0)
+        if normalize:
+            weight_tensor = torch.tensor(weights, dtype=deltas.dtype, device=deltas.device)
+            weight_tensor = weight_tensor.view(-1, *([1] * base.ndim))
+            divisor = (weight_tensor.abs() * agree).sum(dim=0)
+            merged_delta = merged_delta / divisor.clamp(min=1e-8)
+            merged_delta = merged_delta * (divisor > 0)
+        return base + merged_delta
+
+    raise ValueError(f"Unknown merge method {method}, must be one of {MERGE_METHODS}")
+
+
+@torch.no_grad()
+def merge_checkpoints(
+        models: List[MergeModel],
+        output_path: str,
+        method: str = 'weighted_sum',
+        base_model_path: Optional[str] = None,
+        density: float = 1.0,
+        normalize: bool = True,
+        device: Union[str, torch.device] = 'cpu',
+        save_dtype: Optional[torch.dtype] = None,
+        max_shard_size: Union[int, str, None] = 0,
+        num_workers: int = 0,
+        metadata: Optional[Dict[str, str]] = None,
+) -> dict:
+    """
+    Merges safetensors checkpoints one key at a time. Every model is opened lazily with
+    safe_open, so only the tensors for the key being merged (plus whatever is in flight
+    on the worker pool) are in memory. Returns merge stats including throughput.
+    """
+    if method not in MERGE_METHODS:
+        raise ValueError(f"Unknown merge method {method}, must be one of {MERGE_METHODS}")
+    if method != 'weighted_sum' and base_model_path is None:
+        raise ValueError(f"{method} merge requires base_model")
+    if len(models) == 0:
+        raise ValueError("No models to merge")
+
+    handles = [safe_open(model.path, framework="pt", device="cpu") for model in models]
+    base_handle = safe_open(base_model_path, framework="pt", device="cpu") if base_model_path is not None else None
+    # the base model decides the keys and layout, otherwise the first model does
+    primary = base_handle if base_handle is not None else handles[0]
+    model_keys = [set(h.keys()) for h in handles]
+
+    stats = OrderedDict([
+        ('keys', 0),
+        ('copied_keys', 0),
+        ('bytes_read', 0),
+        ('bytes_written', 0),
+    ])
+
+    def merge_key(key, tensors, weights, base):
+        tensors = [t.to(device, dtype=torch.float32) for t in tensors]
+        if base is not None:
+            base = base.to(device, dtype=torch.float32)
+        merged = merge_tensors(tensors, weights, method, base=base, density=density, normalize=normalize)
+        return key, merged
+
+    def load_key(key):
+        primary_tensor = primary.get_tensor(key)
+        stats['bytes_read'] += primary_tensor.numel() * primary_tensor.element_size()
+        # non float tensors and keys missing in a model are passed through from the primary model
+        if not primary_tensor.is_floating_point() or not all(key in keys for keys in model_keys):
+            stats['copied_keys'] += 1
+            return None, primary_tensor
+        tensors = []
+        for handle in (handles if base_handle is not None else handles[1:]):
+            tensor = handle.get_tensor(key)
+            stats['bytes_read'] += tensor.numel() * tensor.element_size()
+            tensors.append(tensor)
+        if base_handle is None:
+            tensors.insert(0, primary_tensor)
+            base = None
+        else:
+            base = primary_tensor
+        weights = [model.get_weight(key) for model in models]
+        return (tensors, weights, base), primary_tensor
+
+    def write(key, tensor, orig_dtype):
+        out_dtype = save_dtype if save_dtype is not None and tensor.is_floating_point() else orig_dtype
+        tensor = tensor.to('cpu', dtype=out_dtype)
+        writer.add(key, tensor)
+        stats['bytes_written'] += tensor.numel() * tensor.element_size()
+        stats['keys'] += 1
+
+    writer = ShardedSafeTensorsWriter(output_path, metadata, parse_size(max_shard_size))
+    executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+    # bounds how many merged tensors can be waiting to be written
+    max_in_flight = max(1, num_workers * 2)
+    pending = deque()
+
+    start = time.time()
+    try:
+        for key in tqdm(list(primary.keys()), desc='Merging'):
+            args, primary_tensor = load_key(key)
+            orig_dtype = primary_tensor.dtype
+            if args is None:
+                write(key, primary_tensor, orig_dtype)
+                continue
+            if executor is None:
+                write(*merge_key(key, *args), orig_dtype)
+                continue
+            pending.append((executor.submit(merge_key, key, *args), orig_dtype))
+            while len(pending) >= max_in_flight:
+                future, dtype = pending.popleft()
+                write(*future.result(), dtype)
+        while len(pending) > 0:
+            future, dtype = pending.popleft()
+            write(*future.result(), dtype)
+        output_paths = writer.close()
+    except Exception:
+        writer.abort()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    elapsed = max(time.time() - start, 1e-9)
+    stats['output_paths'] = output_paths
+    stats['seconds'] = elapsed
+    stats['read_gb_per_sec'] = stats['bytes_read'] / elapsed / 1e9
+    stats['write_gb_per_sec'] = stats['bytes_written'] / elapsed / 1e9
+    return stats
@@ -6,6 +6,7 @@ import random
 import torch
 import torchaudio
 
+from toolkit.latent_quantization import get_latent_cache_dtype
 from toolkit.prompt_utils import PromptEmbeds
 
 ImgExt = Literal['jpg', 'png', 'webp']
@@ -212,6 +213,15 @@ class NetworkConfig:
         # ramtorch, doesn't work yet
         self.layer_offloading = kwargs.get('layer_offloading', False)
 
+        # keep an fp32 residual of every merged weight when merging in for sampling so merging out
+        # restores the weights exactly. Uses 4 bytes per merged weight value
+        self.merge_residual = kwargs.get('merge_residual', False)
+        # allow merging in on quantized models by merging into dequantized copies of the weights
+        self.merge_quantized_shadow = kwargs.get('merge_quantized_shadow', False)
+        # computes linear loras with less overhead, in their weight dtype and with a fused add when it
+        # matches the activations, when dropout is off and the multiplier is a single value
+        self.lora_fast_forward = kwargs.get('lora_fast_forward', True)
+
 
 AdapterTypes = Literal['t2i', 'ip', 'ip+', 'clip', 'ilora', 'photo_maker', 'control_net', 'control_lora', 'i2v']
 
@@ -455,7 +465,13 @@ class TrainConfig:
         # blank prompt preservation will preserve the model's knowledge of a blank prompt
         self.blank_prompt_preservation = kwargs.get('blank_prompt_preservation', False)
         self.blank_prompt_preservation_multiplier = kwargs.get('blank_prompt_preservation_multiplier', 1.0)
-        
+
+        # run the preservation pass and its network free prior in the same forward as the training batch
+        # by giving every sample its own network multiplier (0.0 for the prior). Saves two forward passes
+        # and a backward per step, but holds activations for 3x the batch at once, so peak memory goes up.
+        # Only lora / locon networks without cfg, adapters or control images, otherwise it uses separate passes
+        self.fuse_preservation_forward = kwargs.get('fuse_preservation_forward', False)
+
         # legacy
         if match_adapter_assist and self.match_adapter_chance == 0.0:
             self.match_adapter_chance = 1.0
@@ -520,6 +536,14 @@ class TrainConfig:
         self.do_paramiter_swapping = kwargs.get('do_paramiter_swapping', False)
         # 0.1 is 10% of the parameters active at a time lower is less vram, higher is more
         self.paramiter_swapping_factor = kwargs.get('paramiter_swapping_factor', 0.1)
+        # keeps optimizer state on the cpu and streams it to the device in chunks around the step
+        self.offload_optimizer_state = kwargs.get('offload_optimizer_state', False)
+        # about how much optimizer state is streamed in at a time. Param groups are split into chunks this size
+        self.optimizer_offload_chunk_mb = kwargs.get('optimizer_offload_chunk_mb', 256)
+        # device: the update runs on the training device, cpu: params and grads are streamed to the cpu for the update
+        self.optimizer_offload_update_device = kwargs.get('optimizer_offload_update_device', 'device')
+        # when set, offloaded state is kept in memory mapped files in this folder instead of pinned memory
+        self.optimizer_offload_mmap_dir = kwargs.get('optimizer_offload_mmap_dir', None)
         # bypass the guidance embedding for training. For open flux with guidance embedding
         self.bypass_guidance_embedding = kwargs.get('bypass_guidance_embedding', False)
         
@@ -552,6 +576,9 @@ class TrainConfig:
         # for multi stage models, how often to switch the boundary
         self.switch_boundary_every: int = kwargs.get('switch_boundary_every', 1)
 
+        # how many batches ahead to copy to the device in the background while training on the current one. 0 to copy them in the train loop
+        self.prefetch_batches: int = kwargs.get('prefetch_batches', 0)
+
 
 ModelArch = Literal['sd1', 'sd2', 'sd3', 'sdxl', 'pixart', 'pixart_sigma', 'auraflow', 'flux', 'flex1', 'flex2', 'lumina2', 'vega', 'ssd', 'wan21']
 
@@ -729,6 +756,25 @@ class ModelConfig:
         
 
 
+def get_latent_space_version(model_config: ModelConfig) -> str:
+    # part of the latent cache keys. Goes by the arch like the loaded models do, so the cache
+    # inspection works out the same keys as training without loading one
+    if model_config.latent_space_version is not None:
+        return model_config.latent_space_version
+    elif model_config.arch == 'sdxl':
+        return 'sdxl'
+    elif model_config.arch == 'sd3':
+        return 'sd3'
+    elif model_config.arch == 'auraflow':
+        return 'sdxl'
+    elif model_config.arch == 'flux':
+        return 'flux1'
+    elif model_config.is_pixart_sigma:
+        return 'sdxl'
+    else:
+        return model_config.arch
+
+
 class EMAConfig:
     def __init__(self, **kwargs):
         self.use_ema: bool = kwargs.get('use_ema', False)
@@ -850,6 +896,37 @@ class DatasetConfig:
         self.scale: float = kwargs.get('scale', 1.0)
         self.buckets: bool = kwargs.get('buckets', True)
         self.bucket_tolerance: int = kwargs.get('bucket_tolerance', 64)
+        # when set, each bucket gets its own batch size of pixel_budget // (width * height * num_frames)
+        # instead of the train batch_size, so small buckets fill the device. The loss of each sample is
+        # weighted by bucket batch size / batch_size so every sample counts the same as with a fixed batch.
+        # eg 1048576 with batch_size 1 is one 1024x1024 image or four 512x512 images per step
+        self.pixel_budget: Union[int, None] = kwargs.get('pixel_budget', None)
+        # upper limit for the bucket batch size when using a pixel budget
+        self.pixel_budget_max_batch_size: int = kwargs.get('pixel_budget_max_batch_size', 16)
+        # when latents are not cached, decode, exif transpose and resize every image to its bucket once and
+        # keep them in a packed uint8 file next to the dataset. Workers then only crop, augment and transform.
+        # Takes width * height * 3 bytes per image (and per flip)
+        self.cache_resized_images: bool = kwargs.get('cache_resized_images', False)
+        # with cache_latents, keep the latents in one store in shared memory (/dev/shm) that every rank and
+        # dataloader worker on the node maps, instead of a copy per process. Built by the first process
+        self.shared_latent_cache: bool = kwargs.get('shared_latent_cache', False)
+        # store cached latents as bf16, fp8 (e4m3 with a scale per channel) or int8 (scale and offset per
+        # channel) instead of the model dtype, on disk and in memory. Turned back into the model dtype when
+        # loaded. None keeps them as they come out of the vae
+        self.latent_cache_dtype: Union[str, None] = get_latent_cache_dtype(kwargs.get('latent_cache_dtype', None))
+        # with latents or text embeddings cached to disk only, keep up to this many MB of loaded cache files in
+        # an LRU in each dataloader worker and load the files of its next batch in the background. 0 is off
+        self.cache_memory_budget_mb: float = float(kwargs.get('cache_memory_budget_mb', 0))
+        # read every caption file and folder default caption once at setup instead of on every sample
+        self.preload_captions: bool = kwargs.get('preload_captions', True)
+        # with preload_captions, check for edited captions between epochs and reload them
+        self.watch_captions: bool = kwargs.get('watch_captions', False)
+        # with cache_text_embeddings, cache this many caption variants per image with shuffle_tokens,
+        # token_dropout_rate and random_triggers applied (seeded by the caption), plus the empty caption when
+        # caption_dropout_rate is set, and pick one every step. Variants are stored once per unique caption
+        self.text_embedding_variants: int = kwargs.get('text_embedding_variants', 0)
+        # how many caption variants are encoded at once
+        self.text_embedding_variants_batch_size: int = kwargs.get('text_embedding_variants_batch_size', 8)
         self.is_reg: bool = kwargs.get('is_reg', False)
         self.prior_reg: bool = kwargs.get('prior_reg', False)
         self.network_weight: float = float(kwargs.get('network_weight', 1.0))
@@ -903,6 +980,11 @@ class DatasetConfig:
         self.cache_latents_to_disk: bool = kwargs.get('cache_latents_to_disk', False)
         self.cache_clip_vision_to_disk: bool = kwargs.get('cache_clip_vision_to_disk', False)
         self.cache_text_embeddings: bool = kwargs.get('cache_text_embeddings', False)
+        # put the latent, text embedding, clip vision and control caches in this folder instead of hidden folders
+        # next to the images, eg on a fast local disk. Entries are keyed by file content and encoder settings, so
+        # read only, copied and symlinked datasets all work and every dataset and job shares them. Defaults to the
+        # AITK_CACHE_ROOT environment variable. Trim it with scripts/gc_cache_root.py
+        self.cache_root: Union[str, None] = kwargs.get('cache_root', os.environ.get('AITK_CACHE_ROOT', None))
 
         self.standardize_images: bool = kwargs.get('standardize_images', False)
 
@@ -936,6 +1018,8 @@ class DatasetConfig:
 
         self.num_workers: int = kwargs.get('num_workers', 2)
         self.prefetch_factor: int = kwargs.get('prefetch_factor', 2)
+        # have the dataloader copy batches into pinned memory, for faster and async copies to the gpu
+        self.pin_memory: bool = kwargs.get('pin_memory', False)
         self.extra_values: List[float] = kwargs.get('extra_values', [])
         self.square_crop: bool = kwargs.get('square_crop', False)
         # apply same augmentations to control images. Usually want this true unless special case
@@ -953,6 +1037,11 @@ class DatasetConfig:
         # this could have various issues with shorter videos and videos with variable fps
         # I recommend trimming your videos to the desired length and using shrink_video_to_frames(default)
         self.fps: int = kwargs.get('fps', 16)
+        # when caching video latents, clips are decoded in this many background threads while the vae
+        # encodes, and this many clips from the same bucket are encoded together. Cached clips always
+        # use the first clip of a video when not shrinking the video to frames
+        self.video_cache_workers: int = kwargs.get('video_cache_workers', 2)
+        self.video_cache_batch_size: int = kwargs.get('video_cache_batch_size', 1)
         
         # debug the frame count and frame selection. You dont need this. It is for debugging.
         self.debug: bool = kwargs.get('debug', False)
@@ -9,6 +9,8 @@ from tqdm import tqdm
 
 from torchvision import transforms
 
+from toolkit.cache_root import atomic_write_path, get_cache_entry_path, get_file_content_hash, touch_cache_entry
+
 # supress all warnings
 import warnings
 
@@ -28,8 +30,10 @@ img_ext_list = ['.jpg', '.jpeg', '.png', '.webp']
 
 
 class ControlGenerator:
-    def __init__(self, device, sd=None):
+    def __init__(self, device, sd=None, cache_root=None):
         self.device = device
+        # when set, controls are stored there by image content instead of in a _controls folder
+        self.cache_root = cache_root
         self.sd = sd  # optional. It will unload the model if not None
         self.has_unloaded = False
         self.control_depth_model = None
@@ -39,16 +43,32 @@ class ControlGenerator:
         self.debug = False
         self.regen = False
 
+    def get_controls_folder_and_name(self, img_path):
+        if self.cache_root is not None:
+            control_path = get_cache_entry_path(
+                self.cache_root, 'controls', {'content_hash': get_file_content_hash(img_path)}, ext=''
+            )
+            return os.path.dirname(control_path), os.path.basename(control_path)
+        coltrols_folder = os.path.join(os.path.dirname(img_path), '_controls')
+        file_name_no_ext = os.path.splitext(os.path.basename(img_path))[0]
+        return coltrols_folder, file_name_no_ext
+
+    def save_control(self, img: Image, save_path):
+        with atomic_write_path(save_path) as tmp_path:
+            img.save(tmp_path)
+        return save_path
+
     def get_control_path(self, img_path, control_type: ControlTypes):
         if self.regen:
             return self._generate_control(img_path, control_type)
-        coltrols_folder = os.path.join(os.path.dirname(img_path), '_controls')
-        file_name_no_ext = os.path.splitext(os.path.basename(img_path))[0]
+        coltrols_folder, file_name_no_ext = self.get_controls_folder_and_name(img_path)
         file_name_no_ext_control = f"{file_name_no_ext}.{control_type}"
         for ext in img_ext_list:
             possible_path = os.path.join(
                 coltrols_folder, file_name_no_ext_control + ext)
             if os.path.exists(possible_path):
+                if self.cache_root is not None:
+                    touch_cache_entry(possible_path)
                 return possible_path
         # if we get here, we need to generate the control
         return self._generate_control(img_path, control_type)
@@ -61,8 +81,7 @@ class ControlGenerator:
         device = self.device
         image: Image = None
 
-        coltrols_folder = os.path.join(os.path.dirname(img_path), '_controls')
-        file_name_no_ext = os.path.splitext(os.path.basename(img_path))[0]
+        coltrols_folder, file_name_no_ext = self.get_controls_folder_and_name(img_path)
 
         # we need to generate the control. Unload model if not unloaded
         if not self.has_unloaded:
@@ -107,8 +126,7 @@ class ControlGenerator:
             out_tensor = out_tensor.squeeze(0).cpu().numpy()
             img = Image.fromarray(out_tensor.astype('uint8'))
             img = img.resize(in_size, Image.LANCZOS)
-            img.save(save_path)
-            return save_path
+            return self.save_control(img, save_path)
         elif control_type == 'pose':
             self.debug_print("Generating pose control")
             if self.control_pose_model is None:
@@ -131,8 +149,7 @@ class ControlGenerator:
             img = self.control_pose_model(
                 img, output_type="pil", include_hands=True, include_face=True, detect_resolution=detect_res)
             img = img.convert('RGB')
-            img.save(save_path)
-            return save_path
+            return self.save_control(img, save_path)
 
         elif control_type == 'line':
             self.debug_print("Generating line control")
@@ -146,8 +163,7 @@ class ControlGenerator:
             # img = img.filter(ImageFilter.GaussianBlur(radius=1))
             img = img.point(lambda p: p > 128 and 255)
             img = img.convert('RGB')
-            img.save(save_path)
-            return save_path
+            return self.save_control(img, save_path)
         elif control_type == 'inpaint' or control_type == 'mask':
             self.debug_print("Generating inpaint/mask control")
             img = image.copy()
@@ -186,8 +202,7 @@ class ControlGenerator:
             else:
                 img = mask
                 img = img.convert('RGB')
-            img.save(save_path)
-            return save_path
+            return self.save_control(img, save_path)
         else:
             raise Exception(f"Error: unknown control type {control_type}")
 
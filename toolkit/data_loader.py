@@ -1,10 +1,11 @@
+import bisect
 import copy
 import json
 import os
 import random
 import traceback
 from functools import lru_cache
-from typing import List, TYPE_CHECKING
+from typing import List, TYPE_CHECKING, Union
 
 import cv2
 import numpy as np
@@ -12,15 +13,18 @@ import torch
 from PIL import Image
 from PIL.ImageOps import exif_transpose
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader, ConcatDataset
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, Sampler, get_worker_info
 from tqdm import tqdm
 import albumentations as A
 
 from toolkit import image_utils
 from toolkit.buckets import get_bucket_for_image_size, BucketResolution
+from toolkit.caption_index import CaptionIndex
 from toolkit.config_modules import DatasetConfig, preprocess_dataset_raw_config
-from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin, ControlCachingMixin, TextEmbeddingCachingMixin
+from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin, ControlCachingMixin, TextEmbeddingCachingMixin, ResizedImageCachingMixin
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
+from toolkit.cache_root import acquire_cache_lease, atomic_write_path, get_dataset_cache_dir
+from toolkit.memory_cache_tier import get_memory_cache_tier
 from toolkit.print import print_acc
 from toolkit.accelerator import get_accelerator
 
@@ -378,15 +382,21 @@ class PairedImageDataset(Dataset):
         return img, prompt, (self.neg_weight, self.pos_weight)
 
 
-class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin, TextEmbeddingCachingMixin, BucketsMixin, CaptionMixin, Dataset):
+class AiToolkitDataset(LatentCachingMixin, ResizedImageCachingMixin, ControlCachingMixin, CLIPCachingMixin, TextEmbeddingCachingMixin, BucketsMixin, CaptionMixin, Dataset):
 
     def __init__(
             self,
             dataset_config: 'DatasetConfig',
             batch_size=1,
             sd: 'StableDiffusion' = None,
+            seed: Union[int, None] = None,
     ):
         self.dataset_config = dataset_config
+        # seeds the bucket shuffles and crops when set, so a resumed run makes the same buckets
+        self.seed = seed
+        if dataset_config.cache_root is not None:
+            # before any entry is touched, so the garbage collection keeps what this job reads
+            acquire_cache_lease(dataset_config.cache_root)
         # update bucket divisibility
         self.dataset_config.bucket_tolerance = sd.get_bucket_divisibility()
         self.is_video = dataset_config.num_frames > 1
@@ -417,6 +427,7 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
         self.random_crop = self.random_scale if self.random_scale else dataset_config.random_crop
         self.resolution = dataset_config.resolution
         self.caption_dict = None
+        self.caption_index: Union[CaptionIndex, None] = None
         self.file_list: List['FileItemDTO'] = []
 
         # check if dataset_path is a folder or json
@@ -468,6 +479,11 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
             dataset_folder = os.path.dirname(dataset_folder)
         
         dataset_size_file = os.path.join(dataset_folder, '.aitk_size.json')
+        if self.dataset_config.cache_root is not None:
+            # the dataset may be read only
+            dataset_size_file = os.path.join(
+                get_dataset_cache_dir(self.dataset_config.cache_root, dataset_folder), '.aitk_size.json'
+            )
         dataloader_version = "0.1.2"
         if os.path.exists(dataset_size_file):
             try:
@@ -510,8 +526,9 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                 bad_count += 1
 
         # save the size database
-        with open(dataset_size_file, 'w') as f:
-            json.dump(self.size_database, f)
+        with atomic_write_path(dataset_size_file) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.size_database, f)
         
         if self.is_video:
             print_acc(f"  -  Found {len(self.file_list)} videos")
@@ -546,6 +563,9 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
             else:
                 print_acc(f"  -  Found {len(self.file_list)} images after adding flips")
 
+        if self.dataset_config.preload_captions:
+            self.setup_caption_index()
+
         self.setup_epoch()
 
     def setup_epoch(self):
@@ -557,6 +577,8 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                 self.setup_buckets()
             if self.is_caching_latents:
                 self.cache_latents_all_latents()
+            elif self.dataset_config.cache_resized_images and self.dataset_config.buckets and not self.is_video:
+                self.cache_resized_images()
             if self.is_caching_clip_vision_to_disk:
                 self.cache_clip_vision_to_disk()
             if self.is_caching_text_embeddings:
@@ -565,6 +587,8 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                 # always do this last
                 self.setup_controls()
         else:
+            if self.caption_index is not None and self.dataset_config.watch_captions:
+                self.refresh_caption_index()
             if self.dataset_config.poi is not None:
                 # handle cropping to a specific point of interest
                 # setup buckets every epoch
@@ -582,6 +606,19 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
         file_item.load_caption(self.caption_dict)
         return file_item
 
+    def get_memory_cache_items(self, item) -> list:
+        # the disk cache files __getitem__(item) will load
+        if self.dataset_config.buckets:
+            if len(self.batch_indices) - 1 < item:
+                return []
+            idx_list = self.batch_indices[item]
+        else:
+            idx_list = [item]
+        items = []
+        for idx in idx_list:
+            items += self.file_list[idx].get_memory_cache_items()
+        return items
+
     def __getitem__(self, item):
         if self.dataset_config.buckets:
             # for buckets we collate ourselves for now
@@ -591,20 +628,142 @@ class AiToolkitDataset(LatentCachingMixin, ControlCachingMixin, CLIPCachingMixin
                 # tried everything to solve this. No way to reset length when redoing things. Pick another index
                 item = random.randint(0, len(self.batch_indices) - 1)
             idx_list = self.batch_indices[item]
-            return [self._get_single_item(idx) for idx in idx_list]
+            file_items = [self._get_single_item(idx) for idx in idx_list]
+            if self.dataset_config.pixel_budget is not None:
+                # the loss is a mean over the batch, scale it so each sample weighs the same
+                # as it would in a batch of batch_size no matter how large its bucket batch is
+                for file_item in file_items:
+                    file_item.loss_multiplier = file_item.loss_multiplier * len(file_items) / self.batch_size
+            return file_items
         else:
             # Dataloader is batching
             return self._get_single_item(item)
 
 
+class KnownOrderSampler(Sampler):
+    """
+    Shuffles like shuffle=True, with each epoch's order drawn from the seed and the epoch so a resumed run
+    draws the same one and starts where it left off. The order is drawn as soon as the dataloader iterator
+    is made, before the workers start, and handed to a PrefetchingConcatDataset so the workers know what
+    they load next. Yields indices, or lists of batch_size indices when used as a batch_sampler.
+    """
+
+    def __init__(self, dataset: Dataset, batch_size: Union[int, None] = None, seed: Union[int, None] = None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.dataset.items_per_batch = batch_size or 1
+        self.seed = seed if seed is not None else random.randint(0, 2 ** 31 - 1)
+        self.epoch = 0
+        # what the train loop has taken this epoch, counted by track_dataloader_position
+        self.position = 0
+        # where this epoch starts after a resume
+        self.start_position = 0
+
+    def get_num_samples(self) -> int:
+        if self.batch_size is None:
+            return len(self.dataset)
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __len__(self):
+        return self.get_num_samples() - self.start_position
+
+    def __iter__(self):
+        order = list(range(len(self.dataset)))
+        random.Random(f'{self.seed}|{self.epoch}').shuffle(order)
+        if isinstance(self.dataset, PrefetchingConcatDataset):
+            self.dataset.set_sample_order(torch.tensor(order, dtype=torch.int64))
+        if self.batch_size is not None:
+            order = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        # the dataloader can draw it more than once for an iterator, the start holds until the next epoch
+        self.position = self.start_position
+        return iter(order[self.start_position:])
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.position = 0
+        self.start_position = 0
+
+    def state_dict(self) -> dict:
+        return {
+            'seed': self.seed,
+            'epoch': self.epoch,
+            'position': self.position,
+            # to tell if the dataset changed since
+            'dataset_size': len(self.dataset),
+        }
+
+    def load_state_dict(self, state: dict):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.position = 0
+        if state.get('dataset_size', None) != len(self.dataset):
+            print_acc("Dataset changed since the save, starting its epoch over")
+        else:
+            self.position = state['position']
+        self.start_position = self.position
+
+
+class PrefetchingConcatDataset(ConcatDataset):
+    """
+    Before loading an index, has the memory cache tier load the disk cache files of the batch this
+    worker loads next. Workers get batches round robin, so that is num_workers batches further on.
+    The order lives in shared memory, the dataloader draws it again after the workers have started.
+    """
+
+    def __init__(self, datasets, cache_memory_budget_mb: float):
+        super().__init__(datasets)
+        self.cache_memory_budget_mb = cache_memory_budget_mb
+        self.order: Union[torch.Tensor, None] = None
+        # index -> position in order
+        self.positions: Union[torch.Tensor, None] = None
+        self.items_per_batch = 1
+
+    def set_sample_order(self, order: torch.Tensor):
+        if self.order is None or len(self.order) != len(order):
+            self.order = torch.empty(len(order), dtype=torch.int64).share_memory_()
+            self.positions = torch.empty(len(order), dtype=torch.int64).share_memory_()
+        # in place, so running workers see it
+        self.order.copy_(order)
+        self.positions[order] = torch.arange(len(order))
+
+    def get_memory_cache_items(self, idx) -> list:
+        dataset_idx = bisect.bisect_right(self.cumulative_sizes, idx)
+        sample_idx = idx if dataset_idx == 0 else idx - self.cumulative_sizes[dataset_idx - 1]
+        return self.datasets[dataset_idx].get_memory_cache_items(sample_idx)
+
+    def prefetch_next_batch(self, idx):
+        if self.positions is None or idx >= len(self.positions):
+            return
+        pos = int(self.positions[idx])
+        # only once per batch, from its first index
+        if pos % self.items_per_batch != 0:
+            return
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        start = pos + num_workers * self.items_per_batch
+        items = []
+        for next_idx in self.order[start:start + self.items_per_batch].tolist():
+            items += self.get_memory_cache_items(next_idx)
+        if len(items) > 0:
+            get_memory_cache_tier(self.cache_memory_budget_mb).prefetch(items)
+
+    def __getitem__(self, idx):
+        self.prefetch_next_batch(idx)
+        return super().__getitem__(idx)
+
+
 def get_dataloader_from_datasets(
         dataset_options,
         batch_size=1,
         sd: 'StableDiffusion' = None,
+        state: Union[dict, None] = None,
 ) -> DataLoader:
+    # state is from get_dataloader_state, to carry on from a save
     if dataset_options is None or len(dataset_options) == 0:
         return None
 
+    seed = state['seed'] if state is not None else random.randint(0, 2 ** 31 - 1)
+
     datasets = []
     has_buckets = False
     is_caching_latents = False
@@ -623,7 +782,7 @@ def get_dataloader_from_datasets(
     for config in dataset_config_list:
 
         if config.type == 'image':
-            dataset = AiToolkitDataset(config, batch_size=batch_size, sd=sd)
+            dataset = AiToolkitDataset(config, batch_size=batch_size, sd=sd, seed=seed)
             datasets.append(dataset)
             if config.buckets:
                 has_buckets = True
@@ -632,7 +791,11 @@ def get_dataloader_from_datasets(
         else:
             raise ValueError(f"invalid dataset type: {config.type}")
 
-    concatenated_dataset = ConcatDataset(datasets)
+    cache_memory_budget_mb = max(config.cache_memory_budget_mb for config in dataset_config_list)
+    if cache_memory_budget_mb > 0:
+        concatenated_dataset = PrefetchingConcatDataset(datasets, cache_memory_budget_mb)
+    else:
+        concatenated_dataset = ConcatDataset(datasets)
 
     # todo build scheduler that can get buckets from all datasets that match
     # todo and evenly distribute reg images
@@ -653,6 +816,8 @@ def get_dataloader_from_datasets(
     else:
         dataloader_kwargs['num_workers'] = dataset_config_list[0].num_workers
         dataloader_kwargs['prefetch_factor'] = dataset_config_list[0].prefetch_factor
+    if dataset_config_list[0].pin_memory and torch.cuda.is_available():
+        dataloader_kwargs['pin_memory'] = True
 
     if has_buckets:
         # make sure they all have buckets
@@ -662,19 +827,20 @@ def get_dataloader_from_datasets(
         data_loader = DataLoader(
             concatenated_dataset,
             batch_size=None,  # we batch in the datasets for now
+            sampler=KnownOrderSampler(concatenated_dataset, seed=seed),
             drop_last=False,
-            shuffle=True,
             collate_fn=dto_collation,  # Use the custom collate function
             **dataloader_kwargs
         )
     else:
         data_loader = DataLoader(
             concatenated_dataset,
-            batch_size=batch_size,
-            shuffle=True,
+            batch_sampler=KnownOrderSampler(concatenated_dataset, batch_size, seed=seed),
             collate_fn=dto_collation,
             **dataloader_kwargs
         )
+    if state is not None:
+        get_dataloader_sampler(data_loader).load_state_dict(state)
     return data_loader
 
 
@@ -700,6 +866,34 @@ def trigger_dataloader_setup_epoch(dataloader: DataLoader):
             if hasattr(sub_dataset, 'setup_epoch'):
                 sub_dataset.setup_epoch()
                 sub_dataset.len = None
+    sampler = get_dataloader_sampler(dataloader)
+    if sampler is not None:
+        sampler.set_epoch(sampler.epoch + 1)
+
+
+def get_dataloader_sampler(dataloader: DataLoader) -> Union[KnownOrderSampler, None]:
+    for sampler in [dataloader.batch_sampler, dataloader.sampler]:
+        if isinstance(sampler, KnownOrderSampler):
+            return sampler
+    return None
+
+
+def get_dataloader_state(dataloader: DataLoader) -> Union[dict, None]:
+    # where the dataloader is, to save with a checkpoint
+    sampler = get_dataloader_sampler(dataloader)
+    if sampler is None:
+        return None
+    return sampler.state_dict()
+
+
+def track_dataloader_position(dataloader: DataLoader, iterator):
+    # counts the batches the train loop takes, not the ones workers or a prefetcher got ahead on
+    sampler = get_dataloader_sampler(dataloader)
+    for batch in iterator:
+        if sampler is not None:
+            sampler.position += 1
+        yield batch
+
 
 def get_dataloader_datasets(dataloader: DataLoader):
     # hacky but needed because of different types of datasets and dataloaders
@@ -1,7 +1,7 @@
 import os
 import weakref
 from _weakref import ReferenceType
-from typing import TYPE_CHECKING, List, Union
+from typing import TYPE_CHECKING, Dict, List, Union
 import cv2
 import torch
 import random
@@ -11,10 +11,13 @@ from PIL.ImageOps import exif_transpose
 
 from toolkit import image_utils
 from toolkit.basic import get_quick_signature_string
+from toolkit.batch_collation import collate_prompt_embeds, collate_tensors, apply_to_prompt_embeds
+from toolkit.cache_root import get_file_content_hash
 from toolkit.dataloader_mixins import CaptionProcessingDTOMixin, ImageProcessingDTOMixin, LatentCachingFileItemDTOMixin, \
     ControlFileItemDTOMixin, ArgBreakMixin, PoiFileItemDTOMixin, MaskFileItemDTOMixin, AugmentationFileItemDTOMixin, \
-    UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin, InpaintControlFileItemDTOMixin, TextEmbeddingFileItemDTOMixin
-from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
+    UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin, InpaintControlFileItemDTOMixin, TextEmbeddingFileItemDTOMixin, \
+    get_video_metadata
+from toolkit.prompt_utils import PromptEmbeds
 
 if TYPE_CHECKING:
     from toolkit.config_modules import DatasetConfig
@@ -61,14 +64,19 @@ class FileItemDTO(
         if file_signature is None:
             raise Exception("Error: Could not get file signature for {self.path}")
         
+        # frame count and fps for videos, so loading does not have to open them for it
+        self.video_metadata: Union[dict, None] = None
         use_db_entry = False
         if file_key in size_database:
             db_entry = size_database[file_key]
             if db_entry is not None and len(db_entry) >= 3 and db_entry[2] == file_signature:
-                use_db_entry = True
+                # older entries for videos do not have the metadata yet
+                use_db_entry = not self.is_video or len(db_entry) >= 4
         
         if use_db_entry:
-            w, h, _ = size_database[file_key]
+            w, h = size_database[file_key][0], size_database[file_key][1]
+            if self.is_video:
+                self.video_metadata = size_database[file_key][3]
         elif self.is_video:
             # Open the video file
             video = cv2.VideoCapture(self.path)
@@ -84,7 +92,8 @@ class FileItemDTO(
             
             # Release the video capture object immediately
             video.release()
-            size_database[file_key] = (width, height, file_signature)
+            self.video_metadata = get_video_metadata(self.path)
+            size_database[file_key] = (width, height, file_signature, self.video_metadata)
         else:
             if self.dataset_config.fast_image_size:
             # original method is significantly faster, but some images are read sideways. Not sure why. Do slow method by default.
@@ -101,6 +110,10 @@ class FileItemDTO(
             size_database[file_key] = (w, h, file_signature)
         self.width: int = w
         self.height: int = h
+        # content hash of the file, only needed to key entries in a cache root
+        self.content_hash: Union[str, None] = None
+        if self.dataset_config.cache_root is not None:
+            self.content_hash = get_file_content_hash(self.path, size_database.setdefault('__content_hashes__', {}))
         self.dataloader_transforms = kwargs.get('dataloader_transforms', None)
         super().__init__(*args, **kwargs)
 
@@ -123,6 +136,9 @@ class FileItemDTO(
         self.is_reg = self.dataset_config.is_reg
         self.prior_reg = self.dataset_config.prior_reg
         self.tensor: Union[torch.Tensor, None] = None
+        # set when the dataset caches resized images
+        self.resized_image_cache_dir: Union[str, None] = None
+        self.resized_image_cache_key: Union[str, None] = None
 
     def cleanup(self):
         self.tensor = None
@@ -134,6 +150,10 @@ class FileItemDTO(
         self.cleanup_mask()
         self.cleanup_unconditional()
 
+    def get_memory_cache_items(self):
+        # (path, load function) of the disk cache files loading this item reads
+        return self.get_latent_memory_cache_items() + self.get_text_embedding_memory_cache_items()
+
 
 class DataLoaderBatchDTO:
     def __init__(self, **kwargs):
@@ -154,31 +174,19 @@ class DataLoaderBatchDTO:
             self.clip_image_embeds_unconditional: Union[List[dict], None] = None
             self.sigmas: Union[torch.Tensor, None] = None  # can be added elseware and passed along training code
             self.extra_values: Union[torch.Tensor, None] = torch.tensor([x.extra_values for x in self.file_items]) if len(self.file_items[0].extra_values) > 0 else None
+            # for fields only some items have, which items have them. Items without are zero
+            self.present_masks: Dict[str, torch.Tensor] = {}
             if not is_latents_cached:
                 # only return a tensor if latents are not cached
-                self.tensor: torch.Tensor = torch.cat([x.tensor.unsqueeze(0) for x in self.file_items])
+                self.tensor = self.collate('tensor', [x.tensor for x in self.file_items])
             # if we have encoded latents, we concatenate them
             self.latents: Union[torch.Tensor, None] = None
             if is_latents_cached:
-                self.latents = torch.cat([x.get_latent().unsqueeze(0) for x in self.file_items])
+                self.latents = self.collate('latents', [x.get_latent() for x in self.file_items])
             self.prompt_embeds: Union[PromptEmbeds, None] = None
-            # if self.file_items[0].control_tensor is not None:
-            # if any have a control tensor, we concatenate them
-            if any([x.control_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_control_tensor = None
-                for x in self.file_items:
-                    if x.control_tensor is not None:
-                        base_control_tensor = x.control_tensor
-                        break
-                control_tensors = []
-                for x in self.file_items:
-                    if x.control_tensor is None:
-                        control_tensors.append(torch.zeros_like(base_control_tensor))
-                    else:
-                        control_tensors.append(x.control_tensor)
-                self.control_tensor = torch.cat([x.unsqueeze(0) for x in control_tensors])
-            
+            # if any have a control tensor, we stack them
+            self.control_tensor = self.collate('control_tensor', [x.control_tensor for x in self.file_items])
+
             # handle control tensor list
             if any([x.control_tensor_list is not None for x in self.file_items]):
                 self.control_tensor_list = []
@@ -187,87 +195,21 @@ class DataLoaderBatchDTO:
                         self.control_tensor_list.append(x.control_tensor_list)
                     else:
                         raise Exception(f"Could not find control tensors for all file items, missing for {x.path}")
-                    
-                
-            self.inpaint_tensor: Union[torch.Tensor, None] = None
-            if any([x.inpaint_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_inpaint_tensor = None
-                for x in self.file_items:
-                    if x.inpaint_tensor is not None:
-                        base_inpaint_tensor = x.inpaint_tensor
-                        break
-                inpaint_tensors = []
-                for x in self.file_items:
-                    if x.inpaint_tensor is None:
-                        inpaint_tensors.append(torch.zeros_like(base_inpaint_tensor))
-                    else:
-                        inpaint_tensors.append(x.inpaint_tensor)
-                self.inpaint_tensor = torch.cat([x.unsqueeze(0) for x in inpaint_tensors])
-
-            self.loss_multiplier_list: List[float] = [x.loss_multiplier for x in self.file_items]
 
-            if any([x.clip_image_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_clip_image_tensor = None
-                for x in self.file_items:
-                    if x.clip_image_tensor is not None:
-                        base_clip_image_tensor = x.clip_image_tensor
-                        break
-                clip_image_tensors = []
-                for x in self.file_items:
-                    if x.clip_image_tensor is None:
-                        clip_image_tensors.append(torch.zeros_like(base_clip_image_tensor))
-                    else:
-                        clip_image_tensors.append(x.clip_image_tensor)
-                self.clip_image_tensor = torch.cat([x.unsqueeze(0) for x in clip_image_tensors])
+            self.inpaint_tensor: Union[torch.Tensor, None] = self.collate(
+                'inpaint_tensor', [x.inpaint_tensor for x in self.file_items]
+            )
 
-            if any([x.mask_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_mask_tensor = None
-                for x in self.file_items:
-                    if x.mask_tensor is not None:
-                        base_mask_tensor = x.mask_tensor
-                        break
-                mask_tensors = []
-                for x in self.file_items:
-                    if x.mask_tensor is None:
-                        mask_tensors.append(torch.zeros_like(base_mask_tensor))
-                    else:
-                        mask_tensors.append(x.mask_tensor)
-                self.mask_tensor = torch.cat([x.unsqueeze(0) for x in mask_tensors])
+            self.loss_multiplier_list: List[float] = [x.loss_multiplier for x in self.file_items]
 
+            self.clip_image_tensor = self.collate('clip_image_tensor', [x.clip_image_tensor for x in self.file_items])
+            self.mask_tensor = self.collate('mask_tensor', [x.mask_tensor for x in self.file_items])
             # add unaugmented tensors for ones with augments
-            if any([x.unaugmented_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_unaugmented_tensor = None
-                for x in self.file_items:
-                    if x.unaugmented_tensor is not None:
-                        base_unaugmented_tensor = x.unaugmented_tensor
-                        break
-                unaugmented_tensor = []
-                for x in self.file_items:
-                    if x.unaugmented_tensor is None:
-                        unaugmented_tensor.append(torch.zeros_like(base_unaugmented_tensor))
-                    else:
-                        unaugmented_tensor.append(x.unaugmented_tensor)
-                self.unaugmented_tensor = torch.cat([x.unsqueeze(0) for x in unaugmented_tensor])
-
+            self.unaugmented_tensor = self.collate('unaugmented_tensor', [x.unaugmented_tensor for x in self.file_items])
             # add unconditional tensors
-            if any([x.unconditional_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_unconditional_tensor = None
-                for x in self.file_items:
-                    if x.unaugmented_tensor is not None:
-                        base_unconditional_tensor = x.unconditional_tensor
-                        break
-                unconditional_tensor = []
-                for x in self.file_items:
-                    if x.unconditional_tensor is None:
-                        unconditional_tensor.append(torch.zeros_like(base_unconditional_tensor))
-                    else:
-                        unconditional_tensor.append(x.unconditional_tensor)
-                self.unconditional_tensor = torch.cat([x.unsqueeze(0) for x in unconditional_tensor])
+            self.unconditional_tensor = self.collate(
+                'unconditional_tensor', [x.unconditional_tensor for x in self.file_items]
+            )
 
             if any([x.clip_image_embeds is not None for x in self.file_items]):
                 self.clip_image_embeds = []
@@ -298,13 +240,36 @@ class DataLoaderBatchDTO:
                         prompt_embeds_list.append(base_prompt_embeds)
                     else:
                         prompt_embeds_list.append(x.prompt_embeds)
-                self.prompt_embeds = concat_prompt_embeds(prompt_embeds_list)
+                self.prompt_embeds = collate_prompt_embeds(prompt_embeds_list)
                     
 
         except Exception as e:
             print(e)
             raise e
 
+    def collate(self, name: str, tensors: List[Union[torch.Tensor, None]]) -> Union[torch.Tensor, None]:
+        batch, present_mask = collate_tensors(tensors)
+        if present_mask is not None:
+            self.present_masks[name] = present_mask
+        return batch
+
+    def apply_to_tensors(self, fn):
+        # replaces each batch tensor and the prompt embeds with fn of them
+        for name in [
+            'tensor', 'latents', 'control_tensor', 'inpaint_tensor', 'clip_image_tensor', 'mask_tensor',
+            'unaugmented_tensor', 'unconditional_tensor'
+        ]:
+            value = getattr(self, name, None)
+            if value is not None:
+                setattr(self, name, fn(value))
+        if self.prompt_embeds is not None:
+            self.prompt_embeds = apply_to_prompt_embeds(self.prompt_embeds, fn)
+        return self
+
+    def pin_memory(self):
+        # called by the dataloader's pin memory thread when pin_memory is set
+        return self.apply_to_tensors(lambda t: t.pin_memory())
+
     def get_is_reg_list(self):
         return [x.is_reg for x in self.file_items]
 
@@ -1,13 +1,16 @@
 import base64
+import copy
 import glob
 import hashlib
 import json
 import math
 import os
 import random
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from typing import TYPE_CHECKING, List, Dict, Union
 import traceback
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
@@ -16,13 +19,21 @@ from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection, SiglipImageProcessor
 
-from toolkit.basic import flush, value_map
-from toolkit.buckets import get_bucket_for_image_size, get_resolution
-from toolkit.config_modules import ControlTypes
+from toolkit.basic import flush, value_map, get_quick_signature_string
+from toolkit.buckets import get_bucket_for_image_size, get_resolution, get_bucket_batch_size
+from toolkit.cache_root import atomic_write_path, get_cache_entry_path, get_dataset_cache_dir, get_file_content_hash, \
+    touch_cache_entry
+from toolkit.cache_sharding import CacheShard
+from toolkit.caption_index import DEFAULT_CAPTION_NAME, CaptionIndex, get_caption_path
+from toolkit.config_modules import ControlTypes, get_latent_space_version
 from toolkit.control_generator import ControlGenerator
+from toolkit.latent_quantization import dequantize_latent, get_reconstruction_error, quantize_latent
+from toolkit.memory_cache_tier import get_memory_cache_tier
 from toolkit.metadata import get_meta_for_safetensors
 from toolkit.models.pixtral_vision import PixtralVisionImagePreprocessorCompatible
-from toolkit.prompt_utils import inject_trigger_into_prompt
+from toolkit.prompt_utils import inject_trigger_into_prompt, split_prompt_embeds
+from toolkit.resized_image_cache import get_resized_image_pack
+from toolkit.shared_tensor_store import get_shared_memory_dir, get_shared_tensor_store
 from torchvision import transforms
 from PIL import Image, ImageFilter, ImageOps
 from PIL.ImageOps import exif_transpose
@@ -43,6 +54,81 @@ accelerator = get_accelerator()
 
 # def get_associated_caption_from_img_path(img_path):
 # https://demo.albumentations.ai/
+# a target further ahead than this is seeked to, closer ones are reached by grabbing the frames in
+# between, which is cheaper than a seek decoding again from the keyframe before the target
+SEEK_AHEAD_FRAMES = 32
+
+
+def get_video_metadata(path: str) -> dict:
+    # frame count and fps from the header, nothing is decoded
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise Exception(f"Failed to open video file: {path}")
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return {
+        "frame_count": frame_count,
+        "fps": fps,
+    }
+
+
+def seek_to_video_frame(cap: 'cv2.VideoCapture', frame_idx: int, fps: float) -> bool:
+    # seeks and grabs frame_idx. The position opencv reports back is just what was asked for,
+    # so the timestamp of the grabbed frame is what tells if the seek landed on it
+    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+    if not cap.grab():
+        return False
+    target_msec = frame_idx * 1000.0 / fps
+    return abs(cap.get(cv2.CAP_PROP_POS_MSEC) - target_msec) < 500.0 / fps
+
+
+def read_video_frames(
+        cap: 'cv2.VideoCapture',
+        frame_indices: List[int],
+        fps: Union[float, None] = None,
+        seek_ahead_frames: int = SEEK_AHEAD_FRAMES
+) -> List[np.ndarray]:
+    # decodes forward through the video once and only retrieves the requested frames, as RGB
+    # arrays. Targets more than seek_ahead_frames ahead are seeked to. If a seek does not land
+    # on its frame, it goes back to decoding front to back from the start
+    if fps is None:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+    can_seek = fps is not None and fps > 0
+    wanted = sorted(set(frame_indices))
+    decoded = {}
+    last_frame = None
+    # index of the frame the next grab returns
+    current_frame = 0
+    for frame_idx in wanted:
+        grabbed = False
+        if can_seek and frame_idx - current_frame > seek_ahead_frames:
+            if seek_to_video_frame(cap, frame_idx, fps):
+                grabbed = True
+                current_frame = frame_idx + 1
+            else:
+                # seeking is not exact for this file, or the target is past the real end
+                can_seek = False
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                current_frame = 0
+        if not grabbed:
+            while current_frame < frame_idx and cap.grab():
+                current_frame += 1
+            if current_frame < frame_idx or not cap.grab():
+                break
+            current_frame += 1
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
+        last_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        decoded[frame_idx] = last_frame
+    if last_frame is None:
+        raise Exception(f"Failed to read any of frames {wanted}")
+    # the frame count in the header is often a few frames too high, anything past the
+    # real end gets the last frame that decoded
+    return [decoded.get(frame_idx, last_frame) for frame_idx in frame_indices]
+
+
 class Augments:
     def __init__(self, **kwargs):
         self.method_name = kwargs.get('method', None)
@@ -130,7 +216,21 @@ class CaptionMixin:
         default_prompt_path = os.path.join(os.path.dirname(img_path), 'default.txt')
         default_prompt_path_with_ext = os.path.join(os.path.dirname(img_path), 'default' + ext)
 
-        if os.path.exists(prompt_path):
+        caption_index: Union[CaptionIndex, None] = getattr(self, 'caption_index', None)
+        if caption_index is not None:
+            # read at dataset setup
+            prompt = caption_index.get_caption(prompt_path)
+            if prompt is not None and prompt_path.endswith('.json'):
+                prompt = json.loads(prompt)
+                if 'caption' in prompt:
+                    prompt = prompt['caption']
+            if prompt is None:
+                prompt = caption_index.get_default_caption(os.path.dirname(img_path))
+            if prompt is not None:
+                prompt = clean_caption(prompt)
+            else:
+                prompt = getattr(self, 'default_caption', getattr(self, 'default_prompt', ''))
+        elif os.path.exists(prompt_path):
             with open(prompt_path, 'r', encoding='utf-8') as f:
                 prompt = f.read()
                 # check if is json
@@ -164,6 +264,28 @@ class CaptionMixin:
 
         return prompt
 
+    def setup_caption_index(self: 'AiToolkitDataset'):
+        # read every caption once now instead of checking for and reading files for every sample
+        self.caption_index = CaptionIndex([file_item.path for file_item in self.file_list], self.dataset_config.caption_ext)
+        for file_item in self.file_list:
+            file_item.caption_index = self.caption_index
+        print_acc(f"  -  Preloaded {len(self.caption_index.captions)} captions")
+
+    def refresh_caption_index(self: 'AiToolkitDataset'):
+        changed = self.caption_index.refresh()
+        if len(changed) == 0:
+            return
+        ext = self.dataset_config.caption_ext
+        # a default caption change touches every item in its folder
+        changed_dirs = set(
+            os.path.dirname(path) for path in changed if os.path.splitext(os.path.basename(path))[0] == DEFAULT_CAPTION_NAME
+        )
+        for file_item in self.file_list:
+            if get_caption_path(file_item.path, ext) in changed or os.path.dirname(file_item.path) in changed_dirs:
+                file_item.raw_caption = None
+                file_item.raw_caption_short = None
+        print_acc(f"  -  Reloaded {len(changed)} changed captions for {self.dataset_path}")
+
 
 if TYPE_CHECKING:
     from toolkit.config_modules import DatasetConfig
@@ -182,17 +304,37 @@ class BucketsMixin:
         self.buckets: Dict[str, Bucket] = {}
         self.batch_indices: List[List[int]] = []
 
+    def get_bucket_batch_size(self: 'AiToolkitDataset', bucket: Bucket) -> int:
+        pixel_budget = self.dataset_config.pixel_budget
+        if pixel_budget is None:
+            return self.batch_size
+        return get_bucket_batch_size(
+            bucket.width,
+            bucket.height,
+            pixel_budget,
+            num_frames=self.dataset_config.num_frames,
+            max_batch_size=self.dataset_config.pixel_budget_max_batch_size
+        )
+
     def build_batch_indices(self: 'AiToolkitDataset'):
         self.batch_indices = []
         for key, bucket in self.buckets.items():
-            for start_idx in range(0, len(bucket.file_list_idx), self.batch_size):
-                end_idx = min(start_idx + self.batch_size, len(bucket.file_list_idx))
+            batch_size = self.get_bucket_batch_size(bucket)
+            for start_idx in range(0, len(bucket.file_list_idx), batch_size):
+                end_idx = min(start_idx + batch_size, len(bucket.file_list_idx))
                 batch = bucket.file_list_idx[start_idx:end_idx]
                 self.batch_indices.append(batch)
 
+    def get_bucket_rng(self: 'AiToolkitDataset', name: str):
+        # seeded per dataset and epoch when the dataloader has a seed, so a resumed run makes the same buckets
+        if getattr(self, 'seed', None) is None:
+            return random
+        return random.Random(f'{self.seed}|{self.dataset_path}|{self.epoch_num}|{name}')
+
     def shuffle_buckets(self: 'AiToolkitDataset'):
+        rng = self.get_bucket_rng('shuffle')
         for key, bucket in self.buckets.items():
-            random.shuffle(bucket.file_list_idx)
+            rng.shuffle(bucket.file_list_idx)
 
     def setup_buckets(self: 'AiToolkitDataset', quiet=False):
         if not hasattr(self, 'file_list'):
@@ -210,6 +352,7 @@ class BucketsMixin:
         resolution = config.resolution
         bucket_tolerance = config.bucket_tolerance
         file_list: List['FileItemDTO'] = self.file_list
+        crop_rng = self.get_bucket_rng('crop')
 
         # for file_item in enumerate(file_list):
         for idx, file_item in enumerate(file_list):
@@ -262,8 +405,8 @@ class BucketsMixin:
 
                 if self.dataset_config.random_crop:
                     # random crop
-                    crop_x = random.randint(0, file_item.scale_to_width - new_width)
-                    crop_y = random.randint(0, file_item.scale_to_height - new_height)
+                    crop_x = crop_rng.randint(0, file_item.scale_to_width - new_width)
+                    crop_y = crop_rng.randint(0, file_item.scale_to_height - new_height)
                     file_item.crop_x = crop_x
                     file_item.crop_y = crop_y
                 else:
@@ -286,7 +429,10 @@ class BucketsMixin:
         if not quiet:
             print_acc(f'Bucket sizes for {self.dataset_path}:')
             for key, bucket in self.buckets.items():
-                print_acc(f'{key}: {len(bucket.file_list_idx)} files')
+                if self.dataset_config.pixel_budget is not None:
+                    print_acc(f'{key}: {len(bucket.file_list_idx)} files, batch size {self.get_bucket_batch_size(bucket)}')
+                else:
+                    print_acc(f'{key}: {len(bucket.file_list_idx)} files')
             print_acc(f'{len(self.buckets)} buckets made')
 
 
@@ -302,6 +448,8 @@ class CaptionProcessingDTOMixin:
             dataset_config: DatasetConfig = kwargs.get('dataset_config', None)
             self.extra_values: List[float] = dataset_config.extra_values
             self.trigger_word = dataset_config.trigger_word
+            # set by the dataset when it preloads captions, shared by every item
+            self.caption_index: Union['CaptionIndex', None] = None
 
     # todo allow for loading from sd-scripts style dict
     def load_caption(self: 'FileItemDTO', caption_dict: Union[dict, None]=None):
@@ -321,32 +469,38 @@ class CaptionProcessingDTOMixin:
             prompt_path = path_no_ext + prompt_ext
             short_caption = None
 
-            if os.path.exists(prompt_path):
+            prompt = None
+            if self.caption_index is not None:
+                # read at dataset setup
+                prompt = self.caption_index.get_caption(prompt_path)
+            elif os.path.exists(prompt_path):
                 with open(prompt_path, 'r', encoding='utf-8') as f:
                     prompt = f.read()
-                    short_caption = None
-                    if prompt_path.endswith('.json'):
-                        # replace any line endings with commas for \n \r \r\n
-                        prompt = prompt.replace('\r\n', ' ')
-                        prompt = prompt.replace('\n', ' ')
-                        prompt = prompt.replace('\r', ' ')
-
-                        prompt_json = json.loads(prompt)
-                        if 'caption' in prompt_json:
-                            prompt = prompt_json['caption']
-                        if 'caption_short' in prompt_json:
-                            short_caption = prompt_json['caption_short']
-                            if self.dataset_config.use_short_captions:
-                                prompt = short_caption
-                        if 'extra_values' in prompt_json:
-                            self.extra_values = prompt_json['extra_values']
-
-                    prompt = clean_caption(prompt)
-                    if short_caption is not None:
-                        short_caption = clean_caption(short_caption)
-                    
-                    if prompt.strip() == '' and self.dataset_config.default_caption is not None:
-                        prompt = self.dataset_config.default_caption
+
+            if prompt is not None:
+                short_caption = None
+                if prompt_path.endswith('.json'):
+                    # replace any line endings with commas for \n \r \r\n
+                    prompt = prompt.replace('\r\n', ' ')
+                    prompt = prompt.replace('\n', ' ')
+                    prompt = prompt.replace('\r', ' ')
+
+                    prompt_json = json.loads(prompt)
+                    if 'caption' in prompt_json:
+                        prompt = prompt_json['caption']
+                    if 'caption_short' in prompt_json:
+                        short_caption = prompt_json['caption_short']
+                        if self.dataset_config.use_short_captions:
+                            prompt = short_caption
+                    if 'extra_values' in prompt_json:
+                        self.extra_values = prompt_json['extra_values']
+
+                prompt = clean_caption(prompt)
+                if short_caption is not None:
+                    short_caption = clean_caption(short_caption)
+
+                if prompt.strip() == '' and self.dataset_config.default_caption is not None:
+                    prompt = self.dataset_config.default_caption
             else:
                 prompt = ''
                 if self.dataset_config.default_caption is not None:
@@ -366,8 +520,14 @@ class CaptionProcessingDTOMixin:
             trigger=None,
             to_replace_list=None,
             add_if_not_present=False,
-            short_caption=False
+            short_caption=False,
+            rng: Union[random.Random, None] = None,
+            augment_cached=False
     ):
+        # rng makes the augmentations repeatable, augment_cached applies token dropout even when
+        # text embeddings are cached, for caption variants
+        if rng is None:
+            rng = random
         if trigger is None and self.trigger_word is not None:
             trigger = self.trigger_word
         
@@ -384,7 +544,7 @@ class CaptionProcessingDTOMixin:
         # handle dropout
         if self.dataset_config.caption_dropout_rate > 0 and not short_caption and not self.dataset_config.cache_text_embeddings:
             # get a random float form 0 to 1
-            rand = random.random()
+            rand = rng.random()
             if rand < self.dataset_config.caption_dropout_rate:
                 # drop the caption
                 return ''
@@ -397,7 +557,7 @@ class CaptionProcessingDTOMixin:
         token_list = [x for x in token_list if x]
 
         # handle token dropout
-        if self.dataset_config.token_dropout_rate > 0 and not short_caption and not self.dataset_config.cache_text_embeddings:
+        if self.dataset_config.token_dropout_rate > 0 and not short_caption and (not self.dataset_config.cache_text_embeddings or augment_cached):
             new_token_list = []
             keep_tokens: int = self.dataset_config.keep_tokens
             for idx, token in enumerate(token_list):
@@ -408,14 +568,14 @@ class CaptionProcessingDTOMixin:
                     pass
                 else:
                     # get a random float form 0 to 1
-                    rand = random.random()
+                    rand = rng.random()
                     if rand > self.dataset_config.token_dropout_rate:
                         # keep the token
                         new_token_list.append(token)
             token_list = new_token_list
 
         if self.dataset_config.shuffle_tokens:
-            random.shuffle(token_list)
+            rng.shuffle(token_list)
 
         # join back together
         caption = ', '.join(token_list)
@@ -424,10 +584,10 @@ class CaptionProcessingDTOMixin:
         if self.dataset_config.random_triggers:
             num_triggers = self.dataset_config.random_triggers_max
             if num_triggers > 1:
-                num_triggers = random.randint(0, num_triggers)
+                num_triggers = rng.randint(0, num_triggers)
 
             if num_triggers > 0:
-                triggers = random.sample(self.dataset_config.random_triggers, num_triggers)
+                triggers = rng.sample(self.dataset_config.random_triggers, num_triggers)
                 caption = caption + ', ' + ', '.join(triggers)
                 # add random triggers
                 # for i in range(num_triggers):
@@ -442,7 +602,7 @@ class CaptionProcessingDTOMixin:
             token_list = [x.strip() for x in token_list]
             # remove empty strings
             token_list = [x for x in token_list if x]
-            random.shuffle(token_list)
+            rng.shuffle(token_list)
             caption = ', '.join(token_list)
         if caption == '':
             pass
@@ -455,9 +615,6 @@ class ImageProcessingDTOMixin:
         transform: Union[None, transforms.Compose],
         only_load_latents=False
     ):
-        if self.is_latent_cached:
-            raise Exception('Latent caching not supported for videos')
-        
         if self.augments is not None and len(self.augments) > 0:
             raise Exception('Augments not supported for videos')
             
@@ -466,6 +623,13 @@ class ImageProcessingDTOMixin:
         
         if not self.dataset_config.buckets:
             raise Exception('Buckets required for video processing')
+
+        if self.is_text_embedding_cached:
+            self.load_prompt_embedding()
+        if self.is_latent_cached:
+            # only load it, it is dequantized when the batch is made
+            self.get_latent_state()
+            return
         
         try:
             # Use OpenCV to capture video frames
@@ -475,8 +639,7 @@ class ImageProcessingDTOMixin:
                 raise Exception(f"Failed to open video file: {self.path}")
             
             # Get video properties
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            video_fps = cap.get(cv2.CAP_PROP_FPS)
+            total_frames, video_fps = self.get_video_properties(cap)
             
             # Calculate the max valid frame index (accounting for zero-indexing)
             max_frame_index = total_frames - 1
@@ -488,108 +651,19 @@ class ImageProcessingDTOMixin:
                 print_acc(f"  Max valid frame index: {max_frame_index}")
                 print_acc(f"  FPS: {video_fps}")
             
-            frames_to_extract = []
-            
-            # Always stretch/shrink to the requested number of frames if needed
-            if self.dataset_config.shrink_video_to_frames or total_frames < self.dataset_config.num_frames:
-                # Distribute frames evenly across the entire video
-                interval = max_frame_index / (self.dataset_config.num_frames - 1) if self.dataset_config.num_frames > 1 else 0
-                frames_to_extract = [min(int(round(i * interval)), max_frame_index) for i in range(self.dataset_config.num_frames)]
-            else:
-                # Calculate frame interval based on FPS ratio
-                fps_ratio = video_fps / self.dataset_config.fps
-                frame_interval = max(1, int(round(fps_ratio)))
-                
-                # Calculate max consecutive frames we can extract at desired FPS
-                max_consecutive_frames = (total_frames // frame_interval)
-                
-                if max_consecutive_frames < self.dataset_config.num_frames:
-                    # Not enough frames at desired FPS, so stretch instead
-                    interval = max_frame_index / (self.dataset_config.num_frames - 1) if self.dataset_config.num_frames > 1 else 0
-                    frames_to_extract = [min(int(round(i * interval)), max_frame_index) for i in range(self.dataset_config.num_frames)]
-                else:
-                    # Calculate max start frame to ensure we can get all num_frames
-                    max_start_frame = max_frame_index - ((self.dataset_config.num_frames - 1) * frame_interval)
-                    start_frame = random.randint(0, max(0, max_start_frame))
-                    
-                    # Generate list of frames to extract
-                    frames_to_extract = [start_frame + (i * frame_interval) for i in range(self.dataset_config.num_frames)]
-                    
-            # Final safety check - ensure no frame exceeds max valid index
-            frames_to_extract = [min(frame_idx, max_frame_index) for frame_idx in frames_to_extract]
+            frames_to_extract = self.get_video_frame_indices(total_frames, video_fps)
             
             # Only log frames to extract if in debug mode
             if hasattr(self.dataset_config, 'debug') and self.dataset_config.debug:
                 print_acc(f"  Frames to extract: {frames_to_extract}")
             
-            # Extract frames
-            frames = []
-            for frame_idx in frames_to_extract:
-                # Safety check - ensure frame_idx is within bounds (silently fix)
-                if frame_idx > max_frame_index:
-                    frame_idx = max_frame_index
-                
-                # Set frame position
-                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-                
-                # Silently verify position was set correctly (no warnings unless debug mode)
-                if hasattr(self.dataset_config, 'debug') and self.dataset_config.debug:
-                    actual_pos = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
-                    if actual_pos != frame_idx:
-                        print_acc(f"Warning: Failed to set exact frame position. Requested: {frame_idx}, Actual: {actual_pos}")
-                
-                ret, frame = cap.read()
-                if not ret:
-                    # Try to provide more detailed error information
-                    actual_frame = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
-                    frame_pos_info = f"Requested frame: {frame_idx}, Actual frame position: {actual_frame}"
-                    
-                    # Try to read the next available frame as a fallback
-                    fallback_success = False
-                    for fallback_offset in [1, -1, 5, -5, 10, -10]:
-                        fallback_pos = max(0, min(frame_idx + fallback_offset, max_frame_index))
-                        cap.set(cv2.CAP_PROP_POS_FRAMES, fallback_pos)
-                        fallback_ret, fallback_frame = cap.read()
-                        if fallback_ret:
-                            # Only log in debug mode
-                            if hasattr(self.dataset_config, 'debug') and self.dataset_config.debug:
-                                print_acc(f"Falling back to nearby frame {fallback_pos} instead of {frame_idx}")
-                            frame = fallback_frame
-                            fallback_success = True
-                            break
-                    else:
-                        # No fallback worked, raise a more detailed exception
-                        video_info = f"Video: {self.path}, Total frames: {total_frames}, FPS: {video_fps}"
-                        raise Exception(f"Failed to read frame {frame_idx} from video. {frame_pos_info}. {video_info}")
-                
-                # Convert BGR to RGB
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                
-                # Convert to PIL Image
-                img = Image.fromarray(frame)
-                
-                # Apply the same processing as for single images
-                img = img.convert('RGB')
-                
-                if self.flip_x:
-                    img = img.transpose(Image.FLIP_LEFT_RIGHT)
-                if self.flip_y:
-                    img = img.transpose(Image.FLIP_TOP_BOTTOM)
-                
-                # Apply bucketing
-                img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
-                img = img.crop((
-                    self.crop_x,
-                    self.crop_y,
-                    self.crop_x + self.crop_width,
-                    self.crop_y + self.crop_height
-                ))
-                
-                # Apply transform if provided
-                if transform:
-                    img = transform(img)
-                
-                frames.append(img)
+            # Extract frames in a single forward pass
+            try:
+                frames = read_video_frames(cap, frames_to_extract, video_fps)
+            except Exception as e:
+                video_info = f"Video: {self.path}, Total frames: {total_frames}, FPS: {video_fps}"
+                raise Exception(f"Failed to read frame {frames_to_extract[0]} from video. {e}. {video_info}")
+            frames = [self.process_video_frame(frame, transform) for frame in frames]
             
             # Release the video capture
             cap.release()
@@ -641,31 +715,90 @@ class ImageProcessingDTOMixin:
             # Re-raise with more detailed information
             raise Exception(f"Video loading error ({self.path}): {error_msg}") from e
         
-    def load_and_process_image(
-            self: 'FileItemDTO',
-            transform: Union[None, transforms.Compose],
-            only_load_latents=False
-    ):
-        if self.dataset_config.num_frames > 1:
-            self.load_and_process_video(transform, only_load_latents)
-            return
-        # handle get_prompt_embedding
-        if self.is_text_embedding_cached:
-            self.load_prompt_embedding()
-        # if we are caching latents, just do that
-        if self.is_latent_cached:
-            self.get_latent()
-            if self.has_control_image:
-                self.load_control_image()
-            if self.has_inpaint_image:
-                self.load_inpaint_image()
-            if self.has_clip_image:
-                self.load_clip_image()
-            if self.has_mask_image:
-                self.load_mask_image()
-            if self.has_unconditional:
-                self.load_unconditional_image()
-            return
+    def get_video_frame_indices(self: 'FileItemDTO', total_frames: int, video_fps: float, random_start=True) -> List[int]:
+        # Calculate the max valid frame index (accounting for zero-indexing)
+        max_frame_index = total_frames - 1
+        num_frames = self.dataset_config.num_frames
+
+        # Always stretch/shrink to the requested number of frames if needed
+        if self.dataset_config.shrink_video_to_frames or total_frames < num_frames:
+            # Distribute frames evenly across the entire video
+            interval = max_frame_index / (num_frames - 1) if num_frames > 1 else 0
+            frames_to_extract = [min(int(round(i * interval)), max_frame_index) for i in range(num_frames)]
+        else:
+            # Calculate frame interval based on FPS ratio
+            fps_ratio = video_fps / self.dataset_config.fps
+            frame_interval = max(1, int(round(fps_ratio)))
+
+            # Calculate max consecutive frames we can extract at desired FPS
+            max_consecutive_frames = (total_frames // frame_interval)
+
+            if max_consecutive_frames < num_frames:
+                # Not enough frames at desired FPS, so stretch instead
+                interval = max_frame_index / (num_frames - 1) if num_frames > 1 else 0
+                frames_to_extract = [min(int(round(i * interval)), max_frame_index) for i in range(num_frames)]
+            else:
+                # Calculate max start frame to ensure we can get all num_frames
+                max_start_frame = max_frame_index - ((num_frames - 1) * frame_interval)
+                # cached latents always use the clip at the start so the cache key stays valid
+                start_frame = random.randint(0, max(0, max_start_frame)) if random_start else 0
+
+                # Generate list of frames to extract
+                frames_to_extract = [start_frame + (i * frame_interval) for i in range(num_frames)]
+
+        # Final safety check - ensure no frame exceeds max valid index
+        return [min(frame_idx, max_frame_index) for frame_idx in frames_to_extract]
+
+    def get_video_properties(self: 'FileItemDTO', cap: 'cv2.VideoCapture'):
+        # prefer the metadata from the dataset index, the header frame count is often wrong
+        if self.video_metadata is not None:
+            return self.video_metadata["frame_count"], self.video_metadata["fps"]
+        return int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS)
+
+    def process_video_frame(self: 'FileItemDTO', frame: np.ndarray, transform: Union[None, transforms.Compose]):
+        # Convert to PIL Image
+        img = Image.fromarray(frame)
+
+        # Apply the same processing as for single images
+        img = img.convert('RGB')
+
+        if self.flip_x:
+            img = img.transpose(Image.FLIP_LEFT_RIGHT)
+        if self.flip_y:
+            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+
+        # Apply bucketing
+        img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
+        img = img.crop((
+            self.crop_x,
+            self.crop_y,
+            self.crop_x + self.crop_width,
+            self.crop_y + self.crop_height
+        ))
+
+        # Apply transform if provided
+        if transform:
+            img = transform(img)
+        return img
+
+    def load_video_clip(self: 'FileItemDTO', transform: Union[None, transforms.Compose]):
+        # loads the clip used for latent caching in a single sequential pass over the video
+        cap = cv2.VideoCapture(self.path)
+        if not cap.isOpened():
+            raise Exception(f"Failed to open video file: {self.path}")
+        try:
+            total_frames, video_fps = self.get_video_properties(cap)
+            frame_indices = self.get_video_frame_indices(total_frames, video_fps, random_start=False)
+            frames = read_video_frames(cap, frame_indices, video_fps)
+        except Exception as e:
+            raise Exception(f"Video loading error ({self.path}): {e}") from e
+        finally:
+            cap.release()
+        self.tensor = torch.stack([self.process_video_frame(frame, transform) for frame in frames])
+
+    def load_resized_image(self: 'FileItemDTO') -> Image.Image:
+        # open, exif transpose, flip and, with buckets, resize to the bucket scale. Everything
+        # before the crop, so the result can be cached
         try:
             img = Image.open(self.path)
             img = exif_transpose(img)
@@ -700,8 +833,64 @@ class ImageProcessingDTOMixin:
             img = img.transpose(Image.FLIP_TOP_BOTTOM)
 
         if self.dataset_config.buckets:
-            # scale and crop based on file item
+            # scale based on file item
             img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
+        return img
+
+    def get_resized_image_cache_key(self: 'FileItemDTO', cache_root: str) -> str:
+        item = OrderedDict([
+            ("path", os.path.relpath(self.path, cache_root)),
+            ("signature", get_quick_signature_string(self.path)),
+            ("scale_to_width", self.scale_to_width),
+            ("scale_to_height", self.scale_to_height),
+            ("flip_x", self.flip_x),
+            ("flip_y", self.flip_y),
+            ("use_alpha_as_mask", self.use_alpha_as_mask),
+        ])
+        hash_input = json.dumps(item, sort_keys=True).encode('utf-8')
+        return hashlib.md5(hash_input).hexdigest()
+
+    def get_cached_resized_image(self: 'FileItemDTO') -> Union[Image.Image, None]:
+        if self.resized_image_cache_dir is None or not self.dataset_config.buckets:
+            return None
+        pack = get_resized_image_pack(self.resized_image_cache_dir)
+        cached = pack.get(self.resized_image_cache_key)
+        if cached is None or cached.shape[:2] != (self.scale_to_height, self.scale_to_width):
+            # the bucket changed since the cache was built, eg a point of interest crop
+            return None
+        return Image.fromarray(cached)
+
+    def load_and_process_image(
+            self: 'FileItemDTO',
+            transform: Union[None, transforms.Compose],
+            only_load_latents=False
+    ):
+        if self.dataset_config.num_frames > 1:
+            self.load_and_process_video(transform, only_load_latents)
+            return
+        # handle get_prompt_embedding
+        if self.is_text_embedding_cached:
+            self.load_prompt_embedding()
+        # if we are caching latents, just do that
+        if self.is_latent_cached:
+            # only load it, it is dequantized when the batch is made
+            self.get_latent_state()
+            if self.has_control_image:
+                self.load_control_image()
+            if self.has_inpaint_image:
+                self.load_inpaint_image()
+            if self.has_clip_image:
+                self.load_clip_image()
+            if self.has_mask_image:
+                self.load_mask_image()
+            if self.has_unconditional:
+                self.load_unconditional_image()
+            return
+        img = self.get_cached_resized_image()
+        if img is None:
+            img = self.load_resized_image()
+
+        if self.dataset_config.buckets:
             # crop to x_crop, y_crop, x_crop + crop_width, y_crop + crop_height
             if img.width < self.crop_x + self.crop_width or img.height < self.crop_y + self.crop_height:
                 # todo look into this. This still happens sometimes
@@ -1072,6 +1261,12 @@ class ClipImageFileItemDTOMixin:
     def get_clip_vision_embeddings_path(self: 'FileItemDTO', recalculate=False):
         if self._clip_vision_embeddings_path is not None and not recalculate:
             return self._clip_vision_embeddings_path
+        elif self.dataset_config.cache_root is not None:
+            # keyed by what is in the clip image instead of its name
+            info = self.get_clip_vision_info_dict()
+            del info["filename"]
+            info["content_hash"] = get_file_content_hash(self.clip_image_path)
+            self._clip_vision_embeddings_path = get_cache_entry_path(self.dataset_config.cache_root, 'clip_vision', info)
         else:
             # we store latents in a folder in same path as image called _latent_cache
             img_dir = os.path.dirname(self.clip_image_path)
@@ -1629,17 +1824,27 @@ class ArgBreakMixin:
         pass
 
 
+def load_latent_file(path: str) -> Dict[str, torch.Tensor]:
+    return load_file(path, device='cpu')
+
+
 class LatentCachingFileItemDTOMixin:
     def __init__(self, *args, **kwargs):
         # if we have super, call it
         if hasattr(super(), '__init__'):
             super().__init__(*args, **kwargs)
         self._encoded_latent: Union[torch.Tensor, None] = None
+        # per channel scale and offset of a quantized _encoded_latent
+        self._encoded_latent_params: Dict[str, torch.Tensor] = {}
+        # what a quantized latent is turned back into
+        self.latent_dtype = torch.float32
         self._latent_path: Union[str, None] = None
         self.is_latent_cached = False
         self.is_caching_to_disk = False
         self.is_caching_to_memory = False
         self.latent_load_device = 'cpu'
+        # set when the in memory latents live in a store shared by all processes on the node
+        self.shared_latent_store_path: Union[str, None] = None
         # sd1 or sdxl or others
         self.latent_space_version = 'sd1'
         # todo, increment this if we change the latent format to invalidate cache
@@ -1662,13 +1867,25 @@ class LatentCachingFileItemDTOMixin:
             item["flip_x"] = True
         if self.flip_y:
             item["flip_y"] = True
+        if self.dataset_config.latent_cache_dtype is not None:
+            item["latent_cache_dtype"] = self.dataset_config.latent_cache_dtype
         if self.dataset_config.num_frames > 1:
             item["num_frames"] = self.dataset_config.num_frames
+            # the frame sampling decides which frames end up in the latent
+            item["shrink_video_to_frames"] = self.dataset_config.shrink_video_to_frames
+            if not self.dataset_config.shrink_video_to_frames:
+                item["fps"] = self.dataset_config.fps
         return item
 
     def get_latent_path(self: 'FileItemDTO', recalculate=False):
         if self._latent_path is not None and not recalculate:
             return self._latent_path
+        elif self.dataset_config.cache_root is not None:
+            # keyed by what is in the file instead of its name
+            info = self.get_latent_info_dict()
+            del info["filename"]
+            info["content_hash"] = self.content_hash
+            self._latent_path = get_cache_entry_path(self.dataset_config.cache_root, 'latents', info)
         else:
             # we store latents in a folder in same path as image called _latent_cache
             img_dir = os.path.dirname(self.path)
@@ -1688,22 +1905,52 @@ class LatentCachingFileItemDTOMixin:
             if not self.is_caching_to_memory:
                 # we are caching on disk, don't save in memory
                 self._encoded_latent = None
+                self._encoded_latent_params = {}
             else:
                 # move it back to cpu
                 self._encoded_latent = self._encoded_latent.to('cpu')
 
+    def set_latent_state(self, state_dict: Dict[str, torch.Tensor]):
+        self._encoded_latent = state_dict['latent']
+        self._encoded_latent_params = OrderedDict([(k, v) for k, v in state_dict.items() if k != 'latent'])
+
+    def get_latent_state(self) -> Dict[str, torch.Tensor]:
+        # the latent as it is stored, quantized when latent_cache_dtype is set
+        if self.shared_latent_store_path is not None:
+            store = get_shared_tensor_store(self.shared_latent_store_path)
+            latent_path = self.get_latent_path()
+            state_dict = OrderedDict([('latent', store.get(latent_path))])
+            for name in ['latent_scale', 'latent_offset']:
+                if f'{latent_path}:{name}' in store:
+                    state_dict[name] = store.get(f'{latent_path}:{name}')
+            return state_dict
+        if self._encoded_latent is None:
+            # load it from disk
+            if self.dataset_config.cache_memory_budget_mb > 0:
+                tier = get_memory_cache_tier(self.dataset_config.cache_memory_budget_mb)
+                state_dict = tier.get(self.get_latent_path(), load_latent_file)
+            else:
+                state_dict = load_latent_file(self.get_latent_path())
+            self.set_latent_state(state_dict)
+        return OrderedDict([('latent', self._encoded_latent)] + list(self._encoded_latent_params.items()))
+
+    def get_latent_memory_cache_items(self) -> list:
+        # the disk cache files get_latent will load, for the memory tier to prefetch
+        if not self.is_latent_cached or self.is_caching_to_memory or self.shared_latent_store_path is not None:
+            return []
+        return [(self.get_latent_path(), load_latent_file)]
+
     def get_latent(self, device=None):
         if not self.is_latent_cached:
             return None
-        if self._encoded_latent is None:
-            # load it from disk
-            state_dict = load_file(
-                self.get_latent_path(),
-                # device=device if device is not None else self.latent_load_device
-                device='cpu'
-            )
-            self._encoded_latent = state_dict['latent']
-        return self._encoded_latent
+        if self.shared_latent_store_path is not None and self.dataset_config.latent_cache_dtype is None:
+            # a view into the shared store, nothing is kept on the item
+            return get_shared_tensor_store(self.shared_latent_store_path).get(self.get_latent_path())
+        state_dict = self.get_latent_state()
+        if self.dataset_config.latent_cache_dtype is not None:
+            # dequantized here, in the dataloader worker, so only the small version is kept
+            return dequantize_latent(state_dict, self.latent_dtype)
+        return state_dict['latent']
 
 
 class LatentCachingMixin:
@@ -1712,10 +1959,180 @@ class LatentCachingMixin:
         if hasattr(super(), '__init__'):
             super().__init__(**kwargs)
         self.latent_cache = {}
+        # relative rmse of every latent quantized by this process
+        self.latent_quantization_errors: List[float] = []
+
+    def save_latent(self: 'AiToolkitDataset', file_item: 'FileItemDTO', latent: torch.Tensor, to_disk: bool, to_memory: bool):
+        latent_cache_dtype = self.dataset_config.latent_cache_dtype
+        if latent_cache_dtype is not None:
+            state_dict = quantize_latent(latent, latent_cache_dtype)
+            self.latent_quantization_errors.append(get_reconstruction_error(latent, state_dict))
+        else:
+            state_dict = OrderedDict([
+                ('latent', latent.clone().detach().cpu()),
+            ])
+        if to_disk:
+            # metadata
+            meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
+            with atomic_write_path(file_item.get_latent_path()) as tmp_path:
+                save_file(state_dict, tmp_path, metadata=meta)
+
+        if to_memory:
+            # keep it in memory
+            if latent_cache_dtype is not None:
+                file_item.set_latent_state(state_dict)
+            else:
+                file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
+
+    def print_latent_quantization_error(self: 'AiToolkitDataset'):
+        if len(self.latent_quantization_errors) == 0:
+            return
+        errors = self.latent_quantization_errors
+        print_acc(
+            f" - {self.dataset_config.latent_cache_dtype} latent cache error over {len(errors)} latents: "
+            f"mean {sum(errors) / len(errors) * 100:.2f}%, max {max(errors) * 100:.2f}% (relative rmse)"
+        )
+        self.latent_quantization_errors = []
+
+    def cache_video_latents(self: 'AiToolkitDataset', file_items: List['FileItemDTO'], to_disk: bool, to_memory: bool):
+        # clips are decoded in worker threads (cv2 releases the gil) while the vae encodes the
+        # ones before them. Clips in the same bucket stack, so they are encoded in batches
+        batch_size = max(1, self.dataset_config.video_cache_batch_size)
+        num_workers = max(1, self.dataset_config.video_cache_workers)
+        max_in_flight = num_workers + batch_size
+        file_items = sorted(file_items, key=lambda x: (x.crop_width, x.crop_height))
+        progress_bar = tqdm(total=len(file_items), desc=f'Caching video latents{" to disk" if to_disk else ""}')
+
+        def load_clip(file_item: 'FileItemDTO'):
+            file_item.load_video_clip(self.transform)
+            return file_item
+
+        def encode_batch(batch: List['FileItemDTO']):
+            imgs = torch.stack([x.tensor for x in batch]).to(self.sd.device_torch, dtype=self.sd.torch_dtype)
+            try:
+                latents = self.sd.encode_images(imgs)
+            except Exception as e:
+                print_acc(f"Error processing videos: {[x.path for x in batch]}")
+                print_acc(f"Error: {str(e)}")
+                raise e
+            for file_item, latent in zip(batch, latents):
+                self.save_latent(file_item, latent, to_disk, to_memory)
+                del file_item.tensor
+                file_item.is_latent_cached = True
+            progress_bar.update(len(batch))
+            del imgs
+            del latents
+
+        pending: Dict[tuple, List['FileItemDTO']] = {}
+        item_iter = iter(file_items)
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            in_flight = deque(executor.submit(load_clip, x) for x in itertools.islice(item_iter, max_in_flight))
+            while len(in_flight) > 0:
+                file_item = in_flight.popleft().result()
+                next_item = next(item_iter, None)
+                if next_item is not None:
+                    in_flight.append(executor.submit(load_clip, next_item))
+                bucket_key = (file_item.crop_width, file_item.crop_height)
+                pending.setdefault(bucket_key, []).append(file_item)
+                if len(pending[bucket_key]) >= batch_size:
+                    encode_batch(pending.pop(bucket_key))
+        for batch in pending.values():
+            encode_batch(batch)
+        progress_bar.close()
+
+    def get_latent_space_version(self: 'AiToolkitDataset') -> str:
+        return get_latent_space_version(self.sd.model_config)
+
+    def get_shared_latent_store_path(self: 'AiToolkitDataset') -> str:
+        # the latent paths hash everything that goes into a latent, so the same dataset and
+        # settings map to the same store in every rank
+        latent_paths = [file_item.get_latent_path(recalculate=True) for file_item in self.file_list]
+        hash_input = json.dumps([latent_paths, str(self.sd.torch_dtype)]).encode('utf-8')
+        return os.path.join(get_shared_memory_dir(), f'aitk_latents_{hashlib.md5(hash_input).hexdigest()}')
+
+    def attach_shared_latents(self: 'AiToolkitDataset') -> bool:
+        # use the store another process on this node already built, if it has everything
+        for file_item in self.file_list:
+            file_item.latent_space_version = self.get_latent_space_version()
+        store = get_shared_tensor_store(self.get_shared_latent_store_path())
+        # it may have been built since this process first looked
+        store.index = store._load_index()
+        if not store.has_all([file_item.get_latent_path() for file_item in self.file_list]):
+            return False
+        print_acc(f" - Attaching to shared latents {store.path}")
+        if accelerator.is_local_main_process:
+            # the store may be from another job, so the node's main process also removes it at
+            # exit instead of leaving it in shared memory if the builder dies first
+            store.remove_at_exit()
+        for file_item in self.file_list:
+            file_item.is_caching_to_disk = self.is_caching_latents_to_disk
+            file_item.is_caching_to_memory = True
+            file_item.latent_load_device = self.sd.device
+            file_item.latent_dtype = self.sd.torch_dtype
+            file_item.shared_latent_store_path = store.path
+            file_item.is_latent_cached = True
+        return True
+
+    def share_latents(self: 'AiToolkitDataset'):
+        # move the latents held by this process into the store and point the items at it
+        store = get_shared_tensor_store(self.get_shared_latent_store_path())
+        tensors = OrderedDict()
+        for file_item in self.file_list:
+            latent_path = file_item.get_latent_path()
+            # quantized latents are shared quantized, with their scales next to them
+            for name, tensor in file_item.get_latent_state().items():
+                tensors[latent_path if name == 'latent' else f'{latent_path}:{name}'] = tensor
+        store.write(tensors)
+        for file_item in self.file_list:
+            file_item.shared_latent_store_path = store.path
+            file_item._encoded_latent = None
+            file_item._encoded_latent_params = {}
+        print_acc(f" - Shared latents in {store.path}")
+
+    def cache_image_latent(self: 'AiToolkitDataset', file_item: 'FileItemDTO', to_disk: bool, to_memory: bool):
+        # load the image first
+        file_item.load_and_process_image(self.transform, only_load_latents=True)
+        dtype = self.sd.torch_dtype
+        device = self.sd.device_torch
+        # add batch dimension
+        try:
+            imgs = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
+            latent = self.sd.encode_images(imgs).squeeze(0)
+        except Exception as e:
+            print_acc(f"Error processing image: {file_item.path}")
+            print_acc(f"Error: {str(e)}")
+            raise e
+        self.save_latent(file_item, latent, to_disk, to_memory)
+
+        del imgs
+        del latent
+        del file_item.tensor
+
+    def build_latent_cache_shard(self: 'AiToolkitDataset', shard: CacheShard):
+        # every rank encodes its share of the missing latents to disk, instead of the main
+        # process doing all of them while the others wait
+        for file_item in self.file_list:
+            file_item.latent_space_version = self.get_latent_space_version()
+        missing = [x for x in self.file_list if not os.path.exists(x.get_latent_path(recalculate=True))]
+        mine = [x for x in missing if shard.is_mine(x.get_latent_path())]
+        if len(missing) > 0:
+            print_acc(f" - Caching {len(missing)} latents over {shard.num_shards} processes")
+            self.sd.set_device_state_preset('cache_latents')
+            if self.is_video:
+                if len(mine) > 0:
+                    self.cache_video_latents(mine, to_disk=True, to_memory=False)
+            else:
+                for file_item in tqdm(mine, desc=f'Caching latents shard {shard.shard_index}'):
+                    self.cache_image_latent(file_item, to_disk=True, to_memory=False)
+            self.sd.restore_device_state()
+            self.print_latent_quantization_error()
+        # everyone waits here, then loads the merged cache below
+        shard.merge([x.get_latent_path() for x in mine])
 
     def cache_latents_all_latents(self: 'AiToolkitDataset'):
-        if self.dataset_config.num_frames > 1:
-            raise Exception("Error: caching latents is not supported for multi-frame datasets")
+        shard = CacheShard()
+        if self.is_caching_latents_to_disk and shard.is_distributed:
+            self.build_latent_cache_shard(shard)
         with accelerator.main_process_first():
             print_acc(f"Caching latents for {self.dataset_path}")
             # cache all latents to disk
@@ -1726,70 +2143,42 @@ class LatentCachingMixin:
                 print_acc(" - Saving latents to disk")
             if to_memory:
                 print_acc(" - Keeping latents in memory")
+            share = to_memory and self.dataset_config.shared_latent_cache
+            if share and self.attach_shared_latents():
+                return
             # move sd items to cpu except for vae
             self.sd.set_device_state_preset('cache_latents')
 
             # use tqdm to show progress
             i = 0
+            # videos are decoded in the background and encoded in batches after the loop
+            pending_videos = []
             for file_item in tqdm(self.file_list, desc=f'Caching latents{" to disk" if to_disk else ""}'):
                 # set latent space version
-                if self.sd.model_config.latent_space_version is not None:
-                    file_item.latent_space_version = self.sd.model_config.latent_space_version
-                elif self.sd.is_xl:
-                    file_item.latent_space_version = 'sdxl'
-                elif self.sd.is_v3:
-                    file_item.latent_space_version = 'sd3'
-                elif self.sd.is_auraflow:
-                    file_item.latent_space_version = 'sdxl'
-                elif self.sd.is_flux:
-                    file_item.latent_space_version = 'flux1'
-                elif self.sd.model_config.is_pixart_sigma:
-                    file_item.latent_space_version = 'sdxl'
-                else:
-                    file_item.latent_space_version = self.sd.model_config.arch
+                file_item.latent_space_version = self.get_latent_space_version()
                 file_item.is_caching_to_disk = to_disk
                 file_item.is_caching_to_memory = to_memory
                 file_item.latent_load_device = self.sd.device
+                file_item.latent_dtype = self.sd.torch_dtype
 
                 latent_path = file_item.get_latent_path(recalculate=True)
                 # check if it is saved to disk already
                 if os.path.exists(latent_path):
+                    if self.dataset_config.cache_root is not None:
+                        touch_cache_entry(latent_path)
                     if to_memory:
                         # load it into memory
                         state_dict = load_file(latent_path, device='cpu')
-                        file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
+                        if self.dataset_config.latent_cache_dtype is not None:
+                            file_item.set_latent_state(state_dict)
+                        else:
+                            file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
+                elif self.is_video:
+                    pending_videos.append(file_item)
+                    continue
                 else:
                     # not saved to disk, calculate
-                    # load the image first
-                    file_item.load_and_process_image(self.transform, only_load_latents=True)
-                    dtype = self.sd.torch_dtype
-                    device = self.sd.device_torch
-                    # add batch dimension
-                    try:
-                        imgs = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
-                        latent = self.sd.encode_images(imgs).squeeze(0)
-                    except Exception as e:
-                        print_acc(f"Error processing image: {file_item.path}")
-                        print_acc(f"Error: {str(e)}")
-                        raise e
-                    # save_latent
-                    if to_disk:
-                        state_dict = OrderedDict([
-                            ('latent', latent.clone().detach().cpu()),
-                        ])
-                        # metadata
-                        meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
-                        os.makedirs(os.path.dirname(latent_path), exist_ok=True)
-                        save_file(state_dict, latent_path, metadata=meta)
-
-                    if to_memory:
-                        # keep it in memory
-                        file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
-
-                    del imgs
-                    del latent
-                    del file_item.tensor
-
+                    self.cache_image_latent(file_item, to_disk, to_memory)
                     # flush(garbage_collect=False)
                 file_item.is_latent_cached = True
                 i += 1
@@ -1797,6 +2186,13 @@ class LatentCachingMixin:
                 # if i % 100 == 0:
                 #     flush()
 
+            if len(pending_videos) > 0:
+                self.cache_video_latents(pending_videos, to_disk, to_memory)
+            self.print_latent_quantization_error()
+
+            if share:
+                self.share_latents()
+
             # restore device state
             self.sd.restore_device_state()
 
@@ -1812,6 +2208,9 @@ class TextEmbeddingFileItemDTOMixin:
         self.text_embedding_load_device = 'cpu'
         self.text_embedding_space_version = 'sd1'
         self.text_embedding_version = 1
+        # set when caching caption variants, one is picked every time the embedding is loaded
+        self.text_embedding_variant_paths: List[str] = []
+        self.text_embedding_dropout_path: Union[str, None] = None
 
     def get_text_embedding_info_dict(self: 'FileItemDTO'):
         # make sure the caption is loaded here
@@ -1831,6 +2230,16 @@ class TextEmbeddingFileItemDTOMixin:
     def get_text_embedding_path(self: 'FileItemDTO', recalculate=False):
         if self._text_embedding_path is not None and not recalculate:
             return self._text_embedding_path
+        elif self.dataset_config.cache_root is not None:
+            # keyed by the caption, so every image with the same caption shares it
+            info = self.get_text_embedding_info_dict()
+            if "control_path" in info:
+                control_paths = info.pop("control_path")
+                if isinstance(control_paths, list):
+                    info["control_content_hash"] = [get_file_content_hash(x) for x in control_paths]
+                else:
+                    info["control_content_hash"] = get_file_content_hash(control_paths)
+            self._text_embedding_path = get_cache_entry_path(self.dataset_config.cache_root, 'text_embeddings', info)
         else:
             # we store text embeddings in a folder in same path as image called _text_embedding_cache
             img_dir = os.path.dirname(self.path)
@@ -1845,6 +2254,35 @@ class TextEmbeddingFileItemDTOMixin:
 
         return self._text_embedding_path
 
+    def get_caption_variants(self: 'FileItemDTO') -> List[str]:
+        # seeded by the caption, so the same caption always gives the same variants
+        if self.raw_caption is None:
+            self.load_caption()
+        return [
+            self.get_caption(rng=random.Random(f'{self.raw_caption}|{idx}'), augment_cached=True)
+            for idx in range(self.dataset_config.text_embedding_variants)
+        ]
+
+    def get_text_embedding_variant_path(self: 'FileItemDTO', caption: str, dataset_folder: str) -> str:
+        # keyed by the caption only, every image sharing a caption variant shares the file
+        info = OrderedDict([
+            ("caption", caption),
+            ("text_embedding_space_version", self.text_embedding_space_version),
+            ("text_embedding_version", self.text_embedding_version),
+        ])
+        if self.dataset_config.cache_root is not None:
+            return get_cache_entry_path(self.dataset_config.cache_root, 'text_embeddings', info)
+        hash_input = json.dumps(info, sort_keys=True).encode('utf-8')
+        hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii').replace('=', '')
+        return os.path.join(dataset_folder, '_t_e_cache', f'variant_{hash_str}.safetensors')
+
+    def get_text_embedding_load_path(self: 'FileItemDTO') -> str:
+        if len(self.text_embedding_variant_paths) == 0:
+            return self.get_text_embedding_path()
+        if self.text_embedding_dropout_path is not None and random.random() < self.dataset_config.caption_dropout_rate:
+            return self.text_embedding_dropout_path
+        return random.choice(self.text_embedding_variant_paths)
+
     def cleanup_text_embedding(self):
         if self.prompt_embeds is not None:
             # we are caching on disk, don't save in memory
@@ -1855,7 +2293,19 @@ class TextEmbeddingFileItemDTOMixin:
             return
         if self.prompt_embeds is None:
             # load it from disk
-            self.prompt_embeds = PromptEmbeds.load(self.get_text_embedding_path())
+            text_embedding_path = self.get_text_embedding_load_path()
+            if self.dataset_config.cache_memory_budget_mb > 0:
+                tier = get_memory_cache_tier(self.dataset_config.cache_memory_budget_mb)
+                # a shallow copy, PromptEmbeds.to swaps the tensors on the object it is called on
+                self.prompt_embeds = copy.copy(tier.get(text_embedding_path, PromptEmbeds.load))
+            else:
+                self.prompt_embeds = PromptEmbeds.load(text_embedding_path)
+
+    def get_text_embedding_memory_cache_items(self) -> list:
+        # the variant is only picked when loading, variants still stay in the tier once loaded
+        if not self.is_text_embedding_cached or len(self.text_embedding_variant_paths) > 0:
+            return []
+        return [(self.get_text_embedding_path(), PromptEmbeds.load)]
 
 class TextEmbeddingCachingMixin:
     def __init__(self: 'AiToolkitDataset', **kwargs):
@@ -1864,7 +2314,112 @@ class TextEmbeddingCachingMixin:
             super().__init__(**kwargs)
         self.is_caching_text_embeddings = self.dataset_config.cache_text_embeddings
 
+    def encode_text_embedding(self: 'AiToolkitDataset', file_item: 'FileItemDTO') -> PromptEmbeds:
+        if file_item.encode_control_in_text_embeddings:
+            if file_item.control_path is None:
+                raise Exception(f"Could not find a control image for {file_item.path} which is needed for this model")
+            ctrl_img_list = []
+            control_path_list = file_item.control_path
+            if not isinstance(file_item.control_path, list):
+                control_path_list = [control_path_list]
+            for i in range(len(control_path_list)):
+                try:
+                    img = Image.open(control_path_list[i]).convert("RGB")
+                    img = exif_transpose(img)
+                    # convert to 0 to 1 tensor
+                    img = (
+                        TF.to_tensor(img)
+                        .unsqueeze(0)
+                        .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
+                    )
+                    ctrl_img_list.append(img)
+                except Exception as e:
+                    print_acc(f"Error: {e}")
+                    print_acc(f"Error loading control image: {control_path_list[i]}")
+            
+            if len(ctrl_img_list) == 0:
+                ctrl_img = None
+            elif not self.sd.has_multiple_control_images:
+                ctrl_img = ctrl_img_list[0]
+            else:
+                ctrl_img = ctrl_img_list
+            return self.sd.encode_prompt(file_item.caption, control_images=ctrl_img)
+        else:
+            return self.sd.encode_prompt(file_item.caption)
+
+    def build_text_embedding_cache_shard(self: 'AiToolkitDataset', shard: CacheShard):
+        # every rank encodes its share of the missing embeddings to disk
+        for file_item in self.file_list:
+            file_item.text_embedding_space_version = self.sd.model_config.arch
+        missing = [x for x in self.file_list if not os.path.exists(x.get_text_embedding_path(recalculate=True))]
+        mine = [x for x in missing if shard.is_mine(x.get_text_embedding_path())]
+        if len(mine) > 0:
+            self.sd.set_device_state_preset('cache_text_encoder')
+            for file_item in tqdm(mine, desc=f'Caching text embeddings shard {shard.shard_index}'):
+                prompt_embeds = self.encode_text_embedding(file_item)
+                with atomic_write_path(file_item.get_text_embedding_path()) as tmp_path:
+                    prompt_embeds.save(tmp_path)
+                del prompt_embeds
+        # everyone waits here, then picks up the merged cache below
+        shard.merge([x.get_text_embedding_path() for x in mine])
+
+    def use_text_embedding_variants(self: 'AiToolkitDataset') -> bool:
+        if self.dataset_config.text_embedding_variants <= 0:
+            return False
+        if self.sd.encode_control_in_text_embeddings:
+            print_acc(" - Caption variants are not supported when control images are encoded with the text")
+            return False
+        return True
+
+    def setup_text_embedding_variants(self: 'AiToolkitDataset') -> Dict[str, str]:
+        # works out the variant paths of every item, returns path -> caption of the unique ones
+        dataset_folder = self.dataset_path
+        if not os.path.isdir(dataset_folder):
+            dataset_folder = os.path.dirname(dataset_folder)
+        captions: Dict[str, str] = OrderedDict()
+        for file_item in self.file_list:
+            file_item.text_embedding_space_version = self.sd.model_config.arch
+            file_item.text_embedding_variant_paths = []
+            for caption in file_item.get_caption_variants():
+                path = file_item.get_text_embedding_variant_path(caption, dataset_folder)
+                file_item.text_embedding_variant_paths.append(path)
+                captions[path] = caption
+            if self.dataset_config.caption_dropout_rate > 0:
+                file_item.text_embedding_dropout_path = file_item.get_text_embedding_variant_path('', dataset_folder)
+                captions[file_item.text_embedding_dropout_path] = ''
+        return captions
+
+    def cache_text_embedding_variants(self: 'AiToolkitDataset'):
+        with accelerator.main_process_first():
+            print_acc(f"Caching text embedding variants for {self.dataset_path}")
+            captions = self.setup_text_embedding_variants()
+            missing = [(path, caption) for path, caption in captions.items() if not os.path.exists(path)]
+            if self.dataset_config.cache_root is not None:
+                for path in captions.keys():
+                    if os.path.exists(path):
+                        touch_cache_entry(path)
+            num_variants = len(self.file_list) * self.dataset_config.text_embedding_variants
+            print_acc(f" - {num_variants} variants, {len(captions)} unique captions, {len(missing)} to encode")
+            if len(missing) > 0:
+                self.sd.set_device_state_preset('cache_text_encoder')
+                batch_size = max(1, self.dataset_config.text_embedding_variants_batch_size)
+                for i in tqdm(range(0, len(missing), batch_size), desc='Caching text embedding variants'):
+                    batch = missing[i:i + batch_size]
+                    prompt_embeds = self.sd.encode_prompt([caption for _, caption in batch])
+                    for (path, _), embeds in zip(batch, split_prompt_embeds(prompt_embeds, len(batch))):
+                        with atomic_write_path(path) as tmp_path:
+                            embeds.save(tmp_path)
+                    del prompt_embeds
+            for file_item in self.file_list:
+                file_item.is_text_embedding_cached = True
+
     def cache_text_embeddings(self: 'AiToolkitDataset'):
+        if self.use_text_embedding_variants():
+            self.cache_text_embedding_variants()
+            return
+        shard = CacheShard()
+        if shard.is_distributed:
+            self.build_text_embedding_cache_shard(shard)
         with accelerator.main_process_first():
             print_acc(f"Caching text_embeddings for {self.dataset_path}")
             print_acc(" - Saving text embeddings to disk")
@@ -1885,40 +2440,13 @@ class TextEmbeddingCachingMixin:
                         self.sd.set_device_state_preset('cache_text_encoder')
                         did_move = True
                         
-                    if file_item.encode_control_in_text_embeddings:
-                        if file_item.control_path is None:
-                            raise Exception(f"Could not find a control image for {file_item.path} which is needed for this model")
-                        ctrl_img_list = []
-                        control_path_list = file_item.control_path
-                        if not isinstance(file_item.control_path, list):
-                            control_path_list = [control_path_list]
-                        for i in range(len(control_path_list)):
-                            try:
-                                img = Image.open(control_path_list[i]).convert("RGB")
-                                img = exif_transpose(img)
-                                # convert to 0 to 1 tensor
-                                img = (
-                                    TF.to_tensor(img)
-                                    .unsqueeze(0)
-                                    .to(self.sd.device_torch, dtype=self.sd.torch_dtype)
-                                )
-                                ctrl_img_list.append(img)
-                            except Exception as e:
-                                print_acc(f"Error: {e}")
-                                print_acc(f"Error loading control image: {control_path_list[i]}")
-                        
-                        if len(ctrl_img_list) == 0:
-                            ctrl_img = None
-                        elif not self.sd.has_multiple_control_images:
-                            ctrl_img = ctrl_img_list[0]
-                        else:
-                            ctrl_img = ctrl_img_list
-                        prompt_embeds: PromptEmbeds = self.sd.encode_prompt(file_item.caption, control_images=ctrl_img)
-                    else:
-                        prompt_embeds: PromptEmbeds = self.sd.encode_prompt(file_item.caption)
+                    prompt_embeds: PromptEmbeds = self.encode_text_embedding(file_item)
                     # save it
-                    prompt_embeds.save(text_embedding_path)
+                    with atomic_write_path(text_embedding_path) as tmp_path:
+                        prompt_embeds.save(tmp_path)
                     del prompt_embeds
+                elif self.dataset_config.cache_root is not None:
+                    touch_cache_entry(text_embedding_path)
                 file_item.is_text_embedding_cached = True
                 i += 1
             # restore device state
@@ -1926,6 +2454,63 @@ class TextEmbeddingCachingMixin:
             #     self.sd.restore_device_state()
 
 
+class ResizedImageCachingMixin:
+    def __init__(self: 'AiToolkitDataset', **kwargs):
+        # if we have super, call it
+        if hasattr(super(), '__init__'):
+            super().__init__(**kwargs)
+        self.resized_image_cache_dir: Union[str, None] = None
+
+    def cache_resized_images(self: 'AiToolkitDataset'):
+        # decode and resize every image once into a packed uint8 file, so workers only crop and
+        # transform. Only for bucketed image datasets, latent caching already skips all of this
+        dataset_folder = self.dataset_path
+        if not os.path.isdir(dataset_folder):
+            dataset_folder = os.path.dirname(dataset_folder)
+        self.resized_image_cache_dir = os.path.join(dataset_folder, '_resized_image_cache')
+        if self.dataset_config.cache_root is not None:
+            self.resized_image_cache_dir = get_dataset_cache_dir(
+                self.dataset_config.cache_root, dataset_folder, kind='resized_images'
+            )
+
+        with accelerator.main_process_first():
+            pack = get_resized_image_pack(self.resized_image_cache_dir)
+            if self.dataset_config.cache_root is not None:
+                touch_cache_entry(pack.data_path)
+                touch_cache_entry(pack.index_path)
+            missing = {}
+            for file_item in self.file_list:
+                file_item.resized_image_cache_dir = self.resized_image_cache_dir
+                file_item.resized_image_cache_key = file_item.get_resized_image_cache_key(dataset_folder)
+                if file_item.resized_image_cache_key not in pack:
+                    missing[file_item.resized_image_cache_key] = file_item
+            if len(missing) == 0:
+                return
+            if not accelerator.is_main_process:
+                # the main process wrote them, pick them up
+                pack.index = pack._load_index()
+                return
+
+            print_acc(f"Caching resized images for {self.dataset_path}")
+
+            def load_resized(file_item: 'FileItemDTO'):
+                return file_item.resized_image_cache_key, np.asarray(file_item.load_resized_image())
+
+            chunk = []
+            with ThreadPoolExecutor(max_workers=max(1, self.dataset_config.num_workers)) as executor:
+                for item in tqdm(
+                        executor.map(load_resized, missing.values()),
+                        total=len(missing),
+                        desc='Caching resized images'
+                ):
+                    chunk.append(item)
+                    if len(chunk) >= 64:
+                        pack.add_many(chunk)
+                        chunk = []
+            if len(chunk) > 0:
+                pack.add_many(chunk)
+
+
 class CLIPCachingMixin:
     def __init__(self: 'AiToolkitDataset', **kwargs):
         # if we have super, call it
@@ -1988,36 +2573,11 @@ class CLIPCachingMixin:
 
             is_noise_zero = hasattr(self.sd.adapter, 'clip_noise_zero') and self.sd.adapter.clip_noise_zero
 
-            for i in range(self.clip_vision_num_unconditional_cache):
-                hash_dict = OrderedDict([
-                    ("image_encoder_path", image_encoder_path),
-                    ("is_quad", is_quad),
-                    ("is_noise_zero", is_noise_zero),
-                ])
-                # get base64 hash of md5 checksum of hash_dict
-                hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
-                hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
-                hash_str = hash_str.replace('=', '')
-
-                uncond_path = os.path.join(clip_vision_cache_path, f'uncond_{hash_str}_{i}.safetensors')
-                if os.path.exists(uncond_path):
-                    # skip it
-                    unconditional_paths.append(uncond_path)
-                    continue
-
-                # generate a random image
-                img_shape = (1, 3, self.sd.adapter.input_size, self.sd.adapter.input_size)
-                if is_noise_zero:
-                    tensors_0_1 = torch.rand(img_shape).to(device, dtype=torch.float32)
-                else:
-                    tensors_0_1 = torch.zeros(img_shape).to(device, dtype=torch.float32)
-                clip_image = clip_image_processor(
-                    images=tensors_0_1,
-                    return_tensors="pt",
-                    do_resize=True,
-                    do_rescale=False,
-                ).pixel_values
+            # with several processes each one encodes its share, then they wait for each other
+            shard = CacheShard()
+            written = []
 
+            def encode_clip_vision(clip_image: torch.Tensor):
                 if is_quad:
                     # split the 4x4 grid and stack on batch
                     ci1, ci2 = clip_image.chunk(2, dim=2)
@@ -2030,14 +2590,62 @@ class CLIPCachingMixin:
                     output_hidden_states=True
                 )
                 # make state_dict ['last_hidden_state', 'image_embeds', 'penultimate_hidden_states']
-                state_dict = OrderedDict([
+                return OrderedDict([
                     ('image_embeds', clip_output.image_embeds.clone().detach().cpu()),
                     ('last_hidden_state', clip_output.hidden_states[-1].clone().detach().cpu()),
                     ('penultimate_hidden_states', clip_output.hidden_states[-2].clone().detach().cpu()),
                 ])
 
-                os.makedirs(os.path.dirname(uncond_path), exist_ok=True)
-                save_file(state_dict, uncond_path)
+            def cache_unconditional(uncond_path: str):
+                # generate a random image
+                img_shape = (1, 3, self.sd.adapter.input_size, self.sd.adapter.input_size)
+                if is_noise_zero:
+                    tensors_0_1 = torch.rand(img_shape).to(device, dtype=torch.float32)
+                else:
+                    tensors_0_1 = torch.zeros(img_shape).to(device, dtype=torch.float32)
+                clip_image = clip_image_processor(
+                    images=tensors_0_1,
+                    return_tensors="pt",
+                    do_resize=True,
+                    do_rescale=False,
+                ).pixel_values
+                state_dict = encode_clip_vision(clip_image)
+                with atomic_write_path(uncond_path) as tmp_path:
+                    save_file(state_dict, tmp_path)
+
+            def cache_file_item(file_item: 'FileItemDTO', embedding_path: str):
+                # load the image first
+                file_item.load_clip_image()
+                # add batch dimension
+                clip_image = file_item.clip_image_tensor.unsqueeze(0).to(device, dtype=dtype)
+                state_dict = encode_clip_vision(clip_image)
+                # metadata
+                meta = get_meta_for_safetensors(file_item.get_clip_vision_info_dict())
+                with atomic_write_path(embedding_path) as tmp_path:
+                    save_file(state_dict, tmp_path, metadata=meta)
+
+                del clip_image
+                del file_item.clip_image_tensor
+
+            for i in range(self.clip_vision_num_unconditional_cache):
+                hash_dict = OrderedDict([
+                    ("image_encoder_path", image_encoder_path),
+                    ("is_quad", is_quad),
+                    ("is_noise_zero", is_noise_zero),
+                ])
+                # get base64 hash of md5 checksum of hash_dict
+                hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
+                hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+                hash_str = hash_str.replace('=', '')
+
+                uncond_path = os.path.join(clip_vision_cache_path, f'uncond_{hash_str}_{i}.safetensors')
+                if self.dataset_config.cache_root is not None:
+                    uncond_path = get_cache_entry_path(
+                        self.dataset_config.cache_root, 'clip_vision', dict(hash_dict, unconditional_index=i)
+                    )
+                if not os.path.exists(uncond_path) and shard.is_mine(uncond_path):
+                    cache_unconditional(uncond_path)
+                    written.append(uncond_path)
                 unconditional_paths.append(uncond_path)
 
             self.clip_vision_unconditional_cache = unconditional_paths
@@ -2055,39 +2663,11 @@ class CLIPCachingMixin:
 
                 embedding_path = file_item.get_clip_vision_embeddings_path(recalculate=True)
                 # check if it is saved to disk already
-                if not os.path.exists(embedding_path):
-                    # load the image first
-                    file_item.load_clip_image()
-                    # add batch dimension
-                    clip_image = file_item.clip_image_tensor.unsqueeze(0).to(device, dtype=dtype)
-
-                    if is_quad:
-                        # split the 4x4 grid and stack on batch
-                        ci1, ci2 = clip_image.chunk(2, dim=2)
-                        ci1, ci3 = ci1.chunk(2, dim=3)
-                        ci2, ci4 = ci2.chunk(2, dim=3)
-                        clip_image = torch.cat([ci1, ci2, ci3, ci4], dim=0).detach()
-
-                    clip_output = vision_encoder(
-                        clip_image.to(device, dtype=dtype),
-                        output_hidden_states=True
-                    )
-
-                    # make state_dict ['last_hidden_state', 'image_embeds', 'penultimate_hidden_states']
-                    state_dict = OrderedDict([
-                        ('image_embeds', clip_output.image_embeds.clone().detach().cpu()),
-                        ('last_hidden_state', clip_output.hidden_states[-1].clone().detach().cpu()),
-                        ('penultimate_hidden_states', clip_output.hidden_states[-2].clone().detach().cpu()),
-                    ])
-                    # metadata
-                    meta = get_meta_for_safetensors(file_item.get_clip_vision_info_dict())
-                    os.makedirs(os.path.dirname(embedding_path), exist_ok=True)
-                    save_file(state_dict, embedding_path, metadata=meta)
-
-                    del clip_image
-                    del clip_output
-                    del file_item.clip_image_tensor
-
+                if not os.path.exists(embedding_path) and shard.is_mine(embedding_path):
+                    cache_file_item(file_item, embedding_path)
+                    written.append(embedding_path)
+                elif self.dataset_config.cache_root is not None:
+                    touch_cache_entry(embedding_path)
                     # flush(garbage_collect=False)
                 file_item.is_vision_clip_cached = True
                 i += 1
@@ -2095,6 +2675,17 @@ class CLIPCachingMixin:
             # if i % 100 == 0:
             #     flush()
 
+            if shard.is_distributed:
+                shard.merge(written)
+                # anything another process wrote that we still cannot see, eg no shared disk
+                for uncond_path in unconditional_paths:
+                    if not os.path.exists(uncond_path):
+                        cache_unconditional(uncond_path)
+                for file_item in self.file_list:
+                    embedding_path = file_item.get_clip_vision_embeddings_path()
+                    if not os.path.exists(embedding_path):
+                        cache_file_item(file_item, embedding_path)
+
         # restore device state
         self.sd.restore_device_state()
 
@@ -2134,6 +2725,7 @@ class ControlCachingMixin:
             self.control_generator = ControlGenerator(
                 device=device,
                 sd=self.sd,
+                cache_root=self.dataset_config.cache_root,
             )
 
             # use tqdm to show progress
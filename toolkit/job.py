@@ -18,6 +18,9 @@ def get_job(
     if job == 'train':
         from jobs import TrainJob
         return TrainJob(config)
+    if job == 'merge':
+        from jobs import MergeJob
+        return MergeJob(config)
     if job == 'mod':
         from jobs import ModJob
         return ModJob(config)
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from typing import Dict, Union
+
+import torch
+
+# name in the config -> name in the cache key
+LATENT_CACHE_DTYPES = {
+    'bf16': 'bf16',
+    'bfloat16': 'bf16',
+    'fp8': 'fp8_e4m3',
+    'float8_e4m3': 'fp8_e4m3',
+    'float8_e4m3fn': 'fp8_e4m3',
+    'fp8_e4m3': 'fp8_e4m3',
+    'int8': 'int8',
+}
+
+FP8_E4M3_MAX = 448.0
+
+
+def get_latent_cache_dtype(name: Union[str, None]) -> Union[str, None]:
+    if name is None:
+        return None
+    if name.lower() not in LATENT_CACHE_DTYPES:
+        raise ValueError(f"Unknown latent_cache_dtype {name}, use one of {', '.join(LATENT_CACHE_DTYPES.keys())}")
+    return LATENT_CACHE_DTYPES[name.lower()]
+
+
+def _channel_view_shape(latent: torch.Tensor):
+    # latents are (C, H, W) or (C, T, H, W), scales are per channel
+    return (latent.shape[0],) + (1,) * (latent.ndim - 1)
+
+
+def quantize_latent(latent: torch.Tensor, cache_dtype: str) -> Dict[str, torch.Tensor]:
+    """
+    Returns the state dict to store, 'latent' plus the per channel 'latent_scale' and
+    'latent_offset' the dtype needs to be turned back into floats.
+    """
+    latent = latent.detach().to('cpu', dtype=torch.float32)
+    flat = latent.reshape(latent.shape[0], -1)
+    if cache_dtype == 'bf16':
+        return OrderedDict([('latent', latent.to(torch.bfloat16))])
+    elif cache_dtype == 'fp8_e4m3':
+        # scale every channel so its largest value lands on the largest fp8 value
+        amax = flat.abs().amax(dim=1).clamp(min=1e-12)
+        scale = (amax / FP8_E4M3_MAX).reshape(_channel_view_shape(latent))
+        quantized = (latent / scale).clamp(-FP8_E4M3_MAX, FP8_E4M3_MAX).to(torch.float8_e4m3fn)
+        return OrderedDict([('latent', quantized), ('latent_scale', scale)])
+    elif cache_dtype == 'int8':
+        # spread every channel's min to max over the 256 steps
+        minimum = flat.amin(dim=1)
+        maximum = flat.amax(dim=1)
+        scale = ((maximum - minimum) / 255.0).clamp(min=1e-12).reshape(_channel_view_shape(latent))
+        offset = minimum.reshape(_channel_view_shape(latent))
+        quantized = (torch.round((latent - offset) / scale) - 128).clamp(-128, 127).to(torch.int8)
+        return OrderedDict([('latent', quantized), ('latent_scale', scale), ('latent_offset', offset)])
+    else:
+        raise ValueError(f"Unknown latent cache dtype {cache_dtype}")
+
+
+def dequantize_latent(state_dict: Dict[str, torch.Tensor], dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    latent = state_dict['latent']
+    if latent.dtype == torch.int8:
+        latent = (latent.to(torch.float32) + 128) * state_dict['latent_scale'] + state_dict['latent_offset']
+    elif 'latent_scale' in state_dict:
+        latent = latent.to(torch.float32) * state_dict['latent_scale']
+    return latent.to(dtype)
+
+
+def get_reconstruction_error(latent: torch.Tensor, state_dict: Dict[str, torch.Tensor]) -> float:
+    # rmse relative to the rms of the latent
+    latent = latent.detach().to('cpu', dtype=torch.float32)
+    error = dequantize_latent(state_dict, torch.float32) - latent
+    return (error.pow(2).mean().sqrt() / latent.pow(2).mean().sqrt().clamp(min=1e-12)).item()
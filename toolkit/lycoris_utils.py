@@ -1,5 +1,8 @@
 # heavily based on https://github.com/KohakuBlueleaf/LyCORIS/blob/main/lycoris/utils.py
 
+import json
+import os
+import re
 from typing import *
 
 import numpy as np
@@ -10,6 +13,7 @@ import torch.nn.functional as F
 
 import torch.linalg as linalg
 
+from safetensors import safe_open
 from tqdm import tqdm
 from collections import OrderedDict
 
@@ -111,9 +115,15 @@ def extract_linear(
     return (extract_weight_A, extract_weight_B, diff), 'low rank'
 
 
-def extract_diff(
-        base_model,
-        db_model,
+LINEAR_LAYER_TYPES = {'Linear', 'LoRACompatibleLinear'}
+CONV_LAYER_TYPES = {'Conv2d', 'LoRACompatibleConv'}
+
+
+def extract_layer_diff(
+        lora_name: str,
+        layer: str,
+        tuned_weight: torch.Tensor,
+        base_weight: torch.Tensor,
         mode='fixed',
         linear_mode_param=0,
         conv_mode_param=0,
@@ -122,11 +132,80 @@ def extract_diff(
         sparsity=0.98,
         small_conv=True,
         linear_only=False,
+) -> 'OrderedDict[str, torch.Tensor]':
+    # decomposes the difference of a single layer. Returns an empty dict if nothing to extract
+    loras = OrderedDict()
+    if layer not in LINEAR_LAYER_TYPES and layer not in CONV_LAYER_TYPES:
+        return loras
+    if torch.allclose(tuned_weight, base_weight):
+        return loras
+
+    if layer in LINEAR_LAYER_TYPES:
+        weight, decompose_mode = extract_linear(
+            (tuned_weight - base_weight),
+            mode,
+            linear_mode_param,
+            device=extract_device,
+        )
+        if decompose_mode == 'low rank':
+            extract_a, extract_b, diff = weight
+    else:
+        is_linear = (
+                tuned_weight.shape[2] == 1
+                and tuned_weight.shape[3] == 1
+        )
+        if not is_linear and linear_only:
+            return loras
+        weight, decompose_mode = extract_conv(
+            (tuned_weight - base_weight),
+            mode,
+            linear_mode_param if is_linear else conv_mode_param,
+            device=extract_device,
+        )
+        if decompose_mode == 'low rank':
+            extract_a, extract_b, diff = weight
+        if small_conv and not is_linear and decompose_mode == 'low rank':
+            dim = extract_a.size(0)
+            (extract_c, extract_a, _), _ = extract_conv(
+                extract_a.transpose(0, 1),
+                'fixed', dim,
+                extract_device, True
+            )
+            extract_a = extract_a.transpose(0, 1)
+            extract_c = extract_c.transpose(0, 1)
+            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
+            diff = tuned_weight - torch.einsum(
+                'i j k l, j r, p i -> p r k l',
+                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
+            ).detach().cpu().contiguous()
+            del extract_c
+
+    if decompose_mode == 'low rank':
+        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
+        if use_bias:
+            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
+            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
+
+            indices = sparse_diff.indices().to(torch.int16)
+            values = sparse_diff.values().half()
+            loras[f'{lora_name}.bias_indices'] = indices
+            loras[f'{lora_name}.bias_values'] = values
+            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
+        del extract_a, extract_b, diff
+    elif decompose_mode == 'full':
+        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
+    else:
+        raise NotImplementedError
+    return loras
+
+
+def get_extract_targets(
+        linear_only=False,
         extract_unet=True,
         extract_text_encoder=True,
 ):
-    meta = OrderedDict()
-
     UNET_TARGET_REPLACE_MODULE = [
         "Transformer2DModel",
         "Attention",
@@ -156,9 +235,45 @@ def extract_diff(
     if not extract_text_encoder:
         TEXT_ENCODER_TARGET_REPLACE_MODULE = []
 
+    return UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE
+
+
+def extract_diff(
+        base_model,
+        db_model,
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        linear_only=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+):
+    meta = OrderedDict()
+
+    UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE = get_extract_targets(
+        linear_only=linear_only,
+        extract_unet=extract_unet,
+        extract_text_encoder=extract_text_encoder,
+    )
+
     LORA_PREFIX_UNET = 'lora_unet'
     LORA_PREFIX_TEXT_ENCODER = 'lora_te'
 
+    layer_kwargs = dict(
+        mode=mode,
+        linear_mode_param=linear_mode_param,
+        conv_mode_param=conv_mode_param,
+        extract_device=extract_device,
+        use_bias=use_bias,
+        sparsity=sparsity,
+        small_conv=small_conv,
+        linear_only=linear_only,
+    )
+
     def make_state_dict(
             prefix,
             root_module: torch.nn.Module,
@@ -174,7 +289,7 @@ def extract_diff(
             if module.__class__.__name__ in target_replace_modules:
                 temp[name] = {}
                 for child_name, child_module in module.named_modules():
-                    if child_module.__class__.__name__ not in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
+                    if child_module.__class__.__name__ not in LINEAR_LAYER_TYPES | CONV_LAYER_TYPES:
                         continue
                     temp[name][child_name] = child_module.weight
             elif name in target_replace_names:
@@ -187,138 +302,25 @@ def extract_diff(
                     lora_name = prefix + '.' + name + '.' + child_name
                     lora_name = lora_name.replace('.', '_')
                     layer = child_module.__class__.__name__
-                    if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                        root_weight = child_module.weight
-                        if torch.allclose(root_weight, weights[child_name]):
-                            continue
-
-                    if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                        weight, decompose_mode = extract_linear(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                    elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                        is_linear = (child_module.weight.shape[2] == 1
-                                     and child_module.weight.shape[3] == 1)
-                        if not is_linear and linear_only:
-                            continue
-                        weight, decompose_mode = extract_conv(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param if is_linear else conv_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                        if small_conv and not is_linear and decompose_mode == 'low rank':
-                            dim = extract_a.size(0)
-                            (extract_c, extract_a, _), _ = extract_conv(
-                                extract_a.transpose(0, 1),
-                                'fixed', dim,
-                                extract_device, True
-                            )
-                            extract_a = extract_a.transpose(0, 1)
-                            extract_c = extract_c.transpose(0, 1)
-                            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                            diff = child_module.weight - torch.einsum(
-                                'i j k l, j r, p i -> p r k l',
-                                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                            ).detach().cpu().contiguous()
-                            del extract_c
-                    else:
+                    if layer not in LINEAR_LAYER_TYPES and layer not in CONV_LAYER_TYPES:
                         continue
-                    if decompose_mode == 'low rank':
-                        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                        if use_bias:
-                            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                            indices = sparse_diff.indices().to(torch.int16)
-                            values = sparse_diff.values().half()
-                            loras[f'{lora_name}.bias_indices'] = indices
-                            loras[f'{lora_name}.bias_values'] = values
-                            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                        del extract_a, extract_b, diff
-                    elif decompose_mode == 'full':
-                        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                    else:
-                        raise NotImplementedError
+                    loras.update(extract_layer_diff(
+                        lora_name,
+                        layer,
+                        child_module.weight,
+                        weights[child_name],
+                        **layer_kwargs
+                    ))
             elif name in temp_name:
-                weights = temp_name[name]
                 lora_name = prefix + '.' + name
                 lora_name = lora_name.replace('.', '_')
-                layer = module.__class__.__name__
-
-                if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                    root_weight = module.weight
-                    if torch.allclose(root_weight, weights):
-                        continue
-
-                if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                    weight, decompose_mode = extract_linear(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                    is_linear = (
-                            root_weight.shape[2] == 1
-                            and root_weight.shape[3] == 1
-                    )
-                    if not is_linear and linear_only:
-                        continue
-                    weight, decompose_mode = extract_conv(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param if is_linear else conv_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                    if small_conv and not is_linear and decompose_mode == 'low rank':
-                        dim = extract_a.size(0)
-                        (extract_c, extract_a, _), _ = extract_conv(
-                            extract_a.transpose(0, 1),
-                            'fixed', dim,
-                            extract_device, True
-                        )
-                        extract_a = extract_a.transpose(0, 1)
-                        extract_c = extract_c.transpose(0, 1)
-                        loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                        diff = root_weight - torch.einsum(
-                            'i j k l, j r, p i -> p r k l',
-                            extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                        ).detach().cpu().contiguous()
-                        del extract_c
-                else:
-                    continue
-                if decompose_mode == 'low rank':
-                    loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                    if use_bias:
-                        diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                        sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                        indices = sparse_diff.indices().to(torch.int16)
-                        values = sparse_diff.values().half()
-                        loras[f'{lora_name}.bias_indices'] = indices
-                        loras[f'{lora_name}.bias_values'] = values
-                        loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                    del extract_a, extract_b, diff
-                elif decompose_mode == 'full':
-                    loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                else:
-                    raise NotImplementedError
+                loras.update(extract_layer_diff(
+                    lora_name,
+                    module.__class__.__name__,
+                    module.weight,
+                    temp_name[name],
+                    **layer_kwargs
+                ))
         return loras
 
     text_encoder_loras = make_state_dict(
@@ -338,6 +340,181 @@ def extract_diff(
     return (text_encoder_loras | unet_loras), meta
 
 
+# module class name -> pattern of the diffusers module path for layers inside of it
+EXTRACT_MODULE_PATH_PATTERNS = {
+    "Transformer2DModel": re.compile(r"(^|\.)attentions\.\d+\."),
+    "Attention": re.compile(r"(^|\.)attn\d+\."),
+    "ResnetBlock2D": re.compile(r"(^|\.)resnets\.\d+\."),
+    "Downsample2D": re.compile(r"(^|\.)downsamplers\.\d+\."),
+    "Upsample2D": re.compile(r"(^|\.)upsamplers\.\d+\."),
+    "CLIPAttention": re.compile(r"(^|\.)self_attn\."),
+    "CLIPMLP": re.compile(r"(^|\.)mlp\."),
+}
+
+# same as load_checkpoint_with_text_encoder_conversion, for checkpoints without 'text_model'
+TEXT_ENCODER_KEY_REPLACEMENTS = [
+    ("cond_stage_model.transformer.embeddings.", "cond_stage_model.transformer.text_model.embeddings."),
+    ("cond_stage_model.transformer.encoder.", "cond_stage_model.transformer.text_model.encoder."),
+    ("cond_stage_model.transformer.final_layer_norm.", "cond_stage_model.transformer.text_model.final_layer_norm."),
+]
+
+
+def is_extract_target(module_path: str, target_replace_modules, target_replace_names=[]) -> bool:
+    if module_path in target_replace_names:
+        return True
+    for module_type in target_replace_modules:
+        if module_type in EXTRACT_MODULE_PATH_PATTERNS and EXTRACT_MODULE_PATH_PATTERNS[module_type].search(
+                module_path):
+            return True
+    return False
+
+
+def get_checkpoint_key_lookup(keys) -> Dict[str, str]:
+    # maps the ldm key we expect to the key actually in the file
+    lookup = {}
+    for key in keys:
+        ldm_key = key
+        for rep_from, rep_to in TEXT_ENCODER_KEY_REPLACEMENTS:
+            if key.startswith(rep_from):
+                ldm_key = rep_to + key[len(rep_from):]
+        lookup[ldm_key] = key
+    return lookup
+
+
+def load_extract_keymap(is_v2=False, keymap_path: Optional[str] = None) -> 'OrderedDict[str, tuple]':
+    # diffusers key -> (ldm key, slice string or None)
+    from toolkit.paths import KEYMAPS_ROOT
+    if keymap_path is None:
+        keymap_path = os.path.join(
+            KEYMAPS_ROOT,
+            'stable_diffusion_sd2.json' if is_v2 else 'stable_diffusion_sd1.json'
+        )
+    with open(keymap_path, 'r') as f:
+        mapping = json.load(f, object_pairs_hook=OrderedDict)
+
+    keymap = OrderedDict()
+    for ldm_key, diffusers_key in mapping['ldm_diffusers_keymap'].items():
+        keymap[diffusers_key] = (ldm_key, None)
+    for diffusers_key, operator in mapping.get('diffusers_ldm_operator_map', {}).items():
+        if 'slice' in operator:
+            keymap[diffusers_key] = (operator['slice'][0], operator['slice'][1])
+    return keymap
+
+
+def read_checkpoint_tensor(f, key_lookup: Dict[str, str], ldm_key: str, slice_text: Optional[str] = None):
+    if ldm_key not in key_lookup:
+        return None
+    if slice_text is None:
+        return f.get_tensor(key_lookup[ldm_key])
+    from toolkit.saving import get_slices_from_string
+    tensor_slice = f.get_slice(key_lookup[ldm_key])
+    # the keymaps slice the in_proj biases like the weights, '0:1024, :', so drop the dims the
+    # tensor does not have
+    slices = get_slices_from_string(slice_text)[:len(tensor_slice.get_shape())]
+    # only reads the part of the tensor we need
+    return tensor_slice[slices]
+
+
+@torch.no_grad()
+def iter_extract_diff_from_files(
+        base_model_path: str,
+        db_model_path: str,
+        is_v2=False,
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        linear_only=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+        keymap_path: Optional[str] = None,
+) -> Iterator['OrderedDict[str, torch.Tensor]']:
+    """
+    Streaming version of extract_diff that works directly on two ldm safetensors checkpoints.
+    Layers are read one at a time from both files and the extracted weights are yielded
+    per layer, so peak memory is bounded by the largest layer instead of two full models.
+    Produces the same keys and values as extract_diff on the loaded models.
+    """
+    for path in [base_model_path, db_model_path]:
+        if not path.lower().endswith('.safetensors'):
+            raise ValueError(f"Streaming extraction requires .safetensors checkpoints, got {path}")
+
+    UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE = get_extract_targets(
+        linear_only=linear_only,
+        extract_unet=extract_unet,
+        extract_text_encoder=extract_text_encoder,
+    )
+    keymap = load_extract_keymap(is_v2, keymap_path)
+
+    with safe_open(base_model_path, framework="pt", device="cpu") as base_f, \
+            safe_open(db_model_path, framework="pt", device="cpu") as db_f:
+        base_lookup = get_checkpoint_key_lookup(base_f.keys())
+        db_lookup = get_checkpoint_key_lookup(db_f.keys())
+
+        for diffusers_key, (ldm_key, slice_text) in tqdm(list(keymap.items())):
+            if not diffusers_key.endswith('.weight'):
+                continue
+            if diffusers_key.startswith('unet_'):
+                prefix = 'lora_unet'
+                module_path = diffusers_key[len('unet_'):-len('.weight')]
+                if not is_extract_target(module_path, UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME):
+                    continue
+            elif diffusers_key.startswith('te_'):
+                prefix = 'lora_te'
+                module_path = diffusers_key[len('te_'):-len('.weight')]
+                if not is_extract_target(module_path, TEXT_ENCODER_TARGET_REPLACE_MODULE):
+                    continue
+            else:
+                continue
+
+            base_weight = read_checkpoint_tensor(base_f, base_lookup, ldm_key, slice_text)
+            db_weight = read_checkpoint_tensor(db_f, db_lookup, ldm_key, slice_text)
+            if base_weight is None or db_weight is None:
+                continue
+            # loaded models are fp32
+            base_weight = base_weight.float()
+            db_weight = db_weight.float()
+
+            # match the shapes the diffusers models have after conversion
+            if prefix == 'lora_unet' and base_weight.ndim in [3, 4] and (
+                    module_path.endswith('proj_attn') or ('attentions' in module_path and '.to_' in module_path)
+            ):
+                base_weight = base_weight.reshape(base_weight.shape[0], base_weight.shape[1])
+                db_weight = db_weight.reshape(db_weight.shape[0], db_weight.shape[1])
+            if is_v2 and base_weight.ndim == 2 and module_path.split('.')[-1] in ['proj_in', 'proj_out']:
+                # v2 unet is loaded with conv projections, see linear_transformer_to_conv
+                base_weight = base_weight.unsqueeze(2).unsqueeze(2)
+                db_weight = db_weight.unsqueeze(2).unsqueeze(2)
+
+            if base_weight.ndim == 2:
+                layer = 'Linear'
+            elif base_weight.ndim == 4:
+                layer = 'Conv2d'
+            else:
+                continue
+
+            loras = extract_layer_diff(
+                (prefix + '.' + module_path).replace('.', '_'),
+                layer,
+                db_weight,
+                base_weight,
+                mode=mode,
+                linear_mode_param=linear_mode_param,
+                conv_mode_param=conv_mode_param,
+                extract_device=extract_device,
+                use_bias=use_bias,
+                sparsity=sparsity,
+                small_conv=small_conv,
+                linear_only=linear_only,
+            )
+            del base_weight, db_weight
+            if len(loras) > 0:
+                yield loras
+
+
 def get_module(
         lyco_state_dict: Dict,
         lora_name
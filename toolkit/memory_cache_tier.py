@@ -0,0 +1,122 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Tuple, Union
+
+import torch
+
+from toolkit.print import print_acc
+
+# print the hit rate every this many lookups
+STATS_EVERY = 1000
+
+# one tier per process, dataloader workers each get their own
+_tier: Union['MemoryCacheTier', None] = None
+
+
+def get_object_size(obj: Any) -> int:
+    # bytes held by the tensors in a loaded cache file
+    if isinstance(obj, torch.Tensor):
+        return obj.element_size() * obj.nelement()
+    elif isinstance(obj, dict):
+        return sum(get_object_size(v) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(get_object_size(v) for v in obj)
+    elif hasattr(obj, '__dict__'):
+        return sum(get_object_size(v) for v in vars(obj).values())
+    return 0
+
+
+class MemoryCacheTier:
+    """
+    LRU of loaded cache files, keyed by path and bounded in bytes, in front of the disk caches.
+    Loads for the keys of the next batch run in a background thread.
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.pid = os.getpid()
+        self.entries: OrderedDict[str, Tuple[Any, int]] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        # keys being loaded in the background
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.stats = {'hits': 0, 'misses': 0, 'prefetched': 0, 'evictions': 0}
+
+    def _put(self, key: str, value: Any):
+        # called with the lock held
+        size = get_object_size(value)
+        if size > self.budget_bytes or key in self.entries:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.budget_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.stats['evictions'] += 1
+
+    def _load(self, key: str, load_fn: Callable[[str], Any]):
+        try:
+            value = load_fn(key)
+            with self.lock:
+                self._put(key, value)
+        finally:
+            # a failed load is not kept around, the next get reads the file again
+            with self.lock:
+                self.pending.pop(key, None)
+        return value
+
+    def get(self, key: str, load_fn: Callable[[str], Any]) -> Any:
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                self._maybe_print_stats()
+                return self.entries[key][0]
+            future = self.pending.get(key, None)
+            if future is not None:
+                # the prefetch is already on it
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+            self._maybe_print_stats()
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                # eg the file was still being written when the prefetch read it, try it again here
+                pass
+        return self._load(key, load_fn)
+
+    def prefetch(self, items: List[Tuple[str, Callable[[str], Any]]]):
+        with self.lock:
+            for key, load_fn in items:
+                if key in self.entries or key in self.pending:
+                    continue
+                self.pending[key] = self.executor.submit(self._load, key, load_fn)
+                self.stats['prefetched'] += 1
+
+    def get_hit_rate(self) -> float:
+        lookups = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / lookups if lookups > 0 else 0.0
+
+    def _maybe_print_stats(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        if lookups % STATS_EVERY == 0:
+            print_acc(
+                f"Memory cache tier (pid {self.pid}): {self.get_hit_rate() * 100:.1f}% hits over {lookups} lookups, "
+                f"{self.size / 1024 ** 2:.0f} / {self.budget_bytes / 1024 ** 2:.0f} MB, "
+                f"{self.stats['prefetched']} prefetched, {self.stats['evictions']} evicted"
+            )
+
+
+def get_memory_cache_tier(budget_mb: float) -> MemoryCacheTier:
+    global _tier
+    # a forked worker does not get the parent's loader threads, it starts its own tier
+    if _tier is None or _tier.pid != os.getpid():
+        _tier = MemoryCacheTier(int(budget_mb * 1024 ** 2))
+    # datasets share the tier, the largest budget wins
+    _tier.budget_bytes = max(_tier.budget_bytes, int(budget_mb * 1024 ** 2))
+    return _tier
@@ -24,6 +24,22 @@ CONV_MODULES = [
     'LoRACompatibleConv'
 ]
 
+# counts optimizer steps so cached weight norms know when the lora weights changed
+_optimizer_step_count = 0
+_optimizer_step_hook = None
+
+
+def _count_optimizer_step(optimizer, args, kwargs):
+    global _optimizer_step_count
+    _optimizer_step_count += 1
+
+
+def register_optimizer_step_hook():
+    global _optimizer_step_hook
+    if _optimizer_step_hook is None:
+        _optimizer_step_hook = torch.optim.optimizer.register_optimizer_step_post_hook(_count_optimizer_step)
+
+
 def transpose(weight, fan_in_fan_out):
     if not fan_in_fan_out:
         return weight
@@ -96,6 +112,13 @@ class DoRAModule(ToolkitModuleMixin, ExtractableModuleMixin, torch.nn.Module):
         weight_norm = self._get_weight_norm(weight, lora_weight)
         self.magnitude = nn.Parameter(weight_norm.detach().clone(), requires_grad=True)
 
+        # row norm terms of W + s * up @ down, recomputed once per optimizer step
+        self._norm_cache_key = None
+        self._norm_terms = None
+        self._base_norm_key = None
+        self._base_norm_sq = None
+        register_optimizer_step_hook()
+
     def apply_to(self):
         self.org_forward = self.org_module[0].forward
         self.org_module[0].forward = self.forward
@@ -127,20 +150,52 @@ class DoRAModule(ToolkitModuleMixin, ExtractableModuleMixin, torch.nn.Module):
         weight_norm = torch.linalg.norm(weight, dim=1)
         return weight_norm
 
-    def apply_dora(self, x, scaled_lora_weight):
+    @torch.no_grad()
+    def _get_norm_terms(self, weight):
+        # ||W_i + s (UD)_i||^2 = ||W_i||^2 + 2s (U (W D^T))_ii + s^2 (U (D D^T) U^T)_ii
+        # so the row norms come from small products and W + s UD is never built
+        up_weight = self.lora_up.weight
+        down_weight = self.lora_down.weight
+        base_key = (id(self.org_module[0].weight), weight.device, weight.dtype)
+        if self._base_norm_key != base_key:
+            # the base weight is frozen, this only happens once
+            self._base_norm_sq = weight.float().square().sum(dim=1)
+            self._base_norm_key = base_key
+
+        key = (
+            _optimizer_step_count, up_weight.data_ptr(), up_weight._version,
+            down_weight.data_ptr(), down_weight._version, base_key
+        )
+        if self._norm_cache_key != key:
+            up = up_weight.float()
+            down = down_weight.float()
+            cross = (up * (weight.float() @ down.t())).sum(dim=1)
+            lora_sq = ((up @ (down @ down.t())) * up).sum(dim=1)
+            self._norm_terms = (self._base_norm_sq, cross, lora_sq)
+            self._norm_cache_key = key
+        return self._norm_terms
+
+    def get_weight_norm(self, weight, lora_scale) -> torch.Tensor:
+        base_sq, cross, lora_sq = self._get_norm_terms(weight)
+        norm_sq = base_sq + 2 * lora_scale * cross + lora_scale * lora_scale * lora_sq
+        return norm_sq.clamp_min(0).sqrt()
+
+    def apply_dora(self, x, lora_scale):
         # ref https://github.com/huggingface/peft/blob/1e6d1d73a0850223b0916052fd8d2382a90eae5a/src/peft/tuners/lora/layer.py#L192
-        # lora weight is already scaled
+        # lora_scale is what the lora weight is scaled by
 
         # magnitude = self.lora_magnitude_vector[active_adapter]
         weight = self.get_orig_weight()
-        weight = weight.to(scaled_lora_weight.device, dtype=scaled_lora_weight.dtype)
-        weight_norm = self._get_weight_norm(weight, scaled_lora_weight)
+        weight = weight.to(self.lora_up.weight.device, dtype=self.lora_up.weight.dtype)
         # see section 4.3 of DoRA (https://arxiv.org/abs/2402.09353)
         # "[...] we suggest treating ||V +∆V ||_c in
         # Eq. (5) as a constant, thereby detaching it from the gradient
         # graph. This means that while ||V + ∆V ||_c dynamically
         # reflects the updates of ∆V , it won’t receive any gradient
         # during backpropagation"
-        weight_norm = weight_norm.detach()
-        dora_weight = transpose(weight + scaled_lora_weight, False)
-        return (self.magnitude / weight_norm - 1).view(1, -1) * F.linear(x.to(dora_weight.dtype), dora_weight)
+        # it only changes when the lora weights do, so it is cached until the next optimizer step
+        weight_norm = self.get_weight_norm(weight, lora_scale).to(weight.dtype)
+        x = x.to(weight.dtype)
+        # x @ (W + s * up @ down)^T without building the combined weight
+        dora_output = F.linear(x, weight) + F.linear(F.linear(x, self.lora_down.weight), self.lora_up.weight) * lora_scale
+        return (self.magnitude / weight_norm - 1).view(1, -1) * dora_output
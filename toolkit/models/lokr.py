@@ -249,40 +249,8 @@ class LokrModule(ToolkitModuleMixin, nn.Module):
         return weight
 
     @torch.no_grad()
-    def merge_in(self, merge_weight=1.0):
-        if not self.can_merge_in:
-            return
-
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
-        # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
-
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        scale = self.scale
-        # handle trainable scaler method locon does
-        if hasattr(self, 'scalar'):
-            scale = scale * self.scalar
-
-        lokr_weight = self.get_weight(weight)
-
-        merged_weight = (
-            weight
-            + (lokr_weight * merge_weight).to(weight.device, dtype=weight.dtype)
-        )
-
-        # set weight to org_module
-        org_sd[weight_key] = merged_weight.to(orig_dtype)
-        self.org_module[0].load_state_dict(org_sd)
+    def get_merge_delta(self, merge_weight=1.0):
+        return self.get_weight(self.org_module[0].weight).float() * merge_weight
 
     def get_orig_weight(self):
         weight = self.org_module[0].weight
@@ -302,7 +270,41 @@ class LokrModule(ToolkitModuleMixin, nn.Module):
     def _call_forward(self, x):
         if isinstance(x, QTensor) or isinstance(x, QBytesTensor):
             x = x.dequantize()
+        if self.op is F.linear:
+            return self._kron_forward(x)
+        return self._materialized_forward(x)
+
+    def _kron_forward(self, x):
+        # (w1 ⊗ w2) vec(X) = vec(w2 X w1ᵀ), so the delta is applied to the activations
+        # as two small matmuls and the full size weight is never built
+        org_forwarded = self.org_forward(x)
+
+        w1 = self.lokr_w1 if self.use_w1 else self.lokr_w1_a @ self.lokr_w1_b
+        lx = x.to(w1.dtype)
+        lead_shape = lx.shape[:-1]
+        out_l, in_m = w1.shape
+        in_n = self.lokr_w2.shape[1] if self.use_w2 else self.lokr_w2_b.shape[1]
+
+        # [n, in_m, in_n] -> [n, in_m, out_k]
+        lx = lx.reshape(-1, in_m, in_n)
+        if self.use_w2:
+            lx = lx @ self.lokr_w2.t()
+        else:
+            lx = (lx @ self.lokr_w2_b.t()) @ self.lokr_w2_a.t()
+        # [n, in_m, out_k] -> [n, out_l, out_k]
+        lx = torch.matmul(w1, lx)
+        lx = lx.reshape(*lead_shape, out_l * lx.shape[-1])
+
+        if self.training and self.rank_dropout:
+            drop = (torch.rand(lx.shape[-1], device=lx.device) < self.rank_dropout).to(lx.dtype)
+            lx = lx * drop
+
+        # we do not currently support split batch multipliers for lokr. Just do a mean
+        multiplier = torch.mean(self.network_ref().torch_multiplier)
+        lx = lx * (multiplier * self.scale)
+        return org_forwarded + lx.to(org_forwarded.dtype)
 
+    def _materialized_forward(self, x):
         orig_dtype = x.dtype
 
         orig_weight = self.get_orig_weight()
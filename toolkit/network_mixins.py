@@ -48,6 +48,9 @@ ExtractMode = Union[
 
 printed_messages = []
 
+# max number of weight values computed at once when batching merges with bmm
+MERGE_BATCH_NUMEL = 2 ** 26
+
 
 def print_once(msg):
     global printed_messages
@@ -76,6 +79,44 @@ def broadcast_and_multiply(tensor, multiplier):
     return result
 
 
+def is_quantized_weight(weight) -> bool:
+    if isinstance(weight, QTensor) or isinstance(weight, QBytesTensor):
+        return True
+    # torchao and other quantized tensor subclasses
+    return type(weight) not in [torch.Tensor, nn.Parameter] and hasattr(weight, 'dequantize')
+
+
+def dequantize_weight(weight) -> torch.Tensor:
+    if is_quantized_weight(weight):
+        return weight.dequantize().detach()
+    return weight.detach()
+
+
+@torch.no_grad()
+def merge_modules_batched(modules: List['Module'], merge_weight=1.0):
+    # linear loras with the same shapes get their up @ down products computed together with bmm
+    groups = OrderedDict()
+    for module in modules:
+        up_weight, down_weight, scale = module.get_merge_factors(merge_weight)
+        key = (up_weight.device, tuple(up_weight.shape), tuple(down_weight.shape))
+        groups.setdefault(key, []).append((module, up_weight, down_weight, scale))
+
+    for (device, up_shape, down_shape), items in groups.items():
+        chunk_size = max(1, MERGE_BATCH_NUMEL // (up_shape[0] * down_shape[1]))
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            scales = torch.stack([
+                scale.to(device, torch.float32) if isinstance(scale, torch.Tensor) else
+                torch.tensor(float(scale), device=device) for _, _, _, scale in chunk
+            ])
+            up_weights = torch.stack([up for _, up, _, _ in chunk]) * scales.view(-1, 1, 1)
+            down_weights = torch.stack([down for _, _, down, _ in chunk])
+            deltas = torch.bmm(up_weights, down_weights)
+            for idx, (module, _, _, _) in enumerate(chunk):
+                module.apply_merge_delta(deltas[idx])
+            del up_weights, down_weights, deltas
+
+
 def add_bias(tensor, bias):
     if bias is None:
         return tensor
@@ -177,6 +218,12 @@ class ToolkitModuleMixin:
         self.network_ref: weakref.ref = weakref.ref(network)
         self.is_checkpointing = False
         self._multiplier: Union[float, list, torch.Tensor] = None
+        # fp32 difference between the original and merged weight, for exact unmerges
+        self._merge_residual: Optional[torch.Tensor] = None
+        # dequantized merged weight used in place of a quantized one while merged in
+        self._merge_shadow: Optional[torch.Tensor] = None
+        # values the fast forward reads off the device, reused while they are unchanged
+        self._fast_weight_cache: Dict[str, tuple] = {}
 
     def _call_forward(self: Module, x):
         # module dropout
@@ -275,6 +322,8 @@ class ToolkitModuleMixin:
             skip = True
 
         if skip:
+            if network.is_merged_in and self._merge_shadow is not None:
+                return self._shadow_forward(x)
             # network is not active, avoid doing anything
             return self.org_forward(x, *args, **kwargs)
 
@@ -285,6 +334,9 @@ class ToolkitModuleMixin:
         if self.__class__.__name__ == "LokrModule":
             return self._call_forward(x)
 
+        if network.lora_fast_forward and self._can_fast_forward(x, network):
+            return self._fast_forward(x, network, *args, **kwargs)
+
         org_forwarded = self.org_forward(x, *args, **kwargs)
 
         if isinstance(x, QTensor):
@@ -315,12 +367,10 @@ class ToolkitModuleMixin:
                 lx = torch.nn.functional.dropout(x, p=self.dropout)
             else:
                 lx = x
-            lora_weight = self.lora_up.weight @ self.lora_down.weight
             # scale it here
             # todo handle our batch split scalers for slider training. For now take the mean of them
             scale = multiplier.mean()
-            scaled_lora_weight = lora_weight * scale
-            scaled_lora_output = scaled_lora_output + self.apply_dora(lx, scaled_lora_weight).to(org_forwarded.dtype)
+            scaled_lora_output = scaled_lora_output + self.apply_dora(lx, scale).to(org_forwarded.dtype)
 
         try:
             x = org_forwarded + scaled_lora_output
@@ -331,79 +381,187 @@ class ToolkitModuleMixin:
             raise e
         return x
 
+    def _can_fast_forward(self: Module, x, network: Network) -> bool:
+        # only plain linear loras with a scalar multiplier and nothing random going on
+        if self.__class__.__name__ == "DoRAModule" or getattr(self, 'full_rank', False):
+            return False
+        if not isinstance(network._multiplier, (int, float)):
+            return False
+        if hasattr(self, 'lora_mid') and self.lora_mid is not None:
+            return False
+        if not isinstance(self.lora_down, nn.Linear) or not isinstance(self.lora_up, nn.Linear):
+            return False
+        if self.lora_up.bias is not None or hasattr(self.lora_down, '_memory_management_device'):
+            return False
+        if isinstance(x, QTensor) or x.dim() < 2 or not x.is_floating_point():
+            return False
+        if self.training:
+            if self.module_dropout is not None and self.module_dropout > 0:
+                return False
+            if self.rank_dropout is not None and self.rank_dropout > 0:
+                return False
+            if isinstance(self.dropout, nn.Dropout):
+                if self.dropout.p > 0:
+                    return False
+            elif not isinstance(self.dropout, nn.Identity) and self.dropout is not None and self.dropout > 0:
+                return False
+        return True
+
+    def _fast_forward(self: Module, x, network: Network, *args, **kwargs):
+        org_forwarded = self.org_forward(x, *args, **kwargs)
+        # like the regular forward, the lora runs in its weight dtype and only its output is cast
+        dtype = self.lora_down.weight.dtype
+
+        coefficient = float(network._multiplier) * float(self.scale)
+        lx = nn.functional.linear(x.to(dtype), self.lora_down.weight)
+        # handle trainable scaler method locon does
+        if hasattr(self, 'scalar'):
+            if isinstance(self.scalar, nn.Parameter):
+                lx = lx * self.scalar.to(dtype)
+            else:
+                coefficient = coefficient * self._get_scalar_value()
+
+        if org_forwarded.dtype != dtype:
+            lora_output = nn.functional.linear(lx, self.lora_up.weight) * coefficient
+            return org_forwarded + lora_output.to(org_forwarded.dtype)
+
+        # same dtype, org + coefficient * (lx @ up.T) in one kernel
+        out_shape = org_forwarded.shape
+        out = torch.addmm(
+            org_forwarded.reshape(-1, out_shape[-1]),
+            lx.reshape(-1, lx.shape[-1]),
+            self.lora_up.weight.t(),
+            alpha=coefficient,
+        )
+        return out.view(out_shape)
+
+    def _get_scalar_value(self: Module) -> float:
+        # reading the value syncs with the device, so only do it when it changes
+        key = (self.scalar.data_ptr(), self.scalar._version)
+        cached = self._fast_weight_cache.get('scalar', None)
+        if cached is None or cached[0] != key:
+            cached = (key, float(self.scalar.item()))
+            self._fast_weight_cache['scalar'] = cached
+        return cached[1]
+
     def enable_gradient_checkpointing(self: Module):
         self.is_checkpointing = True
 
     def disable_gradient_checkpointing(self: Module):
         self.is_checkpointing = False
 
-    @torch.no_grad()
-    def merge_out(self: Module, merge_out_weight=1.0):
-        # make sure it is positive
-        merge_out_weight = abs(merge_out_weight)
-        # merging out is just merging in the negative of the weight
-        self.merge_in(merge_weight=-merge_out_weight)
-
-    @torch.no_grad()
-    def merge_in(self: Module, merge_weight=1.0):
-        if not self.can_merge_in:
-            return
-        # get up/down weight
-        if self.full_rank:
-            up_weight = None
+    def _shadow_forward(self: Module, x):
+        org_module = self.org_module[0]
+        if isinstance(x, QTensor):
+            x = x.dequantize()
+        bias = org_module.bias
+        if bias is not None:
+            bias = dequantize_weight(bias).to(self._merge_shadow.dtype)
+        orig_dtype = x.dtype
+        x = x.to(self._merge_shadow.dtype)
+        if self._merge_shadow.dim() == 2:
+            out = nn.functional.linear(x, self._merge_shadow, bias)
         else:
-            up_weight = self.lora_up.weight.clone().float()
-        down_weight = self.lora_down.weight.clone().float()
-
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
-        # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
-
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        multiplier = merge_weight
+            out = nn.functional.conv2d(
+                x, self._merge_shadow, bias, org_module.stride, org_module.padding,
+                org_module.dilation, org_module.groups
+            )
+        return out.to(orig_dtype)
+
+    def can_batch_merge(self: Module) -> bool:
+        # plain linear loras can have their merges batched together
+        if type(self).get_merge_delta is not ToolkitModuleMixin.get_merge_delta:
+            return False
+        if not self.can_merge_in or getattr(self, 'full_rank', False) or hasattr(self, 'lora_mid'):
+            return False
+        return isinstance(self.lora_up, nn.Linear) and isinstance(self.lora_down, nn.Linear)
+
+    def get_merge_factors(self: Module, merge_weight=1.0):
+        up_weight = self.lora_up.weight.float()
+        down_weight = self.lora_down.weight.float()
         scale = self.scale
         # handle trainable scaler method locon does
         if hasattr(self, 'scalar'):
             scale = scale * self.scalar
+        return up_weight, down_weight, scale * merge_weight
+
+    @torch.no_grad()
+    def get_merge_delta(self: Module, merge_weight=1.0) -> torch.Tensor:
+        full_rank = getattr(self, 'full_rank', False)
+        # get up/down weight
+        if full_rank:
+            up_weight = None
+            down_weight = self.lora_down.weight.float()
+            scale = self.scale
+            if hasattr(self, 'scalar'):
+                scale = scale * self.scalar
+            scale = scale * merge_weight
+        else:
+            up_weight, down_weight, scale = self.get_merge_factors(merge_weight)
+        if isinstance(scale, torch.Tensor):
+            scale = scale.to(down_weight.device, torch.float32)
 
-        weight_device = weight.device
-        if weight.device != down_weight.device:
-            weight = weight.to(down_weight.device)
-        if scale.device != down_weight.device:
-            scale = scale.to(down_weight.device)
-        # merge weight
-        if self.full_rank:
-            weight = weight + multiplier * down_weight * scale
-        elif len(weight.size()) == 2:
+        if full_rank:
+            return down_weight * scale
+        elif len(down_weight.size()) == 2:
             # linear
-            weight = weight + multiplier * (up_weight @ down_weight) * scale
+            return (up_weight @ down_weight) * scale
         elif down_weight.size()[2:4] == (1, 1):
             # conv2d 1x1
-            weight = (
-                    weight
-                    + multiplier
-                    * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
-                    * scale
+            return (
+                (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
+                * scale
             )
         else:
             # conv2d 3x3
             conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            # print(conved.size(), weight.size(), module.stride, module.padding)
-            weight = weight + multiplier * conved * scale
+            return conved * scale
+
+    @torch.no_grad()
+    def apply_merge_delta(self: Module, delta: torch.Tensor):
+        network: Network = self.network_ref()
+        weight = self.org_module[0].weight
+        if is_quantized_weight(weight):
+            if not network.merge_quantized_shadow:
+                return
+            # merge into a dequantized copy and leave the quantized weight alone
+            dequantized = dequantize_weight(weight)
+            shadow = dequantized.float().add_(delta.to(weight.device).reshape(dequantized.shape))
+            self._merge_shadow = shadow.to(dequantized.dtype)
+            return
+
+        delta = delta.to(weight.device).reshape(weight.shape)
+        if network.merge_residual:
+            orig_weight = weight.data.float()
+            weight.data.add_(delta)
+            self._merge_residual = orig_weight.sub_(weight.data.float())
+        else:
+            # computed in fp32 and rounded once into the weight
+            weight.data.add_(delta)
+
+    @torch.no_grad()
+    def merge_out(self: Module, merge_out_weight=1.0):
+        if self._merge_shadow is not None:
+            self._merge_shadow = None
+            return
+        if self._merge_residual is not None:
+            weight = self.org_module[0].weight
+            weight.data.copy_(weight.data.float().add_(self._merge_residual))
+            self._merge_residual = None
+            return
+        if not self.can_merge_in or is_quantized_weight(self.org_module[0].weight):
+            return
+        # make sure it is positive
+        merge_out_weight = abs(merge_out_weight)
+        # merging out is just subtracting the merged in weight again
+        weight = self.org_module[0].weight
+        weight.data.add_(self.get_merge_delta(-merge_out_weight).to(weight.device).reshape(weight.shape))
 
-        # set weight to org_module
-        org_sd[weight_key] = weight.to(weight_device, orig_dtype)
-        self.org_module[0].load_state_dict(org_sd)
+    @torch.no_grad()
+    def merge_in(self: Module, merge_weight=1.0):
+        if not self.can_merge_in:
+            return
+        self.apply_merge_delta(self.get_merge_delta(merge_weight))
 
     def setup_lorm(self: Module, state_dict: Optional[Dict[str, Any]] = None):
         # LoRM (Low Rank Middle) is a method reduce the number of parameters in a module while keeping the inputs and
@@ -453,6 +611,12 @@ class ToolkitNetworkMixin:
         self.module_losses: List[torch.Tensor] = []
         self.lorm_train_mode: Literal['local', None] = None
         self.can_merge_in = not is_lorm
+        # keep an fp32 residual per merged weight so unmerging restores it exactly
+        self.merge_residual = network_config.merge_residual if network_config is not None else False
+        # merge into dequantized copies of quantized weights
+        self.merge_quantized_shadow = network_config.merge_quantized_shadow if network_config is not None else False
+        # use the fused forward when nothing random is going on in a lora module
+        self.lora_fast_forward = network_config.lora_fast_forward if network_config is not None else True
         # will prevent optimizer from loading as it will have double states
         self.did_change_weights = False
 
@@ -808,8 +972,13 @@ class ToolkitNetworkMixin:
         if self.network_type.lower() == 'dora':
             return
         self.is_merged_in = True
+        batched = []
         for module in self.get_all_modules():
-            module.merge_in(merge_weight)
+            if module.can_batch_merge():
+                batched.append(module)
+            else:
+                module.merge_in(merge_weight)
+        merge_modules_batched(batched, merge_weight)
 
     def merge_out(self: Network, merge_weight=1.0):
         if not self.is_merged_in:
@@ -1,7 +1,8 @@
 import math
 import torch
 from torch.optim import Optimizer
-from toolkit.optimizers.optimizer_utils import copy_stochastic, Auto8bitTensor, stochastic_grad_accummulation
+from toolkit.optimizers.optimizer_utils import copy_stochastic, copy_stochastic_bf16, Auto8bitTensor, \
+    stochastic_grad_accummulation
 
 class Adam8bit(Optimizer):
     """
@@ -160,3 +161,305 @@ class Adam8bit(Optimizer):
                 if isinstance(value, dict) and value.get('_type') == 'Auto8bitTensor':
                     param_state[key] = Auto8bitTensor(value['state'])
 
+
+
+def _foreach_copy(targets, sources):
+    if len(targets) == 0:
+        return
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(targets, sources)
+    else:
+        for target, source in zip(targets, sources):
+            target.copy_(source)
+
+
+class MultiTensorAdam8bit(Adam8bit):
+    """
+    Bucketed, multi tensor version of Adam8bit.
+
+    Parameters with the same device and dtype are packed into flat buckets. The 8-bit moments
+    and their block-wise scales live in persistent buffers per bucket, so each step is a
+    handful of vectorized ops per bucket instead of a dequantize / requantize per parameter.
+    The first moment is stored as int8 with an absmax scale per block. The second moment is
+    stored as uint8 of its fourth root with a max scale per block, which keeps small values
+    from collapsing to zero. Each parameter is padded to a whole number of blocks, so its
+    state is a view into the bucket buffers and is saved and loaded per parameter.
+
+    Arguments:
+        params (iterable): Iterable of parameters to optimize or dicts defining parameter groups
+        lr (float): Learning rate (default: 1e-3)
+        betas (tuple): Coefficients for computing running averages of gradient and its square (default: (0.9, 0.999))
+        eps (float): Term added to denominator to improve numerical stability (default: 1e-8)
+        weight_decay (float): Weight decay coefficient (default: 0)
+        decouple (bool): Use AdamW style decoupled weight decay (default: True)
+        block_size (int): Number of values sharing one quantization scale (default: 256)
+        bucket_size (int): Max number of values packed into one bucket (default: 2 ** 24)
+    """
+
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
+                 weight_decay=0, decouple=True, block_size=256, bucket_size=2 ** 24):
+        super(MultiTensorAdam8bit, self).__init__(
+            params, lr=lr, betas=betas, eps=eps, weight_decay=weight_decay, decouple=decouple
+        )
+        self.block_size = block_size
+        self.bucket_size = bucket_size
+        # built on the first step so loaded state can be packed into them
+        self._buckets = None
+
+    def _padded_numel(self, numel):
+        return int(math.ceil(numel / self.block_size)) * self.block_size
+
+    def _build_buckets(self):
+        buckets = []
+        for group_idx, group in enumerate(self.param_groups):
+            by_kind = {}
+            for p in group['params']:
+                if not p.requires_grad:
+                    continue
+                by_kind.setdefault((p.device, p.dtype), []).append(p)
+
+            for (device, dtype), params in by_kind.items():
+                chunks = [[]]
+                chunk_numel = 0
+                for p in params:
+                    padded = self._padded_numel(p.numel())
+                    if len(chunks[-1]) > 0 and chunk_numel + padded > self.bucket_size:
+                        chunks.append([])
+                        chunk_numel = 0
+                    chunks[-1].append(p)
+                    chunk_numel += padded
+                for chunk in chunks:
+                    buckets.append(self._make_bucket(group_idx, chunk, device, dtype))
+        self._buckets = buckets
+
+    def _make_bucket(self, group_idx, params, device, dtype):
+        numels = [p.numel() for p in params]
+        padded_numels = [self._padded_numel(n) for n in numels]
+        total = sum(padded_numels)
+        num_blocks = total // self.block_size
+        bucket = {
+            'group_idx': group_idx,
+            'params': params,
+            'numels': numels,
+            'padded_numels': padded_numels,
+            'total': total,
+            'device': device,
+            'dtype': dtype,
+            # per param, a param without a grad skips the step like in Adam8bit
+            'steps': [0] * len(params),
+            'exp_avg': torch.zeros(total, dtype=torch.int8, device=device),
+            'exp_avg_scale': torch.ones(num_blocks, dtype=torch.float32, device=device),
+            'exp_avg_sq': torch.zeros(total, dtype=torch.uint8, device=device),
+            'exp_avg_sq_scale': torch.ones(num_blocks, dtype=torch.float32, device=device),
+        }
+
+        value_views = {
+            key: bucket[key].split(padded_numels) for key in ['exp_avg', 'exp_avg_sq']
+        }
+        scale_views = {
+            key: bucket[key].split([n // self.block_size for n in padded_numels])
+            for key in ['exp_avg_scale', 'exp_avg_sq_scale']
+        }
+
+        for idx, p in enumerate(params):
+            state = self.state[p]
+            # pack state we loaded from a checkpoint into the bucket
+            if 'exp_avg' in state and torch.is_tensor(state['exp_avg']):
+                for key in ['exp_avg', 'exp_avg_sq']:
+                    value_views[key][idx].copy_(state[key].to(device))
+                for key in ['exp_avg_scale', 'exp_avg_sq_scale']:
+                    scale_views[key][idx].copy_(state[key].to(device, dtype=torch.float32))
+                bucket['steps'][idx] = int(state.get('step', 0))
+            state['step'] = bucket['steps'][idx]
+            for key in ['exp_avg', 'exp_avg_sq']:
+                state[key] = value_views[key][idx]
+            for key in ['exp_avg_scale', 'exp_avg_sq_scale']:
+                state[key] = scale_views[key][idx]
+        return bucket
+
+    def _flatten(self, bucket, tensors, zero=True):
+        flat = torch.zeros(bucket['total'], dtype=torch.float32, device=bucket['device']) if zero else \
+            torch.empty(bucket['total'], dtype=torch.float32, device=bucket['device'])
+        views = [view[:n] for view, n in zip(flat.split(bucket['padded_numels']), bucket['numels'])]
+        _foreach_copy(views, [t.reshape(-1) for t in tensors])
+        return flat, views
+
+    def _dequantize(self, bucket):
+        block = self.block_size
+        exp_avg = bucket['exp_avg'].view(-1, block).to(torch.float32)
+        exp_avg.mul_(bucket['exp_avg_scale'].view(-1, 1))
+        # stored as the fourth root of the second moment
+        exp_avg_sq = bucket['exp_avg_sq'].view(-1, block).to(torch.float32).div_(255.0)
+        exp_avg_sq.mul_(bucket['exp_avg_sq_scale'].view(-1, 1)).pow_(4)
+        return exp_avg.view(-1), exp_avg_sq.view(-1)
+
+    def _quantize(self, bucket, exp_avg, exp_avg_sq):
+        block = self.block_size
+        exp_avg = exp_avg.view(-1, block)
+        scale = exp_avg.abs().amax(dim=1).div_(127.0)
+        scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+        bucket['exp_avg'].view(-1, block).copy_(exp_avg.div_(scale.view(-1, 1)).round_().clamp_(-127, 127))
+        bucket['exp_avg_scale'].copy_(scale)
+
+        root = exp_avg_sq.view(-1, block).sqrt_().sqrt_()
+        scale = root.amax(dim=1)
+        scale = torch.where(scale > 0, scale, torch.ones_like(scale))
+        bucket['exp_avg_sq'].view(-1, block).copy_(
+            root.div_(scale.view(-1, 1)).mul_(255.0).round_().clamp_(0, 255)
+        )
+        bucket['exp_avg_sq_scale'].copy_(scale)
+
+    def _write_params(self, bucket, flat_p, params_to_write):
+        views = [view[:n] for view, n in zip(flat_p.split(bucket['padded_numels']), bucket['numels'])]
+        targets = []
+        sources = []
+        for idx, p in enumerate(bucket['params']):
+            if idx in params_to_write:
+                targets.append(p.data)
+                sources.append(views[idx].view_as(p))
+        if bucket['dtype'] == torch.float32:
+            _foreach_copy(targets, sources)
+        elif bucket['dtype'] == torch.bfloat16:
+            # stochastically round the whole bucket at once
+            rounded = torch.empty_like(flat_p)
+            copy_stochastic_bf16(rounded, flat_p)
+            rounded_views = [view[:n] for view, n in zip(rounded.split(bucket['padded_numels']), bucket['numels'])]
+            _foreach_copy(targets, [rounded_views[idx].view_as(p) for idx, p in enumerate(bucket['params'])
+                                    if idx in params_to_write])
+        else:
+            for target, source in zip(targets, sources):
+                copy_stochastic(target, source)
+
+    def _get_bias_corrections(self, bucket, with_grad, lr, beta1, beta2):
+        # step size and sqrt of the second bias correction. Scalars when the params with a grad
+        # are on the same step, else flat per value tensors from each param's own step
+        grad_steps = {bucket['steps'][idx] for idx in with_grad}
+        if len(grad_steps) == 1:
+            step = grad_steps.pop()
+            return lr / (1 - beta1 ** step), math.sqrt(1 - beta2 ** step)
+        # params without a grad are not written, they only need something finite
+        steps = torch.tensor([max(step, 1) for step in bucket['steps']], dtype=torch.float64)
+        step_size = lr / (1 - beta1 ** steps)
+        bias_correction2_sqrt = (1 - beta2 ** steps).sqrt()
+        repeats = torch.tensor(bucket['padded_numels'], device=bucket['device'])
+        return [
+            torch.repeat_interleave(
+                x.to(bucket['device'], dtype=torch.float32), repeats, output_size=bucket['total']
+            )
+            for x in [step_size, bias_correction2_sqrt]
+        ]
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        """Performs a single optimization step.
+
+        Arguments:
+            closure (callable, optional): A closure that reevaluates the model and returns the loss.
+        """
+        # Call pre step
+        self.step_hook()
+
+        loss = None
+        if closure is not None:
+            loss = closure()
+
+        if self._buckets is None:
+            self._build_buckets()
+
+        for bucket in self._buckets:
+            group = self.param_groups[bucket['group_idx']]
+            beta1, beta2 = group['betas']
+            eps = group['eps']
+            lr = group['lr']
+            decay = group['weight_decay']
+            decouple = group['decouple']
+
+            params = bucket['params']
+            with_grad = {idx for idx, p in enumerate(params) if p.grad is not None}
+            if len(with_grad) == 0:
+                continue
+
+            grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+            flat_g, _ = self._flatten(bucket, grads)
+            flat_p, _ = self._flatten(bucket, [p.data for p in params])
+
+            # Apply weight decay (coupled variant)
+            if decay != 0 and not decouple:
+                flat_g.add_(flat_p, alpha=decay)
+
+            exp_avg, exp_avg_sq = self._dequantize(bucket)
+            if len(with_grad) < len(params):
+                # params without a grad keep their state
+                keep_avg = exp_avg.clone()
+                keep_avg_sq = exp_avg_sq.clone()
+
+            steps = bucket['steps']
+            for idx in with_grad:
+                steps[idx] += 1
+            step_size, bias_correction2_sqrt = self._get_bias_corrections(bucket, with_grad, lr, beta1, beta2)
+
+            # Adam EMA updates
+            exp_avg.mul_(beta1).add_(flat_g, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(flat_g, flat_g, value=1 - beta2)
+
+            if len(with_grad) < len(params):
+                offsets = [0]
+                for n in bucket['padded_numels']:
+                    offsets.append(offsets[-1] + n)
+                for idx in range(len(params)):
+                    if idx not in with_grad:
+                        exp_avg[offsets[idx]:offsets[idx + 1]] = keep_avg[offsets[idx]:offsets[idx + 1]]
+                        exp_avg_sq[offsets[idx]:offsets[idx + 1]] = keep_avg_sq[offsets[idx]:offsets[idx + 1]]
+                del keep_avg, keep_avg_sq
+
+            # Apply weight decay (decoupled variant)
+            if decay != 0 and decouple:
+                flat_p.mul_(1 - lr * decay)
+
+            # Bias correction
+            denom = (exp_avg_sq.sqrt() / bias_correction2_sqrt).add_(eps)
+
+            # Take step
+            if torch.is_tensor(step_size):
+                flat_p.sub_(exp_avg.mul(step_size).div_(denom))
+            else:
+                flat_p.addcdiv_(exp_avg, denom, value=-step_size)
+            del denom, flat_g, step_size, bias_correction2_sqrt
+
+            self._quantize(bucket, exp_avg, exp_avg_sq)
+            del exp_avg, exp_avg_sq
+
+            self._write_params(bucket, flat_p, with_grad)
+            del flat_p
+
+            for idx, p in enumerate(params):
+                self.state[p]['step'] = steps[idx]
+
+        return loss
+
+    def state_dict(self):
+        """Returns the state of the optimizer as a dict."""
+        state_dict = super().state_dict()
+        # state tensors are views into the buckets, clone them so only their own values get saved
+        for param_id, param_state in state_dict['state'].items():
+            for key, value in param_state.items():
+                if torch.is_tensor(value):
+                    param_state[key] = value.clone()
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        """Loads the optimizer state."""
+        super().load_state_dict(state_dict)
+        # torch casts floating point state to the param dtype, which would round the fp32 scales
+        # of bf16 params. Take them from the saved state as they were
+        saved_ids = [param_id for group in state_dict['param_groups'] for param_id in group['params']]
+        params = [p for group in self.param_groups for p in group['params']]
+        for param_id, p in zip(saved_ids, params):
+            saved_state = state_dict['state'].get(param_id, None)
+            if saved_state is None:
+                continue
+            for key in ['exp_avg_scale', 'exp_avg_sq_scale']:
+                if key in saved_state:
+                    self.state[p][key] = saved_state[key].to(p.device, dtype=torch.float32)
+        # loaded state gets packed into fresh buckets on the next step
+        self._buckets = None
@@ -137,10 +137,6 @@ def copy_stochastic_bf16(target: torch.Tensor, source: torch.Tensor):
 
 def copy_stochastic(target: torch.Tensor, source: torch.Tensor, eps: Optional[float] = None) -> None:
     with torch.no_grad():
-        # assert if target is on cpu, throw error
-        assert target.device.type != 'cpu', "Target is on cpu!"
-        assert source.device.type != 'cpu', "Source is on cpu!"
-        
         if target.dtype == torch.float32:
             target.copy_(source)
             return
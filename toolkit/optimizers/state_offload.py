@@ -0,0 +1,358 @@
+import os
+from collections import deque
+from typing import Literal, Optional
+
+import torch
+from torch.optim import Optimizer
+
+from toolkit.optimizers.optimizer_utils import Auto8bitTensor
+
+OffloadUpdateDevice = Literal['device', 'cpu']
+
+# these share values across param groups while stepping (prodigy d, dadapt), so they
+# have to see every group in a single step call
+GLOBAL_STEP_OPTIMIZERS = ['Prodigy', 'Prodigy8bit', 'DAdaptAdam', 'DAdaptLion', 'DAdaptAdaGrad', 'DAdaptSGD']
+
+
+class OffloadedOptimizer(Optimizer):
+    """
+    Wraps an optimizer and keeps its state in pinned cpu memory, or in memory mapped files
+    when mmap_dir is set. Param groups are split into chunks of about chunk_mb of state, and
+    state is streamed to the device one chunk at a time around step, while the state for the
+    next chunk is prefetched and the previous chunk is written back on side streams. At most
+    about three chunks of state are on the device at once. With update_device='cpu' the state
+    never leaves the cpu and the params and grads of each chunk are streamed to it instead.
+
+    The wrapped optimizer is stepped with its param_groups swapped to a single group holding a
+    chunk's params and the hyperparameters of the group they are from, so it works with any
+    optimizer that handles each param on its own. Values it writes to the group are copied
+    back to the group. Optimizers that share values across params and groups are stepped with
+    all groups at once.
+    """
+
+    def __init__(
+            self,
+            optimizer: Optimizer,
+            update_device: OffloadUpdateDevice = 'device',
+            mmap_dir: Optional[str] = None,
+            per_group: Optional[bool] = None,
+            chunk_mb: float = 256,
+    ):
+        if update_device not in ['device', 'cpu']:
+            raise ValueError(f"Invalid update_device {update_device}, must be 'device' or 'cpu'")
+        if type(optimizer).__name__ == 'MultiTensorAdam8bit':
+            raise ValueError("MultiTensorAdam8bit keeps its state in persistent device buckets and cannot be offloaded")
+        # do not call Optimizer.__init__, everything is proxied to the wrapped optimizer
+        self.optimizer = optimizer
+        self.update_device = update_device
+        self.mmap_dir = mmap_dir
+        if per_group is None:
+            per_group = type(optimizer).__name__ not in GLOBAL_STEP_OPTIMIZERS
+        self.per_group = per_group
+        self.chunk_bytes = int(chunk_mb * 1024 * 1024)
+        if mmap_dir is not None:
+            os.makedirs(mmap_dir, exist_ok=True)
+
+        # (param, state key) -> cpu tensor that is reused every step
+        self._cpu_buffers = {}
+        # param -> pinned cpu copies of param and grad for cpu updates
+        self._cpu_params = {}
+        self._param_ids = {}
+        self._streams = {}
+        self._pin_memory = torch.cuda.is_available()
+
+    # proxy everything else to the wrapped optimizer
+    def __getattr__(self, name):
+        if name == 'optimizer':
+            raise AttributeError(name)
+        return getattr(self.optimizer, name)
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @param_groups.setter
+    def param_groups(self, value):
+        self.optimizer.param_groups = value
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    @property
+    def defaults(self):
+        return self.optimizer.defaults
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.optimizer!r}, update_device={self.update_device})"
+
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def zero_grad(self, set_to_none: bool = True):
+        self.optimizer.zero_grad(set_to_none=set_to_none)
+
+    def add_param_group(self, param_group):
+        self.optimizer.add_param_group(param_group)
+
+    def state_dict(self):
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict):
+        # the wrapped optimizer moves loaded state to the param device, send it back to the cpu
+        self.optimizer.load_state_dict(state_dict)
+        self._offload(self._group_params(self.param_groups), None)
+        self._synchronize()
+
+    def _stream(self, name, device):
+        if device.type != 'cuda':
+            return None
+        key = (name, device)
+        if key not in self._streams:
+            self._streams[key] = torch.cuda.Stream(device=device)
+        return self._streams[key]
+
+    def _synchronize(self):
+        for stream in self._streams.values():
+            stream.synchronize()
+
+    @staticmethod
+    def _group_params(groups):
+        return [p for group in groups for p in group['params']]
+
+    @staticmethod
+    def _chunk_params(chunk):
+        return [p for _, params in chunk for p in params]
+
+    def _state_bytes(self, p):
+        state = self.state.get(p, None)
+        if not state:
+            # no state until the first step, guess an adam sized one
+            return p.numel() * 4 * 2
+        num_bytes = 0
+        for value in state.values():
+            if isinstance(value, Auto8bitTensor):
+                value = value.quantized
+            if torch.is_tensor(value):
+                num_bytes += value.numel() * value.element_size()
+        return num_bytes
+
+    def _make_chunks(self):
+        # chunks are lists of (group, params of it)
+        if not self.per_group:
+            return [[(group, group['params']) for group in self.param_groups]]
+        chunks = []
+        for group in self.param_groups:
+            params = []
+            num_bytes = 0
+            for p in group['params']:
+                size = self._state_bytes(p)
+                if len(params) > 0 and num_bytes + size > self.chunk_bytes:
+                    chunks.append([(group, params)])
+                    params = []
+                    num_bytes = 0
+                params.append(p)
+                num_bytes += size
+            if len(params) > 0:
+                chunks.append([(group, params)])
+        return chunks
+
+    def _param_id(self, p):
+        if p not in self._param_ids:
+            self._param_ids[p] = len(self._param_ids)
+        return self._param_ids[p]
+
+    def _cpu_buffer(self, p, key, tensor):
+        buffer = self._cpu_buffers.get((p, key), None)
+        if buffer is not None and buffer.shape == tensor.shape and buffer.dtype == tensor.dtype:
+            return buffer
+        if self.mmap_dir is not None:
+            path = os.path.join(self.mmap_dir, f"{self._param_id(p)}_{key}.bin")
+            num_bytes = tensor.numel() * tensor.element_size()
+            with open(path, 'wb') as f:
+                f.truncate(num_bytes)
+            buffer = torch.from_file(path, shared=True, size=tensor.numel(), dtype=tensor.dtype).view(tensor.shape)
+        else:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=self._pin_memory)
+        self._cpu_buffers[(p, key)] = buffer
+        return buffer
+
+    def _to_cpu(self, p, key, value):
+        if isinstance(value, Auto8bitTensor):
+            state = value.state_dict()
+            state['quantized'] = self._to_cpu(p, f"{key}.quantized", state['quantized'])
+            return Auto8bitTensor(state)
+        if not torch.is_tensor(value) or value.device.type == 'cpu' and self.mmap_dir is None:
+            return value
+        buffer = self._cpu_buffer(p, key, value)
+        if buffer.data_ptr() != value.data_ptr():
+            buffer.copy_(value, non_blocking=value.device.type != 'cpu')
+        return buffer
+
+    @staticmethod
+    def _to_device(value, device, compute_stream):
+        if isinstance(value, Auto8bitTensor):
+            state = value.state_dict()
+            state['quantized'] = OffloadedOptimizer._to_device(state['quantized'], device, compute_stream)
+            return Auto8bitTensor(state)
+        if torch.is_tensor(value) and value.dim() > 0:
+            value = value.to(device, non_blocking=True)
+            if compute_stream is not None:
+                # allocated on the load stream but used and freed on the compute stream
+                value.record_stream(compute_stream)
+            return value
+        # scalar tensors like step stay where the optimizer put them
+        return value
+
+    def _prefetch(self, params):
+        # stream the state of params to their device
+        for p in params:
+            state = self.state.get(p, None)
+            if not state:
+                continue
+            stream = self._stream('load', p.device)
+            compute_stream = torch.cuda.current_stream(p.device) if stream is not None else None
+            with torch.cuda.stream(stream) if stream is not None else _null_context():
+                for key, value in state.items():
+                    state[key] = self._to_device(value, p.device, compute_stream)
+        if len(params) > 0:
+            stream = self._stream('load', params[0].device)
+            if stream is not None:
+                event = torch.cuda.Event()
+                event.record(stream)
+                return event
+        return None
+
+    def _offload(self, params, compute_event):
+        # write the state of params back to the cpu
+        for p in params:
+            state = self.state.get(p, None)
+            if not state:
+                continue
+            stream = self._stream('offload', p.device)
+            if stream is not None:
+                if compute_event is not None:
+                    stream.wait_event(compute_event)
+                for value in state.values():
+                    if torch.is_tensor(value) and value.device.type == 'cuda':
+                        value.record_stream(stream)
+                    elif isinstance(value, Auto8bitTensor) and value.quantized.device.type == 'cuda':
+                        value.quantized.record_stream(stream)
+            with torch.cuda.stream(stream) if stream is not None else _null_context():
+                for key, value in list(state.items()):
+                    state[key] = self._to_cpu(p, key, value)
+
+    def _step_on_cpu(self, groups):
+        # stream params and grads to the cpu, step there, and copy the params back
+        swapped = []
+        for group in groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                if p not in self._cpu_params or self._cpu_params[p][0].shape != p.shape:
+                    self._cpu_params[p] = (
+                        torch.empty(p.shape, dtype=p.dtype, pin_memory=self._pin_memory),
+                        torch.empty(p.grad.shape, dtype=p.grad.dtype, pin_memory=self._pin_memory),
+                    )
+                cpu_data, cpu_grad = self._cpu_params[p]
+                cpu_data.copy_(p.data, non_blocking=True)
+                cpu_grad.copy_(p.grad, non_blocking=True)
+                swapped.append((p, p.data, p.grad))
+        if len(swapped) > 0 and swapped[0][1].device.type == 'cuda':
+            torch.cuda.current_stream(swapped[0][1].device).synchronize()
+
+        for p, data, grad in swapped:
+            cpu_data, cpu_grad = self._cpu_params[p]
+            p.data = cpu_data
+            p.grad = cpu_grad
+        try:
+            self.optimizer.step()
+        finally:
+            for p, data, grad in swapped:
+                cpu_data = p.data
+                p.data = data
+                p.grad = grad
+                # the copy back overlaps with the next group stepping on the cpu
+                stream = self._stream('offload', data.device)
+                with torch.cuda.stream(stream) if stream is not None else _null_context():
+                    data.copy_(cpu_data, non_blocking=True)
+
+    def _step_chunk(self, chunk):
+        all_groups = self.optimizer.param_groups
+        groups = []
+        for group, params in chunk:
+            if params is group['params']:
+                groups.append(group)
+            else:
+                # made now so it has what earlier chunks of the group wrote to it
+                sub_group = dict(group)
+                sub_group['params'] = params
+                groups.append(sub_group)
+        self.optimizer.param_groups = groups
+        try:
+            if self.update_device == 'cpu':
+                self._step_on_cpu(groups)
+            else:
+                self.optimizer.step()
+        finally:
+            self.optimizer.param_groups = all_groups
+            for (group, _), stepped_group in zip(chunk, groups):
+                if stepped_group is not group:
+                    for key, value in stepped_group.items():
+                        if key != 'params':
+                            group[key] = value
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+
+        # pull in stochastically accumulated grads for every group before splitting them
+        if hasattr(self.optimizer, 'step_hook'):
+            self.optimizer.step_hook()
+
+        chunks = self._make_chunks()
+        if len(chunks) == 0:
+            return loss
+
+        if self.update_device == 'cpu':
+            for chunk in chunks:
+                self._step_chunk(chunk)
+                # state created on the first step still has to be moved to the mmap files
+                self._offload(self._chunk_params(chunk), None)
+            self._synchronize()
+            return loss
+
+        # prefetch the next chunk and write back the last one while this one steps
+        load_events = deque([self._prefetch(self._chunk_params(chunks[0]))])
+        for idx, chunk in enumerate(chunks):
+            params = self._chunk_params(chunk)
+            if idx + 1 < len(chunks):
+                load_events.append(self._prefetch(self._chunk_params(chunks[idx + 1])))
+            load_event = load_events.popleft()
+            if load_event is not None:
+                torch.cuda.current_stream(params[0].device).wait_event(load_event)
+
+            self._step_chunk(chunk)
+
+            compute_event = None
+            if len(params) > 0 and params[0].device.type == 'cuda':
+                compute_event = torch.cuda.Event()
+                compute_event.record(torch.cuda.current_stream(params[0].device))
+            self._offload(params, compute_event)
+        # the cpu buffers have to be complete before the next step reads them
+        self._synchronize()
+        return loss
+
+
+class _null_context:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
@@ -3,6 +3,11 @@ import os
 TOOLKIT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 CONFIG_ROOT = os.path.join(TOOLKIT_ROOT, 'config')
 KEYMAPS_ROOT = os.path.join(TOOLKIT_ROOT, "toolkit", "keymaps")
+# compiled keymaps are cached here
+KEYMAPS_CACHE_ROOT = os.getenv(
+    "AITK_KEYMAPS_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "ai-toolkit", "keymaps")
+)
 ORIG_CONFIGS_ROOT = os.path.join(TOOLKIT_ROOT, "toolkit", "orig_configs")
 DIFFUSERS_CONFIGS_ROOT = os.path.join(TOOLKIT_ROOT, "toolkit", "diffusers_configs")
 COMFY_PATH = os.getenv("COMFY_PATH", None)
@@ -366,6 +366,15 @@ def split_prompt_embeds(concatenated: PromptEmbeds, num_parts=None) -> List[Prom
         for text, pooled in zip(text_embeds_splits, pooled_embeds_splits)
     ]
 
+    if concatenated.attention_mask is not None:
+        if isinstance(concatenated.attention_mask, list) or isinstance(concatenated.attention_mask, tuple):
+            mask_splits = list(zip(*[torch.chunk(mask, num_parts, dim=0) for mask in concatenated.attention_mask]))
+            mask_splits = [list(masks) for masks in mask_splits]
+        else:
+            mask_splits = torch.chunk(concatenated.attention_mask, num_parts, dim=0)
+        for prompt_embeds, mask in zip(prompt_embeds_list, mask_splits):
+            prompt_embeds.attention_mask = mask
+
     return prompt_embeds_list
 
 
@@ -0,0 +1,144 @@
+import json
+import os
+import time
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from toolkit.cache_root import STALE_TMP_SECONDS, atomic_write_path
+
+RESIZED_IMAGE_CACHE_VERSION = 1
+
+# one pack per cache folder per process, so file items only need to carry the folder and key
+_packs: Dict[str, 'ResizedImagePack'] = {}
+
+
+class ResizedImagePack:
+    """
+    Bucket resized uint8 RGB images packed back to back in one file, with a json index of
+    key -> [offset, height, width]. Reads go through a read only memory map, so dataloader
+    workers share the page cache and never decode or resize the source image. Compacting writes
+    the next generation of the data file and the index names the one it points into.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.generation = 0
+        self.data_path = self._get_data_path(self.generation)
+        self._mmap: Union[np.memmap, None] = None
+        self.index: Dict[str, List[int]] = self._load_index()
+
+    def _get_data_path(self, generation: int) -> str:
+        # generation 0 keeps the name packs had before compaction wrote new generations
+        if generation == 0:
+            return os.path.join(self.cache_dir, 'images.bin')
+        return os.path.join(self.cache_dir, f'images.{generation}.bin')
+
+    def _load_index(self) -> Dict[str, List[int]]:
+        if not os.path.exists(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except Exception:
+            return {}
+        if index.get('__version__') != RESIZED_IMAGE_CACHE_VERSION:
+            return {}
+        # indexes from before generations have none and point at images.bin
+        generation = index.get('generation', 0)
+        if generation != self.generation:
+            self.generation = generation
+            self.data_path = self._get_data_path(generation)
+            self._mmap = None
+        if not os.path.exists(self.data_path):
+            return {}
+        entries = index.get('entries', {})
+        # drop anything past the end of the data, eg from a write that was cut off
+        data_size = os.path.getsize(self.data_path)
+        return {k: v for k, v in entries.items() if v[0] + v[1] * v[2] * 3 <= data_size}
+
+    def _save_index(self):
+        with atomic_write_path(self.index_path) as tmp_path:
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    '__version__': RESIZED_IMAGE_CACHE_VERSION,
+                    'generation': self.generation,
+                    'entries': self.index,
+                }, f)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def add_many(self, items: List[Tuple[str, np.ndarray]]):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # another process may have added to the pack since this one loaded it, go by what is on disk
+        self.index = self._load_index()
+        self._mmap = None
+        # data no index on disk points at is left over, unless it was written just now by a
+        # process that has not saved its index yet
+        is_stale = len(self.index) == 0 and os.path.exists(self.data_path) and \
+            time.time() - os.path.getmtime(self.data_path) > STALE_TMP_SECONDS
+        with open(self.data_path, 'wb' if is_stale else 'ab') as f:
+            for key, image in items:
+                if image.dtype != np.uint8 or image.ndim != 3 or image.shape[2] != 3:
+                    raise ValueError(f"Expected a uint8 HxWx3 image for {key}, got {image.dtype} {image.shape}")
+                offset = f.tell()
+                f.write(np.ascontiguousarray(image).tobytes())
+                self.index[key] = [offset, image.shape[0], image.shape[1]]
+        # only point the index at data once it is on disk
+        self._save_index()
+        self._mmap = None
+
+    def get(self, key: str) -> Union[np.ndarray, None]:
+        entry = self.index.get(key, None)
+        if entry is None:
+            return None
+        offset, height, width = entry
+        size = height * width * 3
+        if self._mmap is None or self._mmap.shape[0] < offset + size:
+            self._mmap = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        return self._mmap[offset:offset + size].reshape(height, width, 3)
+
+    def get_entry_size(self, key: str) -> int:
+        _, height, width = self.index[key]
+        return height * width * 3
+
+    def compact(self, keep_keys):
+        # rewrite the pack with only the given entries. Not safe while something trains on it.
+        # The old data file stays in place until the index points at the new one, so a crash at
+        # any point leaves an index that matches its data
+        old_data_path = self.data_path
+        new_data_path = self._get_data_path(self.generation + 1)
+        new_index = {}
+        # anything already there is from a compaction that never got to the index
+        with open(new_data_path, 'wb') as f:
+            for key in list(self.index.keys()):
+                if key in keep_keys:
+                    image = self.get(key)
+                    new_index[key] = [f.tell(), image.shape[0], image.shape[1]]
+                    f.write(image.tobytes())
+        self._mmap = None
+        self.generation += 1
+        self.data_path = new_data_path
+        self.index = new_index
+        self._save_index()
+        try:
+            os.remove(old_data_path)
+        except OSError:
+            pass
+
+    def __getstate__(self):
+        # memory maps do not pickle, workers open their own
+        state = self.__dict__.copy()
+        state['_mmap'] = None
+        return state
+
+
+def get_resized_image_pack(cache_dir: str) -> ResizedImagePack:
+    if cache_dir not in _packs:
+        _packs[cache_dir] = ResizedImagePack(cache_dir)
+    return _packs[cache_dir]
@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+import struct
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import torch
+
+# torch dtype -> safetensors dtype string
+SAFETENSORS_DTYPES = {
+    torch.float64: "F64",
+    torch.float32: "F32",
+    torch.float16: "F16",
+    torch.bfloat16: "BF16",
+    torch.int64: "I64",
+    torch.int32: "I32",
+    torch.int16: "I16",
+    torch.int8: "I8",
+    torch.uint8: "U8",
+    torch.bool: "BOOL",
+}
+if hasattr(torch, 'float8_e4m3fn'):
+    SAFETENSORS_DTYPES[torch.float8_e4m3fn] = "F8_E4M3"
+if hasattr(torch, 'float8_e5m2'):
+    SAFETENSORS_DTYPES[torch.float8_e5m2] = "F8_E5M2"
+
+# copy the data section in chunks so we never hold it in memory
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+def tensor_to_bytes(tensor: torch.Tensor) -> bytes:
+    tensor = tensor.detach().to('cpu').contiguous()
+    if tensor.numel() == 0:
+        return b''
+    # view the raw memory as bytes. Works for bf16 and fp8 which numpy does not know about
+    return tensor.reshape(-1).view(torch.uint8).numpy().tobytes()
+
+
+class SafeTensorsStreamWriter:
+    """
+    Writes a safetensors file one tensor at a time. Tensor data is appended to a
+    temporary file as it is added, so only the tensor currently being written needs to
+    be in memory. The header is written and the data is copied behind it on close.
+    Output is a normal safetensors file readable by load_file / safe_open.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            metadata: Optional[Dict[str, str]] = None,
+    ):
+        self.path = path
+        self.metadata = OrderedDict() if metadata is None else OrderedDict(metadata)
+        self.header = OrderedDict()
+        self.offset = 0
+        self.closed = False
+
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        self._data_path = f"{path}.data.tmp"
+        self._data_file = open(self._data_path, 'wb')
+
+    def __contains__(self, key: str):
+        return key in self.header
+
+    def __len__(self):
+        return len(self.header)
+
+    @property
+    def num_bytes(self) -> int:
+        return self.offset
+
+    def add(self, key: str, tensor: torch.Tensor):
+        if self.closed:
+            raise RuntimeError(f"Writer for {self.path} is already closed")
+        if key in self.header:
+            raise ValueError(f"Duplicate key {key} in {self.path}")
+        if tensor.dtype not in SAFETENSORS_DTYPES:
+            raise ValueError(f"Unsupported dtype {tensor.dtype} for key {key}")
+        data = tensor_to_bytes(tensor)
+        self._data_file.write(data)
+        self.header[key] = {
+            "dtype": SAFETENSORS_DTYPES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [self.offset, self.offset + len(data)],
+        }
+        self.offset += len(data)
+
+    def update(self, state_dict: Dict[str, torch.Tensor]):
+        for key, tensor in state_dict.items():
+            self.add(key, tensor)
+
+    def close(self):
+        if self.closed:
+            return
+        self._data_file.close()
+
+        header = OrderedDict()
+        if len(self.metadata) > 0:
+            header["__metadata__"] = OrderedDict((k, str(v)) for k, v in self.metadata.items())
+        header.update(self.header)
+        header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        # pad the header with spaces so the data section is 8 byte aligned
+        header_bytes += b' ' * ((8 - len(header_bytes) % 8) % 8)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as out_file:
+            out_file.write(struct.pack('<Q', len(header_bytes)))
+            out_file.write(header_bytes)
+            with open(self._data_path, 'rb') as data_file:
+                shutil.copyfileobj(data_file, out_file, COPY_CHUNK_SIZE)
+        os.remove(self._data_path)
+        os.replace(tmp_path, self.path)
+        self.closed = True
+
+    def abort(self):
+        if self.closed:
+            return
+        self._data_file.close()
+        if os.path.exists(self._data_path):
+            os.remove(self._data_path)
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class ShardedSafeTensorsWriter:
+    """
+    Splits output across several safetensors files as tensors come in, closing a
+    shard once it reaches max_shard_size. With a single shard the output is written
+    to output_path as is, otherwise shards are named like huggingface ones and an
+    index file is written next to them.
+    """
+
+    def __init__(self, output_path: str, metadata: Optional[Dict[str, str]] = None, max_shard_size: int = 0):
+        self.output_path = output_path
+        self.metadata = metadata
+        self.max_shard_size = max_shard_size
+        self.shard_paths: List[str] = []
+        self.weight_map: OrderedDict = OrderedDict()
+        self.total_bytes = 0
+        self.writer: Optional[SafeTensorsStreamWriter] = None
+        self._new_shard()
+
+    def _temp_shard_path(self, idx):
+        root, ext = os.path.splitext(self.output_path)
+        return f"{root}-{idx:05d}{ext}.partial"
+
+    def _new_shard(self):
+        if self.writer is not None:
+            self.writer.close()
+        path = self._temp_shard_path(len(self.shard_paths) + 1)
+        self.shard_paths.append(path)
+        self.writer = SafeTensorsStreamWriter(path, self.metadata)
+
+    def add(self, key: str, tensor: torch.Tensor):
+        num_bytes = tensor.numel() * tensor.element_size()
+        if 0 < self.max_shard_size < self.writer.num_bytes + num_bytes and len(self.writer) > 0:
+            self._new_shard()
+        self.writer.add(key, tensor)
+        self.weight_map[key] = len(self.shard_paths) - 1
+        self.total_bytes += num_bytes
+
+    def close(self) -> List[str]:
+        self.writer.close()
+        num_shards = len(self.shard_paths)
+        if num_shards == 1:
+            os.replace(self.shard_paths[0], self.output_path)
+            return [self.output_path]
+
+        root, ext = os.path.splitext(self.output_path)
+        final_paths = []
+        for idx, path in enumerate(self.shard_paths):
+            final_path = f"{root}-{idx + 1:05d}-of-{num_shards:05d}{ext}"
+            os.replace(path, final_path)
+            final_paths.append(final_path)
+
+        index = {
+            "metadata": {"total_size": self.total_bytes},
+            "weight_map": OrderedDict(
+                (key, os.path.basename(final_paths[shard_idx])) for key, shard_idx in self.weight_map.items()
+            ),
+        }
+        with open(f"{self.output_path}.index.json", 'w') as f:
+            json.dump(index, f, indent=2)
+        return final_paths
+
+    def abort(self):
+        self.writer.abort()
+        for path in self.shard_paths:
+            if os.path.exists(path):
+                os.remove(path)
@@ -1,22 +1,167 @@
 import json
 import os
 from collections import OrderedDict
-from typing import TYPE_CHECKING, Literal, Optional, Union
+from typing import TYPE_CHECKING, List, Literal, Mapping, Optional, Union
 
 import torch
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
+from tqdm import tqdm
 
 from toolkit.train_tools import get_torch_dtype
-from toolkit.paths import KEYMAPS_ROOT
+from toolkit.paths import KEYMAPS_ROOT, KEYMAPS_CACHE_ROOT
+from toolkit.basic import parse_size
+from toolkit.safetensors_stream import ShardedSafeTensorsWriter
 
 if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
 
 
+KEYMAP_CACHE_VERSION = 1
+
+# compiled keymaps already loaded in this process
+_compiled_keymaps = {}
+
+
+def parse_slice_component(component: str) -> slice:
+    # "0:1024" -> slice(0, 1024), ":" -> slice(None). A bare number n is slice(n) like the old eval
+    component = component.strip()
+    if ':' not in component:
+        return slice(int(component)) if component != '' else slice(None)
+    parts = component.split(':')
+    if len(parts) > 3:
+        raise ValueError(f"Invalid slice {component}")
+    values = [int(p.strip()) if p.strip() != '' else None for p in parts]
+    return slice(*values)
+
+
 def get_slices_from_string(s: str) -> tuple:
-    slice_strings = s.split(',')
-    slices = [eval(f"slice({component.strip()})") for component in slice_strings]
-    return tuple(slices)
+    return tuple(parse_slice_component(component) for component in s.split(','))
+
+
+class CompiledKeymap:
+    """
+    Keymap json turned into a flat list of operations with the slices already parsed.
+    Operations are applied in order, later ones overwrite earlier ones for the same ldm key.
+      ('cat', ldm_key, [diffusers_keys])
+      ('slice', ldm_key, diffusers_key, [[start, stop, step], ...])
+      ('copy', ldm_key, diffusers_key, view_shape or None)
+    """
+
+    def __init__(self, ops: list):
+        self.ops = ops
+
+    def to_json(self) -> dict:
+        return {'version': KEYMAP_CACHE_VERSION, 'ops': self.ops}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'CompiledKeymap':
+        if data.get('version', None) != KEYMAP_CACHE_VERSION:
+            raise ValueError("Keymap cache version mismatch")
+        return cls(data['ops'])
+
+    @classmethod
+    def from_mapping(cls, mapping: dict) -> 'CompiledKeymap':
+        ops = []
+        ldm_diffusers_shape_map = mapping['ldm_diffusers_shape_map']
+        ldm_diffusers_operator_map = mapping['ldm_diffusers_operator_map']
+        for ldm_key, operator in ldm_diffusers_operator_map.items():
+            if 'cat' in operator:
+                ops.append(['cat', ldm_key, list(operator['cat'])])
+            if 'slice' in operator:
+                slices = get_slices_from_string(operator['slice'][1])
+                ops.append(['slice', ldm_key, operator['slice'][0], [[x.start, x.stop, x.step] for x in slices]])
+        for ldm_key, diffusers_key in mapping['ldm_diffusers_keymap'].items():
+            shape = ldm_diffusers_shape_map[ldm_key][0] if ldm_key in ldm_diffusers_shape_map else None
+            ops.append(['copy', ldm_key, diffusers_key, shape])
+        return cls(ops)
+
+    @property
+    def keymap_ops(self):
+        return [op for op in self.ops if op[0] == 'copy']
+
+    def final_ops(self, diffusers_state_dict: Mapping) -> 'OrderedDict':
+        # ldm key -> the op that decides its value. Copies with a missing source are skipped
+        final = OrderedDict()
+        for op in self.ops:
+            if op[0] == 'copy' and op[2] not in diffusers_state_dict:
+                continue
+            final[op[1]] = op
+        return final
+
+
+def get_keymap_cache_path(mapping_path: str) -> str:
+    stat = os.stat(mapping_path)
+    name = os.path.splitext(os.path.basename(mapping_path))[0]
+    return os.path.join(
+        KEYMAPS_CACHE_ROOT,
+        f"{name}.{stat.st_size}.{stat.st_mtime_ns}.v{KEYMAP_CACHE_VERSION}.json"
+    )
+
+
+def load_compiled_keymap(mapping_path: str, use_cache: bool = True) -> CompiledKeymap:
+    cache_path = get_keymap_cache_path(mapping_path)
+    if cache_path in _compiled_keymaps:
+        return _compiled_keymaps[cache_path]
+
+    compiled = None
+    if use_cache and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                compiled = CompiledKeymap.from_json(json.load(f))
+        except Exception as e:
+            print(f"Failed to load keymap cache {cache_path}, rebuilding: {e}")
+            compiled = None
+
+    if compiled is None:
+        with open(mapping_path, 'r') as f:
+            mapping = json.load(f, object_pairs_hook=OrderedDict)
+        compiled = CompiledKeymap.from_mapping(mapping)
+        if use_cache:
+            try:
+                os.makedirs(KEYMAPS_CACHE_ROOT, exist_ok=True)
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(compiled.to_json(), f)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                # cache is only an optimization
+                print(f"Could not write keymap cache {cache_path}: {e}")
+
+    _compiled_keymaps[cache_path] = compiled
+    return compiled
+
+
+def apply_keymap_op(op, diffusers_state_dict: Mapping, device, dtype) -> Optional[torch.Tensor]:
+    op_type = op[0]
+    if op_type == 'cat':
+        cat_list = [diffusers_state_dict[diffusers_key].detach() for diffusers_key in op[2]]
+        return torch.cat(cat_list, dim=0).to(device, dtype=dtype)
+    if op_type == 'slice':
+        slices = tuple(slice(*x) for x in op[3])
+        return diffusers_state_dict[op[2]][slices].detach().to(device, dtype=dtype)
+    if op_type == 'copy':
+        if op[2] not in diffusers_state_dict:
+            return None
+        tensor = diffusers_state_dict[op[2]].detach().to(device, dtype=dtype)
+        # see if we need to reshape
+        if op[3] is not None:
+            tensor = tensor.view(op[3])
+        return tensor
+    raise ValueError(f"Unknown keymap op {op_type}")
+
+
+def warn_missing_keymap_keys(keymap: CompiledKeymap, diffusers_state_dict: Mapping):
+    # see if any are missing from know mapping
+    missing_diffusers_keys = [op[2] for op in keymap.keymap_ops if op[2] not in diffusers_state_dict]
+    missing_ldm_keys = [op[1] for op in keymap.keymap_ops if op[2] not in diffusers_state_dict]
+
+    if len(missing_diffusers_keys) > 0:
+        print(f"WARNING!!!! Missing {len(missing_diffusers_keys)} diffusers keys")
+        print(missing_diffusers_keys)
+    if len(missing_ldm_keys) > 0:
+        print(f"WARNING!!!! Missing {len(missing_ldm_keys)} ldm keys")
+        print(missing_ldm_keys)
 
 
 def convert_state_dict_to_ldm_with_mapping(
@@ -29,16 +174,7 @@ def convert_state_dict_to_ldm_with_mapping(
     converted_state_dict = OrderedDict()
 
     # load mapping
-    with open(mapping_path, 'r') as f:
-        mapping = json.load(f, object_pairs_hook=OrderedDict)
-
-    # keep track of keys not matched
-    ldm_matched_keys = []
-    diffusers_matched_keys = []
-
-    ldm_diffusers_keymap = mapping['ldm_diffusers_keymap']
-    ldm_diffusers_shape_map = mapping['ldm_diffusers_shape_map']
-    ldm_diffusers_operator_map = mapping['ldm_diffusers_operator_map']
+    keymap = load_compiled_keymap(mapping_path)
 
     # load base if it exists
     # the base just has come keys like timing ids and stuff diffusers doesn't have or they don't match
@@ -48,58 +184,102 @@ def convert_state_dict_to_ldm_with_mapping(
         for key in converted_state_dict:
             converted_state_dict[key] = converted_state_dict[key].to(device, dtype=dtype)
 
-    # process operators first
-    for ldm_key in ldm_diffusers_operator_map:
-        # if the key cat is in the ldm key, we need to process it
-        if 'cat' in ldm_diffusers_operator_map[ldm_key]:
-            cat_list = []
-            for diffusers_key in ldm_diffusers_operator_map[ldm_key]['cat']:
-                cat_list.append(diffusers_state_dict[diffusers_key].detach())
-            converted_state_dict[ldm_key] = torch.cat(cat_list, dim=0).to(device, dtype=dtype)
-            diffusers_matched_keys.extend(ldm_diffusers_operator_map[ldm_key]['cat'])
-            ldm_matched_keys.append(ldm_key)
-        if 'slice' in ldm_diffusers_operator_map[ldm_key]:
-            tensor_to_slice = diffusers_state_dict[ldm_diffusers_operator_map[ldm_key]['slice'][0]]
-            slice_text = diffusers_state_dict[ldm_diffusers_operator_map[ldm_key]['slice'][1]]
-            converted_state_dict[ldm_key] = tensor_to_slice[get_slices_from_string(slice_text)].detach().to(device,
-                                                                                                            dtype=dtype)
-            diffusers_matched_keys.extend(ldm_diffusers_operator_map[ldm_key]['slice'])
-            ldm_matched_keys.append(ldm_key)
-
-    # process the rest of the keys
-    for ldm_key in ldm_diffusers_keymap:
-        # if the key is in the ldm key, we need to process it
-        if ldm_diffusers_keymap[ldm_key] in diffusers_state_dict:
-            tensor = diffusers_state_dict[ldm_diffusers_keymap[ldm_key]].detach().to(device, dtype=dtype)
-            # see if we need to reshape
-            if ldm_key in ldm_diffusers_shape_map:
-                tensor = tensor.view(ldm_diffusers_shape_map[ldm_key][0])
-            converted_state_dict[ldm_key] = tensor
-            diffusers_matched_keys.append(ldm_diffusers_keymap[ldm_key])
-            ldm_matched_keys.append(ldm_key)
-
-    # see if any are missing from know mapping
-    mapped_diffusers_keys = list(ldm_diffusers_keymap.values())
-    mapped_ldm_keys = list(ldm_diffusers_keymap.keys())
+    # operators are first in the compiled keymap, then the rest of the keys
+    for op in keymap.ops:
+        tensor = apply_keymap_op(op, diffusers_state_dict, device, dtype)
+        if tensor is not None:
+            converted_state_dict[op[1]] = tensor
 
-    missing_diffusers_keys = [x for x in mapped_diffusers_keys if x not in diffusers_matched_keys]
-    missing_ldm_keys = [x for x in mapped_ldm_keys if x not in ldm_matched_keys]
-
-    if len(missing_diffusers_keys) > 0:
-        print(f"WARNING!!!! Missing {len(missing_diffusers_keys)} diffusers keys")
-        print(missing_diffusers_keys)
-    if len(missing_ldm_keys) > 0:
-        print(f"WARNING!!!! Missing {len(missing_ldm_keys)} ldm keys")
-        print(missing_ldm_keys)
+    warn_missing_keymap_keys(keymap, diffusers_state_dict)
 
     return converted_state_dict
 
 
-def get_ldm_state_dict_from_diffusers(
-        state_dict: 'OrderedDict',
-        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega', 'sdxl_refiner'] = '2',
-        device='cpu',
-        dtype=get_torch_dtype('fp32'),
+class LazySafetensorsStateDict(Mapping):
+    """
+    Read only state dict backed by one or more safetensors files. Tensors are only
+    read from disk when accessed. Each file can get a key prefix, like 'unet_', so a
+    diffusers folder can be presented with the keys the keymaps expect.
+    """
+
+    def __init__(self):
+        self._handles = []
+        self._key_to_handle = OrderedDict()
+
+    def add_file(self, path: str, prefix: str = ''):
+        # sharded checkpoints are added through their index file
+        if path.endswith('.index.json'):
+            with open(path, 'r') as f:
+                index = json.load(f)
+            folder = os.path.dirname(path)
+            for file_name in OrderedDict.fromkeys(index['weight_map'].values()):
+                self.add_file(os.path.join(folder, file_name), prefix)
+            return self
+        handle = safe_open(path, framework="pt", device="cpu")
+        self._handles.append(handle)
+        for key in handle.keys():
+            self._key_to_handle[f"{prefix}{key}"] = (handle, key)
+        return self
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        handle, file_key = self._key_to_handle[key]
+        return handle.get_tensor(file_key)
+
+    def __contains__(self, key):
+        return key in self._key_to_handle
+
+    def __iter__(self):
+        return iter(self._key_to_handle)
+
+    def __len__(self):
+        return len(self._key_to_handle)
+
+
+def save_state_dict_to_ldm_with_mapping(
+        diffusers_state_dict: Mapping,
+        mapping_path: str,
+        output_file: str,
+        base_path: Union[str, None] = None,
+        dtype: torch.dtype = torch.float32,
+        meta: Optional['OrderedDict'] = None,
+        max_shard_size: Union[int, str, None] = 0,
+) -> List[str]:
+    """
+    Streaming version of convert_state_dict_to_ldm_with_mapping. Each converted tensor is
+    written to disk as soon as it is made, so the converted state dict is never in memory.
+    diffusers_state_dict can be a regular state dict or a LazySafetensorsStateDict.
+    Returns the written file paths.
+    """
+    keymap = load_compiled_keymap(mapping_path)
+    final_ops = keymap.final_ops(diffusers_state_dict)
+
+    writer = ShardedSafeTensorsWriter(output_file, meta, parse_size(max_shard_size))
+    try:
+        if base_path is not None:
+            with safe_open(base_path, framework="pt", device="cpu") as base_f:
+                for key in base_f.keys():
+                    # skip what the keymap replaces
+                    if key in final_ops:
+                        continue
+                    writer.add(key, base_f.get_tensor(key).to('cpu', dtype=dtype))
+
+        for ldm_key, op in tqdm(list(final_ops.items()), desc='Converting'):
+            tensor = apply_keymap_op(op, diffusers_state_dict, 'cpu', dtype)
+            if tensor is None:
+                continue
+            writer.add(ldm_key, tensor.contiguous())
+            del tensor
+        output_paths = writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+    warn_missing_keymap_keys(keymap, diffusers_state_dict)
+    return output_paths
+
+
+def get_ldm_keymap_paths(
+        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega', 'sdxl_refiner'] = '2'
 ):
     if sd_version == '1':
         base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd1_ldm_base.safetensors')
@@ -125,8 +305,18 @@ def get_ldm_state_dict_from_diffusers(
         mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_refiner.json')
     else:
         raise ValueError(f"Invalid sd_version {sd_version}")
+    return base_path, mapping_path
+
+
+def get_ldm_state_dict_from_diffusers(
+        state_dict: 'OrderedDict',
+        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega', 'sdxl_refiner'] = '2',
+        device='cpu',
+        dtype=get_torch_dtype('fp32'),
+):
+    base_path, mapping_path = get_ldm_keymap_paths(sd_version)
 
-        # convert the state dict
+    # convert the state dict
     return convert_state_dict_to_ldm_with_mapping(
         state_dict,
         mapping_path,
@@ -143,17 +333,18 @@ def save_ldm_model_from_diffusers(
         save_dtype=get_torch_dtype('fp16'),
         sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega'] = '2'
 ):
-    converted_state_dict = get_ldm_state_dict_from_diffusers(
+    base_path, mapping_path = get_ldm_keymap_paths(sd_version)
+
+    # streams the converted tensors to disk so we don't hold a second copy of the model
+    save_state_dict_to_ldm_with_mapping(
         sd.state_dict(),
-        sd_version,
-        device='cpu',
-        dtype=save_dtype
+        mapping_path,
+        output_file,
+        base_path,
+        dtype=save_dtype,
+        meta=meta,
     )
 
-    # make sure parent folder exists
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    save_file(converted_state_dict, output_file, metadata=meta)
-
 
 def save_lora_from_diffusers(
         lora_state_dict: 'OrderedDict',
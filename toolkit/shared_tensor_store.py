@@ -0,0 +1,142 @@
+import atexit
+import json
+import os
+import socket
+import tempfile
+from typing import Dict, List, Union
+
+import torch
+
+from toolkit.cache_root import is_process_alive
+
+SHARED_TENSOR_STORE_VERSION = 1
+# offsets are aligned so every dtype can be viewed straight out of the byte storage
+_ALIGNMENT = 64
+
+# one mapping per store per process, file items only carry the store path and their key
+_stores: Dict[str, 'SharedTensorStore'] = {}
+
+
+def get_shared_memory_dir() -> str:
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    # no tmpfs, the page cache still shares a regular file between processes
+    return tempfile.gettempdir()
+
+
+class SharedTensorStore:
+    """
+    Tensors packed back to back in one file in shared memory, with a json index of
+    key -> [offset, dtype, shape]. Every process maps the same file copy on write, so the
+    data is held once per node no matter how many ranks and dataloader workers read it. The
+    index records the process that built the store, a store whose builder died without
+    removing it is stale and gets built again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_path = path + '.json'
+        self.index: Dict[str, list] = self._load_index()
+        self._storage: Union[torch.Tensor, None] = None
+        self._remove_registered = False
+
+    def _load_index(self) -> Dict[str, list]:
+        if not os.path.exists(self.index_path) or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except Exception:
+            return {}
+        if index.get('__version__') != SHARED_TENSOR_STORE_VERSION:
+            return {}
+        if os.path.getsize(self.path) != index.get('size', -1):
+            return {}
+        if index.get('host') == socket.gethostname() and index.get('pid') != os.getpid():
+            if not is_process_alive(index['pid']):
+                # the builder was killed before it could remove it
+                return {}
+        elif index.get('host') is None:
+            # from before owners were recorded, nothing would ever remove it
+            return {}
+        return index.get('entries', {})
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def has_all(self, keys: List[str]) -> bool:
+        return all(key in self.index for key in keys)
+
+    def write(self, tensors: Dict[str, torch.Tensor], remove_at_exit: bool = True):
+        # write to a temp file and move it in place, so processes attaching at the same time
+        # see either nothing or the complete store
+        entries = {}
+        offset = 0
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            for key, tensor in tensors.items():
+                padding = -offset % _ALIGNMENT
+                f.write(b'\0' * padding)
+                offset += padding
+                data = tensor.detach().to('cpu').contiguous().reshape(-1).view(torch.uint8).numpy()
+                f.write(data.tobytes())
+                entries[key] = [offset, str(tensor.dtype).replace('torch.', ''), list(tensor.shape)]
+                offset += data.nbytes
+        os.replace(tmp_path, self.path)
+
+        tmp_index_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_index_path, 'w') as f:
+            json.dump({
+                '__version__': SHARED_TENSOR_STORE_VERSION,
+                'size': offset,
+                'host': socket.gethostname(),
+                'pid': os.getpid(),
+                'entries': entries,
+            }, f)
+        os.replace(tmp_index_path, self.index_path)
+        self.index = entries
+        self._storage = None
+        if remove_at_exit:
+            self.remove_at_exit()
+
+    def remove_at_exit(self):
+        # shared memory outlives the process, so it is removed when this one exits. Processes
+        # that still have it mapped keep their mapping
+        if not self._remove_registered:
+            self._remove_registered = True
+            atexit.register(self.remove)
+
+    def remove(self):
+        for path in [self.path, self.index_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get(self, key: str) -> Union[torch.Tensor, None]:
+        entry = self.index.get(key, None)
+        if entry is None:
+            return None
+        offset, dtype, shape = entry
+        if self._storage is None:
+            size = os.path.getsize(self.path)
+            # mapped private, reads share the pages and an in place write only copies the page it touches
+            self._storage = torch.from_file(self.path, shared=False, size=size, dtype=torch.uint8)
+        dtype = getattr(torch, dtype)
+        num_bytes = torch.empty(0, dtype=dtype).element_size()
+        for dim in shape:
+            num_bytes *= dim
+        return self._storage[offset:offset + num_bytes].view(dtype).reshape(shape)
+
+    def __getstate__(self):
+        # the mapping does not pickle, spawned workers map the file again
+        state = self.__dict__.copy()
+        state['_storage'] = None
+        return state
+
+
+def get_shared_tensor_store(path: str) -> SharedTensorStore:
+    if path not in _stores:
+        _stores[path] = SharedTensorStore(path)
+    return _stores[path]
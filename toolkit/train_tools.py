@@ -763,3 +763,27 @@ def precondition_model_outputs_flow_match(model_output, model_input, timestep_te
         out = mo_chunks[idx] * (-sigmas) + mi_chunks[idx]
         out_chunks.append(out)
     return torch.cat(out_chunks, dim=0)
+
+
+def predict_with_fused_prior(network, network_weight_list, predict_fn, latents, timesteps, embeds, num_chunks=3):
+    # runs the trained passes and the network free prior pass as a single batch. embeds holds
+    # num_chunks batches back to back, the last one is predicted with a network multiplier of 0.0
+    # in place of disabling the network. The multiplier is left set so gradient checkpointing
+    # recomputes the same graph in the backward pass, set it back to network_weight_list after backward
+    batch_size = latents.shape[0]
+    if not isinstance(network_weight_list, (list, tuple)):
+        network_weight_list = [network_weight_list] * batch_size
+    if len(network_weight_list) != batch_size:
+        raise ValueError(
+            f"Expected {batch_size} network weights for the fused prior, got {len(network_weight_list)}"
+        )
+    network.multiplier = list(network_weight_list) * (num_chunks - 1) + [0.0] * batch_size
+    pred = predict_fn(
+        torch.cat([latents] * num_chunks, dim=0),
+        torch.cat([timesteps] * num_chunks, dim=0),
+        embeds,
+    )
+    preds = list(pred.chunk(num_chunks, dim=0))
+    # the prior is a target, nothing should flow back through it
+    preds[-1] = preds[-1].detach()
+    return preds
@@ -679,6 +679,16 @@ export default function SimpleJob({
                     )}
                   </>
                 )}
+                {(jobConfig.config.process[0].train.diff_output_preservation ||
+                  jobConfig.config.process[0].train.blank_prompt_preservation) && (
+                  <Checkbox
+                    label="Fuse Preservation Forward"
+                    docKey={'train.fuse_preservation_forward'}
+                    className="pt-1"
+                    checked={jobConfig.config.process[0].train.fuse_preservation_forward || false}
+                    onChange={value => setJobConfig(value, 'config.process[0].train.fuse_preservation_forward')}
+                  />
+                )}
               </div>
             </div>
           </Card>
@@ -258,6 +258,19 @@ const docs: { [key: string]: ConfigDoc } = {
       </>
     ),
   },
+  'train.fuse_preservation_forward': {
+    title: 'Fuse Preservation Forward',
+    description: (
+      <>
+        Runs the preservation step and its prior prediction in the same forward pass as the normal training step,
+        instead of three separate passes. The batch is stacked three times, and the LoRA is turned off only for the
+        copy used as the prior. This removes two forward passes and a backward pass from each step, so steps are
+        faster, but activations for three times the batch are held at once, so peak VRAM goes up. Leave it off if you
+        are close to running out of VRAM. It only applies to LoRA and LoCon networks without CFG, adapters or control
+        images, otherwise the separate passes are used.
+      </>
+    ),
+  },
   'train.do_differential_guidance': {
     title: 'Differential Guidance',
     description: (